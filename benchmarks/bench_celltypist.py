@@ -0,0 +1,77 @@
+"""Time and peak memory of `celltypist` labelling with majority voting, with each way of building the neighbourhood
+graph, against reusing a precomputed graph.
+
+The `celltypist` case builds the graph with `celltypist`'s own pipeline, which scales a dense copy of the highly
+variable genes; `approximate` runs a sparse PCA and an approximate nearest neighbour search; `reused` over-clusters a
+graph already stored in `obsp['connectivities']`. Predictions are made `--prediction_chunk_size` cells at a time.
+
+The reported peak is the memory allocated on top of the data, which is traced from once the data is generated. Each
+case runs in a fresh process, after a small warm-up run that compiles the `numba` code of the nearest neighbour search.
+
+Usage:
+    python benchmarks/bench_celltypist.py --sizes 100000 1000000
+"""
+
+import multiprocessing
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict
+
+import numpy as np
+from synthetic import make_dataset
+
+from macta_tools import annotate
+from macta_tools.tools import _celltypist_interface
+
+CASES = ('celltypist', 'approximate', 'reused')
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark majority voting of celltypist on large queries')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100_000, 1_000_000], help='numbers of query cells')
+    parser.add_argument('--n_genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--n_ref_cells', type=int, default=5000)
+    parser.add_argument('--prediction_chunk_size', type=int, default=50_000)
+    parser.add_argument('--n_jobs', type=int, default=1)
+    return parser.parse_args()
+
+
+def run_case(case: str, n_cells: int, args: Namespace) -> Dict[str, Any]:
+    """Generates the data and labels it with majority voting. Runs in its own process."""
+
+    ref_data = make_dataset(args.n_ref_cells, n_genes=args.n_genes, density=args.density, seed=0)
+    expr_data = make_dataset(n_cells, n_genes=args.n_genes, density=args.density, seed=1)
+    kwargs = dict(labels='cell_type', neighbors='celltypist' if case == 'celltypist' else 'approximate',
+                  prediction_chunk_size=args.prediction_chunk_size, n_jobs=args.n_jobs)
+
+    _celltypist_interface._approximate_graph(expr_data[:1000])
+    if case == 'reused':
+        expr_data.obsp['connectivities'] = _celltypist_interface._approximate_graph(expr_data)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    results = annotate(expr_data, ref_data, 'ref', annot_tools=['celltypist'], **kwargs)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    accuracy = float(np.mean(results['celltypist'].to_numpy() == expr_data.obs['cell_type'].to_numpy()))
+    return {'case': case, 'n_cells': n_cells, 'seconds': seconds, 'peak_mb': peak / 1e6, 'accuracy': accuracy}
+
+
+def main() -> None:
+    args = parse_args()
+
+    for n_cells in args.sizes:
+        for case in CASES:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                record = pool.submit(run_case, case, n_cells, args).result()
+            print(f'{record["case"]:<11} {n_cells:>9} cells  {record["seconds"]:8.2f} s  '
+                  f'peak {record["peak_mb"]:7.0f} MB  accuracy {record["accuracy"]:.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Wall time and memory of every consensus method on synthetic results of several tools.
+
+Usage:
+    python benchmarks/bench_consensus.py --cells 10000000 --tools 8
+"""
+
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from typing import Dict, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+from macta_tools import consensus
+from macta_tools._consensus import Result
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark the consensus of the results of several tools')
+    parser.add_argument('--cells', type=int, default=10_000_000, help='number of cells')
+    parser.add_argument('--tools', type=int, default=8, help='number of tools')
+    parser.add_argument('--n_cell_types', type=int, default=30)
+    parser.add_argument('--accuracy', type=float, default=0.7, help='fraction of cells each tool labels correctly')
+    parser.add_argument('--score_cells', type=int, default=1_000_000,
+                        help='number of cells of the score-averaged consensus, whose inputs are cells x cell types')
+    return parser.parse_args()
+
+
+def make_results(n_cells: int, n_tools: int, n_cell_types: int, accuracy: float, scores: bool, seed: int = 0
+                 ) -> Tuple[npt.NDArray[np.int64], Dict[str, Result]]:
+    """Generates the true labels of the cells and, for each tool, labels or scores that match them at `accuracy`."""
+
+    rng = np.random.default_rng(seed)
+    cell_types = [f'type_{i}' for i in range(n_cell_types)]
+    cells = pd.Index([f'cell_{i}' for i in range(n_cells)])
+    truth = rng.integers(0, n_cell_types, n_cells)
+
+    results: Dict[str, Result] = {}
+    for tool in range(n_tools):
+        codes = np.where(rng.random(n_cells) < accuracy, truth, rng.integers(0, n_cell_types, n_cells))
+        if scores:
+            values = rng.random((n_cells, n_cell_types), dtype=np.float32)
+            values[np.arange(n_cells), codes] += 1
+            results[f'tool_{tool}'] = pd.DataFrame(values, index=cells, columns=cell_types)
+        else:
+            results[f'tool_{tool}'] = pd.Series(pd.Categorical.from_codes(codes, cell_types), index=cells)
+
+    return truth, results
+
+
+def run(method: str, truth: npt.NDArray[np.int64], results: Dict[str, Result]) -> None:
+    weights = {tool: float(i + 1) for i, tool in enumerate(results)}
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    combined = consensus(results, method, weights=weights)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    accuracy = (combined['label'].cat.codes.to_numpy() == truth).mean()
+    print(f'{method:<10} {len(truth):>10} cells x {len(results)} tools  {seconds:7.2f} s  '
+          f'peak {peak / 1e6:8.0f} MB  accuracy {accuracy:.3f}')
+
+
+def main() -> None:
+    args = parse_args()
+
+    truth, results = make_results(args.cells, args.tools, args.n_cell_types, args.accuracy, scores=False)
+    run('majority', truth, results)
+    run('weighted', truth, results)
+    del results
+
+    truth, results = make_results(args.score_cells, args.tools, args.n_cell_types, args.accuracy, scores=True)
+    run('scores', truth, results)
+
+
+if __name__ == '__main__':
+    main()
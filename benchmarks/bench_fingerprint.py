@@ -0,0 +1,77 @@
+"""Throughput of `macta_tools.utils.fingerprint.fingerprint` on large synthetic sparse matrices.
+
+Usage:
+    python benchmarks/bench_fingerprint.py --n_cells 200000 --n_genes 20000 --density 0.05
+"""
+
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Callable
+
+import anndata
+from anndata import AnnData
+from scipy import sparse
+from synthetic import random_csr
+
+from macta_tools.utils.fingerprint import fingerprint
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark AnnData fingerprinting throughput')
+    parser.add_argument('--n_cells', type=int, default=200_000)
+    parser.add_argument('--n_genes', type=int, default=20_000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--sample_bytes', type=int, default=64 << 20)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--skip_backed', action='store_true')
+    return parser.parse_args()
+
+
+def matrix_bytes(matrix: sparse.csr_matrix) -> int:
+    return int(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes)
+
+
+def best_time(function: Callable[[], str], repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def report(name: str, seconds: float, n_bytes: int) -> None:
+    print(f'{name:<28} {seconds:8.3f} s {n_bytes / seconds / 1e9:8.2f} GB/s')
+
+
+def main() -> None:
+    args = parse_args()
+
+    matrix = random_csr(args.n_cells, args.n_genes, args.density)
+    data = AnnData(matrix)
+    n_bytes = matrix_bytes(matrix)
+    print(f'{args.n_cells} cells x {args.n_genes} genes, {matrix.nnz} non-zeros, {n_bytes / 1e9:.2f} GB of buffers')
+
+    report('full, 1 thread', best_time(lambda: fingerprint(data, n_threads=1), args.repeats), n_bytes)
+    report('full, all threads', best_time(lambda: fingerprint(data), args.repeats), n_bytes)
+    report(f'sampled ({args.sample_bytes >> 20} MiB/buffer)',
+           best_time(lambda: fingerprint(data, sample_bytes=args.sample_bytes), args.repeats), n_bytes)
+
+    if args.skip_backed:
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / 'data.h5ad'
+        data.write_h5ad(path)
+
+        backed = anndata.read_h5ad(path, backed='r')
+        report('backed, full', best_time(lambda: fingerprint(backed), args.repeats), n_bytes)
+        report('backed, sampled', best_time(lambda: fingerprint(backed, sample_bytes=args.sample_bytes),
+                                            args.repeats), n_bytes)
+        backed.file.close()
+
+
+if __name__ == '__main__':
+    main()
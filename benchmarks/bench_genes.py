@@ -0,0 +1,63 @@
+"""Time of aligning the genes of a query to the features of a reference, the first time and when the alignment is
+reused, and of reindexing the query matrix to the features.
+
+The query has Ensembl IDs (with versions) in `var_names` and symbols in `var['gene_symbols']`, while the reference uses
+symbols, as when a Cell Ranger output is annotated against a celltypist model.
+
+Usage:
+    python benchmarks/bench_genes.py --n_cells 100000 --n_genes 30000 --n_features 6000
+"""
+
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Any, Callable
+
+import numpy as np
+import pandas as pd
+from synthetic import random_csr
+
+from macta_tools.utils import genes
+from macta_tools.utils.genes import gene_alignment
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark aligning query genes to reference features')
+    parser.add_argument('--n_cells', type=int, default=100_000)
+    parser.add_argument('--n_genes', type=int, default=30_000)
+    parser.add_argument('--n_features', type=int, default=6000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--repeats', type=int, default=5)
+    return parser.parse_args()
+
+
+def best_time(function: Callable[[], Any], repeats: int, before: Callable[[], Any] = lambda: None) -> float:
+    times = []
+    for _ in range(repeats):
+        before()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    args = parse_args()
+    rng = np.random.default_rng(0)
+
+    symbols = np.array([f'GENE{i}' for i in range(args.n_genes)])
+    var = pd.DataFrame({'gene_symbols': symbols}, index=[f'ENSG{i:011d}.{i % 7}' for i in range(args.n_genes)])
+    features = list(rng.choice(symbols, args.n_features, replace=False))
+    matrix = random_csr(args.n_cells, args.n_genes, args.density)
+
+    first = best_time(lambda: gene_alignment(var, features), args.repeats, before=genes._ALIGNMENTS.clear)
+    reused = best_time(lambda: gene_alignment(var, features), args.repeats)
+    alignment = gene_alignment(var, features)
+    reindexed = best_time(lambda: alignment.reindex(matrix), args.repeats)
+
+    print(alignment.describe())
+    print(f'align {first * 1e3:8.1f} ms  |  reused {reused * 1e3:8.1f} ms  |  reindex {reindexed:6.2f} s '
+          f'({args.n_cells} cells)')
+
+
+if __name__ == '__main__':
+    main()
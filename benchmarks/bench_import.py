@@ -0,0 +1,59 @@
+"""Time taken to import `macta_tools`, and to load each of its tools on top of that.
+
+Every measurement runs in a fresh interpreter, so that no module is already imported.
+
+Usage:
+    python benchmarks/bench_import.py --repeats 5
+"""
+
+import statistics
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from typing import List
+
+from macta_tools.tools import AVAILABLE
+
+TIMER = """
+import time
+start = time.perf_counter()
+{statement}
+print(time.perf_counter() - start)
+"""
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark the import time of macta_tools and of its tools')
+    parser.add_argument('--tools', nargs='+', default=list(AVAILABLE), help='tools whose loading is timed')
+    parser.add_argument('--repeats', type=int, default=5, help='number of fresh interpreters per measurement')
+    return parser.parse_args()
+
+
+def time_statement(statement: str, repeats: int) -> List[float]:
+    """Runs `statement` in `repeats` fresh interpreters and returns its durations in seconds."""
+
+    times = []
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', TIMER.format(statement=statement)],
+                                check=True, capture_output=True, text=True).stdout
+        times.append(float(output.split()[-1]))
+    return times
+
+
+def print_times(name: str, times: List[float]) -> None:
+    print(f'{name:<40} median {statistics.median(times):7.3f} s  min {min(times):7.3f} s')
+
+
+def main() -> None:
+    args = parse_args()
+
+    print_times('import macta_tools', time_statement('import macta_tools', args.repeats))
+    for tool_name in args.tools:
+        statement = f'import macta_tools; macta_tools.tools.AVAILABLE[{tool_name!r}]'
+        print_times(f'import macta_tools + load {tool_name}', time_statement(statement, args.repeats))
+    print_times('import macta_tools + load all tools',
+                time_statement('import macta_tools; macta_tools.tools.AVAILABLE.load_all()', args.repeats))
+
+
+if __name__ == '__main__':
+    main()
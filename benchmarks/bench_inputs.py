@@ -0,0 +1,99 @@
+"""Startup time and peak memory of opening a large h5ad file, and of getting the log-normalized data a tool needs from
+it, for each way of reading the file.
+
+The file holds log-normalized data in `X`, raw counts in `layers['counts']` and `raw`, like most processed data sets.
+`read_h5ad` loads all of it, `backed` is `anndata`'s backed mode (which still loads `layers` and `raw`), and
+`read_input` leaves every matrix on disk, so that only `X` is read when the log-normalized representation is computed.
+
+The reported peak is the memory allocated while opening the file and computing the representation; the pages of
+memory-mapped arrays are not counted, as they belong to the page cache. Times and peaks are measured in separate fresh
+processes, as tracing allocations slows down reading the annotations.
+
+Usage:
+    python benchmarks/bench_inputs.py --sizes 100000 1000000
+"""
+
+import multiprocessing
+import tempfile
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Dict
+
+import anndata
+from anndata import AnnData
+from synthetic import make_dataset
+
+from macta_tools import read_input
+from macta_tools.utils.representations import Representation, RepresentationCache
+
+CASES = ('read_h5ad', 'backed', 'read_input')
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark opening large h5ad files')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100_000, 1_000_000], help='numbers of cells')
+    parser.add_argument('--n_genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    return parser.parse_args()
+
+
+def write_file(path: Path, n_cells: int, args: Namespace) -> None:
+    """Writes a processed data set into `path`. Runs in its own process, so that it does not inflate the others."""
+
+    data = make_dataset(n_cells, n_genes=args.n_genes, density=args.density)
+    data.raw = AnnData(data.layers['counts'], var=data.var)
+    data.write_h5ad(path)
+
+
+def open_file(case: str, path: Path) -> Any:
+    if case == 'read_h5ad':
+        return anndata.read_h5ad(path)
+    if case == 'backed':
+        return anndata.read_h5ad(path, backed='r')
+    return read_input(path)
+
+
+def run_case(case: str, path: Path, trace: bool) -> Dict[str, float]:
+    """Opens the file and computes its log-normalized representation, measuring the wall time of each step, or their
+    peak memory if `trace` (as tracing slows down the allocations). Runs in its own process."""
+
+    measure = (lambda: tracemalloc.get_traced_memory()[1] / 1e6) if trace else time.perf_counter
+    if trace:
+        tracemalloc.start()
+
+    start = measure()
+    data = open_file(case, path)
+    opened = measure()
+    RepresentationCache(data).get(Representation('lognorm'))
+    represented = measure()
+
+    if trace:
+        return {'open_peak_mb': opened, 'peak_mb': represented}
+    return {'open_seconds': opened - start, 'seconds': represented - start}
+
+
+def main() -> None:
+    args = parse_args()
+    context = multiprocessing.get_context('spawn')
+
+    with tempfile.TemporaryDirectory() as directory:
+        for n_cells in args.sizes:
+            path = Path(directory) / f'{n_cells}.h5ad'
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                pool.submit(write_file, path, n_cells, args).result()
+            print(f'{n_cells} cells, {path.stat().st_size / 1e9:.2f} GB')
+
+            for case in CASES:
+                record: Dict[str, float] = {}
+                for trace in (False, True):
+                    with ProcessPoolExecutor(1, mp_context=context) as pool:
+                        record.update(pool.submit(run_case, case, path, trace).result())
+                print(f'  {case:<11} open {record["open_seconds"]:7.2f} s  peak {record["open_peak_mb"]:7.0f} MB'
+                      f'  |  lognorm {record["seconds"]:7.2f} s  peak {record["peak_mb"]:7.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""Peak memory of `annotate` running two tools that modify their inputs, against copying the data for every tool.
+
+The `registering` tool adds fields to `obs` and `uns` of the query, like `SCVI.setup_anndata`, before scoring markers.
+With `isolate`, both tools share the query's matrices, so peak memory stays close to one copy of the data; the
+`copies` case emulates callers that defensively copy the data before running each tool.
+
+The reported peak is the memory allocated on top of the data, which is traced from once the data is generated. Each
+case runs in a fresh process.
+
+Usage:
+    python benchmarks/bench_isolation.py --sizes 100000 1000000
+"""
+
+import multiprocessing
+import time
+import tracemalloc
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict
+
+import numpy as np
+from anndata import AnnData
+from synthetic import make_dataset, make_markers
+
+from macta_tools import annotate
+from macta_tools.tools import MarkerInterface
+
+CASES = ('isolated', 'copies')
+
+
+class RegisteringInterface(MarkerInterface):
+    """Marker scoring that first registers fields into the query, as many tools do with their inputs."""
+
+    def preprocess_expr(self, expr_data: AnnData, **kwargs: Any) -> AnnData:
+        expr_data.obs['_registered_batch'] = expr_data.obs['batch'].cat.codes.to_numpy()
+        expr_data.uns['_registry'] = {'batch_key': 'batch', 'n_cells': expr_data.n_obs}
+        return super().preprocess_expr(expr_data, **kwargs)
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark the memory of running several tools on the same data')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[100_000, 1_000_000], help='numbers of query cells')
+    parser.add_argument('--n_genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    return parser.parse_args()
+
+
+def run_case(case: str, n_cells: int, args: Namespace) -> Dict[str, Any]:
+    """Generates the data and annotates it with both tools. Runs in its own process."""
+
+    expr_data = make_dataset(n_cells, n_genes=args.n_genes, density=args.density, seed=1)
+    del expr_data.layers['counts']
+    markers = make_markers(args.n_genes)
+    data_mb = sum(buffer.nbytes for buffer in (expr_data.X.data, expr_data.X.indices, expr_data.X.indptr)) / 1e6
+
+    tool_interfaces = {'registering': RegisteringInterface(), 'marker': MarkerInterface()}
+    tracemalloc.start()
+    start = time.perf_counter()
+    if case == 'isolated':
+        results = annotate(expr_data, markers, 'marker', tool_interfaces=tool_interfaces)
+    else:
+        results = {}
+        for tool_name, interface in tool_interfaces.items():
+            results.update(annotate(expr_data.copy(), markers, 'marker', tool_interfaces={tool_name: interface}))
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    assert np.array_equal(results['registering'], results['marker']) and '_registry' not in expr_data.uns
+    return {'case': case, 'n_cells': n_cells, 'seconds': seconds, 'data_mb': data_mb, 'peak_mb': peak / 1e6}
+
+
+def main() -> None:
+    args = parse_args()
+
+    for n_cells in args.sizes:
+        for case in CASES:
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                record = pool.submit(run_case, case, n_cells, args).result()
+            ratio = record['peak_mb'] / record['data_mb']
+            print(f'{record["case"]:<9} {n_cells:>9} cells  {record["seconds"]:7.2f} s  '
+                  f'data {record["data_mb"]:7.0f} MB  peak {record["peak_mb"]:7.0f} MB ({ratio:.2f}x data)')
+
+
+if __name__ == '__main__':
+    main()
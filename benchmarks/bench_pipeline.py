@@ -0,0 +1,145 @@
+"""Wall time and peak memory of every stage of `CTAToolInterface.run_full`, for every available tool and data size.
+
+Each (tool, size) case runs in a fresh process, so that peak resident memory is measured for that case alone.
+
+Usage:
+    python benchmarks/bench_pipeline.py --sizes 10000 100000 1000000 --output results.json
+    python benchmarks/bench_pipeline.py --sizes 10000 100000 --baseline results.json
+"""
+
+import json
+import multiprocessing
+import resource
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from synthetic import make_dataset, make_markers
+
+from macta_tools.tools import AVAILABLE
+
+STAGES = ('preprocess_ref', 'preprocess_expr', 'annotate', 'convert')
+
+# Annotation type and key word arguments each tool is benchmarked with; other tools are run as `'ref'` without kwargs
+TOOL_CASES: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    'celltypist': ('ref', {'labels': 'cell_type'}),
+    'marker': ('marker', {'scoring': 'zscore'}),
+    'scanvi': ('ref', {'cell_type_col': 'cell_type', 'batch_col': 'batch', 'ref_type': 'counts'}),
+}
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark every stage of the annotation pipeline')
+    parser.add_argument('--tools', nargs='+', default=list(AVAILABLE), help='tools to benchmark')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10_000, 100_000, 1_000_000],
+                        help='numbers of query cells')
+    parser.add_argument('--ref_cells', type=int, default=20_000, help='number of reference cells')
+    parser.add_argument('--n_genes', type=int, default=2000)
+    parser.add_argument('--density', type=float, default=0.05)
+    parser.add_argument('--n_cell_types', type=int, default=10)
+    parser.add_argument('--n_batches', type=int, default=2)
+    parser.add_argument('--result_type', choices=['labels', 'scores'], default='labels')
+    parser.add_argument('--output', help='JSON file in which the measurements are written')
+    parser.add_argument('--baseline', help='JSON file of earlier measurements to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='relative slowdown or memory growth over the baseline reported as a regression')
+    return parser.parse_args()
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # `ru_maxrss` is in bytes on macOS and in kilobytes elsewhere
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def timed(record: Dict[str, Any], stage: str, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    record[stage] = {'seconds': time.perf_counter() - start, 'peak_rss_mb': peak_rss_mb()}
+    return result
+
+
+def run_case(tool_name: str, n_cells: int, args: Namespace) -> Dict[str, Any]:
+    """Generates the data and times every stage of one tool on it. Runs in its own process."""
+
+    annot_type, kwargs = TOOL_CASES.get(tool_name, ('ref', {}))
+    interface = AVAILABLE[tool_name]
+
+    data_kwargs = dict(n_genes=args.n_genes, density=args.density, n_cell_types=args.n_cell_types,
+                       n_batches=args.n_batches)
+    expr_data = make_dataset(n_cells, seed=1, **data_kwargs)
+    ref_data = make_markers(args.n_genes, args.n_cell_types) if annot_type == 'marker' else \
+        make_dataset(args.ref_cells, seed=0, **data_kwargs)
+
+    record: Dict[str, Any] = {'tool': tool_name, 'n_cells': n_cells, 'data_rss_mb': peak_rss_mb()}
+    ref_model = timed(record, 'preprocess_ref', interface.preprocess_ref, ref_data, **kwargs)
+    expr_data = timed(record, 'preprocess_expr', interface.preprocess_expr, expr_data, **kwargs)
+    results = timed(record, 'annotate', interface.annotate, expr_data, ref_model, **kwargs)
+    timed(record, 'convert', interface.convert, results, args.result_type, **kwargs)
+    return record
+
+
+def run_isolated(tool_name: str, n_cells: int, args: Namespace) -> Optional[Dict[str, Any]]:
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        try:
+            return pool.submit(run_case, tool_name, n_cells, args).result()
+        except Exception as e:
+            print(f'{tool_name} on {n_cells} cells failed: {e!r}', file=sys.stderr)
+            return None
+
+
+def print_record(record: Dict[str, Any]) -> None:
+    stages = '  '.join(f'{stage} {record[stage]["seconds"]:9.2f} s {record[stage]["peak_rss_mb"]:8.0f} MB'
+                       for stage in STAGES)
+    print(f'{record["tool"]:<12} {record["n_cells"]:>9}  {stages}')
+
+
+def compare(records: List[Dict[str, Any]], baseline: List[Dict[str, Any]], tolerance: float) -> List[str]:
+    """Lists the stages that got slower or used more memory than in `baseline`, beyond `tolerance`."""
+
+    previous = {(record['tool'], record['n_cells']): record for record in baseline}
+    regressions = []
+
+    for record in records:
+        old = previous.get((record['tool'], record['n_cells']))
+        if old is None:
+            continue
+
+        for stage in STAGES:
+            for metric in ('seconds', 'peak_rss_mb'):
+                new_value, old_value = record[stage][metric], old[stage][metric]
+                if old_value > 0 and new_value > old_value * (1 + tolerance):
+                    regressions.append(f'{record["tool"]} on {record["n_cells"]} cells: {stage} {metric} '
+                                       f'{old_value:.2f} -> {new_value:.2f}')
+
+    return regressions
+
+
+def main() -> None:
+    args = parse_args()
+
+    records = []
+    for tool_name in args.tools:
+        for n_cells in args.sizes:
+            record = run_isolated(tool_name, n_cells, args)
+            if record is not None:
+                print_record(record)
+                records.append(record)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(records, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(records, json.load(file), args.tolerance)
+        print('\n'.join(['Regressions:', *regressions]) if regressions else 'No regressions')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""Time of selecting the tools whose requirements match a request, among many registered tools: checking every
+`RequirementList` as `plan` used to (filtering the key word arguments, then running every requirement), building a
+`DispatchTable` and looking a first request up in it, and looking requests up once their kinds of inputs were seen.
+
+Usage:
+    python benchmarks/bench_requirements.py --tools 100 1000
+"""
+
+import time
+from argparse import ArgumentParser, Namespace
+from typing import Any, Callable, Dict, List
+
+import pandas as pd
+from anndata import AnnData
+
+from macta_tools.utils.requirements import (ContainsRequirement, DispatchTable, EqualityRequirement,
+                                            IsInstanceRequirement, RequirementList)
+
+ANNOT_TYPES = ('marker', 'ref')
+RESULT_TYPES = ('labels', 'scores')
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark selecting tools by their requirements')
+    parser.add_argument('--tools', nargs='+', type=int, default=[100, 1000], help='numbers of registered tools')
+    parser.add_argument('--requests', type=int, default=1000, help='number of requests selected per measurement')
+    parser.add_argument('--repeats', type=int, default=5)
+    return parser.parse_args()
+
+
+def make_requirements(n_tools: int) -> Dict[str, RequirementList]:
+    """Requirements of `n_tools` tools, alternating the annotation types, result types and kinds of references."""
+
+    requirements = {}
+    for i in range(n_tools):
+        tool_requirements: Dict[str, Any] = {'annot_type': EqualityRequirement(ANNOT_TYPES[i % 2])}
+        if i % 3 == 0:
+            tool_requirements['result_type'] = ContainsRequirement(RESULT_TYPES[:1 + i % 2])
+        if i % 2 == 0:
+            tool_requirements['ref_data'] = IsInstanceRequirement(pd.DataFrame)
+        requirements[f'tool_{i}'] = RequirementList(tool_requirements)
+    return requirements
+
+
+def make_requests(n_requests: int) -> List[Dict[str, Any]]:
+    """Requests with every annotation type, result type and kind of reference, and a few unrelated kwargs."""
+
+    markers, reference = pd.DataFrame({'gene': ['a'], 'cell_type': ['x']}), AnnData(obs=pd.DataFrame(index=['c']))
+    return [{'annot_type': ANNOT_TYPES[i % 2], 'result_type': RESULT_TYPES[i // 2 % 2],
+             'ref_data': markers if i % 2 == 0 else reference, 'labels': 'cell_type', 'batch_col': 'batch'}
+            for i in range(n_requests)]
+
+
+def check_every_tool(requirements: Dict[str, RequirementList], values: Dict[str, Any]) -> List[str]:
+    """Selection before the requirements were compiled: filter the kwargs and run every requirement of every tool."""
+
+    return [tool_name for tool_name, requirement_list in requirements.items()
+            if all(requirement_list.requirements[k].check(v) for k, v in values.items()
+                   if k in requirement_list.requirements)]
+
+
+def best_time(function: Callable[[], Any], repeats: int, before: Callable[[], Any] = lambda: None) -> float:
+    times = []
+    for _ in range(repeats):
+        before()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main() -> None:
+    args = parse_args()
+    requests = make_requests(args.requests)
+
+    for n_tools in args.tools:
+        requirements = make_requirements(n_tools)
+
+        naive = best_time(lambda: [check_every_tool(requirements, values) for values in requests], args.repeats)
+        build = best_time(lambda: DispatchTable(requirements), args.repeats)
+
+        # Fresh requirements, whose outcomes were never memoized
+        fresh: Dict[str, Dict[str, RequirementList]] = {}
+        first = best_time(lambda: DispatchTable(fresh['requirements']).match(**requests[0]), args.repeats,
+                          before=lambda: fresh.update(requirements=make_requirements(n_tools)))
+        table = DispatchTable(requirements)
+        cached = best_time(lambda: [table.match(**values) for values in requests], args.repeats)
+
+        assert all(table.match(**values) == set(check_every_tool(requirements, values)) for values in requests)
+        print(f'{n_tools:>6} tools  |  check every tool {naive / args.requests * 1e6:9.1f} us/request  |  '
+              f'build table {build * 1e6:8.1f} us  |  build + first lookup {first * 1e6:8.1f} us  |  '
+              f'cached lookup {cached / args.requests * 1e6:6.2f} us/request')
+
+
+if __name__ == '__main__':
+    main()
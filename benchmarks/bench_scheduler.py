@@ -0,0 +1,88 @@
+"""Wall time of annotating several query files one after the other (`prepare` + `annotate_many`) and with the runs
+packed onto the node by their estimated resources (`annotate_batch`), and how the estimates compare to the peak
+memory the runs actually reached.
+
+Scheduled runs each start a fresh process, which pays the imports, so the batch only wins once there are cores to run
+queries side by side and the runs are long enough to amortize the start-up.
+
+Usage:
+    python benchmarks/bench_scheduler.py --tools celltypist marker --query_cells 20000 --samples 4 --max_threads 4
+"""
+
+import resource
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from synthetic import make_dataset, make_markers
+
+from macta_tools import annotate_batch, annotate_many, prepare, read_input
+from macta_tools.tools import AVAILABLE
+from macta_tools.utils.resources import DataSize, node_capacity
+
+# Annotation type and key word arguments of the tools, as in `bench_pipeline.py`
+TOOL_CASES: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    'celltypist': ('ref', {'labels': 'cell_type', 'majority_voting': False}),
+    'marker': ('marker', {'scoring': 'zscore'}),
+}
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark serial against resource-scheduled annotation of several queries')
+    parser.add_argument('--tools', nargs='+', default=[tool for tool in TOOL_CASES if tool in AVAILABLE])
+    parser.add_argument('--ref_cells', type=int, default=10_000)
+    parser.add_argument('--query_cells', type=int, default=20_000)
+    parser.add_argument('--n_genes', type=int, default=2000)
+    parser.add_argument('--samples', type=int, default=4, help='number of query files')
+    parser.add_argument('--max_threads', type=int, help='threads of the scheduled runs, the usable cores by default')
+    parser.add_argument('--max_memory', type=int, help='memory in bytes of the scheduled runs')
+    return parser.parse_args()
+
+
+def peak_children_rss_mb() -> float:
+    """Peak resident memory of the largest child process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def main() -> None:
+    args = parse_args()
+    max_threads, max_memory = node_capacity(args.max_threads, args.max_memory)
+    print(f'{args.samples} samples of {args.query_cells} cells, reference of {args.ref_cells} cells, '
+          f'{max_threads} threads and {(max_memory or 0) / 1e9:.1f} GB for the scheduled runs')
+
+    with tempfile.TemporaryDirectory() as directory:
+        queries: List[Path] = []
+        for sample in range(args.samples):
+            queries.append(Path(directory) / f'query_{sample}.h5ad')
+            make_dataset(args.query_cells, args.n_genes, seed=sample + 1).write_h5ad(queries[-1])
+
+        ref = make_dataset(args.ref_cells, args.n_genes, seed=0)
+        references = {'ref': ref, 'marker': make_markers(args.n_genes)}
+
+        for tool in args.tools:
+            annot_type, kwargs = TOOL_CASES[tool]
+            ref_data = references[annot_type]
+
+            start = time.perf_counter()
+            prepared = prepare(ref_data, annot_type, annot_tools=[tool], **kwargs)
+            annotate_many(prepared, queries)
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            annotate_batch(queries, ref_data, annot_type, annot_tools=[tool], max_threads=max_threads,
+                           max_memory=max_memory, **kwargs)
+            scheduled = time.perf_counter() - start
+
+            estimate = AVAILABLE[tool].estimate_resources(DataSize.of(read_input(queries[0])), DataSize.of(ref_data),
+                                                          **kwargs)
+            print(f'{tool:>12}  serial {serial:6.1f} s  scheduled {scheduled:6.1f} s  '
+                  f'estimated {estimate.memory / 1e6:6.0f} MB + process, '
+                  f'largest run {peak_children_rss_mb():6.0f} MB')
+
+
+if __name__ == '__main__':
+    main()
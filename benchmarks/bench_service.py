@@ -0,0 +1,131 @@
+"""Per-sample latency of annotating query files one at a time, in a fresh `macta_tools` process per sample as the CLI
+does, and as requests to a service that keeps the prepared references in memory (see `AnnotationService`).
+
+A fresh process pays the interpreter start-up, the imports, the preparation of the reference (e.g. training a
+celltypist model) and the annotation; a request to the service only pays the annotation and reading the query.
+
+Usage:
+    python benchmarks/bench_service.py --tools celltypist marker --ref_cells 20000 --query_cells 5000 --samples 5
+"""
+
+import http.client
+import json
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from synthetic import make_dataset, make_markers
+
+from macta_tools import AnnotationService, make_server
+from macta_tools.tools import AVAILABLE
+
+# Annotation type and key word arguments of the tools, as in `bench_pipeline.py`
+TOOL_CASES: Dict[str, Tuple[str, Dict[str, Any]]] = {
+    'celltypist': ('ref', {'labels': 'cell_type'}),
+    'marker': ('marker', {'scoring': 'zscore'}),
+}
+
+COLD_RUN = """
+import time
+start = time.perf_counter()
+from macta_tools import annotate
+annotate({query!r}, {ref!r}, {annot_type!r}, annot_tools=[{tool!r}], **{kwargs!r})
+print(time.perf_counter() - start)
+"""
+
+
+def parse_args() -> Namespace:
+    parser = ArgumentParser(description='Benchmark per-sample latency of fresh processes against the service')
+    parser.add_argument('--tools', nargs='+', default=[tool for tool in TOOL_CASES if tool in AVAILABLE])
+    parser.add_argument('--ref_cells', type=int, default=20_000)
+    parser.add_argument('--query_cells', type=int, default=5000)
+    parser.add_argument('--n_genes', type=int, default=2000)
+    parser.add_argument('--samples', type=int, default=5,
+                        help='number of query files annotated one at a time, at least 2')
+    return parser.parse_args()
+
+
+def cold_latencies(tool: str, queries: List[Path], ref: Path) -> List[float]:
+    annot_type, kwargs = TOOL_CASES[tool]
+    return [float(subprocess.run([sys.executable, '-W', 'ignore', '-c',
+                                  COLD_RUN.format(query=str(query), ref=str(ref), annot_type=annot_type, tool=tool,
+                                                  kwargs=kwargs)],
+                                 check=True, capture_output=True, text=True).stdout.split()[-1])
+            for query in queries]
+
+
+def send_requests(service: AnnotationService, address: Tuple[str, int], queries: List[Path],
+                  latencies: List[float]) -> None:
+    """Sends the queries one at a time, recording their latencies, then closes `service`."""
+
+    connection = http.client.HTTPConnection(*address)
+    try:
+        for query in queries:
+            start = time.perf_counter()
+            connection.request('POST', '/annotate', json.dumps({'expr': str(query)}),
+                               headers={'Content-Type': 'application/json'})
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise RuntimeError(f'{query.name}: {body.decode()}')
+            latencies.append(time.perf_counter() - start)
+    finally:
+        connection.close()
+        service.close()
+
+
+def warm_latencies(tool: str, queries: List[Path], ref: Path) -> Tuple[float, List[float]]:
+    """Starts a service as `macta-tools-serve` does, annotating on the main thread, and sends it the queries one at a
+    time from another thread."""
+
+    annot_type, kwargs = TOOL_CASES[tool]
+
+    start = time.perf_counter()
+    service = AnnotationService.from_reference(ref, annot_type, annot_tools=[tool], **kwargs)
+    started = time.perf_counter() - start
+
+    server: Any = make_server(service, port=0, data_dir=queries[0].parent)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    latencies: List[float] = []
+    client = threading.Thread(target=send_requests, args=(service, server.server_address, queries, latencies))
+    client.start()
+    service.run()
+
+    client.join()
+    server.shutdown()
+    server.server_close()
+    return started, latencies
+
+
+def main() -> None:
+    args = parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        queries = []
+        for sample in range(args.samples):
+            queries.append(Path(directory) / f'query_{sample}.h5ad')
+            make_dataset(args.query_cells, n_genes=args.n_genes, seed=sample + 1).write_h5ad(queries[-1])
+
+        refs = {'ref': Path(directory) / 'ref.h5ad', 'marker': Path(directory) / 'markers.csv'}
+        make_dataset(args.ref_cells, n_genes=args.n_genes, seed=0).write_h5ad(refs['ref'])
+        make_markers(args.n_genes).to_csv(refs['marker'], index=False)
+
+        print(f'{args.samples} samples of {args.query_cells} cells, reference of {args.ref_cells} cells')
+        for tool in args.tools:
+            ref = refs[TOOL_CASES[tool][0]]
+            cold = cold_latencies(tool, queries, ref)
+            started, warm = warm_latencies(tool, queries, ref)
+            # The first request compiles the just-in-time compiled functions of the tools, e.g. `numba`'s
+            print(f'  {tool:<11} fresh process {statistics.median(cold):7.2f} s/sample  |  service start '
+                  f'{started:7.2f} s, first sample {warm[0]:7.2f} s, then {statistics.median(warm[1:]):7.2f} s/sample')
+
+
+if __name__ == '__main__':
+    main()
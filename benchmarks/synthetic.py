@@ -0,0 +1,102 @@
+"""Synthetic single-cell data sets for the benchmarks."""
+
+from typing import Any, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from anndata import AnnData
+from scipy import sparse
+
+
+def random_csr(n_cells: int, n_genes: int, density: float, seed: int = 0) -> sparse.csr_matrix:
+    """Builds a CSR matrix with the buffers of a real count matrix, without the cost of `scipy.sparse.random`.
+
+    The column indices of each row are neither sorted nor unique, which is enough for benchmarks that only look at
+    the raw buffers.
+    """
+
+    rng = np.random.default_rng(seed)
+    nnz_per_cell = max(int(n_genes * density), 1)
+    indptr = np.arange(0, (n_cells + 1) * nnz_per_cell, nnz_per_cell, dtype=np.int64)
+    indices = rng.integers(0, n_genes, n_cells * nnz_per_cell, dtype=np.int32)
+    data = rng.integers(1, 20, n_cells * nnz_per_cell, dtype=np.int32).astype(np.float32)
+    return sparse.csr_matrix((data, indices, indptr), shape=(n_cells, n_genes))
+
+
+def make_dataset(n_cells: int, n_genes: int = 2000, density: float = 0.05, n_cell_types: int = 10,
+                 n_batches: int = 2, n_markers: int = 20, marker_fraction: float = 0.3, seed: int = 0
+                 ) -> AnnData:
+    """Generates a labelled count matrix in which every cell type over-expresses its own marker genes.
+
+    The marker genes of each cell type only depend on `n_genes`, `n_cell_types` and `n_markers` (not on `seed`), so
+    that a reference and a query generated with different seeds share the same cell types.
+
+    Arguments:
+        n_cells (int): number of cells
+        n_genes (int): number of genes
+        density (float): fraction of non-zero entries of the count matrix
+        n_cell_types (int): number of cell types, stored in `obs['cell_type']`
+        n_batches (int): number of batches, stored in `obs['batch']`, each with its own library size
+        n_markers (int): number of marker genes of each cell type
+        marker_fraction (float): fraction of each cell's non-zero entries that fall on its cell type's markers
+        seed (int): seed of the random generator
+
+    Returns:
+        `AnnData` with raw counts in `layers['counts']` and log1p-normalized (to 10000 counts per cell) data in `X`
+    """
+
+    rng = np.random.default_rng(seed)
+    markers = marker_genes(n_genes, n_cell_types, n_markers)
+
+    cell_types = rng.integers(0, n_cell_types, n_cells)
+    batches = rng.integers(0, n_batches, n_cells)
+
+    nnz_per_cell = max(int(n_genes * density), 1)
+    n_marker_entries = min(int(nnz_per_cell * marker_fraction), n_markers)
+    indices = rng.integers(0, n_genes, (n_cells, nnz_per_cell))
+    marker_choice = rng.integers(0, n_markers, (n_cells, n_marker_entries))
+    indices[:, :n_marker_entries] = markers[cell_types[:, None], marker_choice]
+
+    library_scale = 1.0 + batches[:, None] * 0.5
+    data = rng.poisson(2.0 * library_scale, (n_cells, nnz_per_cell)) + 1
+    data[:, :n_marker_entries] *= 3
+
+    indptr = np.arange(0, (n_cells + 1) * nnz_per_cell, nnz_per_cell, dtype=np.int64)
+    counts = sparse.csr_matrix((data.ravel().astype(np.float32), indices.ravel().astype(np.int32), indptr),
+                               shape=(n_cells, n_genes))
+    counts.sum_duplicates()
+
+    lognorm = counts.multiply(1e4 / counts.sum(axis=1)).tocsr().astype(np.float32)
+    lognorm.data = np.log1p(lognorm.data)
+
+    obs = pd.DataFrame({
+        'cell_type': pd.Categorical([f'type_{i}' for i in cell_types]),
+        'batch': pd.Categorical([f'batch_{i}' for i in batches]),
+    }, index=[f'cell_{seed}_{i}' for i in range(n_cells)])
+    var = pd.DataFrame(index=[f'gene_{i}' for i in range(n_genes)])
+
+    data_set = AnnData(lognorm, obs=obs, var=var)
+    data_set.layers['counts'] = counts
+    return data_set
+
+
+def marker_genes(n_genes: int, n_cell_types: int, n_markers: int) -> npt.NDArray[np.int64]:
+    """Returns the `n_cell_types` x `n_markers` array of marker gene indices used by `make_dataset`."""
+    genes = np.random.default_rng(n_genes).permutation(n_genes)
+    return genes[:n_cell_types * n_markers].reshape(n_cell_types, n_markers)
+
+
+def make_markers(n_genes: int = 2000, n_cell_types: int = 10, n_markers: int = 20) -> pd.DataFrame:
+    """Returns the marker genes of the cell types of `make_dataset`, as a long `cell_type`/`gene` table."""
+
+    markers = marker_genes(n_genes, n_cell_types, n_markers)
+    return pd.DataFrame({
+        'cell_type': np.repeat([f'type_{i}' for i in range(n_cell_types)], n_markers),
+        'gene': [f'gene_{i}' for i in markers.ravel()],
+    })
+
+
+def make_ref_and_query(n_ref_cells: int, n_query_cells: int, **kwargs: Any) -> Tuple[AnnData, AnnData]:
+    """Generates a reference and a query that share genes and cell types, but not cells."""
+    return make_dataset(n_ref_cells, seed=0, **kwargs), make_dataset(n_query_cells, seed=1, **kwargs)
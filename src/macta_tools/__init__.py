@@ -1,6 +1,17 @@
 from macta_tools import tools, utils
-from macta_tools._annotate import annotate
+from macta_tools._annotate import PreparedReference, annotate, annotate_batch, annotate_many, prepare
+from macta_tools._checkpoints import RunDirectory
 from macta_tools._cli import main as cli_main
+from macta_tools._consensus import LabelMatrix, consensus, label_matrix
+from macta_tools._inputs import read_input
+from macta_tools._planning import ExecutionPlan, PlanningError, plan
+from macta_tools._results import ResultsReader, ResultsWriter, read_results, write_results
+from macta_tools._service import AnnotationService
+from macta_tools._service import main as serve_main
+from macta_tools._service import make_server
 
-__all__ = ['annotate', 'tools', 'utils', 'cli_main']
+__all__ = ['annotate', 'annotate_many', 'annotate_batch', 'prepare', 'PreparedReference', 'read_input', 'consensus',
+           'label_matrix', 'LabelMatrix', 'ResultsReader', 'ResultsWriter', 'read_results', 'write_results', 'plan',
+           'ExecutionPlan', 'PlanningError', 'RunDirectory', 'AnnotationService', 'make_server', 'tools', 'utils',
+           'cli_main', 'serve_main']
 __version__ = '0.0.4'
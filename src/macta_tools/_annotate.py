@@ -1,53 +1,278 @@
-"""Encloses the `annotate` function, which runs all necessary annotation tools."""
+"""Encloses the `annotate` function, which runs all necessary annotation tools, its two-phase variant `prepare` +
+`annotate_many`, which prepares the reference once for any number of query data sets, and `annotate_batch`, which
+packs the runs of all tools on all query data sets onto the node by their estimated resources."""
 
 import logging
-from typing import Any, Container, Dict, Optional, Union
+import tempfile
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Container, Dict, Iterable, List, Mapping, Optional, TypeVar, Union
 
 import pandas as pd
 from anndata import AnnData
 
-from macta_tools.tools import AVAILABLE, CTAToolInterface
+from macta_tools._checkpoints import RunDirectory
+from macta_tools._inputs import open_expr, open_ref
+from macta_tools._parallel import EXECUTORS, _run_tool_worker, run_tools_concurrently, share_data, share_input
+from macta_tools._planning import plan
+from macta_tools._results import ResultsReader, ResultsWriter
+from macta_tools._scheduler import ResourceScheduler, Task
+from macta_tools.tools import AVAILABLE, CTAToolInterface, ToolRegistry
+from macta_tools.utils.chunks import iter_chunks
+from macta_tools.utils.isolation import isolate
+from macta_tools.utils.model_cache import CacheEntry, ModelCache
+from macta_tools.utils.profiling import Profiler, stage, tool_context
+from macta_tools.utils.representations import RepresentationCache
+from macta_tools.utils.resources import DataSize
 
+T = TypeVar('T')
+Result = Union[pd.Series, pd.DataFrame]
 
-def annotate(expr_data: AnnData, ref_data: Union[AnnData, pd.DataFrame], annot_type: str, result_type: str = 'labels',
-             annot_tools: Optional[Container[str]] = None,
-             tool_interfaces: Optional[Dict[str, CTAToolInterface]] = None, **kwargs: Any
-             ) -> Dict[str, Union[pd.Series, pd.DataFrame]]:
+
+def _select_tools(annot_tools: Optional[Container[str]], tool_interfaces: Optional[Mapping[str, CTAToolInterface]],
+                  annot_type: Optional[str] = None, result_type: Optional[str] = None) -> Dict[str, CTAToolInterface]:
+    """Selects the interfaces named in `annot_tools` (all if empty) from `tool_interfaces` (`AVAILABLE` if `None`).
+
+    Tools of a `ToolRegistry` that declare that they cannot perform `annot_type` or output `result_type` are skipped
+    without importing them.
+    """
+
+    if tool_interfaces is None:
+        tool_interfaces = AVAILABLE
+
+    if not annot_tools:
+        annot_tools = list(tool_interfaces.keys())
+
+    # Interfaces are only retrieved once selected, so that `AVAILABLE` does not import the other tools
+    selected = {}
+    for tool_name in tool_interfaces:
+        if tool_name not in annot_tools:
+            continue
+
+        if isinstance(tool_interfaces, ToolRegistry) and \
+                not tool_interfaces.specs[tool_name].supports(annot_type, result_type):
+            logging.warning(f'{tool_name}: incompatible requirements. Skipping this tool.')
+            continue
+
+        try:
+            selected[tool_name] = tool_interfaces[tool_name]
+        except ImportError:
+            logging.error(f'{tool_name}: required packages not imported. Skipping this tool.')
+
+    return selected
+
+
+def _is_compatible(tool_name: str, interface: CTAToolInterface, **values: Any) -> bool:
+    """Checks `values` against the requirements of `interface`, logging why the tool is skipped if they fail."""
+
+    if interface._requirements is None:
+        logging.warn(f'{tool_name}: no requirements available. Proceeding with run.')
+        return False
+
+    # Values without a requirement are ignored; other kwargs are meant for the tool itself
+    if not interface._requirements.check(**values):
+        logging.warn(f'{tool_name}: incompatible requirements. Skipping this tool.')
+        return False
+
+    return True
+
+
+def _run_guarded(tool_name: str, function: Callable[..., T], *args: Any, **kwargs: Any) -> Optional[T]:
+    """Calls `function`, logging and skipping the tool if it raises."""
+
+    try:
+        return function(*args, **kwargs)
+
+    except ImportError:
+        # NOTE this should never occur if the tool_interfaces are set according to what can be imported
+        logging.error(f'{tool_name}: required packages not imported. Skipping this tool.')
+
+    except Exception as e:
+        logging.error(f'{tool_name}: main run encountered unknown error {e}. Skipping this run')
+
+    return None
+
+
+def annotate(expr_data: Union[AnnData, str, Path], ref_data: Union[AnnData, pd.DataFrame, str, Path], annot_type: str,
+             result_type: str = 'labels', annot_tools: Optional[Container[str]] = None,
+             tool_interfaces: Optional[Mapping[str, CTAToolInterface]] = None, executor: Optional[str] = None,
+             max_workers: Optional[int] = None, max_threads: Optional[int] = None, max_memory: Optional[int] = None,
+             chunk_size: Optional[int] = None, profiler: Optional[Profiler] = None,
+             output: Union[str, Path, None] = None, on_invalid: str = 'raise',
+             run_dir: Union[str, Path, RunDirectory, None] = None, **kwargs: Any
+             ) -> Mapping[str, Union[pd.Series, pd.DataFrame]]:
     """Runs MACTA annotation analysis.
 
+    Every tool is given its own isolated copy of `expr_data` and `ref_data` (see `utils.isolation.isolate`), which
+    shares their matrices read-only, so that tools cannot affect each other's results nor modify the caller's data.
+
     Arguments:
-        expr_data (AnnData): experimental data on which the analysis is performed
-        ref_data (AnnData/DataFrame): reference/marker data used to analyse `expr_data`
+        expr_data (AnnData/str/Path): experimental data on which the analysis is performed, or the path to its
+            h5ad/zarr/loom file (see `read_input`); h5ad and zarr files are opened without loading their matrices,
+            only the ones that tools use are read
+        ref_data (AnnData/DataFrame/str/Path): reference/marker data used to analyse `expr_data`, or the path to its
+            file (see `read_input`); other strings are passed on to the tools, e.g. the names of `celltypist` models
         annot_type (str): type of autoannotation to perform <marker/ref>
         result_type (str): type of results to output <labels>
         annot_tools (str/List[str]): selection of tools to consider using in annotation, '*' to select all tools
         tool_interfaces (Dict): dict of annotation tool name -> `CTAToolInterface`
+        executor (str): if set, runs the selected tools concurrently on a worker pool <process/thread/scheduled>.
+            `'scheduled'` packs them by their estimated threads and memory, see `annotate_batch`
+        max_workers (int): maximum number of concurrent workers of the `'process'` and `'thread'` executors,
+            defaults to one per tool
+        max_threads (int): threads that tools may use together with the `'scheduled'` executor, see `annotate_batch`
+        max_memory (int): memory in bytes that tools may use together with the `'scheduled'` executor
+        chunk_size (int): if set, tools that support it annotate `expr_data` this many cells at a time, so that only
+            one chunk is held in memory
+        profiler (Profiler): if set, records the wall time, CPU time and peak memory of every stage of every tool
+        output (str/Path): if set, the results are written into this results file (see `ResultsWriter`); with
+            `chunk_size`, they are streamed into it a chunk at a time instead of being collected in memory
+        on_invalid (str): what to do with selected tools whose inputs are invalid, which is checked for every tool
+            before any of them runs <raise/skip>. `'raise'` raises a `PlanningError` listing all problems, `'skip'`
+            logs them and runs the other tools
+        run_dir (str/Path/RunDirectory): if set, the prepared reference, annotation state and result of every tool
+            are checkpointed into this directory (see `RunDirectory`) as soon as they are complete, and a run that
+            is started again with the same inputs resumes from the last completed stage of every tool
 
     Returns:
-        results of auto-annotation
+        dict of tool name -> results of auto-annotation, or a `ResultsReader` of `output` if it is set
     """
 
-    if tool_interfaces is None:
-        tool_interfaces = AVAILABLE
+    if executor is not None and executor not in EXECUTORS:
+        raise ValueError(f'{executor} is an invalid option for `executor`, expected one of {EXECUTORS}')
 
-    if not annot_tools:
-        annot_tools = list(tool_interfaces.keys())
+    # The inputs as given, which worker processes open again if they are files
+    expr_source, ref_source = expr_data, ref_data
+    expr_data, ref_data = open_expr(expr_data), open_ref(ref_data)
+    selected = _select_tools(annot_tools, tool_interfaces, annot_type, result_type)
+    selected = plan(selected, expr_data, ref_data, annot_type, result_type, on_invalid=on_invalid, **kwargs).tools
 
-    results = {}
+    run = _open_run(run_dir)
+    if run is not None:
+        kwargs = run.kwargs(kwargs)
 
-    for tool_name, interface in tool_interfaces.items():
-        if tool_name not in annot_tools:
-            continue
+    if output is not None:
+        metadata = {tool_name: _tool_metadata(tool_name, interface, annot_type, result_type, chunk_size)
+                    for tool_name, interface in selected.items()}
+        run_metadata = {'annot_type': annot_type, 'result_type': result_type}
 
-        result = run_tool(tool_name, interface, expr_data, ref_data, annot_type, result_type, **kwargs)
-        if result is not None:
+        if chunk_size is not None:
+            with ResultsWriter(output, expr_data.obs_names, metadata=run_metadata) as writer:
+                _stream_results(writer, selected, expr_data, ref_data, annot_type, result_type, chunk_size, metadata,
+                                profiler, **kwargs)
+        else:
+            in_memory = annotate(expr_source, ref_source, annot_type, result_type, tool_interfaces=selected,
+                                 executor=executor, max_workers=max_workers, max_threads=max_threads,
+                                 max_memory=max_memory, profiler=profiler, run_dir=run, **kwargs)
+            with ResultsWriter(output, expr_data.obs_names, metadata=run_metadata) as writer:
+                writer.write(in_memory, metadata)
+
+        return ResultsReader(output)
+
+    order = list(selected)
+    results: Dict[str, Result] = {}
+    tool_keys: Dict[str, str] = {}
+
+    if run is not None:
+        run_key = run.run_key(expr_data, ref_data, annot_type, result_type, kwargs)
+        for tool_name, interface in selected.items():
+            tool_keys[tool_name] = run.tool_key(run_key, tool_name, interface)
+            result = run.load_result(tool_keys[tool_name], tool_name)
+            if result is not None:
+                logging.info(f'{tool_name}: result found in {run}. Skipping this tool.')
+                results[tool_name] = result
+        selected = {tool_name: interface for tool_name, interface in selected.items() if tool_name not in results}
+
+    if executor == 'scheduled' and len(selected) > 1:
+        completed = _run_scheduled(selected, [expr_data], ref_data, annot_type, result_type, max_threads, max_memory,
+                                   chunk_size, profiler, **kwargs)[0]
+        for tool_name, result in completed.items():
+            if run is not None:
+                run.store_result(tool_keys[tool_name], tool_name, result)
+            results[tool_name] = result
+
+    elif executor is not None and len(selected) > 1:
+        completed = run_tools_concurrently(selected, expr_data, ref_data, annot_type, result_type, executor=executor,
+                                           max_workers=max_workers, chunk_size=chunk_size, profiler=profiler,
+                                           expr_source=expr_source, ref_source=ref_source, **kwargs)
+        for tool_name, result in completed.items():
+            if run is not None:
+                run.store_result(tool_keys[tool_name], tool_name, result)
             results[tool_name] = result
 
-    return results
+    else:
+        # Representations (e.g. log-normalized data) that several tools need are only computed once
+        expr_representations, ref_representations = RepresentationCache(expr_data), RepresentationCache(ref_data)
+
+        for tool_name, interface in selected.items():
+            state_checkpoint = None if run is None else run.state(tool_keys[tool_name])
+            result = run_tool(tool_name, interface, expr_data, ref_data, annot_type, result_type,
+                              chunk_size=chunk_size, profiler=profiler, expr_representations=expr_representations,
+                              ref_representations=ref_representations, state_checkpoint=state_checkpoint, **kwargs)
+            if result is not None:
+                # Checkpointed right away, so that it survives a later tool bringing the whole run down
+                if run is not None:
+                    run.store_result(tool_keys[tool_name], tool_name, result)
+                results[tool_name] = result
+
+    return {tool_name: results[tool_name] for tool_name in order if tool_name in results}
+
+
+def _open_run(run_dir: Union[str, Path, RunDirectory, None]) -> Optional[RunDirectory]:
+    if run_dir is None or isinstance(run_dir, RunDirectory):
+        return run_dir
+    return RunDirectory(run_dir)
+
+
+def _tool_metadata(tool_name: str, interface: CTAToolInterface, annot_type: str, result_type: str,
+                   chunk_size: Optional[int]) -> Dict[str, Any]:
+    return {'tool': tool_name, 'interface': type(interface).__qualname__, 'annot_type': annot_type,
+            'result_type': result_type, 'chunked': chunk_size is not None and interface._supports_chunks}
+
+
+def _stream_results(writer: ResultsWriter, tool_interfaces: Dict[str, CTAToolInterface], expr_data: AnnData,
+                    ref_data: Union[AnnData, pd.DataFrame], annot_type: str, result_type: str, chunk_size: int,
+                    metadata: Dict[str, Dict[str, Any]], profiler: Optional[Profiler], **kwargs: Any) -> None:
+    """Annotates `expr_data` a chunk at a time, appending the results of every tool to `writer` after each chunk.
+
+    References are prepared once; tools that do not support chunks annotate all of `expr_data` at once.
+    """
+
+    prepared = prepare(ref_data, annot_type, result_type, tool_interfaces=tool_interfaces, profiler=profiler,
+                       **kwargs)
+
+    unchunked = [tool_name for tool_name, reference in prepared.items() if not reference.interface._supports_chunks]
+    representations = RepresentationCache(expr_data)
+    for tool_name in unchunked:
+        logging.warning(f'{tool_name}: annotating in chunks is not supported. Loading all of `expr_data` instead.')
+        result = prepared.pop(tool_name).annotate(expr_data, result_type, profiler=profiler,
+                                                  representations=representations)
+        if result is not None:
+            writer.write({tool_name: result}, metadata)
+    del representations
+
+    for chunk in iter_chunks(expr_data, chunk_size):
+        # The representations of each chunk are shared by the tools, which annotate it one after the other
+        representations = RepresentationCache(chunk)
+        for tool_name, reference in list(prepared.items()):
+            # Options that only make sense on all cells at once (e.g. majority voting) are disabled, as in
+            # `run_prepared`
+            result = reference.annotate(chunk, result_type, profiler=profiler, representations=representations,
+                                        **reference.interface._chunk_kwargs)
+            if result is None:
+                # The tool failed on this chunk, so its results would be incomplete
+                writer.discard(tool_name)
+                del prepared[tool_name]
+                continue
+            writer.append(tool_name, result, metadata[tool_name])
 
 
 def run_tool(tool_name: str, interface: CTAToolInterface, expr_data: AnnData, ref_data: Union[AnnData, pd.DataFrame],
-             annot_type: str, result_type: str, **kwargs: Any) -> Union[pd.DataFrame, pd.Series, None]:
+             annot_type: str, result_type: str, chunk_size: Optional[int] = None,
+             profiler: Optional[Profiler] = None, expr_representations: Optional[RepresentationCache] = None,
+             ref_representations: Optional[RepresentationCache] = None, state_checkpoint: Optional[CacheEntry] = None,
+             **kwargs: Any) -> Union[pd.DataFrame, pd.Series, None]:
     """Fully runs the annotation for one tool and handles typical issues and exceptions.
 
     Arguments:
@@ -57,29 +282,273 @@ def run_tool(tool_name: str, interface: CTAToolInterface, expr_data: AnnData, re
         ref_data (AnnData): reference data for the cells to label
         annot_type (str): annotation type to perform <marker/ref>
         result_type (str): a string representing how the result should be structured
+        chunk_size (int): if set and supported by the interface, the number of cells annotated at a time
+        profiler (Profiler): if set, records the wall time, CPU time and peak memory of every stage of the run
+        expr_representations (RepresentationCache): cache of the representations of `expr_data` shared with other
+            tools, if any
+        ref_representations (RepresentationCache): cache of the representations of `ref_data` shared with other
+            tools, if any
+        state_checkpoint (CacheEntry): checkpoint of the annotation state of the tool, if any; not used with
+            `chunk_size`
         **kwargs (Any): other key word arguments to pass to the interface functions
 
     Returns:
         A `pandas.Series` containing the results for each cell type if the run is valid. Otherwise, returns `None`
     """
 
-    if interface._requirements is None:
-        logging.warn(f'{tool_name}: no requirements available. Proceeding with run.')
+    if not _is_compatible(tool_name, interface, expr_data=expr_data, ref_data=ref_data, annot_type=annot_type,
+                          result_type=result_type, **kwargs):
         return None
 
-    if not interface._requirements.check(expr_data=expr_data, ref_data=ref_data, annot_type=annot_type,
-                                         result_type=result_type, **kwargs):
-        logging.warn(f'{tool_name}: incompatible requirements. Skipping this tool.')
-        return None
+    if chunk_size is not None and not interface._supports_chunks:
+        logging.warning(f'{tool_name}: annotating in chunks is not supported. Loading all of `expr_data` instead.')
 
-    try:
-        return interface.run_full(expr_data, ref_data, result_type, **kwargs)
+    # Every tool gets its own annotations of the data, so that what it writes into them does not affect other tools
+    with tool_context(profiler, tool_name):
+        if chunk_size is not None and interface._supports_chunks:
+            return _run_guarded(tool_name, interface.run_chunked, expr_data, isolate(ref_data), result_type,
+                                chunk_size, ref_representations=ref_representations, **kwargs)
 
-    except ImportError:
-        # NOTE this should never occur if the tool_interfaces are set according to what can be imported
-        logging.error(f'{tool_name}: required packages not imported. Skipping this tool.')
+        # Matrices on disk are only loaded by the representations that use them
+        return _run_guarded(tool_name, interface.run_full, isolate(expr_data), isolate(ref_data),
+                            result_type, expr_representations=expr_representations,
+                            ref_representations=ref_representations, state_checkpoint=state_checkpoint, **kwargs)
+
+
+@dataclass
+class PreparedReference:
+    """Reference data prepared by one tool, which can annotate any number of query data sets.
+
+    Attributes:
+        tool_name (str): the name of the tool that prepared the reference
+        interface (CTAToolInterface): the interface of that tool
+        model (Any): the prepared reference, as returned by `interface.prepare_ref`
+        annot_type (str): annotation type the reference was prepared for <marker/ref>
+        kwargs (Dict[str, Any]): key word arguments the reference was prepared with, reused when annotating
+    """
+
+    tool_name: str
+    interface: CTAToolInterface
+    model: Any
+    annot_type: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)
+
+    def annotate(self, expr_data: AnnData, result_type: str = 'labels', chunk_size: Optional[int] = None,
+                 profiler: Optional[Profiler] = None, representations: Optional[RepresentationCache] = None,
+                 **kwargs: Any) -> Optional[Result]:
+        """Annotates `expr_data` against this prepared reference.
+
+        Arguments:
+            expr_data (AnnData): expression data for the cells to label
+            result_type (str): a string representing how the result should be structured
+            chunk_size (int): if set and supported by the interface, the number of cells annotated at a time
+            profiler (Profiler): if set, records the wall time, CPU time and peak memory of every stage
+            representations (RepresentationCache): cache of the representations of `expr_data` shared with other
+                tools, if any; not used with `chunk_size`
+            **kwargs (Any): key word arguments that override the ones the reference was prepared with
+
+        Returns:
+            results of annotation if the run is valid, otherwise `None`
+        """
+
+        kwargs = {**self.kwargs, **kwargs}
+        if not _is_compatible(self.tool_name, self.interface, expr_data=expr_data, annot_type=self.annot_type,
+                              result_type=result_type, **kwargs):
+            return None
+
+        if chunk_size is not None and not self.interface._supports_chunks:
+            logging.warning(f'{self.tool_name}: annotating in chunks is not supported. '
+                            'Loading all of `expr_data` instead.')
+            chunk_size = None
+
+        with tool_context(profiler, self.tool_name):
+            return _run_guarded(self.tool_name, self.interface.run_prepared,
+                                expr_data if chunk_size is not None else isolate(expr_data), self.model,
+                                result_type, chunk_size=chunk_size, expr_representations=representations, **kwargs)
+
+
+def prepare(ref_data: Union[AnnData, pd.DataFrame, str, Path], annot_type: str, result_type: str = 'labels',
+            annot_tools: Optional[Container[str]] = None,
+            tool_interfaces: Optional[Mapping[str, CTAToolInterface]] = None, profiler: Optional[Profiler] = None,
+            on_invalid: str = 'raise', run_dir: Union[str, Path, RunDirectory, None] = None, **kwargs: Any
+            ) -> Dict[str, PreparedReference]:
+    """Prepares the reference (e.g. trains or loads the reference models) of every selected tool once.
+
+    Arguments:
+        ref_data (AnnData/DataFrame/str/Path): reference/marker data used to analyse the query data sets, or the
+            path to its file, see `annotate`
+        annot_type (str): type of autoannotation to perform <marker/ref>
+        result_type (str): type of results that will be output <labels/scores>
+        annot_tools (str/List[str]): selection of tools to consider using in annotation, '*' to select all tools
+        tool_interfaces (Dict): dict of annotation tool name -> `CTAToolInterface`
+        profiler (Profiler): if set, records the wall time, CPU time and peak memory of every preparation
+        on_invalid (str): what to do with selected tools whose reference is invalid <raise/skip>, see `annotate`
+        run_dir (str/Path/RunDirectory): if set, prepared references are checkpointed into this directory, unless a
+            `model_cache` is given
+        **kwargs (Any): other key word arguments to pass to the interface functions
+
+    Returns:
+        dict of tool name -> `PreparedReference`, for each tool whose reference was prepared successfully
+    """
+
+    prepared = {}
+    ref_data = open_ref(ref_data)
+    representations = RepresentationCache(ref_data)
+    run = _open_run(run_dir)
+    if run is not None:
+        kwargs = run.kwargs(kwargs)
+
+    selected = _select_tools(annot_tools, tool_interfaces, annot_type, result_type)
+    for tool_name, interface in plan(selected, None, ref_data, annot_type, result_type, on_invalid=on_invalid,
+                                     **kwargs).tools.items():
+        with tool_context(profiler, tool_name), stage('prepare_ref'):
+            model = _run_guarded(tool_name, interface.prepare_ref, isolate(ref_data), representations=representations,
+                                 **kwargs)
+        if model is not None:
+            prepared[tool_name] = PreparedReference(tool_name, interface, model, annot_type, kwargs)
+
+    return prepared
+
+
+def annotate_many(prepared: Dict[str, PreparedReference], expr_datas: Iterable[Union[AnnData, str, Path]],
+                  result_type: str = 'labels', chunk_size: Optional[int] = None, profiler: Optional[Profiler] = None,
+                  **kwargs: Any) -> List[Dict[str, Result]]:
+    """Annotates several query data sets against references prepared once by `prepare`.
+
+    Arguments:
+        prepared (Dict): dict of tool name -> `PreparedReference`, as returned by `prepare`
+        expr_datas (Iterable): query data sets, or paths to their files, which are opened one at a time (see
+            `annotate`)
+        result_type (str): type of results to output <labels/scores>
+        chunk_size (int): if set, tools that support it annotate each query this many cells at a time
+        profiler (Profiler): if set, records the wall time, CPU time and peak memory of every stage of every run
+        **kwargs (Any): key word arguments that override the ones the references were prepared with
+
+    Returns:
+        list holding, for each query data set in order, a dict of tool name -> results
+    """
 
+    all_results = []
+
+    for expr_data in expr_datas:
+        expr_data = open_expr(expr_data)
+
+        results = {}
+        representations = RepresentationCache(expr_data)
+        for tool_name, reference in prepared.items():
+            result = reference.annotate(expr_data, result_type, chunk_size=chunk_size, profiler=profiler,
+                                        representations=representations, **kwargs)
+            if result is not None:
+                results[tool_name] = result
+
+        all_results.append(results)
+
+    return all_results
+
+
+def annotate_batch(expr_datas: Iterable[Union[AnnData, str, Path]],
+                   ref_data: Union[AnnData, pd.DataFrame, str, Path], annot_type: str, result_type: str = 'labels',
+                   annot_tools: Optional[Container[str]] = None,
+                   tool_interfaces: Optional[Mapping[str, CTAToolInterface]] = None, max_threads: Optional[int] = None,
+                   max_memory: Optional[int] = None, chunk_size: Optional[int] = None,
+                   profiler: Optional[Profiler] = None, on_invalid: str = 'raise',
+                   model_cache: Union[ModelCache, str, Path, None] = None, **kwargs: Any) -> List[Dict[str, Result]]:
+    """Annotates several query data sets with every selected tool, running as many tool runs at once as the node
+    holds.
+
+    Every run of a tool on a query is a task, whose threads and peak memory the tool estimates from the size of the
+    inputs (see `CTAToolInterface.estimate_resources`). Tasks start as soon as they fit next to the running ones
+    within `max_threads` and `max_memory` (see `ResourceScheduler`), each in its own process whose OpenMP, BLAS,
+    `torch` and `numba` threads are limited to the threads it declared.
+
+    Tools that cache their prepared reference (see `CTAToolInterface._caches_ref`) prepare it once, on the first
+    query, and load it from `model_cache` for the other queries, which wait for it.
+
+    Arguments:
+        expr_datas (Iterable): query data sets, or paths to their files; h5ad and zarr files are opened by the
+            workers, while in-memory data sets are written once to temporary h5ad files (honoring `TMPDIR`)
+        ref_data (AnnData/DataFrame/str/Path): reference/marker data used to analyse the query data sets, or the
+            path to its file, see `annotate`
+        annot_type (str): type of autoannotation to perform <marker/ref>
+        result_type (str): type of results to output <labels/scores>
+        annot_tools (str/List[str]): selection of tools to consider using in annotation, '*' to select all tools
+        tool_interfaces (Dict): dict of annotation tool name -> `CTAToolInterface`
+        max_threads (int): threads that tool runs may use together, the number of usable cores by default
+        max_memory (int): memory in bytes that tool runs may use together, by default 80% of the memory available
+            when the batch starts
+        chunk_size (int): if set, tools that support it annotate each query this many cells at a time
+        profiler (Profiler): if set, records the wall time, CPU time and peak memory of every stage of every run
+        on_invalid (str): what to do with selected tools whose reference is invalid <raise/skip>, see `annotate`
+        model_cache (ModelCache/str/Path): cache, or cache directory, of prepared references; a temporary cache is
+            used for the batch if `None`
+        **kwargs (Any): other key word arguments to pass to the interface functions
+
+    Returns:
+        list holding, for each query data set in order, a dict of tool name -> results
+    """
+
+    ref_data = open_ref(ref_data)
+    selected = _select_tools(annot_tools, tool_interfaces, annot_type, result_type)
+    selected = plan(selected, None, ref_data, annot_type, result_type, on_invalid=on_invalid, **kwargs).tools
+    expr_datas = list(expr_datas)
+
+    with tempfile.TemporaryDirectory(prefix='macta_tools_') as directory:
+        if model_cache is None:
+            model_cache = ModelCache(Path(directory) / 'models')
+        return _run_scheduled(selected, expr_datas, ref_data, annot_type, result_type, max_threads, max_memory,
+                              chunk_size, profiler, model_cache=model_cache, **kwargs)
+
+
+def _run_scheduled(tool_interfaces: Dict[str, CTAToolInterface], expr_datas: List[Any], ref_data: Any,
+                   annot_type: str, result_type: str, max_threads: Optional[int], max_memory: Optional[int],
+                   chunk_size: Optional[int], profiler: Optional[Profiler], **kwargs: Any) -> List[Dict[str, Result]]:
+    """Runs every tool of `tool_interfaces` on every query of `expr_datas` on a `ResourceScheduler`."""
+
+    scheduler = ResourceScheduler(max_threads, max_memory)
+    ref_size = DataSize.of(ref_data)
+
+    with tempfile.TemporaryDirectory(prefix='macta_tools_') as directory:
+        shared_ref = share_data(ref_data, directory, 'ref_data')
+
+        tasks = []
+        for index, expr_data in enumerate(expr_datas):
+            opened = open_expr(expr_data)
+            expr_size = DataSize.of(opened)
+            shared_expr = share_input(expr_data, opened, directory, f'expr_data_{index}')
+            del opened
+
+            for tool_name, interface in tool_interfaces.items():
+                resources = interface.estimate_resources(expr_size, ref_size, **kwargs)
+                logging.info(f'{tool_name}: query {index} needs {resources.threads} threads and '
+                             f'{resources.memory / 1024 ** 2:.0f} MiB')
+
+                # Later queries load the reference that the first one prepared into the model cache
+                after = (0, tool_name) if index > 0 and 'model_cache' in kwargs and interface._caches_ref else None
+                tasks.append(Task((index, tool_name), _run_tool_worker,
+                                  (tool_name, interface, shared_expr, shared_ref, annot_type, result_type, chunk_size,
+                                   profiler, kwargs), resources, after))
+
+        futures = scheduler.run(tasks)
+
+    all_results: List[Dict[str, Result]] = [{} for _ in expr_datas]
+    for index in range(len(expr_datas)):
+        for tool_name in tool_interfaces:
+            _collect(futures[index, tool_name], tool_name, all_results[index], profiler)
+
+    return all_results
+
+
+def _collect(future: 'Future[Any]', tool_name: str, results: Dict[str, Result], profiler: Optional[Profiler]) -> None:
+    """Adds the result of a task of `_run_scheduled` to `results`, and its records to `profiler`."""
+
+    try:
+        result, records = future.result()
     except Exception as e:
-        logging.error(f'{tool_name}: main run encountered unknown error {e}. Skipping this run')
+        # `run_tool` handles errors raised by the tools, so these come from the worker process itself
+        logging.error(f'{tool_name}: worker encountered unknown error {e}. Skipping this run')
+        return
 
-    return None
+    if profiler is not None:
+        profiler.add(records)
+    if result is not None:
+        results[tool_name] = result
@@ -0,0 +1,106 @@
+"""Run directories, which checkpoint every stage of every tool of an annotation run, so that a run that died (e.g.
+out of memory or preempted) resumes from the last stage it completed when it is started again with the same inputs.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Union
+
+import pandas as pd
+from anndata import AnnData
+
+from macta_tools._results import read_results, write_results
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.fingerprint import fingerprint
+from macta_tools.utils.model_cache import CacheEntry, ModelCache
+
+Result = Union[pd.Series, pd.DataFrame]
+
+_RESULT_FILE = 'result.h5'
+
+# Key word arguments that do not change the results of the tools
+_EXECUTION_KWARGS = ('model_cache',)
+
+
+def _used_columns(data: AnnData, kwargs: Mapping[str, Any]) -> List[Any]:
+    """Lists the `obs` columns of `data` named by the key word arguments of the tools (e.g. `labels`, `batch_col`)."""
+
+    columns = data.obs.columns
+    named = (value for value in kwargs.values() if isinstance(value, (str, int)) and not isinstance(value, bool))
+    return list(dict.fromkeys(value for value in named if value in columns))
+
+
+def _describe(data: Any, kwargs: Mapping[str, Any]) -> Any:
+    """Describes the contents of an input of the tools, for the checkpoint keys.
+
+    Only the `obs` columns the tools are pointed at through `kwargs` are fingerprinted, the other ones cannot change
+    their results.
+    """
+
+    if isinstance(data, AnnData):
+        return fingerprint(data, obs_columns=_used_columns(data, kwargs))
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        hashed = pd.util.hash_pandas_object(data, index=True).to_numpy()
+        columns = list(map(str, data.columns)) if isinstance(data, pd.DataFrame) else [str(data.name)]
+        return {'hash': hashlib.blake2b(hashed.tobytes(), digest_size=20).hexdigest(), 'columns': columns}
+    return data
+
+
+class RunDirectory:
+    """Directory holding the checkpoints of annotation runs.
+
+    Three stages of every tool are checkpointed, each in a `ModelCache`:
+
+    - `models/`: prepared references, for interfaces that can save them (see `CTAToolInterface._caches_ref`), which is
+      used as the `model_cache` of the run unless another one is given
+    - `states/`: results of `CTAToolInterface.annotate` (e.g. a model trained on the query), for interfaces that can
+      save them (see `CTAToolInterface._checkpoints_state`)
+    - `results/`: converted results of every tool that completed
+
+    Checkpoints are keyed on the contents of the inputs and the options of the run, so the same directory can hold
+    several runs, and a changed input never resumes from stale checkpoints.
+
+    Attributes:
+        directory (Path): the run directory
+        models (ModelCache): checkpoints of the prepared references
+        states (ModelCache): checkpoints of the annotation states
+        results (ModelCache): checkpoints of the converted results
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.models = ModelCache(self.directory / 'models')
+        self.states = ModelCache(self.directory / 'states')
+        self.results = ModelCache(self.directory / 'results')
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({str(self.directory)!r})'
+
+    @staticmethod
+    def run_key(expr_data: Any, ref_data: Any, annot_type: str, result_type: str, kwargs: Mapping[str, Any]) -> str:
+        """Builds the key of a run from its inputs and options, which fingerprints the data once for all tools."""
+
+        options = {key: value for key, value in kwargs.items() if key not in _EXECUTION_KWARGS}
+        return ModelCache.key(expr=_describe(expr_data, options), ref=_describe(ref_data, options),
+                              annot_type=annot_type, result_type=result_type, kwargs=options)
+
+    @staticmethod
+    def tool_key(run_key: str, tool_name: str, interface: CTAToolInterface) -> str:
+        """Builds the key of the checkpoints of one tool in a run."""
+        return ModelCache.key(run=run_key, tool=tool_name, interface=type(interface).__qualname__)
+
+    def state(self, tool_key: str) -> CacheEntry:
+        """Returns the checkpoint of the annotation state of a tool, to pass to `CTAToolInterface.run_full`."""
+        return CacheEntry(self.states, tool_key)
+
+    def load_result(self, tool_key: str, tool_name: str) -> Optional[Result]:
+        """Loads the result of a tool that completed in an earlier run, if any."""
+        return self.results.load(tool_key, lambda path: read_results(path / _RESULT_FILE)[tool_name])
+
+    def store_result(self, tool_key: str, tool_name: str, result: Result) -> None:
+        """Checkpoints the result of a tool that completed."""
+        self.results.store(tool_key, result, lambda value, path: write_results(path / _RESULT_FILE, {tool_name: value}))
+
+    def kwargs(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Adds the prepared reference checkpoints to the key word arguments of the tools, unless they have a cache."""
+        return kwargs if kwargs.get('model_cache') is not None else {**kwargs, 'model_cache': self.models}
@@ -1,10 +1,20 @@
-from argparse import ArgumentParser, FileType, Namespace
+import sys
+from argparse import ArgumentParser, Namespace
+from collections import Counter
 from pathlib import Path
+from typing import Any, Callable, Dict, List, Mapping, Optional
 
-import scanpy as sc
 from pandas.compat.pickle_compat import pkl
 
-from macta_tools import annotate
+from macta_tools import annotate, annotate_batch, annotate_many, prepare
+from macta_tools._consensus import consensus
+from macta_tools._inputs import read_input
+from macta_tools._planning import PlanningError
+from macta_tools._results import ResultsWriter, write_results
+from macta_tools.tools import TRAINING_PROFILES
+from macta_tools.utils.model_cache import ModelCache
+from macta_tools.utils.profiling import Profiler
+from macta_tools.utils.scores import SCORE_DTYPES
 
 
 def parse_args() -> Namespace:
@@ -14,13 +24,18 @@ def parse_args() -> Namespace:
     parser.add_argument(
         'expr',
         # dest='expr_data',
-        type=FileType(),
+        type=Path,
+        nargs='+',
+        help='one or more query data sets (h5ad, zarr or loom), opened without loading the matrices that no tool '
+             'uses; with several, the reference is prepared once and reused for all of them',
     )
 
     parser.add_argument(
         'ref',
         # dest='ref_data',
-        type=FileType(),
+        type=Path,
+        help='reference data set (h5ad, zarr or loom), celltypist model (a .pkl file or the name of a model), or '
+             'CSV/TSV table of cell types and their marker genes for marker annotation',
     )
 
     parser.add_argument(
@@ -36,7 +51,9 @@ def parse_args() -> Namespace:
     parser.add_argument(
         'output',
         # dest='output_path',
-        type=FileType(),
+        type=Path,
+        help='output file, or output directory holding one file per query when several are given, named after the '
+             'query files (prefixed with their directory when several queries share a name)',
     )
 
     parser.add_argument(
@@ -44,6 +61,107 @@ def parse_args() -> Namespace:
         nargs='+',
     )
 
+    # Execution options
+
+    parser.add_argument(
+        '--executor',
+        choices=['process', 'thread', 'scheduled'],
+        help='run the tools concurrently; `scheduled` packs the runs of all tools on all expression files onto the '
+             'node by their estimated threads and memory',
+    )
+
+    parser.add_argument(
+        '--max_workers',
+        type=int,
+    )
+
+    parser.add_argument(
+        '--max_threads',
+        type=int,
+        help='threads that tools may use together with the scheduled executor, defaults to the usable cores',
+    )
+
+    parser.add_argument(
+        '--max_memory',
+        type=int,
+        help='memory in bytes that tools may use together with the scheduled executor, defaults to 80%% of the '
+             'available memory',
+    )
+
+    parser.add_argument(
+        '--chunk_size',
+        type=int,
+        help='annotate the expression data this many cells at a time, reading it from disk in backed mode',
+    )
+
+    parser.add_argument(
+        '--output_format',
+        choices=['h5', 'pickle'],
+        default='h5',
+        help='format of the output: a chunked results file that can be read a tool at a time, or a pickled dict',
+    )
+
+    parser.add_argument(
+        '--profile',
+        type=Path,
+        help='write the wall time, CPU time and peak memory of every stage of every tool to this JSON/CSV file',
+    )
+
+    parser.add_argument(
+        '--consensus',
+        choices=['majority', 'weighted', 'scores'],
+        help='also combine the results of the tools into one label per cell, stored under the "consensus" key',
+    )
+
+    parser.add_argument(
+        '--tool_weights',
+        nargs='+',
+        metavar='TOOL=WEIGHT',
+        help='weights of the tools for the weighted and scores consensus',
+    )
+
+    parser.add_argument(
+        '--min_confidence',
+        type=float,
+        help='leave cells whose consensus confidence is lower unlabelled',
+    )
+
+    parser.add_argument(
+        '--on_invalid',
+        choices=['raise', 'skip'],
+        default='raise',
+        help='whether to stop before running any tool, or to skip tools, when the inputs of some tools are invalid',
+    )
+
+    parser.add_argument(
+        '--run_dir',
+        type=Path,
+        help='directory in which every stage of every tool is checkpointed, so that the run can be resumed',
+    )
+
+    parser.add_argument(
+        '--model_cache',
+        help='directory in which trained reference models are cached',
+    )
+
+    parser.add_argument(
+        '--model_cache_max_bytes',
+        type=int,
+        help='maximum size of the model cache, least recently used models are evicted beyond it',
+    )
+
+    parser.add_argument(
+        '--score_dtype',
+        choices=SCORE_DTYPES,
+        help='float dtype of the scores of every tool (default: float32)',
+    )
+
+    parser.add_argument(
+        '--score_top_k',
+        type=int,
+        help='only keep the best scores of every cell, as sparse columns',
+    )
+
     # Tool kwargs
 
     parser.add_argument(
@@ -56,31 +174,79 @@ def parse_args() -> Namespace:
         type=bool,
     )
 
+    parser.add_argument(
+        '--model_store',
+        type=Path,
+        help='directory of the celltypist models, defaults to the one celltypist downloads models into',
+    )
+
+    parser.add_argument(
+        '--offline',
+        action='store_true',
+        default=None,
+        help='never download models, named models must already be in --model_store',
+    )
+
     parser.add_argument('--batch_col')
     parser.add_argument('--cell_type_col')
 
+    parser.add_argument(
+        '--training_profile',
+        choices=list(TRAINING_PROFILES),
+        help='speed/accuracy trade-off of the models trained by the tools (default: balanced)',
+    )
+
     return parser.parse_args()
 
 
-# def read_file(path_name: bytes) -> Union[AnnData, pd.DataFrame, None]:
-#
-#     path = Path(str(path_name))
-#     ext = path.suffix
-#
-#     if ext == 'csv':
-#         return pd.read_csv(path)
-#
-#     if ext == 'tsv':
-#         return pd.read_csv(path, delimiter='\t')
-#
-#     if ext == 'pkl':
-#         with path.open('rb') as file:
-#             return pkl.load(file)
-#
-#     if ext == 'h5ad':
-#         return sc.read_h5ad(path)
-#
-#     return None
+def parse_weights(weights: Optional[List[str]]) -> Optional[Dict[str, float]]:
+    """Parses `TOOL=WEIGHT` arguments into a dict of tool name -> weight."""
+
+    if weights is None:
+        return None
+
+    parsed = {}
+    for weight in weights:
+        tool, separator, value = weight.partition('=')
+        if not separator:
+            raise ValueError(f'{weight} is an invalid tool weight, expected TOOL=WEIGHT')
+        parsed[tool] = float(value)
+    return parsed
+
+
+def output_stems(expr_files: List[Path]) -> List[str]:
+    """Names of the output files of several queries: the names of the query files, prefixed with the name of their
+    directory when several queries share a name, and suffixed with their position if that is not enough."""
+
+    def deduplicated(names: List[str], rename: Callable[[int, str], str]) -> List[str]:
+        counts = Counter(names)
+        return [rename(index, name) if counts[name] > 1 else name for index, name in enumerate(names)]
+
+    stems = deduplicated([expr_file.stem for expr_file in expr_files],
+                         lambda index, stem: f'{expr_files[index].resolve().parent.name}_{stem}')
+    return deduplicated(stems, lambda index, stem: f'{stem}_{index}')
+
+
+def write_consensus(path: Path, results: Mapping[str, Any], consensus_kwargs: Dict[str, Any]) -> None:
+    """Adds the consensus of `results` to the results file at `path`, if a consensus method was given."""
+
+    if consensus_kwargs['method'] is None or not results:
+        return
+
+    combined = consensus(results, **consensus_kwargs)
+    with ResultsWriter(path, mode='a') as writer:
+        writer.append('consensus', combined['label'], {'consensus': consensus_kwargs})
+        writer.append('consensus_confidence', combined[['confidence']], {'consensus': consensus_kwargs})
+
+
+def write_pickle(path: Path, results: Dict[str, Any], consensus_kwargs: Dict[str, Any]) -> None:
+    """Pickles `results` into `path`, along with their consensus under the `'consensus'` key if requested."""
+
+    if consensus_kwargs['method'] is not None and results:
+        results['consensus'] = consensus(results, **consensus_kwargs)
+
+    with path.open('wb') as file:
+        pkl.dump(results, file)
 
 
 def main():
@@ -91,10 +257,71 @@ def main():
     # pprint(vars(args))
     # print()
 
-    expr_data = sc.read_h5ad(args.expr)
-    ref_data = sc.read_h5ad(args.ref)
+    if args.model_cache is not None:
+        args.model_cache = ModelCache(args.model_cache, max_bytes=args.model_cache_max_bytes)
+    del args.model_cache_max_bytes
 
-    results = annotate(expr_data, ref_data, **vars(args))
+    consensus_kwargs = {'method': args.consensus, 'weights': parse_weights(args.tool_weights),
+                        'min_confidence': args.min_confidence}
+    del args.consensus, args.tool_weights, args.min_confidence
 
-    with Path(args.output).open('wb') as file:
-        pkl.dump(results, file)
+    output_format = args.output_format
+    del args.output_format
+
+    profile_path = args.profile
+    del args.profile
+    if profile_path is not None:
+        args.profiler = Profiler()
+
+    kwargs = {key: value for key, value in vars(args).items() if value is not None}
+    expr_files, ref_file, output = kwargs.pop('expr'), kwargs.pop('ref'), kwargs.pop('output')
+    kwargs['result_type'] = kwargs.pop('convert_to')
+    kwargs['annot_tools'] = kwargs.pop('tools', None)
+
+    # Marker references are tables of cell types and their marker genes, whatever their extension. Other references
+    # and the query files are opened by `annotate`, see `read_input`
+    ref_data = read_input(ref_file, 'table') if kwargs['annot_type'] == 'marker' else ref_file
+
+    # Query files are only opened once they are annotated
+    try:
+        if len(expr_files) == 1:
+            if output_format == 'h5':
+                # Results are streamed into the output file when annotating in chunks
+                results = annotate(expr_files[0], ref_data, output=output, **kwargs)
+                write_consensus(output, results, consensus_kwargs)
+            else:
+                results = dict(annotate(expr_files[0], ref_data, **kwargs))
+                write_pickle(output, results, consensus_kwargs)
+
+        else:
+            result_type, chunk_size = kwargs.pop('result_type'), kwargs.pop('chunk_size', None)
+            profiler = kwargs.pop('profiler', None)
+            executor, max_threads, max_memory = (kwargs.pop(option, None)
+                                                 for option in ('executor', 'max_threads', 'max_memory'))
+            kwargs.pop('max_workers', None)
+
+            if executor == 'scheduled':
+                all_results = annotate_batch(expr_files, ref_data, result_type=result_type, max_threads=max_threads,
+                                             max_memory=max_memory, chunk_size=chunk_size, profiler=profiler,
+                                             **kwargs)
+            else:
+                prepared = prepare(ref_data, result_type=result_type, profiler=profiler, **kwargs)
+                all_results = annotate_many(prepared, expr_files, result_type, chunk_size, profiler=profiler)
+
+            output.mkdir(parents=True, exist_ok=True)
+            for stem, results in zip(output_stems(expr_files), all_results):
+                if output_format == 'h5':
+                    write_results(output / f'{stem}.h5', results)
+                    write_consensus(output / f'{stem}.h5', results, consensus_kwargs)
+                else:
+                    write_pickle(output / f'{stem}.pkl', results, consensus_kwargs)
+
+    except PlanningError as e:
+        # Every problem was found before any tool ran, so there is nothing to clean up
+        sys.exit(f'error: {e}')
+
+    if profile_path is not None:
+        if profile_path.suffix == '.csv':
+            args.profiler.to_csv(profile_path)
+        else:
+            args.profiler.to_json(profile_path)
@@ -0,0 +1,283 @@
+"""Consensus of the results of several annotation tools, as returned by `annotate`.
+
+Labels are handled as integer codes into one vocabulary shared by every tool, so that every consensus is computed with
+vectorized NumPy operations on a cells x tools code matrix (or a cells x cell types score matrix).
+"""
+
+from dataclasses import dataclass
+from typing import Any, List, Mapping, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+CONSENSUS_METHODS = ('majority', 'weighted', 'scores')
+
+# Number of cells whose scores `average_scores` accumulates at a time
+_BLOCK_SIZE = 2 ** 16
+
+Result = Union[pd.Series, pd.DataFrame]
+
+
+@dataclass
+class LabelMatrix:
+    """Labels of every cell by every tool, as integer codes into a shared vocabulary.
+
+    Attributes:
+        codes (np.ndarray): cells x tools matrix of codes into `categories`, -1 where a tool did not label a cell
+        categories (pd.Index): vocabulary of labels of all of the tools
+        cells (pd.Index): cell names, in the order of the rows of `codes`
+        tools (List[str]): tool names, in the order of the columns of `codes`
+    """
+
+    codes: npt.NDArray[np.signedinteger[Any]]
+    categories: pd.Index
+    cells: pd.Index
+    tools: List[str]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Returns the labels as a cells x tools `DataFrame` of categoricals sharing the same categories."""
+        return pd.DataFrame({
+            tool: pd.Categorical.from_codes(self.codes[:, i], self.categories) for i, tool in enumerate(self.tools)
+        }, index=self.cells)
+
+
+def _as_labels(result: Result) -> pd.Series:
+    """Labels of a result; scores are turned into the best scoring label of each cell, none if it has no score."""
+
+    if isinstance(result, pd.DataFrame):
+        scores = result.to_numpy(dtype=np.float32)
+        unscored = np.isnan(scores).all(axis=1)
+        best = np.nan_to_num(scores, nan=-np.inf).argmax(axis=1)
+        return pd.Series(pd.Categorical.from_codes(np.where(unscored, -1, best), result.columns.astype(str)),
+                         index=result.index)
+    return result
+
+
+def _align_cells(results: Mapping[str, Result]) -> pd.Index:
+    """Union of the cell names of every result, in order of appearance."""
+
+    indexes = [result.index for result in results.values()]
+    cells = indexes[0]
+    for index in indexes[1:]:
+        if not index.equals(cells):
+            cells = cells.union(index, sort=False)
+    return cells
+
+
+def _codes_dtype(n_categories: int) -> np.dtype[Any]:
+    return np.dtype(np.int8 if n_categories < 2 ** 7 else np.int16 if n_categories < 2 ** 15 else np.int32)
+
+
+def label_matrix(results: Mapping[str, Result]) -> LabelMatrix:
+    """Encodes the labels of several tools with a shared vocabulary.
+
+    Arguments:
+        results (Mapping): dict of tool name -> labels (`Series`) or scores (`DataFrame`, turned into their best label)
+
+    Returns:
+        `LabelMatrix` of the labels, over the union of the cells of every tool
+    """
+
+    if not results:
+        raise ValueError('`results` holds no results to combine')
+
+    labels = {tool: _as_labels(result) for tool, result in results.items()}
+    cells = _align_cells(labels)
+
+    # Categorical labels are recoded through their categories, which avoids hashing every label
+    tool_categories = [label.cat.categories if isinstance(label.dtype, pd.CategoricalDtype)
+                       else pd.Index(pd.unique(label.dropna())) for label in labels.values()]
+    categories = pd.Index(pd.unique(np.concatenate([np.asarray(c, dtype=object) for c in tool_categories])))
+
+    # Column-major, so that the per-tool columns compared by `vote` are contiguous
+    codes = np.full((len(cells), len(labels)), -1, dtype=_codes_dtype(len(categories)), order='F')
+    for i, (label, label_categories) in enumerate(zip(labels.values(), tool_categories)):
+        if isinstance(label.dtype, pd.CategoricalDtype):
+            recode = np.append(categories.get_indexer(label_categories), -1).astype(codes.dtype)
+            tool_codes = recode[label.cat.codes.to_numpy()]
+        else:
+            tool_codes = categories.get_indexer(label)
+
+        rows = slice(None) if label.index.equals(cells) else cells.get_indexer(label.index)
+        codes[rows, i] = tool_codes
+
+    return LabelMatrix(codes, categories, cells, list(labels))
+
+
+def _weights(tools: List[str], weights: Optional[Mapping[str, float]]) -> npt.NDArray[np.float32]:
+    if weights is None:
+        return np.ones(len(tools), dtype=np.float32)
+    return np.array([weights.get(tool, 0.0) for tool in tools], dtype=np.float32)
+
+
+def vote(matrix: LabelMatrix, weights: Optional[Mapping[str, float]] = None) -> pd.DataFrame:
+    """Picks the label of each cell with the largest (weighted) number of votes.
+
+    Votes are counted by comparing the columns of the code matrix pairwise, which only takes a few values per cell of
+    memory whatever the size of the vocabulary. Ties go to the label of the first tool, in the order of `matrix.tools`.
+
+    Arguments:
+        matrix (LabelMatrix): labels of every tool
+        weights (Mapping): dict of tool name -> weight of its votes, 0 for missing tools; every vote weighs 1 if `None`
+
+    Returns:
+        `DataFrame` indexed by cell with the consensus `label` and its `confidence`, the fraction of the weight of the
+        tools that labelled the cell which voted for it
+    """
+
+    tool_weights = _weights(matrix.tools, weights)
+    codes = matrix.codes
+    n_cells, n_tools = codes.shape
+
+    best_support = np.zeros(n_cells, dtype=np.float32)
+    best_codes = np.full(n_cells, -1, dtype=codes.dtype)
+    total = np.zeros(n_cells, dtype=np.float32)
+
+    # Buffers reused by every comparison, so that memory stays at a few arrays of one value per cell
+    support = np.empty(n_cells, dtype=np.float32)
+    votes = np.empty(n_cells, dtype=np.float32)
+    agree = np.empty(n_cells, dtype=bool)
+
+    # The label of each tool `t` gets the weight of the tools agreeing with it; only the best label so far is kept
+    for t in range(n_tools):
+        label = codes[:, t]
+        labelled = label >= 0
+        total += labelled * tool_weights[t]
+
+        support[:] = 0
+        for s in range(n_tools):
+            if tool_weights[s] != 0:
+                np.equal(codes[:, s], label, out=agree)
+                support += np.multiply(agree, tool_weights[s], out=votes)
+        support *= labelled
+
+        better = np.greater(support, best_support, out=agree)
+        np.copyto(best_support, support, where=better)
+        np.copyto(best_codes, label, where=better)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        confidence = np.where(best_support > 0, best_support / total, 0).astype(np.float32)
+
+    return pd.DataFrame({
+        'label': pd.Categorical.from_codes(best_codes, matrix.categories),
+        'confidence': confidence,
+    }, index=matrix.cells)
+
+
+def _label_codes(labels: pd.Series, categories: pd.Index) -> npt.NDArray[np.int32]:
+    """Codes of `labels` into `categories`, -1 for missing labels."""
+
+    labelled = labels.notna().to_numpy()
+    codes = np.full(len(labels), -1, dtype=np.int32)
+    codes[labelled] = categories.get_indexer(labels[labelled].astype(str))
+    return codes
+
+
+def average_scores(results: Mapping[str, Result], weights: Optional[Mapping[str, float]] = None) -> pd.DataFrame:
+    """Picks the label of each cell with the highest (weighted) average score over the tools.
+
+    Labels (`Series`) count as a score of 1 for their label and 0 for the others. Scores missing for a cell type or a
+    cell are left out of its average.
+
+    Arguments:
+        results (Mapping): dict of tool name -> scores (`DataFrame` of cells x cell types) or labels (`Series`)
+        weights (Mapping): dict of tool name -> weight of its scores, 0 for missing tools; all weigh 1 if `None`
+
+    Returns:
+        `DataFrame` indexed by cell with the consensus `label` and its average score as `confidence`
+    """
+
+    if not results:
+        raise ValueError('`results` holds no results to combine')
+
+    tools = list(results)
+    tool_weights = _weights(tools, weights)
+    cells = _align_cells(results)
+    categories = pd.Index(pd.unique(np.concatenate([
+        np.asarray(result.columns if isinstance(result, pd.DataFrame) else pd.unique(result.dropna()), dtype=object)
+        for result in results.values()
+    ])).astype(str))
+
+    # Rows of every tool for each cell (-1 where it did not annotate the cell), and the codes of labels
+    rows = {tool: None if result.index.equals(cells) else result.index.get_indexer(cells)
+            for tool, result in results.items()}
+    label_codes = {tool: _label_codes(result, categories) for tool, result in results.items()
+                   if not isinstance(result, pd.DataFrame)}
+    columns = {tool: categories.get_indexer(result.columns.astype(str))
+               for tool, result in results.items() if isinstance(result, pd.DataFrame)}
+
+    best_codes = np.full(len(cells), -1, dtype=np.int32)
+    confidence = np.full(len(cells), np.nan, dtype=np.float32)
+
+    # Sums are accumulated a block of cells at a time, so that memory stays at a few blocks x cell types arrays
+    for start in range(0, len(cells), _BLOCK_SIZE):
+        stop = min(start + _BLOCK_SIZE, len(cells))
+        sums = np.zeros((stop - start, len(categories)), dtype=np.float32)
+        counts = np.zeros_like(sums)
+
+        for tool, weight in zip(tools, tool_weights):
+            result, tool_rows = results[tool], rows[tool]
+            block_rows = np.arange(start, stop) if tool_rows is None else tool_rows[start:stop]
+            found = block_rows >= 0
+
+            if isinstance(result, pd.DataFrame):
+                scores = result.iloc[block_rows[found]].to_numpy(dtype=np.float32)
+                present = ~np.isnan(scores)
+                np.copyto(scores, 0, where=~present)
+                block = np.ix_(np.flatnonzero(found), columns[tool])
+                sums[block] += scores * weight
+                counts[block] += present * weight
+
+            else:
+                codes = np.full(stop - start, -1, dtype=np.int32)
+                codes[found] = label_codes[tool][block_rows[found]]
+                labelled = codes >= 0
+                sums[labelled, codes[labelled]] += weight
+                counts[labelled] += weight
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            averages = np.nan_to_num(sums / counts, nan=-np.inf)
+
+        best = averages.argmax(axis=1)
+        best_scores = averages[np.arange(stop - start), best]
+        labelled = np.isfinite(best_scores)
+        best_codes[start:stop] = np.where(labelled, best, -1)
+        confidence[start:stop] = np.where(labelled, best_scores, np.nan)
+
+    return pd.DataFrame({
+        'label': pd.Categorical.from_codes(best_codes, categories),
+        'confidence': confidence,
+    }, index=cells)
+
+
+def consensus(results: Mapping[str, Result], method: str = 'majority', weights: Optional[Mapping[str, float]] = None,
+              min_confidence: Optional[float] = None) -> pd.DataFrame:
+    """Combines the results of several annotation tools into one label per cell.
+
+    Arguments:
+        results (Mapping): results of `annotate`, dict of tool name -> labels (`Series`) or scores (`DataFrame`)
+        method (str): consensus method <majority/weighted/scores>. `'majority'` and `'weighted'` vote with the labels
+            of the tools (the best scoring label for scores), `'scores'` averages the scores of the tools
+        weights (Mapping): dict of tool name -> weight, required by `'weighted'`, optional for `'scores'`
+        min_confidence (float): if set, cells whose consensus confidence is lower are left unlabelled
+
+    Returns:
+        `DataFrame` indexed by cell with the consensus `label` (categorical) and its `confidence`
+    """
+
+    if method not in CONSENSUS_METHODS:
+        raise ValueError(f'{method} is an invalid option for `method`, expected one of {CONSENSUS_METHODS}')
+
+    if method == 'weighted' and weights is None:
+        raise ValueError('the `weighted` consensus requires `weights`')
+
+    if method == 'scores':
+        combined = average_scores(results, weights)
+    else:
+        combined = vote(label_matrix(results), weights if method == 'weighted' else None)
+
+    if min_confidence is not None:
+        combined['label'] = combined['label'].where(combined['confidence'] >= min_confidence)
+
+    return combined
@@ -0,0 +1,186 @@
+"""Reads the inputs of `annotate` from files, dispatching on their format, without loading their matrices.
+
+Expression data (h5ad, zarr) is opened lazily: `obs`, `var` and `uns` are read, while every matrix (`X`, `layers`,
+`raw.X`, `obsm`, `obsp`, ...) stays on disk until a tool needs it:
+
+    sparse matrices         backed sparse datasets, which only read the rows that are sliced (see `iter_chunks`)
+    contiguous arrays       read-only memory maps of the file, whose pages are read as they are accessed
+    other arrays            read into memory (e.g. compressed or chunked dense arrays, which cannot be mapped)
+
+Representations (see `utils.representations`) then load only the matrix they derive from, e.g. `layers['counts']` for
+a tool that trains on raw counts, so the other matrices of the file are never read.
+"""
+
+from pathlib import Path
+from typing import Any, Callable, Dict, Union
+
+import h5py
+import numpy as np
+import pandas as pd
+from anndata import AnnData
+from anndata.experimental import read_dispatched
+
+# `anndata.io` is new in anndata 0.11, which needs Python 3.10
+try:
+    from anndata.io import read_loom, sparse_dataset
+except ImportError:
+    from anndata import read_loom  # type: ignore
+    from anndata.experimental import sparse_dataset  # type: ignore
+
+INPUT_FORMATS: Dict[str, str] = {
+    '.h5ad': 'h5ad',
+    '.zarr': 'zarr',
+    '.loom': 'loom',
+    '.csv': 'table',
+    '.tsv': 'table',
+    '.txt': 'table',
+    '.pkl': 'model',
+}
+
+_FORMATS = tuple(dict.fromkeys(INPUT_FORMATS.values()))
+
+# Formats holding data, as opposed to models, which may also be named rather than given as a path
+DATA_FORMATS = ('h5ad', 'zarr', 'loom', 'table')
+
+_COMPRESSIONS = ('.gz', '.bz2', '.xz', '.zip', '.zst')
+_TABLE_SEPARATORS = {'.csv': ',', '.tsv': '\t'}
+
+_LAZY_ELEMENTS = ('/X', '/layers/', '/raw/X', '/obsm/', '/varm/', '/obsp/', '/varp/')
+
+
+def _suffix(path: Path) -> str:
+    """Suffix of `path` that determines its format, ignoring a compression suffix (e.g. `.csv` of `markers.csv.gz`)."""
+
+    suffixes = [suffix.lower() for suffix in path.suffixes]
+    if len(suffixes) > 1 and suffixes[-1] in _COMPRESSIONS:
+        return suffixes[-2]
+    return suffixes[-1] if suffixes else ''
+
+
+def input_format(path: Union[str, Path]) -> str:
+    """Returns the format of the input file `path`, one of the values of `INPUT_FORMATS`."""
+
+    suffix = _suffix(Path(path))
+    if suffix not in INPUT_FORMATS:
+        raise ValueError(f'{path} has an unsupported format, expected one of the extensions {tuple(INPUT_FORMATS)}')
+    return INPUT_FORMATS[suffix]
+
+
+def _memory_map(dataset: h5py.Dataset) -> Any:
+    """Maps a contiguous, uncompressed HDF5 dataset read-only, or returns `None` if its layout cannot be mapped."""
+
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.size == 0 or dataset.dtype.kind not in 'biuf':
+        return None
+
+    mapped = np.memmap(dataset.file.filename, mode='r', dtype=dataset.dtype, offset=offset, shape=dataset.shape)
+    # A plain array viewing the mapping, which tools and `anndata` handle like any other array
+    return mapped.view(np.ndarray)
+
+
+def _open_element(read: Callable[[Any], Any], elem_name: str, elem: Any, iospec: Any) -> Any:
+    """Opens the matrices of an h5ad/zarr store lazily, and reads all other elements."""
+
+    if not elem_name.startswith(_LAZY_ELEMENTS):
+        return read(elem)
+
+    if iospec.encoding_type in ('csr_matrix', 'csc_matrix'):
+        return sparse_dataset(elem)
+
+    if iospec.encoding_type == 'array' and isinstance(elem, h5py.Dataset):
+        mapped = _memory_map(elem)
+        if mapped is not None:
+            return mapped
+
+    return read(elem)
+
+
+def open_anndata(path: Union[str, Path]) -> AnnData:
+    """Opens an h5ad file or zarr store lazily, reading its annotations but leaving its matrices on disk.
+
+    The file stays open (read-only) as long as the returned object refers to it.
+
+    Arguments:
+        path (str/Path): path of the h5ad file, or of the directory of the zarr store
+
+    Returns:
+        `AnnData` whose matrices are backed sparse datasets, read-only memory-mapped arrays or in-memory arrays
+    """
+
+    if Path(path).is_dir():
+        import zarr
+
+        store = zarr.open(str(path), mode='r')
+    else:
+        store = h5py.File(path, 'r')
+
+    data: AnnData = read_dispatched(store, _open_element)
+    return data
+
+
+def read_table(path: Union[str, Path]) -> pd.DataFrame:
+    """Reads a CSV/TSV table, such as the cell types and marker genes of a marker reference; the separator of other
+    text files is detected."""
+
+    separator = _TABLE_SEPARATORS.get(_suffix(Path(path)))
+    if separator is None:
+        return pd.read_csv(path, sep=None, engine='python')
+    return pd.read_csv(path, sep=separator)
+
+
+def read_input(path: Union[str, Path], file_format: Union[str, None] = None) -> Union[AnnData, pd.DataFrame, str]:
+    """Reads an input of `annotate`, dispatching on its format.
+
+    Arguments:
+        path (str/Path): path of the input
+        file_format (str): format of the input, one of the values of `INPUT_FORMATS`; detected from the extension of
+            `path` if `None`
+
+    Returns:
+        - h5ad/zarr: an `AnnData` opened lazily, see `open_anndata`
+        - loom: an `AnnData` read into memory
+        - table: a `DataFrame`
+        - model: the absolute path of the model file, which the tools that use such models load themselves
+    """
+
+    path = Path(path)
+    if file_format is None:
+        file_format = input_format(path)
+    if not path.exists():
+        raise FileNotFoundError(f'no input file {path}')
+
+    if file_format in ('h5ad', 'zarr'):
+        return open_anndata(path)
+    if file_format == 'loom':
+        return read_loom(path)
+    if file_format == 'table':
+        return read_table(path)
+    if file_format == 'model':
+        return str(path.resolve())
+
+    raise ValueError(f'{file_format} is an invalid input format, expected one of {_FORMATS}')
+
+
+def open_expr(expr_data: Union[AnnData, str, Path]) -> AnnData:
+    """Reads `expr_data` with `read_input` if it is a path, otherwise returns it unchanged."""
+
+    if isinstance(expr_data, (str, Path)):
+        path, expr_data = expr_data, read_input(expr_data)
+        if not isinstance(expr_data, AnnData):
+            raise ValueError(f'{path} does not hold expression data')
+    return expr_data
+
+
+def open_ref(ref_data: Any) -> Any:
+    """Reads `ref_data` with `read_input` if it is the path of a data file.
+
+    Other strings and paths, e.g. the name of a model of a tool, are passed on as strings.
+    """
+
+    if not isinstance(ref_data, (str, Path)):
+        return ref_data
+
+    path = Path(ref_data)
+    if path.exists() or INPUT_FORMATS.get(_suffix(path)) in DATA_FORMATS:
+        return read_input(path)
+    return str(ref_data)
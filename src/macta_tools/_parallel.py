@@ -0,0 +1,173 @@
+"""Concurrent execution of annotation tools for `annotate`."""
+
+import logging
+import multiprocessing
+import tempfile
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+from anndata import AnnData
+
+from macta_tools._inputs import input_format, open_anndata
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.profiling import Profiler, StageRecord
+from macta_tools.utils.representations import RepresentationCache
+
+EXECUTORS = ('process', 'thread', 'scheduled')
+
+
+@dataclass(frozen=True)
+class OnDiskData:
+    """Placeholder for an `AnnData` object that worker processes read from an h5ad file instead of unpickling."""
+
+    path: str
+
+
+def share_data(data: Any, directory: Union[str, Path], name: str) -> Any:
+    """Makes `data` cheap to send to worker processes.
+
+    Arguments:
+        data (Any): expression or reference data passed to `annotate`
+        directory (str/Path): directory in which in-memory `AnnData` objects are written
+        name (str): file name stem used when `data` has to be written
+
+    Returns:
+        an `OnDiskData` pointing to an h5ad file if `data` is an `AnnData`, otherwise `data` itself
+    """
+
+    if not isinstance(data, AnnData):
+        return data
+
+    if data.isbacked and not data.is_view:
+        return OnDiskData(str(data.filename))
+
+    path = Path(directory) / f'{name}.h5ad'
+    data.write_h5ad(path)
+    return OnDiskData(str(path))
+
+
+def share_input(data: Any, opened: Any, directory: Union[str, Path], name: str) -> Any:
+    """Makes an input cheap to send to worker processes: h5ad and zarr files are opened again by the workers, other
+    data sets are written once to an h5ad file, see `share_data`.
+
+    Arguments:
+        data (Any): input as passed to `annotate`, e.g. the path of a file
+        opened (Any): `data` opened with `open_expr` or `open_ref`
+        directory (str/Path): directory in which in-memory `AnnData` objects are written
+        name (str): file name stem used when `opened` has to be written
+
+    Returns:
+        an `OnDiskData` pointing to the file of `data` or to an h5ad file if `opened` is an `AnnData`, otherwise
+        `opened` itself
+    """
+
+    if isinstance(data, (str, Path)) and isinstance(opened, AnnData) and input_format(data) in ('h5ad', 'zarr'):
+        return OnDiskData(str(data))
+    return share_data(opened, directory, name)
+
+
+def load_data(data: Any) -> Any:
+    """Inverse of `share_data`, opens `OnDiskData` (see `open_anndata`) and passes anything else through."""
+
+    if isinstance(data, OnDiskData):
+        return open_anndata(data.path)
+    return data
+
+
+def _run_tool_worker(tool_name: str, interface: CTAToolInterface, expr_data: Any, ref_data: Any, annot_type: str,
+                     result_type: str, chunk_size: Optional[int], profiler: Optional[Profiler], kwargs: Dict[str, Any]
+                     ) -> Tuple[Union[pd.DataFrame, pd.Series, None], List[StageRecord]]:
+    """Entry point of a worker; loads the shared data and runs a single tool with `run_tool`.
+
+    Returns:
+        the result of `run_tool`, and the records of `profiler`, which is a copy when running in another process
+    """
+
+    # Imported here to avoid a circular import with `macta_tools._annotate`
+    from macta_tools._annotate import run_tool
+
+    result = run_tool(tool_name, interface, load_data(expr_data), load_data(ref_data),
+                      annot_type, result_type, chunk_size=chunk_size, profiler=profiler, **kwargs)
+    return result, [] if profiler is None else profiler.records
+
+
+def _make_executor(executor: str, max_workers: Optional[int]) -> Executor:
+    if executor == 'process':
+        # `spawn` avoids forking a parent that may already hold torch/OpenMP thread pools
+        return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+    if executor == 'thread':
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    raise ValueError(f'{executor} is an invalid option for `executor`, expected one of {EXECUTORS}')
+
+
+def run_tools_concurrently(tool_interfaces: Dict[str, CTAToolInterface], expr_data: Any, ref_data: Any,
+                           annot_type: str, result_type: str, executor: str = 'process',
+                           max_workers: Optional[int] = None, chunk_size: Optional[int] = None,
+                           profiler: Optional[Profiler] = None, expr_source: Any = None, ref_source: Any = None,
+                           **kwargs: Any) -> Dict[str, Union[pd.Series, pd.DataFrame]]:
+    """Runs `run_tool` for every tool in `tool_interfaces` on a pool of workers.
+
+    With the `'process'` executor, inputs opened from h5ad or zarr files are opened again by every worker, while
+    in-memory `AnnData` inputs are written once to a temporary h5ad file (honoring `TMPDIR`) and every worker reads
+    them from there, so that no worker receives a pickled copy of the data.
+
+    Arguments:
+        tool_interfaces (Dict): dict of annotation tool name -> `CTAToolInterface` to run
+        expr_data (AnnData): expression data for the cells to label
+        ref_data (AnnData/DataFrame): reference/marker data for the cells to label
+        annot_type (str): annotation type to perform <marker/ref>
+        result_type (str): a string representing how the result should be structured
+        executor (str): kind of worker pool to use <process/thread>
+        max_workers (int): maximum number of workers, defaults to one per tool
+        chunk_size (int): if set, the number of cells annotated at a time by tools that support it
+        profiler (Profiler): if set, records the wall time, CPU time and peak memory of every stage of every tool
+        expr_source (Any): the path `expr_data` was opened from, if any, see `share_input`
+        ref_source (Any): the path `ref_data` was opened from, if any
+        **kwargs (Any): other key word arguments to pass to the interface functions
+
+    Returns:
+        dict of tool name -> results, for each tool that ran successfully
+    """
+
+    if max_workers is None:
+        max_workers = max(len(tool_interfaces), 1)
+
+    with tempfile.TemporaryDirectory(prefix='macta_tools_') as directory, \
+            _make_executor(executor, max_workers) as pool:
+
+        if executor == 'process':
+            expr_data = share_input(expr_source, expr_data, directory, 'expr_data')
+            ref_data = share_input(ref_source, ref_data, directory, 'ref_data')
+        else:
+            # Threads share the representations of the data, while every process computes the ones it needs
+            kwargs = {**kwargs, 'expr_representations': RepresentationCache(expr_data),
+                      'ref_representations': RepresentationCache(ref_data)}
+
+        futures: Dict[str, Future[Tuple[Union[pd.DataFrame, pd.Series, None], List[StageRecord]]]] = {
+            tool_name: pool.submit(_run_tool_worker, tool_name, interface, expr_data, ref_data, annot_type,
+                                   result_type, chunk_size, profiler, kwargs)
+            for tool_name, interface in tool_interfaces.items()
+        }
+
+        results = {}
+        for tool_name, future in futures.items():
+            try:
+                result, records = future.result()
+            except Exception as e:
+                # `run_tool` handles errors raised by the tools, so these come from the pool itself
+                logging.error(f'{tool_name}: worker encountered unknown error {e}. Skipping this run')
+                continue
+
+            # Threads share `profiler`, while worker processes measured into a copy of it
+            if profiler is not None and executor == 'process':
+                profiler.add(records)
+
+            if result is not None:
+                results[tool_name] = result
+
+    return results
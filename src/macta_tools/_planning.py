@@ -0,0 +1,139 @@
+"""Planning phase of `annotate`, which validates every selected tool against the actual inputs before any tool runs.
+
+Problems that would only surface deep into a run (a missing key word argument, obs column or layer, normalized data
+where raw counts are expected, genes that do not match the reference) are all collected up front, so that no compute
+is spent on runs that were always going to fail.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.requirements import DispatchTable
+
+ON_INVALID = ('raise', 'skip')
+
+# Number of sets of tools whose `DispatchTable` is kept, least recently used ones are evicted beyond it
+_CACHE_SIZE = 64
+_TABLES: 'OrderedDict[Tuple[Tuple[str, int], ...], DispatchTable]' = OrderedDict()
+_TABLES_LOCK = threading.Lock()
+
+
+class PlanningError(ValueError):
+    """Raised when some of the selected tools cannot run on the given inputs.
+
+    Attributes:
+        problems (Dict[str, List[str]]): dict of tool name -> problems found with its inputs
+    """
+
+    def __init__(self, problems: Dict[str, List[str]]):
+        self.problems = problems
+        lines = [f'{tool_name}: {problem}' for tool_name, tool_problems in problems.items()
+                 for problem in tool_problems]
+        super().__init__('\n'.join(['invalid inputs for the selected tools:', *lines]))
+
+
+@dataclass
+class ExecutionPlan:
+    """Tools that will run, and why the other selected tools will not.
+
+    Attributes:
+        tools (Dict[str, CTAToolInterface]): dict of tool name -> interface, for every tool that will run, in order
+        skipped (Dict[str, str]): dict of tool name -> reason, for tools whose requirements do not match the request
+        problems (Dict[str, List[str]]): dict of tool name -> problems found with its inputs
+    """
+
+    tools: Dict[str, CTAToolInterface] = field(default_factory=dict)
+    skipped: Dict[str, str] = field(default_factory=dict)
+    problems: Dict[str, List[str]] = field(default_factory=dict)
+
+
+def dispatch_table(tool_interfaces: Mapping[str, CTAToolInterface]) -> DispatchTable:
+    """`DispatchTable` of the requirements of `tool_interfaces`, compiled once per set of tools and requirements.
+
+    Tools without requirements are left out of the table.
+    """
+
+    key = tuple((tool_name, id(interface._requirements)) for tool_name, interface in tool_interfaces.items()
+                if interface._requirements is not None)
+
+    with _TABLES_LOCK:
+        if key in _TABLES:
+            _TABLES.move_to_end(key)
+            return _TABLES[key]
+
+    # The table holds on to the requirements, so their ids in `key` cannot be reused while it is cached
+    table = DispatchTable({tool_name: interface._requirements for tool_name, interface in tool_interfaces.items()
+                           if interface._requirements is not None})
+
+    with _TABLES_LOCK:
+        _TABLES[key] = table
+        while len(_TABLES) > _CACHE_SIZE:
+            _TABLES.popitem(last=False)
+    return table
+
+
+def plan(tool_interfaces: Mapping[str, CTAToolInterface], expr_data: Any, ref_data: Any, annot_type: str,
+         result_type: str, on_invalid: str = 'raise', **kwargs: Any) -> ExecutionPlan:
+    """Validates every tool of `tool_interfaces` against the inputs, before any of them runs.
+
+    Tools whose requirements do not match `annot_type`, `result_type` or the inputs are skipped, as they were never
+    meant to run. The remaining tools are validated with `CTAToolInterface.validate`.
+
+    Arguments:
+        tool_interfaces (Mapping): dict of tool name -> `CTAToolInterface` of the selected tools
+        expr_data (AnnData): expression data to annotate, possibly backed; `None` to only validate the reference
+        ref_data (AnnData/DataFrame): reference/marker data
+        annot_type (str): type of autoannotation to perform <marker/ref>
+        result_type (str): type of results to output <labels/scores>
+        on_invalid (str): what to do with tools whose inputs have problems <raise/skip>. `'raise'` raises a
+            `PlanningError` listing the problems of every tool, `'skip'` logs them and leaves the tools out
+        **kwargs (Any): key word arguments that will be passed to the interface functions
+
+    Returns:
+        `ExecutionPlan` of the tools that will run
+    """
+
+    if on_invalid not in ON_INVALID:
+        raise ValueError(f'{on_invalid} is an invalid option for `on_invalid`, expected one of {ON_INVALID}')
+
+    execution_plan = ExecutionPlan()
+    values = dict(kwargs, ref_data=ref_data, annot_type=annot_type, result_type=result_type)
+    if expr_data is not None:
+        values['expr_data'] = expr_data
+
+    # Only values that have a matching requirement are checked; other kwargs are meant for the tools themselves
+    compatible = dispatch_table(tool_interfaces).match(**values)
+
+    for tool_name, interface in tool_interfaces.items():
+        reason: Optional[str] = None
+        if interface._requirements is None:
+            reason = 'no requirements available'
+        elif tool_name not in compatible:
+            reason = 'incompatible requirements'
+
+        if reason is not None:
+            logging.warning(f'{tool_name}: {reason}. Skipping this tool.')
+            execution_plan.skipped[tool_name] = reason
+            continue
+
+        try:
+            problems = interface.validate(expr_data, ref_data, **kwargs)
+        except Exception as e:
+            problems = [f'validation encountered unknown error {e}']
+
+        if problems:
+            execution_plan.problems[tool_name] = problems
+        else:
+            execution_plan.tools[tool_name] = interface
+
+    if execution_plan.problems:
+        if on_invalid == 'raise':
+            raise PlanningError(execution_plan.problems)
+        for tool_name, problems in execution_plan.problems.items():
+            logging.error(f'{tool_name}: {"; ".join(problems)}. Skipping this tool.')
+
+    return execution_plan
@@ -0,0 +1,325 @@
+"""Chunked, columnar file format for the results of `annotate`, which can be written as they are computed and read one
+tool (or one block of cells) at a time.
+
+The results are stored in an HDF5 file laid out as follows:
+
+    /cells                      names of the cells, in order
+    /tools/<tool>               one group per tool, whose attributes hold `kind` <labels/scores> and its metadata
+    /tools/<tool>/codes         labels: integer codes into `categories` (-1 for unlabelled cells)
+    /tools/<tool>/categories    labels: vocabulary of the labels
+    /tools/<tool>/scores        scores: cells x cell types float32 matrix, chunked in blocks of cells and columns
+    /tools/<tool>/columns       scores: names of the cell types
+"""
+
+import json
+import logging
+from pathlib import Path
+from types import TracebackType
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Type, Union
+
+import h5py
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+
+FORMAT_NAME = 'macta_tools.results'
+FORMAT_VERSION = 1
+WRITE_MODES = ('w', 'a')
+
+Result = Union[pd.Series, pd.DataFrame]
+
+_STRINGS = h5py.string_dtype()
+
+
+def _string_dataset(group: h5py.Group, name: str, values: Any) -> h5py.Dataset:
+    return group.create_dataset(name, data=np.asarray([str(value) for value in values], dtype=object), dtype=_STRINGS)
+
+
+class ResultsWriter:
+    """Writes results into a results file, a tool and a block of cells at a time.
+
+    Each tool's results are appended in the order of `cells`; a tool whose results do not cover every cell when the
+    writer is closed is marked as incomplete.
+
+    Example:
+        with ResultsWriter('results.h5', expr_data.obs_names) as writer:
+            for chunk in iter_chunks(expr_data, 100_000):
+                writer.append('celltypist', labels_of(chunk))
+    """
+
+    def __init__(self, path: Union[str, Path], cells: Optional[pd.Index] = None, chunk_rows: int = 65_536,
+                 column_block: int = 64, compression: Optional[str] = None, metadata: Optional[Dict[str, Any]] = None,
+                 mode: str = 'w'):
+        """Creates (or overwrites) the results file at `path`, or opens it to add tools.
+
+        Arguments:
+            path (str/Path): path of the results file
+            cells (pd.Index): names of every cell the results will cover, in order; read from the file in mode `'a'`
+            chunk_rows (int): number of cells in each chunk of the datasets
+            column_block (int): number of score columns in each chunk of the score datasets
+            compression (str): HDF5 compression filter of the datasets, e.g. `'gzip'` or `'lzf'`
+            metadata (Dict[str, Any]): JSON-serializable metadata of the whole run, ignored in mode `'a'`
+            mode (str): `'w'` to create the file, `'a'` to add tools to an existing file
+        """
+
+        if mode not in WRITE_MODES:
+            raise ValueError(f'{mode} is an invalid option for `mode`, expected one of {WRITE_MODES}')
+
+        self.path = Path(path)
+        self._file = h5py.File(self.path, mode)
+
+        if mode == 'a':
+            cells = pd.Index(self._file['cells'].asstr()[()])
+        elif cells is None:
+            raise ValueError('`cells` are required to create a results file')
+        else:
+            self._file.attrs['format'] = FORMAT_NAME
+            self._file.attrs['version'] = FORMAT_VERSION
+            self._file.attrs['metadata'] = json.dumps(metadata or {})
+            _string_dataset(self._file, 'cells', cells)
+            self._file.create_group('tools')
+
+        self.cells = pd.Index(cells)
+        self.chunk_rows = max(min(chunk_rows, len(self.cells)), 1)
+        self.column_block = column_block
+        self.compression = compression
+        self._tools = self._file['tools']
+
+        # Number of cells written so far by each tool, and vocabularies of the label tools
+        self._offsets: Dict[str, int] = {}
+        self._categories: Dict[str, pd.Index] = {}
+
+    def __enter__(self) -> 'ResultsWriter':
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException],
+                 traceback: Optional[TracebackType]) -> None:
+        self.close()
+
+    def _create(self, tool: str, result: Result, metadata: Optional[Dict[str, Any]]) -> h5py.Group:
+        group = self._tools.create_group(tool)
+        group.attrs['metadata'] = json.dumps(metadata or {})
+        n_cells = len(self.cells)
+
+        if isinstance(result, pd.DataFrame):
+            group.attrs['kind'] = 'scores'
+            n_columns = result.shape[1]
+            group.create_dataset('scores', shape=(n_cells, n_columns), dtype=np.float32, fillvalue=np.nan,
+                                 chunks=(self.chunk_rows, max(min(self.column_block, n_columns), 1)),
+                                 compression=self.compression)
+            _string_dataset(group, 'columns', result.columns)
+        else:
+            group.attrs['kind'] = 'labels'
+            group.create_dataset('codes', shape=(n_cells,), dtype=np.int32, fillvalue=-1, chunks=(self.chunk_rows,),
+                                 compression=self.compression)
+            self._categories[tool] = pd.Index([], dtype=object)
+
+        self._offsets[tool] = 0
+        return group
+
+    def append(self, tool: str, result: Result, metadata: Optional[Dict[str, Any]] = None) -> None:
+        """Writes the results of `tool` for the next cells.
+
+        Arguments:
+            tool (str): name of the tool
+            result (Series/DataFrame): labels or scores of the cells following those already written for `tool`
+            metadata (Dict[str, Any]): JSON-serializable metadata of the tool, only stored on its first append
+        """
+
+        if tool in self._tools and tool not in self._offsets:
+            raise ValueError(f'{tool}: results were already written by an earlier writer')
+
+        group = self._tools[tool] if tool in self._tools else self._create(tool, result, metadata)
+        start = self._offsets[tool]
+        stop = start + len(result)
+
+        if not result.index.equals(self.cells[start:stop]):
+            raise ValueError(f'{tool}: results are not indexed by the next {len(result)} cells after the {start} '
+                             'already written')
+
+        if group.attrs['kind'] == 'scores':
+            if not isinstance(result, pd.DataFrame):
+                raise ValueError(f'{tool}: labels cannot be appended to scores')
+            columns = pd.Index(group['columns'].asstr()[()])
+            if not result.columns.astype(str).equals(columns):
+                result = result.set_axis(result.columns.astype(str), axis=1)
+                if not set(result.columns) <= set(columns):
+                    raise ValueError(f'{tool}: scores have columns that earlier scores did not have')
+                result = result.reindex(columns=columns)
+            # Written in blocks of rows, so that sparse (top-k) scores are never densified all at once
+            for offset in range(0, len(result), self.chunk_rows):
+                block = result.iloc[offset:offset + self.chunk_rows].to_numpy(dtype=np.float32)
+                group['scores'][start + offset:start + offset + len(block)] = block
+
+        else:
+            if isinstance(result, pd.DataFrame):
+                raise ValueError(f'{tool}: scores cannot be appended to labels')
+            group['codes'][start:stop] = self._encode(tool, result)
+
+        self._offsets[tool] = stop
+
+    def _encode(self, tool: str, labels: pd.Series) -> npt.NDArray[np.int32]:
+        """Codes of `labels` into the vocabulary of `tool`, which is extended with their new labels."""
+
+        if isinstance(labels.dtype, pd.CategoricalDtype):
+            label_categories, label_codes = labels.cat.categories.astype(str), labels.cat.codes.to_numpy()
+        else:
+            label_codes, label_categories = pd.factorize(labels)
+            label_categories = pd.Index(label_categories).astype(str)
+
+        categories = self._categories[tool]
+        new = label_categories[categories.get_indexer(label_categories) < 0]
+        if len(new):
+            categories = self._categories[tool] = categories.append(pd.Index(new.unique(), dtype=object))
+
+        recode = np.append(categories.get_indexer(label_categories), -1).astype(np.int32)
+        codes: npt.NDArray[np.int32] = recode[label_codes]
+        return codes
+
+    def write(self, results: Mapping[str, Result], metadata: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        """Writes the results of every tool for all cells at once, aligning them with `cells`.
+
+        Arguments:
+            results (Mapping): dict of tool name -> labels or scores, as returned by `annotate`
+            metadata (Dict): dict of tool name -> JSON-serializable metadata of the tool
+        """
+
+        for tool, result in results.items():
+            if not result.index.equals(self.cells):
+                result = result.reindex(self.cells)
+            self.append(tool, result, (metadata or {}).get(tool))
+
+    def discard(self, tool: str) -> None:
+        """Removes everything written for `tool`, e.g. after it failed."""
+
+        if tool in self._tools:
+            del self._tools[tool]
+        self._offsets.pop(tool, None)
+        self._categories.pop(tool, None)
+
+    def close(self) -> None:
+        """Writes the vocabularies and completeness of the tools, and closes the file."""
+
+        if not self._file:
+            return
+
+        for tool, offset in self._offsets.items():
+            group = self._tools[tool]
+            group.attrs['complete'] = offset == len(self.cells)
+            if tool in self._categories:
+                _string_dataset(group, 'categories', self._categories[tool])
+            if offset != len(self.cells):
+                logging.warning(f'{tool}: results only cover {offset} of {len(self.cells)} cells')
+
+        self._file.close()
+
+
+class ResultsReader(Mapping[str, Result]):
+    """Reads a results file lazily: each tool's results (or a block of their cells) are only read when requested.
+
+    As a mapping of tool name -> labels (`Series` of categoricals) or scores (`DataFrame`), it can be used in place of
+    the results returned by `annotate`.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Opens the results file at `path`, checking its format."""
+
+        self.path = Path(path)
+        with h5py.File(self.path, 'r') as file:
+            if file.attrs.get('format') != FORMAT_NAME:
+                raise ValueError(f'{path} is not a macta_tools results file')
+            self.metadata: Dict[str, Any] = json.loads(file.attrs['metadata'])
+            self._tools: List[str] = list(file['tools'])
+        self._cells: Optional[pd.Index] = None
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({str(self.path)!r}, tools={self._tools})'
+
+    @property
+    def cells(self) -> pd.Index:
+        """Names of the cells."""
+        if self._cells is None:
+            with h5py.File(self.path, 'r') as file:
+                self._cells = pd.Index(file['cells'].asstr()[()])
+        return self._cells
+
+    def __getitem__(self, tool: str) -> Result:
+        if tool not in self._tools:
+            raise KeyError(tool)
+        return self.read(tool)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._tools)
+
+    def __len__(self) -> int:
+        return len(self._tools)
+
+    def tool_metadata(self, tool: str) -> Dict[str, Any]:
+        """Metadata of `tool`, along with its `kind` <labels/scores> and whether its results are `complete`."""
+
+        with h5py.File(self.path, 'r') as file:
+            attrs = file['tools'][tool].attrs
+            return {**json.loads(attrs['metadata']), 'kind': attrs['kind'],
+                    'complete': bool(attrs.get('complete', False))}
+
+    def read(self, tool: str, start: Optional[int] = None, stop: Optional[int] = None,
+             columns: Optional[List[str]] = None) -> Result:
+        """Reads the results of `tool` for a block of consecutive cells.
+
+        Arguments:
+            tool (str): name of the tool
+            start (int): first cell to read, from the first cell if `None`
+            stop (int): cell after the last cell to read, until the last cell if `None`
+            columns (List[str]): for scores, the cell types to read, all if `None`
+
+        Returns:
+            labels as a `Series` of categoricals, or scores as a `DataFrame` of float32, indexed by cell
+        """
+
+        rows = slice(start, stop)
+        index = self.cells[rows]
+
+        with h5py.File(self.path, 'r') as file:
+            group = file['tools'][tool]
+
+            if group.attrs['kind'] == 'labels':
+                categories = group['categories'].asstr()[()]
+                return pd.Series(pd.Categorical.from_codes(group['codes'][rows], categories), index=index, name=tool)
+
+            all_columns = pd.Index(group['columns'].asstr()[()])
+            if columns is None:
+                return pd.DataFrame(group['scores'][rows], index=index, columns=all_columns)
+
+            # HDF5 reads only the chunks holding the requested columns, which must be given in increasing order
+            positions = all_columns.get_indexer(columns)
+            if (positions < 0).any():
+                raise KeyError(f'{tool}: unknown columns {list(np.asarray(columns)[positions < 0])}')
+            order = np.argsort(positions)
+            values = np.empty((len(index), len(positions)), dtype=np.float32)
+            values[:, order] = group['scores'][rows, np.sort(positions)]
+            return pd.DataFrame(values, index=index, columns=pd.Index(columns))
+
+
+def write_results(path: Union[str, Path], results: Mapping[str, Result],
+                  metadata: Optional[Dict[str, Dict[str, Any]]] = None, **kwargs: Any) -> None:
+    """Writes the results of `annotate` into a results file, over the union of the cells of every tool.
+
+    Arguments:
+        path (str/Path): path of the results file
+        results (Mapping): dict of tool name -> labels or scores
+        metadata (Dict): dict of tool name -> JSON-serializable metadata of the tool
+        **kwargs (Any): other key word arguments passed to `ResultsWriter`
+    """
+
+    cells = pd.Index([])
+    for result in results.values():
+        cells = result.index if not len(cells) else cells if result.index.equals(cells) else \
+            cells.union(result.index, sort=False)
+
+    with ResultsWriter(path, cells, **kwargs) as writer:
+        writer.write(results, metadata)
+
+
+def read_results(path: Union[str, Path]) -> ResultsReader:
+    """Opens the results file at `path`, see `ResultsReader`."""
+    return ResultsReader(path)
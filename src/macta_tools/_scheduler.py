@@ -0,0 +1,140 @@
+"""Resource-aware placement of tool runs on a node, for `annotate_batch`.
+
+Every task declares the CPU threads and memory it needs (see `CTAToolInterface.estimate_resources`). The scheduler
+starts tasks, in order, as soon as their resources fit next to the running ones, and later, smaller tasks fill the
+room that earlier, larger ones leave. Every task runs in its own spawned process whose native libraries are limited to
+the threads it declared (see `limit_threads`), so concurrent tasks never oversubscribe the cores.
+"""
+
+import logging
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+from macta_tools.utils.resources import ResourceEstimate, limit_threads, node_capacity
+
+# Memory of a worker process besides its task: the interpreter, `numpy`, `scanpy`, `anndata` and the tool's imports
+PROCESS_MEMORY = 300 * 1024 ** 2
+
+
+@dataclass(frozen=True)
+class Task:
+    """A function to run in a worker process, with the resources it needs.
+
+    Attributes:
+        key (Hashable): unique key of the task, which its future is returned under
+        function (Callable): picklable function to run, e.g. defined at the top level of a module
+        args (Tuple): picklable arguments of `function`
+        resources (ResourceEstimate): threads and memory that `function` needs at its peak
+        after (Hashable): key of a task that must complete (successfully or not) before this one starts, if any
+    """
+
+    key: Hashable
+    function: Callable[..., Any]
+    args: Tuple[Any, ...]
+    resources: ResourceEstimate
+    after: Optional[Hashable] = None
+
+
+class ResourceScheduler:
+    """Runs tasks concurrently without exceeding a budget of threads and memory.
+
+    Arguments:
+        max_threads (int): threads that running tasks may use together, the number of usable cores by default
+        max_memory (int): memory in bytes that running tasks may use together, including `PROCESS_MEMORY` per task,
+            a fraction of the available memory by default (see `node_capacity`)
+        process_memory (int): memory of a worker process besides its task
+
+    Attributes:
+        max_threads (int): budget of threads
+        max_memory (int): budget of memory in bytes, `None` if unlimited
+        peak_threads (int): most threads used at once by the last `run`
+        peak_memory (int): most memory reserved at once by the last `run`
+    """
+
+    def __init__(self, max_threads: Optional[int] = None, max_memory: Optional[int] = None,
+                 process_memory: int = PROCESS_MEMORY):
+        if max_threads is not None and max_threads < 1:
+            raise ValueError(f'`max_threads` must be positive, got {max_threads}')
+
+        self.max_threads, self.max_memory = node_capacity(max_threads, max_memory)
+        self.process_memory = process_memory
+        self.peak_threads = 0
+        self.peak_memory = 0
+
+    def reserved(self, task: Task) -> Tuple[int, int]:
+        """Threads and memory reserved for `task`: its threads are capped by `max_threads`, so that a task asking
+        for more than the node has still runs."""
+        return min(task.resources.threads, self.max_threads), task.resources.memory + self.process_memory
+
+    def run(self, tasks: Iterable[Task]) -> Dict[Hashable, 'Future[Any]']:
+        """Runs all `tasks`, starting them as soon as their dependency completed and their resources fit.
+
+        A task whose memory exceeds `max_memory` on its own runs once no other task is running, with a warning.
+
+        Arguments:
+            tasks (Iterable[Task]): tasks to run, started in this order when several fit
+
+        Returns:
+            dict of task key -> completed future of the result of its function
+        """
+
+        pending = list(tasks)
+        keys = [task.key for task in pending]
+        if len(set(keys)) < len(keys):
+            raise ValueError('tasks must have unique keys')
+        unknown = {task.after for task in pending if task.after is not None} - set(keys)
+        if unknown:
+            raise ValueError(f'tasks depend on unknown tasks {sorted(map(str, unknown))}')
+
+        futures: Dict[Hashable, Future[Any]] = {}
+        running: Dict[Future[Any], Tuple[Task, ProcessPoolExecutor]] = {}
+        completed: Set[Hashable] = set()
+        threads = memory = 0
+        self.peak_threads = self.peak_memory = 0
+
+        while pending or running:
+            for task in list(pending):
+                if task.after is not None and task.after not in completed:
+                    continue
+
+                task_threads, task_memory = self.reserved(task)
+                fits = threads + task_threads <= self.max_threads and \
+                    (self.max_memory is None or memory + task_memory <= self.max_memory)
+                if not fits and running:
+                    continue
+                if not fits:
+                    logging.warning(f'{task.key}: estimated memory of {task_memory / 1024 ** 3:.1f} GiB exceeds the '
+                                    f'budget of {(self.max_memory or 0) / 1024 ** 3:.1f} GiB. Running it alone.')
+
+                pending.remove(task)
+                future, executor = self._start(task, task_threads)
+                futures[task.key] = future
+                running[future] = task, executor
+                threads, memory = threads + task_threads, memory + task_memory
+                self.peak_threads, self.peak_memory = max(self.peak_threads, threads), max(self.peak_memory, memory)
+
+            if not running:
+                raise ValueError(f'tasks {sorted(str(task.key) for task in pending)} depend on each other')
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                task, executor = running.pop(future)
+                executor.shutdown()
+                completed.add(task.key)
+
+                task_threads, task_memory = self.reserved(task)
+                threads, memory = threads - task_threads, memory - task_memory
+
+        return {key: futures[key] for key in keys}
+
+    @staticmethod
+    def _start(task: Task, threads: int) -> Tuple['Future[Any]', ProcessPoolExecutor]:
+        """Runs `task` in a fresh process limited to `threads` threads; the process exits with the task, which
+        returns its memory to the node."""
+
+        # `spawn` avoids forking a parent that may already hold torch/OpenMP thread pools
+        executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=limit_threads, initargs=(threads,))
+        return executor.submit(task.function, *task.args), executor
@@ -0,0 +1,593 @@
+"""Long-running annotation service, which prepares the references of the selected tools once and keeps them in memory
+to annotate query data sets as they arrive, over HTTP on a TCP port or a Unix socket.
+
+Requests are queued and annotated by a single worker, so prepared models are never used concurrently. The worker
+drains the queue in batches: pending requests with the same options are annotated together by one
+`annotate_many` call. Queries are not concatenated, as tools such as scANVI's query training and celltypist's majority
+voting depend on the whole query.
+
+Endpoints:
+
+    GET  /health            status, tools and number of pending and completed requests
+    POST /annotate          JSON body `{"expr": "query.h5ad", "result_type": "labels", "chunk_size": null,
+                            "output": null, "kwargs": {}}`, or an uploaded h5ad file as the body, with the options as
+                            URL parameters (`/annotate?result_type=scores`)
+
+Results are returned as JSON, one object per tool in pandas' `split` orientation (`index`, `data` and, for scores,
+`columns`), with unlabelled cells and unreported scores as `null`; or written into the results file `output` (see
+`write_results`) if it is set, in which case only its path is returned.
+
+Clients can only make the server read and write files in the directories it is given (see `make_server`): `expr` is a
+path in its data directory, and `output` a path in its output directory. Either option is refused if the server has no
+such directory, and queries can then only be uploaded.
+"""
+
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, Optional, Tuple, Union
+from urllib.parse import parse_qsl, urlsplit
+
+from anndata import AnnData
+
+from macta_tools._annotate import PreparedReference, Result, annotate_many, prepare
+from macta_tools._inputs import read_input
+from macta_tools._planning import PlanningError
+from macta_tools._results import write_results
+from macta_tools.tools import TRAINING_PROFILES
+from macta_tools.utils.model_cache import ModelCache
+from macta_tools.utils.scores import SCORE_DTYPES
+
+RESULT_TYPES = ('labels', 'scores')
+
+# Content types of request bodies that are uploaded h5ad files rather than JSON
+_UPLOAD_TYPES = ('application/x-hdf5', 'application/octet-stream')
+
+
+@dataclass
+class _Request:
+    expr_data: Union[AnnData, str, Path]
+    result_type: str
+    chunk_size: Optional[int]
+    kwargs: Dict[str, Any]
+    future: 'Future[Dict[str, Result]]' = field(default_factory=Future)
+
+    @property
+    def options(self) -> Tuple[str, Optional[int], str]:
+        """Options of the request, which requests annotated in the same `annotate_many` call share."""
+        return self.result_type, self.chunk_size, json.dumps(self.kwargs, sort_keys=True, default=repr)
+
+
+class AnnotationService:
+    """Annotates query data sets against references prepared once, on a worker thread fed by a queue.
+
+    Attributes:
+        prepared (Dict[str, PreparedReference]): dict of tool name -> reference prepared by `prepare`
+        result_type (str): type of results of requests that do not set it <labels/scores>
+        max_batch (int): maximum number of requests annotated in one batch
+        batch_wait (float): seconds the worker waits for more requests once one arrives, to batch them
+        n_completed (int): number of requests annotated so far, successfully or not
+        n_batches (int): number of batches annotated so far
+    """
+
+    def __init__(self, prepared: Dict[str, PreparedReference], result_type: str = 'labels', max_batch: int = 8,
+                 batch_wait: float = 0.05):
+        if not prepared:
+            raise ValueError('no prepared reference to annotate queries against')
+        if result_type not in RESULT_TYPES:
+            raise ValueError(f'{result_type} is an invalid option for `result_type`, expected one of {RESULT_TYPES}')
+        if max_batch < 1:
+            raise ValueError(f'`max_batch` must be at least 1, got {max_batch}')
+
+        self.prepared = prepared
+        self.result_type = result_type
+        self.max_batch = max_batch
+        self.batch_wait = batch_wait
+        self.n_completed = 0
+        self.n_batches = 0
+
+        self._queue: 'queue.Queue[Optional[_Request]]' = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._running = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_reference(cls, ref_data: Any, annot_type: str, result_type: str = 'labels', max_batch: int = 8,
+                       batch_wait: float = 0.05, **kwargs: Any) -> 'AnnotationService':
+        """Prepares `ref_data` for every selected tool, see `prepare`, and returns a service annotating against it.
+
+        Arguments:
+            ref_data (AnnData/DataFrame/str/Path): reference/marker data, or the path to its file
+            annot_type (str): type of autoannotation to perform <marker/ref>
+            result_type (str): type of results of requests that do not set it <labels/scores>
+            max_batch (int): maximum number of requests annotated in one batch
+            batch_wait (float): seconds the worker waits for more requests once one arrives, to batch them
+            **kwargs (Any): other key word arguments of `prepare`, e.g. `annot_tools` or `model_cache`
+        """
+
+        prepared = prepare(ref_data, annot_type, result_type, **kwargs)
+        return cls(prepared, result_type, max_batch, batch_wait)
+
+    @property
+    def tools(self) -> List[str]:
+        return list(self.prepared)
+
+    @property
+    def n_pending(self) -> int:
+        """Number of requests waiting in the queue."""
+        return self._queue.qsize()
+
+    def start(self) -> 'AnnotationService':
+        """Starts annotating the queued requests on a worker thread, if the service is not running."""
+
+        with self._lock:
+            if not self._running:
+                self._running = True
+                self._worker = threading.Thread(target=self._work, name='macta-annotation-service', daemon=True)
+                self._worker.start()
+        return self
+
+    def run(self) -> None:
+        """Annotates the queued requests on the calling thread until `close` is called from another thread.
+
+        Some thread pools must be started from the main thread for the interpreter to exit, e.g. `numba`'s, which
+        celltypist's majority voting starts, so long-running processes should run the service on their main thread.
+        """
+
+        with self._lock:
+            if self._running:
+                raise RuntimeError('the service is already running')
+            self._running = True
+        self._work()
+
+    def close(self) -> None:
+        """Stops the service once the requests queued so far are annotated."""
+
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+            self._queue.put(None)
+            worker, self._worker = self._worker, None
+
+        if worker is not None:
+            worker.join()
+
+    def __enter__(self) -> 'AnnotationService':
+        return self.start()
+
+    def __exit__(self, *_: Any) -> None:
+        self.close()
+
+    def submit(self, expr_data: Union[AnnData, str, Path], result_type: Optional[str] = None,
+               chunk_size: Optional[int] = None, **kwargs: Any) -> 'Future[Dict[str, Result]]':
+        """Queues `expr_data` for annotation, once the service is started (see `start` and `run`).
+
+        Arguments:
+            expr_data (AnnData/str/Path): query data set, or the path to its file, opened by the worker (see
+                `read_input`)
+            result_type (str): type of results to output <labels/scores>, defaults to `self.result_type`
+            chunk_size (int): if set, tools that support it annotate the query this many cells at a time
+            **kwargs (Any): key word arguments that override the ones the references were prepared with
+
+        Returns:
+            `Future` of the dict of tool name -> results, or of the exception raised annotating the query
+        """
+
+        result_type = self.result_type if result_type is None else result_type
+        if result_type not in RESULT_TYPES:
+            raise ValueError(f'{result_type} is an invalid option for `result_type`, expected one of {RESULT_TYPES}')
+
+        request = _Request(expr_data, result_type, chunk_size, kwargs)
+        self._queue.put(request)
+        return request.future
+
+    def annotate(self, expr_data: Union[AnnData, str, Path], result_type: Optional[str] = None,
+                 chunk_size: Optional[int] = None, **kwargs: Any) -> Dict[str, Result]:
+        """Annotates `expr_data`, waiting for its turn in the queue, see `submit`."""
+
+        if not self._running:
+            raise RuntimeError('the service is not running, see `start`')
+        return self.submit(expr_data, result_type, chunk_size, **kwargs).result()
+
+    def _next_batch(self) -> Tuple[List[_Request], bool]:
+        """Waits for a request, then collects the ones that arrive within `batch_wait`; returns them and whether the
+        service was closed."""
+
+        first = self._queue.get()
+        if first is None:
+            return [], True
+
+        batch, deadline = [first], time.monotonic() + self.batch_wait
+        while len(batch) < self.max_batch:
+            try:
+                request = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                return batch, True
+            batch.append(request)
+        return batch, False
+
+    def _work(self) -> None:
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+            if not batch:
+                continue
+
+            groups: Dict[Tuple[str, Optional[int], str], List[_Request]] = {}
+            for request in batch:
+                groups.setdefault(request.options, []).append(request)
+            for requests in groups.values():
+                self._annotate(requests)
+
+            self.n_batches += 1
+            self.n_completed += len(batch)
+
+    def _annotate(self, requests: List[_Request]) -> None:
+        """Annotates requests that share their options, attributing any failure to the request that raised it."""
+
+        requests = [request for request in requests if request.future.set_running_or_notify_cancel()]
+        if not requests:
+            return
+
+        first = requests[0]
+        try:
+            all_results = annotate_many(self.prepared, [request.expr_data for request in requests], first.result_type,
+                                        first.chunk_size, **first.kwargs)
+        except Exception as e:
+            if len(requests) == 1:
+                first.future.set_exception(e)
+                return
+            # Annotates them one at a time, to find the one that failed
+            for request in requests:
+                try:
+                    request.future.set_result(annotate_many(self.prepared, [request.expr_data], request.result_type,
+                                                            request.chunk_size, **request.kwargs)[0])
+                except Exception as e:
+                    request.future.set_exception(e)
+            return
+
+        for request, results in zip(requests, all_results):
+            request.future.set_result(results)
+
+
+def results_to_json(results: Mapping[str, Result]) -> str:
+    """Serializes the results of the tools into a JSON object of tool name -> result in pandas' `split` orientation,
+    with missing values as `null`."""
+
+    tools = [f'{json.dumps(tool_name)}: {result.to_json(orient="split")}' for tool_name, result in results.items()]
+    return '{' + ', '.join(tools) + '}'
+
+
+class _RequestError(ValueError):
+    """Invalid request, answered with status 400."""
+
+
+def _confine(path: Any, directory: Optional[Path], option: str) -> Path:
+    """Resolves the `path` that a client gave as `option` in `directory`, which it must not leave."""
+
+    if directory is None:
+        raise _RequestError(f'the server does not accept "{option}" paths')
+    if not isinstance(path, str):
+        raise _RequestError(f'"{option}" must be a path')
+
+    resolved = (directory / path).resolve()
+    if resolved != directory and directory not in resolved.parents:
+        raise _RequestError(f'"{option}" must be a path in the directory of the server')
+    return resolved
+
+
+def _chunk_size(value: Any) -> Optional[int]:
+    """Parses the `chunk_size` option of a request, given in its JSON body or as a URL parameter."""
+
+    if value is None:
+        return None
+    if isinstance(value, str) and value.isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+        raise _RequestError('"chunk_size" must be a positive integer')
+    return value
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: Any
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def service(self) -> AnnotationService:
+        service: AnnotationService = self.server.service
+        return service
+
+    def address_string(self) -> str:
+        # Clients of Unix sockets have no address
+        return str(self.client_address[0]) if isinstance(self.client_address, tuple) else 'unix'
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.info(f'{self.address_string()} {format % args}')
+
+    def _reply(self, status: int, body: str) -> None:
+        encoded = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(encoded)))
+        self.end_headers()
+        self.wfile.write(encoded)
+
+    def _error(self, status: int, message: str) -> None:
+        self._reply(status, json.dumps({'error': message}))
+
+    def do_GET(self) -> None:
+        if urlsplit(self.path).path != '/health':
+            return self._error(404, f'no endpoint {self.path}')
+
+        service = self.service
+        self._reply(200, json.dumps({'status': 'ok', 'tools': service.tools, 'pending': service.n_pending,
+                                     'completed': service.n_completed, 'batches': service.n_batches}))
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != '/annotate':
+            return self._error(404, f'no endpoint {self.path}')
+
+        upload = None
+        try:
+            body = self.rfile.read(self._content_length())
+            if self.headers.get_content_type() in _UPLOAD_TYPES:
+                options: Dict[str, Any] = dict(parse_qsl(url.query))
+                upload = self._save_upload(body)
+            else:
+                options = json.loads(body or b'{}')
+            reply = self._annotate(options, upload)
+        except (_RequestError, FileNotFoundError, PlanningError, json.JSONDecodeError) as e:
+            return self._error(400, str(e))
+        except Exception as e:
+            logging.exception('annotation request failed')
+            return self._error(500, f'{type(e).__name__}: {e}')
+        finally:
+            if upload is not None:
+                upload.unlink()
+
+        self._reply(200, reply)
+
+    def _content_length(self) -> int:
+        length = self.headers.get('Content-Length', '0')
+        if not length.isdigit():
+            raise _RequestError(f'{length!r} is an invalid Content-Length')
+        return int(length)
+
+    def _save_upload(self, body: bytes) -> Path:
+        if not body:
+            raise _RequestError('the uploaded file is empty')
+        descriptor, path = tempfile.mkstemp(suffix='.h5ad', dir=self.server.upload_dir)
+        with os.fdopen(descriptor, 'wb') as file:
+            file.write(body)
+        return Path(path)
+
+    def _annotate(self, options: Dict[str, Any], upload: Optional[Path] = None) -> str:
+        if not isinstance(options, dict) or (upload is None and 'expr' not in options):
+            raise _RequestError('the request must give the path of the query as "expr", or upload it')
+
+        unknown = set(options) - {'expr', 'result_type', 'chunk_size', 'output', 'kwargs'}
+        if unknown:
+            raise _RequestError(f'unknown options {sorted(unknown)}')
+
+        expr = upload if upload is not None else _confine(options['expr'], self.server.data_dir, 'expr')
+        output = options.get('output')
+        if output is not None:
+            output = _confine(output, self.server.output_dir, 'output')
+        chunk_size = _chunk_size(options.get('chunk_size'))
+        kwargs = options.get('kwargs') or {}
+        if not isinstance(kwargs, dict):
+            raise _RequestError('"kwargs" must be an object')
+
+        start = time.perf_counter()
+        try:
+            future = self.service.submit(expr, options.get('result_type'), chunk_size, **kwargs)
+            results = future.result()
+        except ValueError as e:
+            raise _RequestError(str(e)) from e
+        seconds = time.perf_counter() - start
+
+        if output is not None:
+            write_results(output, results)
+            return json.dumps({'output': str(output), 'tools': list(results), 'seconds': seconds})
+        return f'{{"results": {results_to_json(results)}, "seconds": {json.dumps(seconds)}}}'
+
+
+class _ServiceServer:
+    """Server of the requests of an `AnnotationService`, which is closed along with it."""
+
+    service: AnnotationService
+    upload_dir: str
+    data_dir: Optional[Path]
+    output_dir: Optional[Path]
+
+    def attach(self, service: AnnotationService, data_dir: Union[str, Path, None] = None,
+               output_dir: Union[str, Path, None] = None) -> None:
+        self.service = service
+        self.data_dir = None if data_dir is None else Path(data_dir).resolve()
+        self.output_dir = None if output_dir is None else Path(output_dir).resolve()
+        self._uploads = tempfile.TemporaryDirectory(prefix='macta-uploads-')
+        self.upload_dir = self._uploads.name
+
+    def server_close(self) -> None:
+        super().server_close()  # type: ignore[misc]
+        self.service.close()
+        self._uploads.cleanup()
+
+
+class _HTTPServer(_ServiceServer, ThreadingHTTPServer):
+    pass
+
+
+class _UnixHTTPServer(_ServiceServer, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_close(self) -> None:
+        super().server_close()
+        Path(str(self.server_address)).unlink(missing_ok=True)
+
+
+def make_server(service: AnnotationService, host: str = '127.0.0.1', port: int = 8000,
+                socket_path: Union[str, Path, None] = None, data_dir: Union[str, Path, None] = None,
+                output_dir: Union[str, Path, None] = None) -> socketserver.BaseServer:
+    """Makes an HTTP server of the requests of `service`, which must be started (see `AnnotationService.start`).
+
+    Arguments:
+        service (AnnotationService): service that annotates the queries
+        host (str): host the server listens on
+        port (int): port the server listens on, any free port if 0 (see `server.server_address`)
+        socket_path (str/Path): if set, the server listens on this Unix socket instead of `host` and `port`
+        data_dir (str/Path): directory of the queries that clients may give as `expr`; queries can only be uploaded
+            if it is `None`
+        output_dir (str/Path): directory of the results files that clients may give as `output`, which is refused
+            if it is `None`
+
+    Returns:
+        the server, whose `serve_forever` answers requests until `shutdown` is called; `server_close` also closes
+        `service` and removes the uploaded files and the socket
+    """
+
+    server: Union[_HTTPServer, _UnixHTTPServer]
+    if socket_path is not None:
+        Path(socket_path).unlink(missing_ok=True)
+        server = _UnixHTTPServer(str(socket_path), _Handler)
+    else:
+        server = _HTTPServer((host, port), _Handler)
+
+    server.attach(service, data_dir, output_dir)
+    return server
+
+
+def parse_args() -> Namespace:
+
+    parser = ArgumentParser('MACTA-tools-serve', description='Annotate queries against references kept in memory')
+
+    parser.add_argument(
+        'ref',
+        type=Path,
+        help='reference data set (h5ad, zarr or loom), celltypist model (a .pkl file or the name of a model), or '
+             'CSV/TSV table of cell types and their marker genes for marker annotation',
+    )
+
+    parser.add_argument(
+        'annot_type',
+        choices=['marker', 'ref'],
+    )
+
+    parser.add_argument(
+        '-t', '--tools',
+        nargs='+',
+    )
+
+    parser.add_argument(
+        '--result_type',
+        choices=RESULT_TYPES,
+        default='labels',
+        help='type of results of the requests that do not set it',
+    )
+
+    # Server options
+
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+
+    parser.add_argument(
+        '--socket',
+        type=Path,
+        help='listen on this Unix socket instead of --host and --port',
+    )
+
+    parser.add_argument(
+        '--data_dir',
+        type=Path,
+        help='directory of the query files that requests may give as "expr", otherwise queries must be uploaded',
+    )
+
+    parser.add_argument(
+        '--output_dir',
+        type=Path,
+        help='directory in which requests may write results files, as "output"',
+    )
+
+    parser.add_argument(
+        '--max_batch',
+        type=int,
+        default=8,
+        help='maximum number of queued requests annotated together',
+    )
+
+    parser.add_argument(
+        '--batch_wait',
+        type=float,
+        default=0.05,
+        help='seconds to wait for more requests once one arrives, to batch them',
+    )
+
+    # Preparation options and tool kwargs, as in `macta-tools`
+
+    parser.add_argument('--on_invalid', choices=['raise', 'skip'], default='raise')
+    parser.add_argument('--model_cache', help='directory in which trained reference models are cached')
+    parser.add_argument('--model_store', type=Path, help='directory of the celltypist models')
+    parser.add_argument('--offline', action='store_true', default=None, help='never download models')
+    parser.add_argument('--batch_col')
+    parser.add_argument('--cell_type_col')
+    parser.add_argument('--training_profile', choices=list(TRAINING_PROFILES))
+    parser.add_argument('--score_dtype', choices=SCORE_DTYPES)
+    parser.add_argument('--score_top_k', type=int)
+
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    if args.model_cache is not None:
+        args.model_cache = ModelCache(args.model_cache)
+
+    server_options = {option: vars(args).pop(option)
+                      for option in ('host', 'port', 'socket', 'data_dir', 'output_dir', 'max_batch', 'batch_wait',
+                                     'result_type')}
+    kwargs = {key: value for key, value in vars(args).items() if value is not None}
+    ref_file, kwargs['annot_tools'] = kwargs.pop('ref'), kwargs.pop('tools', None)
+
+    # Marker references are tables of cell types and their marker genes, whatever their extension
+    ref_data = read_input(ref_file, 'table') if kwargs['annot_type'] == 'marker' else ref_file
+
+    try:
+        service = AnnotationService.from_reference(ref_data, result_type=server_options['result_type'],
+                                                   max_batch=server_options['max_batch'],
+                                                   batch_wait=server_options['batch_wait'], **kwargs)
+    except PlanningError as e:
+        sys.exit(f'error: {e}')
+
+    server = make_server(service, server_options['host'], server_options['port'], server_options['socket'],
+                         server_options['data_dir'], server_options['output_dir'])
+    where = server_options['socket'] or f'http://{server_options["host"]}:{server_options["port"]}'
+    logging.info(f'Annotating with {", ".join(service.tools)} on {where}')
+    # HTTP requests are answered on other threads, while the service annotates on the main thread (see `run`)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    # Service managers stop the service with SIGTERM; `close` takes a lock, so it does not run in the handler
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=service.close).start())
+    try:
+        service.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
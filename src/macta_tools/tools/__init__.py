@@ -1,25 +1,32 @@
-import sys
-import warnings
-from contextlib import suppress
-from typing import Dict
-
-from numba.core.errors import NumbaDeprecationWarning
+from typing import Any, Dict
 
+from macta_tools.tools._celltypist_models import CelltypistModelStore
 from macta_tools.tools._cta_tool_interface import CTAToolInterface
+from macta_tools.tools._registry import ENTRY_POINT_GROUP, ToolRegistry, ToolSpec, discover_plugins
+from macta_tools.tools._training import TRAINING_PROFILES, PhaseBudget, TrainingProfile, resolve_profile
+
+# Backends are only imported when their interface is first used, see `ToolRegistry`
+SPECS = [
+    ToolSpec('celltypist', 'macta_tools.tools._celltypist_interface:CelltypistInterface', requires=('celltypist',),
+             annot_types=('ref',), result_types=('labels', 'scores'), supports_chunks=True),
+    ToolSpec('marker', 'macta_tools.tools._marker_interface:MarkerInterface',
+             annot_types=('marker',), result_types=('labels', 'scores'), supports_chunks=True),
+    ToolSpec('scanvi', 'macta_tools.tools._scanvi:ScanviInterface', requires=('scarches',),
+             annot_types=('ref',), result_types=('labels', 'scores')),
+]
+
+# Third-party tools register themselves in the `ENTRY_POINT_GROUP` entry point group
+AVAILABLE = ToolRegistry(SPECS, group=ENTRY_POINT_GROUP)
 
-AVAILABLE: Dict[str, CTAToolInterface] = {}
-__all__ = ['AVAILABLE', 'CTAToolInterface']
+# Interface classes exported by this module, imported on first access
+_INTERFACE_CLASSES: Dict[str, ToolSpec] = {spec.target.partition(':')[2]: spec for spec in SPECS}
 
-# TODO delete this when possible
-if not sys.warnoptions:
-    warnings.simplefilter('ignore', NumbaDeprecationWarning)
+__all__ = ['AVAILABLE', 'ENTRY_POINT_GROUP', 'TRAINING_PROFILES', 'CTAToolInterface', 'CelltypistModelStore',
+           'PhaseBudget', 'ToolRegistry', 'ToolSpec', 'TrainingProfile', 'discover_plugins', 'resolve_profile',
+           *(name for name, spec in _INTERFACE_CLASSES.items() if spec.is_installed())]
 
-with suppress(ImportError):
-    from macta_tools.tools._celltypist_interface import CelltypistInterface
-    __all__.append('CelltypistInterface')
-    AVAILABLE['celltypist'] = CelltypistInterface()
 
-with suppress(ImportError):
-    from macta_tools.tools._scanvi import ScanviInterface
-    __all__.append('ScanviInterface')
-    AVAILABLE['scanvi'] = ScanviInterface()
+def __getattr__(name: str) -> Any:
+    if name in _INTERFACE_CLASSES:
+        return _INTERFACE_CLASSES[name].load()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
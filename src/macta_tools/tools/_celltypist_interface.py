@@ -1,21 +1,145 @@
 """Wrapper code for `celltypist`."""
 
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Union
+from importlib import metadata
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
 
 import celltypist
+import numpy as np
 import pandas as pd
+import scanpy as sc
 from anndata import AnnData
 from celltypist import models
-from celltypist.classifier import AnnotationResult
+from celltypist.classifier import AnnotationResult, Classifier
+from scipy import sparse
 
+from macta_tools.tools._celltypist_models import CelltypistModelStore, copy_model
 from macta_tools.tools._cta_tool_interface import CTAToolInterface
+from macta_tools.utils.fingerprint import fingerprint
+from macta_tools.utils.genes import gene_alignment
+from macta_tools.utils.representations import Representation
 from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+from macta_tools.utils.resources import DataSize, ResourceEstimate
+from macta_tools.utils.validation import check_gene_overlap, check_obs_columns
 
 # Disable `celltypist`'s trivial output logs
 logging.getLogger(celltypist.__name__).setLevel(logging.ERROR)
 
+# Ways of building the neighbourhood graph that majority voting over-clusters: `celltypist`'s own pipeline (which
+# scales a dense copy of the data), or a sparse PCA followed by an approximate nearest neighbour search
+NEIGHBORS_METHODS = ('celltypist', 'approximate')
+
+# `celltypist` does not majority vote this few cells
+_MIN_VOTING_CELLS = 50
+
+# Parameters of the approximate neighbourhood graph, as in `celltypist`'s own pipeline
+_N_TOP_GENES = 2500
+_N_PCS = 50
+_N_NEIGHBORS = 10
+
+# Faster backends of the neighbourhood graph and the over-clustering, which `scanpy` takes as options from 1.10 on
+_SCANPY_1_10 = tuple(int(part) for part in metadata.version('scanpy').split('.')[:2]) >= (1, 10)
+_NEIGHBORS_KWARGS: Dict[str, Any] = {'transformer': 'pynndescent'} if _SCANPY_1_10 else {}
+_LEIDEN_KWARGS: Dict[str, Any] = {'flavor': 'igraph'} if _SCANPY_1_10 else {}
+
+
+def _predict(expr_data: AnnData, model: models.Model, chunk_size: Optional[int], n_jobs: int) -> AnnotationResult:
+    """Predicts the cell types of `expr_data`, `chunk_size` cells at a time on `n_jobs` threads if `chunk_size` is set.
+
+    The genes are aligned to the features of the model once (see `gene_alignment`), rather than by `celltypist` for
+    every chunk, and only the chunks being predicted are scaled into dense matrices, so memory does not grow with the
+    number of cells.
+    """
+
+    aligned = _align_to_model(expr_data, model)
+    if chunk_size is None or expr_data.n_obs <= chunk_size:
+        result = celltypist.annotate(aligned, model=model, majority_voting=False)
+        return AnnotationResult(result.predicted_labels, result.decision_matrix, result.probability_matrix, expr_data)
+
+    def predict(start: int) -> AnnotationResult:
+        return celltypist.annotate(aligned[start:start + chunk_size], model=copy_model(model),
+                                   majority_voting=False)
+
+    with ThreadPoolExecutor(n_jobs) as pool:
+        chunks = list(pool.map(predict, range(0, expr_data.n_obs, chunk_size)))
+
+    labels = pd.concat([chunk.predicted_labels.astype(str) for chunk in chunks]).astype('category')
+    return AnnotationResult(labels, pd.concat([chunk.decision_matrix for chunk in chunks]),
+                            pd.concat([chunk.probability_matrix for chunk in chunks]), expr_data)
+
+
+def _align_to_model(expr_data: AnnData, model: models.Model) -> AnnData:
+    """Restricts `expr_data` to the features of `model` it measures, named as in the model."""
+
+    alignment = gene_alignment(expr_data.var, model.features, fill_missing=False)
+    if alignment.n_shared == 0:
+        raise ValueError('no genes of `expr_data` are features of the model; check that both use the same gene '
+                         'identifiers')
+    logging.info(f'celltypist: {alignment.describe()}')
+
+    if expr_data.var_names.equals(pd.Index(alignment.features)):
+        return expr_data
+    return AnnData(alignment.reindex(expr_data.X), obs=pd.DataFrame(index=expr_data.obs_names),
+                   var=pd.DataFrame(index=pd.Index(alignment.features)))
+
+
+def _approximate_graph(data: AnnData) -> sparse.csr_matrix:
+    """Builds the neighbourhood graph of `data` from a PCA of its scaled highly variable genes, without densifying
+    them, and an approximate nearest neighbour search, which both scale about linearly with the number of cells."""
+
+    genes = AnnData(data.X, obs=pd.DataFrame(index=data.obs_names), var=pd.DataFrame(index=data.var_names))
+    sc.pp.highly_variable_genes(genes, n_top_genes=min(_N_TOP_GENES, data.n_vars))
+    matrix = sparse.csr_matrix(data.X)[:, genes.var['highly_variable'].to_numpy()].astype(np.float32)
+
+    # Unit variance genes, as `celltypist` scales them; centering is left to the PCA, which keeps the matrix sparse
+    mean = np.asarray(matrix.mean(axis=0)).ravel()
+    std = np.sqrt(np.maximum(np.asarray(matrix.multiply(matrix).mean(axis=0)).ravel() - mean ** 2, 0))
+    matrix = matrix @ sparse.diags(np.divide(1, std, out=np.zeros_like(std), where=std > 0))
+
+    n_pcs = min(_N_PCS, min(matrix.shape) - 1)
+    cells = AnnData(obs=pd.DataFrame(index=data.obs_names), obsm={'X_pca': sc.pp.pca(matrix, n_comps=n_pcs)})
+    sc.pp.neighbors(cells, n_neighbors=_N_NEIGHBORS, use_rep='X_pca', **_NEIGHBORS_KWARGS)
+    return cells.obsp['connectivities']
+
+
+def _model_store(model_store: Union[CelltypistModelStore, str, Path, None], offline: bool) -> CelltypistModelStore:
+    if isinstance(model_store, CelltypistModelStore):
+        return model_store
+    return CelltypistModelStore(model_store, offline=offline)
+
+
+def _resolution(n_cells: int) -> float:
+    """Resolution of the Leiden over-clustering of `n_cells` cells, as chosen by `celltypist`."""
+
+    for max_cells, resolution in ((5_000, 5), (20_000, 10), (40_000, 15), (100_000, 20), (200_000, 25)):
+        if n_cells < max_cells:
+            return resolution
+    return 30
+
+
+def _over_cluster(data: AnnData, over_clustering: Optional[str], neighbors: str) -> pd.Series:
+    """Over-clusters `data` for majority voting, reusing the clusters in `obs[over_clustering]` or the neighbourhood
+    graph in `obsp['connectivities']` if `data` has them."""
+
+    if over_clustering is not None and over_clustering in data.obs:
+        return data.obs[over_clustering]
+
+    if 'connectivities' in data.obsp:
+        adjacency = data.obsp['connectivities']
+    elif neighbors == 'approximate':
+        adjacency = _approximate_graph(data)
+    else:
+        adjacency = Classifier._construct_neighbor_graph(data.copy())[1]
+
+    cells = AnnData(obs=pd.DataFrame(index=data.obs_names))
+    sc.tl.leiden(cells, resolution=_resolution(data.n_obs), adjacency=adjacency, key_added='over_clustering',
+                 n_iterations=2, directed=False, **_LEIDEN_KWARGS)
+    return cells.obs['over_clustering']
+
 
 @dataclass
 class CelltypistInterface(CTAToolInterface):
@@ -25,17 +149,46 @@ class CelltypistInterface(CTAToolInterface):
         annot_type=EqualityRequirement('ref'),
     )
 
-    def annotate(self, expr_data: AnnData, ref_data: models.Model, **_: Any) -> AnnotationResult:
+    # Predictions are per-cell, but majority voting over-clusters the whole data set, so it is disabled for chunks
+    _supports_chunks = True
+    _chunk_kwargs = {'majority_voting': False}
+
+    # Models trained on an obs column are cached, see `ref_cache_parts`
+    _caches_ref = True
+
+    def expr_representation(self, ref_data: models.Model, **_: Any) -> Representation:
+        """`celltypist` expects log1p-normalized data to 10000 counts per cell, matched to the model by gene name."""
+        return Representation('lognorm')
+
+    def ref_representation(self, **_: Any) -> Representation:
+        """Models are trained on log1p-normalized data to 10000 counts per cell."""
+        return Representation('lognorm')
+
+    def annotate(self, expr_data: AnnData, ref_data: models.Model, majority_voting: bool = True,
+                 over_clustering: Optional[str] = 'over_clustering', neighbors: str = 'celltypist',
+                 prediction_chunk_size: Optional[int] = None, n_jobs: int = 1, **_: Any) -> AnnotationResult:
         """Runs annotation using `celltypist`.
 
         Arguments:
             expr_data (AnnData): experimental data being analyzed
-            ref_data (AnnData): reference/marker data used to analyze (NOT the model)
+            ref_data (models.Model): the model, as returned by `self.preprocess_ref`
+            majority_voting (bool): if `True`, refines the per-cell predictions by majority voting over clusters
+            over_clustering (str): obs column of `expr_data` holding precomputed clusters to majority vote over, if
+                present. Otherwise, a neighbourhood graph in `obsp['connectivities']` is reused, if any
+            neighbors (str): how the neighbourhood graph is built when `expr_data` has none <celltypist/approximate>
+            prediction_chunk_size (int): if set, cells are predicted this many at a time, which bounds memory
+            n_jobs (int): number of threads predicting chunks concurrently
 
         Returns:
             `AnnotationResult` object containing the results of annotation using celltypist
         """
-        return celltypist.annotate(expr_data, model=ref_data, majority_voting=True)
+
+        predictions = _predict(expr_data, ref_data, prediction_chunk_size, n_jobs)
+        if not majority_voting or predictions.cell_count <= _MIN_VOTING_CELLS:
+            return predictions
+
+        clusters = _over_cluster(expr_data, over_clustering, neighbors)
+        return Classifier.majority_vote(predictions, clusters.to_numpy())
 
     def convert(self, results: AnnotationResult, convert_to: str, **_: Any) -> Union[pd.DataFrame, pd.Series]:
         """Converts `celltypist` results to standardized format.
@@ -49,38 +202,115 @@ class CelltypistInterface(CTAToolInterface):
         """
 
         if convert_to == 'labels':
-            return results.predicted_labels.majority_voting
+            if 'majority_voting' in results.predicted_labels:
+                return results.predicted_labels.majority_voting
+            return results.predicted_labels.predicted_labels
 
         if convert_to == 'scores':
             return results.probability_matrix
 
         raise ValueError(f'{convert_to} is an invalid option for `convert_to`')
 
-    def preprocess_ref(self, ref_data: Union[AnnData, str], update_models: bool = True, force_update: bool = True,
-                       **kwargs: Any) -> models.Model:
+    def preprocess_ref(self, ref_data: Union[AnnData, str, Path], update_models: bool = False,
+                       force_update: bool = False, model_store: Union[CelltypistModelStore, str, Path, None] = None,
+                       offline: bool = False, **kwargs: Any) -> models.Model:
         """Preprocesses the reference data into a `celltypist.models.Model`.
 
         Arguments:
-            ref_data (Union[AnnData, str]): raw reference data. Can be an `AnnData` on which to train the model or a
-                `str` which represents the celltypist model name to load.
-            update_models (bool): if `True`, updates the celltypist model cache
-            force_update (bool): passed along directly to `celltypist.models.download_models`
+            ref_data (Union[AnnData, str, Path]): raw reference data. Can be an `AnnData` on which to train the model,
+                the name of a model of the celltypist collection (e.g. `'Immune_All_Low.pkl'`) or the path of a model
+                file
+            update_models (bool): if `True`, downloads the named model again if the collection has a newer version
+            force_update (bool): if `True`, downloads the named model again even if it is stored
+            model_store (Union[CelltypistModelStore, str, Path]): store of the named models, or its directory;
+                defaults to the directory `celltypist` downloads models into
+            offline (bool): if `True`, nothing is downloaded, so named models must already be in `model_store`.
+                Ignored if `model_store` is a `CelltypistModelStore`
 
         Returns:
-            `celltypist.models.Model` to be used for annotation
-
-        Notes:
-            - When `ref_data` is a `str`, this function force-updates all celltypist models. This will result in a
-                substantial delay while the data is being downloaded
-            - TODO add another case of ref_data: loading a trained model from a file
+            `celltypist.models.Model` to be used for annotation; models loaded from files are only read once per
+            process
         """
 
-        if isinstance(ref_data, str):
-            if update_models:
-                models.download_models(force_update=force_update)
-            return models.Model.load(model=ref_data)
+        if isinstance(ref_data, (str, Path)):
+            store = _model_store(model_store, offline)
+            return store.load(ref_data, update=update_models, force=force_update)
 
         elif isinstance(ref_data, AnnData):
             return celltypist.train(ref_data, labels=kwargs['labels'], check_expression=False)
 
         raise ValueError(f'{type(ref_data)} is an unsupported data type for `ref_data`')
+
+    def validate(self, expr_data: Optional[AnnData], ref_data: Union[AnnData, str, Path], **kwargs: Any
+                 ) -> List[str]:
+        """Checks the neighbourhood graph method, that a named model is available, and that a reference `AnnData` has
+        the labels to train on and shares genes with `expr_data`."""
+
+        problems = super().validate(expr_data, ref_data, **kwargs)
+        if kwargs.get('neighbors', 'celltypist') not in NEIGHBORS_METHODS:
+            problems.append(f'{kwargs["neighbors"]} is an invalid `neighbors` method, expected one of '
+                            f'{NEIGHBORS_METHODS}')
+
+        if isinstance(ref_data, (str, Path)):
+            store = _model_store(kwargs.get('model_store'), kwargs.get('offline', False))
+            is_path = isinstance(ref_data, Path) or os.sep in ref_data
+            if is_path and not Path(ref_data).is_file():
+                problems.append(f'no celltypist model file {ref_data}')
+            elif not is_path and store.offline and not store.verify(str(ref_data)):
+                problems.append(f'celltypist model {ref_data} is not stored in {store.directory} (offline mode)')
+        if not isinstance(ref_data, AnnData):
+            return problems
+
+        labels = kwargs.get('labels')
+        if labels is None:
+            problems.append('missing required key word argument `labels` to train on `ref_data`')
+        elif isinstance(labels, str):
+            problems += check_obs_columns(ref_data, [labels], 'ref_data')
+
+        if expr_data is not None:
+            problems += check_gene_overlap(expr_data.var, ref_data.var_names)
+        return problems
+
+    def estimate_resources(self, expr_size: DataSize, ref_size: DataSize, majority_voting: bool = True,
+                           neighbors: str = 'celltypist', prediction_chunk_size: Optional[int] = None,
+                           n_jobs: int = 1, **_: Any) -> ResourceEstimate:
+        """Training scales a dense copy of the reference, and prediction one of the query restricted to the features
+        of the model, or `n_jobs` chunks of it. Majority voting with `celltypist`'s own neighbourhood graph scales a
+        dense copy of the highly variable genes of the query."""
+
+        # Models loaded by name have unknown features, at most the genes of the query
+        n_features = ref_size.n_genes or expr_size.n_genes
+        training = ref_size.nbytes + 2 * ref_size.dense_nbytes()
+
+        n_predicted = expr_size.n_cells if prediction_chunk_size is None else \
+            min(expr_size.n_cells, prediction_chunk_size * n_jobs)
+        prediction = 2 * DataSize(n_predicted, n_features).dense_nbytes()
+        if majority_voting and neighbors == 'celltypist' and expr_size.n_cells > _MIN_VOTING_CELLS:
+            prediction = max(prediction, 2 * expr_size.dense_nbytes(_N_TOP_GENES, itemsize=4))
+
+        # The log-normalized copy of the query is kept while predicting
+        memory = max(training, expr_size.nbytes + prediction)
+        return ResourceEstimate(threads=n_jobs if prediction_chunk_size is not None else 1, memory=memory)
+
+    def ref_cache_parts(self, ref_data: Union[AnnData, str], labels: Any = None, **_: Any
+                        ) -> Optional[Dict[str, Any]]:
+        """Describes a trained reference for the model cache. Only models trained on an obs column are cached.
+
+        Arguments:
+            ref_data (Union[AnnData, str]): raw reference data
+            labels (Any): labels passed along to `celltypist.train`
+
+        Returns:
+            dict describing the trained model, or `None` if `ref_data` is not an `AnnData` labelled by an obs column
+        """
+
+        if not isinstance(ref_data, AnnData) or not isinstance(labels, str):
+            return None
+
+        return {'ref': fingerprint(ref_data, obs_columns=[labels]), 'labels': labels}
+
+    def save_ref(self, model: models.Model, path: Path) -> None:
+        model.write(str(path / 'model.pkl'))
+
+    def load_ref(self, path: Path, ref_data: Any, **_: Any) -> models.Model:
+        return models.Model.load(model=str(path / 'model.pkl'))
@@ -0,0 +1,215 @@
+"""Local store of `celltypist` models, which downloads a model only when it is missing and can run fully offline.
+
+`celltypist.models.download_models` fetches every model of the `celltypist` collection; the store fetches single models
+instead, records their checksums in a manifest, and verifies them before loading. A directory of pre-seeded model files
+is enough to run offline. `celltypist` itself is only imported when a model is loaded.
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import urllib.request
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Optional, Tuple, Union
+
+if TYPE_CHECKING:
+    from celltypist import models
+
+# Index of the `celltypist` model collection, which lists the URL and version of every model
+INDEX_URL = 'https://celltypist.cog.sanger.ac.uk/models/models.json'
+
+MANIFEST_FILE = 'macta_manifest.json'
+_INDEX_FILE = 'models.json'
+_TIMEOUT_SECONDS = 60
+
+# Models loaded by this process, keyed on the path, modification time and size of their files, shared by every store
+_LOADED: Dict[Tuple[str, int, int], 'models.Model'] = {}
+_LOADED_LOCK = threading.Lock()
+
+
+def _default_directory() -> Path:
+    """The model directory of `celltypist` (`$CELLTYPIST_FOLDER/data/models`), so that its downloads are reused."""
+    celltypist_folder = os.getenv('CELLTYPIST_FOLDER', default=str(Path.home() / '.celltypist'))
+    return Path(celltypist_folder) / 'data' / 'models'
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_key(path: Path) -> Tuple[str, int, int]:
+    stat = path.stat()
+    return str(path.resolve()), stat.st_mtime_ns, stat.st_size
+
+
+def copy_model(model: 'models.Model') -> 'models.Model':
+    """Copies `model`, sharing its coefficients, so that the copy can predict concurrently with `model`."""
+
+    # `celltypist.classifier.Classifier.celltype` replaces attributes of the classifier of the model while predicting
+    copied = copy.copy(model)
+    copied.classifier = copy.copy(model.classifier)
+    return copied
+
+
+class CelltypistModelStore:
+    """Directory of `celltypist` models, with a manifest of their checksums and versions.
+
+    Attributes:
+        directory (Path): directory holding the model files, by default the one `celltypist` downloads models into
+        offline (bool): if `True`, nothing is downloaded and only the models in `directory` can be loaded
+        index_url (str): URL of the index of the model collection
+    """
+
+    def __init__(self, directory: Union[str, Path, None] = None, offline: bool = False, index_url: str = INDEX_URL):
+        self.directory = _default_directory() if directory is None else Path(directory)
+        self.offline = offline
+        self.index_url = index_url
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({str(self.directory)!r}, offline={self.offline})'
+
+    @staticmethod
+    def model_name(name: str) -> str:
+        """Returns the file name of the model `name`, e.g. `'Immune_All_Low.pkl'` for `'Immune_All_Low'`."""
+        return name if name.endswith('.pkl') else f'{name}.pkl'
+
+    def path(self, name: str) -> Path:
+        """Path of the model `name` in the store, which may not exist yet."""
+        return self.directory / self.model_name(name)
+
+    def manifest(self) -> Dict[str, Dict[str, Any]]:
+        """Entries of the stored models, keyed on their file names, holding their `sha256` and `version`."""
+
+        try:
+            manifest: Dict[str, Dict[str, Any]] = json.loads((self.directory / MANIFEST_FILE).read_text())
+            return manifest
+        except (OSError, ValueError):
+            return {}
+
+    def _record(self, name: str, path: Path, version: Optional[str]) -> None:
+        """Records the checksum and version of the model file `name` in the manifest, which is replaced atomically."""
+
+        manifest = self.manifest()
+        manifest[name] = {'sha256': _sha256(path), 'version': version}
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, suffix='.tmp', delete=False) as file:
+            json.dump(manifest, file, indent=2, sort_keys=True)
+        os.replace(file.name, self.directory / MANIFEST_FILE)
+
+    def _download(self, url: str, path: Path) -> None:
+        """Downloads `url` into `path`, through a temporary file so that `path` is never partially written."""
+
+        if self.offline:
+            raise FileNotFoundError(f'cannot download {url} in offline mode')
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+        descriptor, name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        staging = Path(name)
+        try:
+            with os.fdopen(descriptor, 'wb') as file, \
+                    urllib.request.urlopen(url, timeout=_TIMEOUT_SECONDS) as response:
+                for block in iter(lambda: response.read(1 << 20), b''):
+                    file.write(block)
+            os.replace(staging, path)
+        finally:
+            staging.unlink(missing_ok=True)
+
+    def index(self, update: bool = False) -> Dict[str, Dict[str, Any]]:
+        """Entries of the models of the collection, keyed on their file names, downloading the index if it is missing
+        or if `update` is set (and the store is online)."""
+
+        index_path = self.directory / _INDEX_FILE
+        if not self.offline and (update or not index_path.is_file()):
+            self._download(self.index_url, index_path)
+        if not index_path.is_file():
+            raise FileNotFoundError(f'no model index in {self.directory}, which is needed to download models')
+
+        return {entry['filename']: entry for entry in json.loads(index_path.read_text())['models']}
+
+    def verify(self, name: str) -> bool:
+        """Whether the model `name` is stored and matches the checksum of its manifest entry, if it has one."""
+
+        path = self.path(name)
+        if not path.is_file():
+            return False
+        entry = self.manifest().get(path.name)
+        return entry is None or entry['sha256'] == _sha256(path)
+
+    def fetch(self, name: str, update: bool = False, force: bool = False) -> Path:
+        """Makes sure that the model `name` is stored, downloading it if it is not (or is corrupt).
+
+        Models found in the directory without a manifest entry (e.g. pre-seeded files) are added to the manifest.
+
+        Arguments:
+            name (str): name of the model, with or without the `.pkl` extension
+            update (bool): if `True`, downloads the model again if the index lists a newer version
+            force (bool): if `True`, downloads the model again even if it is stored
+
+        Returns:
+            path of the stored model
+        """
+
+        path = self.path(name)
+        with self._lock:
+            stored = self.verify(name)
+            if stored and not force and not (update and not self.offline):
+                if path.name not in self.manifest():
+                    self._record(path.name, path, None)
+                return path
+
+            if self.offline:
+                problem = 'is corrupt' if path.is_file() else 'is not stored'
+                raise FileNotFoundError(f'celltypist model {path.name} {problem} in {self.directory} (offline mode)')
+
+            index = self.index(update=update or force)
+            if path.name not in index:
+                raise ValueError(f'{path.name} is not a model of the celltypist collection')
+
+            version = index[path.name].get('version')
+            if stored and not force and self.manifest().get(path.name, {}).get('version') == version:
+                return path
+
+            logging.info(f'Downloading celltypist model {path.name} into {self.directory}')
+            self._download(index[path.name]['url'], path)
+            self._record(path.name, path, version)
+        return path
+
+    def load(self, model: Union[str, Path], update: bool = False, force: bool = False) -> 'models.Model':
+        """Loads a model by name (from the store) or by file path, once per process.
+
+        Arguments:
+            model (str/Path): name of a model of the collection, or path of a model file
+            update (bool): see `CelltypistModelStore.fetch`
+            force (bool): see `CelltypistModelStore.fetch`
+
+        Returns:
+            the `celltypist` model, which shares its coefficients with the other loads of the same file
+        """
+
+        from celltypist import models
+
+        if isinstance(model, Path) or os.sep in model:
+            path = Path(model)
+            if not path.is_file():
+                raise FileNotFoundError(f'no celltypist model file {path}')
+        else:
+            path = self.path(model)
+            # Models that this process already loaded were verified then
+            if update or force or not path.is_file() or _file_key(path) not in _LOADED:
+                path = self.fetch(model, update=update, force=force)
+
+        key = _file_key(path)
+        with _LOADED_LOCK:
+            if key not in _LOADED:
+                _LOADED[key] = models.Model.load(model=str(path))
+            return copy_model(_LOADED[key])
@@ -1,11 +1,19 @@
 """Implementation of abstract class for an interface to a CTA tool."""
 
 from abc import ABC, abstractmethod
-from typing import Any, Collection, Dict, Optional, Union
+from pathlib import Path
+from typing import Any, Collection, Dict, List, Optional, Union
 
 import pandas as pd
 
+from macta_tools.utils.chunks import iter_chunks
+from macta_tools.utils.model_cache import CacheEntry, ModelCache
+from macta_tools.utils.profiling import stage
+from macta_tools.utils.representations import Representation, RepresentationCache, represent
 from macta_tools.utils.requirements import RequirementList
+from macta_tools.utils.resources import DataSize, ResourceEstimate
+from macta_tools.utils.scores import check_score_format, format_scores
+from macta_tools.utils.validation import check_kwargs
 
 
 class CTAToolInterface(ABC):
@@ -14,6 +22,15 @@ class CTAToolInterface(ABC):
     _required_kwargs: Collection[str] = []
     _requirements: Optional[RequirementList] = None
 
+    # Whether cells are annotated independently of each other, so that `expr_data` can be annotated in chunks
+    _supports_chunks: bool = False
+    # kwargs that override the ones given by the user when annotating chunks
+    _chunk_kwargs: Dict[str, Any] = {}
+    # Whether preprocessed references can be cached with `save_ref` and `load_ref` (see `ref_cache_parts`)
+    _caches_ref: bool = False
+    # Whether the results of `annotate` (e.g. a model trained on the query) can be checkpointed with `save_state`
+    _checkpoints_state: bool = False
+
     # region Abstract methods
 
     @abstractmethod
@@ -37,7 +54,8 @@ class CTAToolInterface(ABC):
             convert_to (str): format to which `res` will be converted
 
         Returns:
-            `pandas.Series` object containing data in the `convert_to` format
+            `pandas.Series` of labels, or `pandas.DataFrame` of cells x cell types scores (higher is better), indexed
+            by cell. Scores are cast by `run_prepared`, see `format_scores`
         """
 
     # endregion
@@ -66,33 +84,252 @@ class CTAToolInterface(ABC):
         """
         return ref_data
 
+    def expr_representation(self, ref_data: Any, **_: Any) -> Optional[Representation]:
+        """Declares the representation of `expr_data` that `self.preprocess_expr` expects.
+
+        The representation is computed once per query by the pipeline and shared with the other tools that need it.
+
+        Arguments:
+            ref_data: reference/marker data, as returned by `self.prepare_ref`, e.g. to align genes to
+
+        Returns:
+            `Representation` of `expr_data`, or `None` to receive `expr_data` as given
+        """
+        return None
+
+    def ref_representation(self, **_: Any) -> Optional[Representation]:
+        """Declares the representation of `ref_data` that `self.preprocess_ref` expects, if it is an `AnnData`.
+
+        Returns:
+            `Representation` of `ref_data`, or `None` to receive `ref_data` as given
+        """
+        return None
+
+    # endregion
+
+    # region Reference model caching
+
+    def prepare_ref(self, ref_data: Any, model_cache: Union[ModelCache, str, Path, None] = None,
+                    representations: Optional[RepresentationCache] = None, **kwargs: Any) -> Any:
+        """Runs `self.preprocess_ref`, reusing a model from `model_cache` if this reference was already preprocessed.
+
+        Arguments:
+            ref_data (AnnData): reference/marker data used to analyze
+            model_cache (ModelCache/str/Path): cache, or cache directory, of preprocessed references. No caching
+                is done if `None`, if not `self._caches_ref`, or if `self.ref_cache_parts` is `None` for this
+                `ref_data`
+            representations (RepresentationCache): cache of the representations of `ref_data` shared with other
+                tools; `self.ref_representation` is computed for this tool alone if `None`
+
+        Returns:
+            Reference/marker data in a format that `annotate` will accept
+        """
+
+        ref_data = represent(ref_data, self.ref_representation(**kwargs), representations)
+
+        key_parts = None if model_cache is None or not self._caches_ref else self.ref_cache_parts(ref_data, **kwargs)
+        if model_cache is None or key_parts is None:
+            return self.preprocess_ref(ref_data, **kwargs)
+
+        if not isinstance(model_cache, ModelCache):
+            model_cache = ModelCache(model_cache)
+
+        key = model_cache.key(tool=type(self).__qualname__, **key_parts)
+        model = model_cache.load(key, lambda path: self.load_ref(path, ref_data, **kwargs))
+
+        if model is None:
+            model = self.preprocess_ref(ref_data, **kwargs)
+            model_cache.store(key, model, self.save_ref)
+
+        return model
+
+    def ref_cache_parts(self, ref_data: Any, **_: Any) -> Optional[Dict[str, Any]]:
+        """Describes everything that determines the result of `self.preprocess_ref`, to be used as a cache key.
+
+        Arguments:
+            ref_data (AnnData): reference/marker data used to analyze
+
+        Returns:
+            JSON-serializable dict (e.g. a fingerprint of `ref_data` and the training parameters), or `None` if this
+            preprocessed reference cannot be cached. Only called if `self._caches_ref`
+        """
+        return None
+
+    def save_ref(self, model: Any, path: Path) -> None:
+        """Saves a preprocessed reference, as returned by `self.preprocess_ref`, into the directory `path`.
+
+        Interfaces that implement it set `_caches_ref`."""
+        raise TypeError(f'{type(self).__name__} does not cache preprocessed references (`_caches_ref` is not set)')
+
+    def load_ref(self, path: Path, ref_data: Any, **_: Any) -> Any:
+        """Loads a preprocessed reference that was saved into the directory `path` by `self.save_ref`."""
+        raise TypeError(f'{type(self).__name__} does not cache preprocessed references (`_caches_ref` is not set)')
+
+    def save_state(self, state: Any, path: Path) -> None:
+        """Saves the results of `self.annotate` into the directory `path`.
+
+        Interfaces that implement it set `_checkpoints_state`."""
+        raise TypeError(f'{type(self).__name__} does not checkpoint annotation states (`_checkpoints_state` is not '
+                        'set)')
+
+    def load_state(self, path: Path, expr_data: Any, ref_data: Any, **_: Any) -> Any:
+        """Loads the results of `self.annotate` that were saved into the directory `path` by `self.save_state`."""
+        raise TypeError(f'{type(self).__name__} does not checkpoint annotation states (`_checkpoints_state` is not '
+                        'set)')
+
     # endregion
 
     # region Other class methods for annotation
 
-    def run_full(self, expr_data: Any, ref_data: Any, convert_to: str, **kwargs: Any) -> Union[pd.DataFrame, pd.Series]:
+    def run_full(self, expr_data: Any, ref_data: Any, convert_to: str,
+                 expr_representations: Optional[RepresentationCache] = None,
+                 ref_representations: Optional[RepresentationCache] = None,
+                 state_checkpoint: Optional[CacheEntry] = None, **kwargs: Any) -> Union[pd.DataFrame, pd.Series]:
         """Run `self.annotate`, followed by `self.convert` on a data set.
 
         Arguments:
             expr_data (AnnData): expression data being analyzed
             ref_data: reference/marker data used to analyze
             convert_to (str): format to which `res` will be converted
+            expr_representations (RepresentationCache): cache of the representations of `expr_data`, if shared
+            ref_representations (RepresentationCache): cache of the representations of `ref_data`, if shared
+            state_checkpoint (CacheEntry): checkpoint of the results of `self.annotate`, see `self.run_prepared`
 
         Returns:
             `pandas.Series` object containing the results of annotation, in the
             `convert_to` format
         """
 
-        expr_data = self.preprocess_expr(expr_data, **kwargs)
-        ref_data = self.preprocess_ref(ref_data, **kwargs)
+        with stage('prepare_ref'):
+            ref_data = self.prepare_ref(ref_data, representations=ref_representations, **kwargs)
+        return self.run_prepared(expr_data, ref_data, convert_to, expr_representations=expr_representations,
+                                 state_checkpoint=state_checkpoint, **kwargs)
+
+    def run_prepared(self, expr_data: Any, ref_data: Any, convert_to: str, chunk_size: Optional[int] = None,
+                     expr_representations: Optional[RepresentationCache] = None,
+                     state_checkpoint: Optional[CacheEntry] = None, score_dtype: str = 'float32',
+                     score_top_k: Optional[int] = None, **kwargs: Any) -> Union[pd.DataFrame, pd.Series]:
+        """Run `self.preprocess_expr`, `self.annotate` and `self.convert` against an already prepared reference.
+
+        Arguments:
+            expr_data (AnnData): expression data being analyzed
+            ref_data: reference/marker data, as returned by `self.prepare_ref`
+            convert_to (str): format to which `res` will be converted
+            chunk_size (int): if set, `expr_data` (which may be backed) is annotated this many cells at a time, and
+                only one chunk is loaded into memory at a time
+            expr_representations (RepresentationCache): cache of the representations of `expr_data` shared with
+                other tools; `self.expr_representation` is computed for this tool alone if `None`. Ignored with
+                `chunk_size`, as every chunk has its own representations
+            state_checkpoint (CacheEntry): if set and `self._checkpoints_state`, the results of `self.annotate` are
+                loaded from this entry if it holds them, and stored into it otherwise. Ignored with `chunk_size`
+            score_dtype (str): float dtype of scores <float16/float32/float64>
+            score_top_k (int): if set, only the best `score_top_k` scores of every cell are kept, as sparse columns
+
+        Returns:
+            `pandas` object containing the results of annotation, in the `convert_to` format
+        """
+
+        if chunk_size is not None:
+            if not self._supports_chunks:
+                raise ValueError(f'{type(self).__name__} does not support annotating `expr_data` in chunks')
+
+            kwargs = {**kwargs, **self._chunk_kwargs, 'score_dtype': score_dtype, 'score_top_k': score_top_k}
+            return pd.concat([self.run_prepared(chunk, ref_data, convert_to, **kwargs)
+                              for chunk in iter_chunks(expr_data, chunk_size)])
+
+        with stage('preprocess_expr'):
+            expr_data = represent(expr_data, self.expr_representation(ref_data, **kwargs), expr_representations)
+            expr_data = self.preprocess_expr(expr_data, **kwargs)
+        with stage('annotate'):
+            results = self._annotate_checkpointed(expr_data, ref_data, state_checkpoint, **kwargs)
+        with stage('convert'):
+            converted = self.convert(results, convert_to, **kwargs)
+            if convert_to == 'scores' and isinstance(converted, pd.DataFrame):
+                converted = format_scores(converted, score_dtype, score_top_k)
+            return converted
+
+    def _annotate_checkpointed(self, expr_data: Any, ref_data: Any, state_checkpoint: Optional[CacheEntry],
+                               **kwargs: Any) -> Any:
+        if state_checkpoint is None or not self._checkpoints_state:
+            return self.annotate(expr_data, ref_data, **kwargs)
+
+        results = state_checkpoint.load(lambda path: self.load_state(path, expr_data, ref_data, **kwargs))
+        if results is None:
+            results = self.annotate(expr_data, ref_data, **kwargs)
+            state_checkpoint.store(results, self.save_state)
+        return results
+
+    def run_chunked(self, expr_data: Any, ref_data: Any, convert_to: str, chunk_size: int,
+                    ref_representations: Optional[RepresentationCache] = None, **kwargs: Any
+                    ) -> Union[pd.DataFrame, pd.Series]:
+        """Like `self.run_full`, but annotates `expr_data` in chunks of cells against a reference prepared once.
+
+        Only one chunk of `expr_data` is loaded into memory at a time, so `expr_data` can be a backed `AnnData` that
+        does not fit in memory.
+
+        Arguments:
+            expr_data (AnnData): expression data being analyzed, possibly backed
+            ref_data: reference/marker data used to analyze
+            convert_to (str): format to which `res` will be converted
+            chunk_size (int): maximum number of cells annotated at once
+            ref_representations (RepresentationCache): cache of the representations of `ref_data`, if shared
+
+        Returns:
+            `pandas` object containing the concatenated results of all chunks, in the `convert_to` format
+        """
+
+        if not self._supports_chunks:
+            raise ValueError(f'{type(self).__name__} does not support annotating `expr_data` in chunks')
 
-        results = self.annotate(expr_data, ref_data, **kwargs)
-        return self.convert(results, convert_to, **kwargs)
+        with stage('prepare_ref'):
+            ref_data = self.prepare_ref(ref_data, representations=ref_representations, **kwargs)
+        return self.run_prepared(expr_data, ref_data, convert_to, chunk_size=chunk_size, **kwargs)
+
+    # endregion
+
+    # region Resource estimation
+
+    def estimate_resources(self, expr_size: DataSize, ref_size: DataSize, **_: Any) -> ResourceEstimate:
+        """Estimates the CPU threads and peak memory of `self.run_full`, to schedule runs without oversubscribing
+        the node (see `annotate_batch`).
+
+        The default assumes a single-threaded tool that holds two copies of each matrix. Overrides should account
+        for the dense copies and the threads their tool uses with the given key word arguments.
+
+        Arguments:
+            expr_size (DataSize): size of the expression data, all zeros when only the reference is prepared
+            ref_size (DataSize): size of the reference data, all zeros if it is not a matrix (e.g. a model name)
+            **kwargs (Any): key word arguments that will be passed to the interface functions
+
+        Returns:
+            `ResourceEstimate` of the run
+        """
+        return ResourceEstimate(threads=1, memory=2 * (expr_size.nbytes + ref_size.nbytes))
 
     # endregion
 
     # region Class methods for requirement validation
 
+    def validate(self, expr_data: Any, ref_data: Any, **kwargs: Any) -> List[str]:
+        """Checks that the inputs are valid for this tool, before any tool runs.
+
+        Only cheap checks belong here (key word arguments, obs columns, layers, gene overlap, a sample of the values),
+        so that problems are found up front rather than after hours of training. Overrides should extend the problems
+        found by this method, which checks `self._required_kwargs` and the format of the scores.
+
+        Arguments:
+            expr_data (AnnData): expression data being analyzed, possibly backed, or `None` when only `ref_data` is
+                being prepared
+            ref_data: reference/marker data used to analyze
+            **kwargs (Any): key word arguments that will be passed to the interface functions
+
+        Returns:
+            list of the problems found, empty if the inputs are valid
+        """
+
+        problems = check_kwargs(kwargs, self._required_kwargs)
+        return problems + check_score_format(kwargs.get('score_dtype', 'float32'), kwargs.get('score_top_k'))
+
     def check_requirements(self, values: Optional[Dict[str, Any]] = None, **kwargs: Any) -> bool:
         """Check if a set of other values is compatible with this annotation tool interface
 
@@ -0,0 +1,268 @@
+"""Marker-based annotation, scoring every cell against the marker genes of every cell type."""
+
+import logging
+from dataclasses import dataclass
+from typing import Any, List, Optional, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools.tools._cta_tool_interface import CTAToolInterface
+from macta_tools.utils.genes import gene_alignment
+from macta_tools.utils.representations import Representation
+from macta_tools.utils.requirements import EqualityRequirement, IsInstanceRequirement, RequirementList
+from macta_tools.utils.resources import DataSize, ResourceEstimate
+from macta_tools.utils.validation import check_gene_overlap
+
+SCORINGS = ('mean', 'zscore', 'rank')
+
+
+@dataclass
+class MarkerSet:
+    """Marker genes of a set of cell types, as a genes x cell types weight matrix.
+
+    Attributes:
+        genes (pd.Index): marker genes
+        cell_types (pd.Index): cell types
+        weights (np.ndarray): `len(genes)` x `len(cell_types)` weight of each gene for each cell type, 0 if the gene is
+            not one of its markers
+    """
+
+    genes: pd.Index
+    cell_types: pd.Index
+    weights: npt.NDArray[np.float32]
+
+    @classmethod
+    def from_frame(cls, markers: pd.DataFrame, cell_type_col: str = 'cell_type', gene_col: str = 'gene',
+                   weight_col: Optional[str] = None) -> 'MarkerSet':
+        """Reads a marker table.
+
+        Arguments:
+            markers (pd.DataFrame): either a long table with one row per (cell type, marker gene) pair, or a wide table
+                whose columns are cell types, each listing its marker genes (padded with missing values)
+            cell_type_col (str): column of the cell types in a long table
+            gene_col (str): column of the genes in a long table
+            weight_col (str): optional column of the marker weights in a long table, all markers weigh 1 otherwise
+
+        Returns:
+            `MarkerSet` of the markers; duplicate pairs are counted once
+        """
+
+        if cell_type_col in markers.columns and gene_col in markers.columns:
+            long = markers[[cell_type_col, gene_col]].rename(columns={cell_type_col: 'cell_type', gene_col: 'gene'})
+            long['weight'] = 1.0 if weight_col is None else markers[weight_col].astype(float)
+        else:
+            long = markers.melt(var_name='cell_type', value_name='gene')
+            long['weight'] = 1.0
+
+        long = long.dropna(subset=['cell_type', 'gene']).drop_duplicates(subset=['cell_type', 'gene'])
+        long = long.astype({'cell_type': str, 'gene': str})
+
+        cell_types = pd.Index(pd.unique(long['cell_type']))
+        genes = pd.Index(pd.unique(long['gene']))
+
+        weights = np.zeros((len(genes), len(cell_types)), dtype=np.float32)
+        weights[genes.get_indexer(long['gene']), cell_types.get_indexer(long['cell_type'])] = \
+            long['weight'].to_numpy(dtype=np.float32)
+        return cls(genes, cell_types, weights)
+
+    def align(self, var: Union[pd.DataFrame, pd.Index]) -> npt.NDArray[np.float32]:
+        """Places the weights on the genes of an expression matrix.
+
+        Arguments:
+            var (DataFrame/Index): `var` of the expression matrix, or its `var_names`, see `gene_alignment`
+
+        Returns:
+            `len(var)` x `len(self.cell_types)` weights, normalized so that the weights of each cell type sum to 1 over
+            the genes present in `var`; the column of a cell type with none of them is all NaN
+        """
+
+        aligned = np.zeros((len(var), len(self.cell_types)), dtype=np.float32)
+        positions = gene_alignment(var, self.genes).positions
+        found = positions >= 0
+        aligned[positions[found]] = self.weights[found]
+
+        totals = aligned.sum(axis=0)
+        missing = totals == 0
+        if missing.any():
+            logging.warning(f'marker: no marker genes of {list(self.cell_types[missing])} found in the expression '
+                            'data, their scores are NaN')
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            normalized: npt.NDArray[np.float32] = aligned / totals
+        return normalized
+
+
+def _row_ranks(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """Ranks the genes of every cell by expression, normalized to [0, 1].
+
+    Zeros rank lowest and are not stored, the stored entries of a row rank above them; ties get their average rank.
+
+    Arguments:
+        matrix (sparse.csr_matrix): cells x genes non-negative expression matrix without explicit zeros
+
+    Returns:
+        matrix with the same sparsity structure as `matrix`, holding the rank of each entry divided by the number of
+        genes
+    """
+
+    n_cells, n_genes = matrix.shape
+    rows = np.repeat(np.arange(n_cells, dtype=np.uint64), np.diff(matrix.indptr))
+
+    # Sorting single integer keys (row, then value) is an order of magnitude faster than `np.lexsort`; the bits of
+    # non-negative float32 values are ordered like the values themselves
+    bits = np.ascontiguousarray(matrix.data, dtype=np.float32).view(np.uint32)
+    order = np.argsort((rows << np.uint64(32)) | bits.astype(np.uint64))
+    values, rows = matrix.data[order], rows[order].astype(np.int64)
+
+    # Position of each sorted entry within its row, after the zeros of that row
+    nnz = np.diff(matrix.indptr)
+    positions = np.arange(len(values)) - matrix.indptr[rows] + (n_genes - nnz)[rows]
+
+    # Entries with equal values in the same row share the average of their (1-based) positions
+    new_run = np.ones(len(values), dtype=bool)
+    new_run[1:] = (values[1:] != values[:-1]) | (rows[1:] != rows[:-1])
+    run_ids = np.cumsum(new_run) - 1
+    run_starts = positions[new_run]
+    run_lengths = np.diff(np.append(np.flatnonzero(new_run), len(values)))
+    ranks = run_starts[run_ids] + (run_lengths[run_ids] + 1) / 2
+
+    result = matrix.astype(np.float32, copy=True)
+    result.data[order] = ranks / n_genes
+    return result
+
+
+@dataclass
+class MarkerInterface(CTAToolInterface):
+    """Interface for scoring cells against marker genes, implemented with sparse matrix products."""
+
+    _requirements = RequirementList(
+        annot_type=EqualityRequirement('marker'),
+        ref_data=IsInstanceRequirement(pd.DataFrame),
+    )
+
+    # Every scoring method only depends on the cell itself
+    _supports_chunks = True
+
+    def expr_representation(self, ref_data: MarkerSet, layer: Optional[str] = None, **_: Any
+                            ) -> Optional[Representation]:
+        """Markers are scored on log1p-normalized data to 10000 counts per cell; a chosen `layer` is scored as it is."""
+        return Representation('lognorm') if layer is None else None
+
+    def preprocess_ref(self, ref_data: Union[pd.DataFrame, MarkerSet], cell_type_col: str = 'cell_type',
+                       gene_col: str = 'gene', weight_col: Optional[str] = None, **_: Any) -> MarkerSet:
+        """Reads the marker table into a `MarkerSet`.
+
+        Arguments:
+            ref_data (pd.DataFrame): long or wide marker table, see `MarkerSet.from_frame`
+            cell_type_col (str): column of the cell types in a long table
+            gene_col (str): column of the genes in a long table
+            weight_col (str): optional column of the marker weights in a long table
+
+        Returns:
+            `MarkerSet` to be used for annotation
+        """
+
+        if isinstance(ref_data, MarkerSet):
+            return ref_data
+        return MarkerSet.from_frame(ref_data, cell_type_col, gene_col, weight_col)
+
+    def validate(self, expr_data: Optional[AnnData], ref_data: Union[pd.DataFrame, MarkerSet], scoring: str = 'mean',
+                 layer: Optional[str] = None, **kwargs: Any) -> List[str]:
+        """Checks that the marker table can be read, and that `expr_data` measures some of its marker genes."""
+
+        problems = super().validate(expr_data, ref_data, **kwargs)
+        if scoring not in SCORINGS:
+            problems.append(f'{scoring} is an invalid option for `scoring`, expected one of {SCORINGS}')
+
+        try:
+            markers = self.preprocess_ref(ref_data, **kwargs)
+        except (KeyError, ValueError) as e:
+            return problems + [f'invalid marker table: {e!r}']
+
+        if expr_data is not None:
+            if layer is not None and layer not in expr_data.layers:
+                problems.append(f'`expr_data` has no layer {layer!r}')
+            problems += check_gene_overlap(expr_data.var, markers.genes, min_overlap=0, what='marker genes')
+        return problems
+
+    def estimate_resources(self, expr_size: DataSize, ref_size: DataSize, scoring: str = 'mean', **_: Any
+                           ) -> ResourceEstimate:
+        """Scores are a dense cells x cell types matrix, with at most as many cell types as rows of the marker table.
+        Ranking sorts every stored value of the query, and the z-score squares them."""
+
+        copies = {'rank': 6, 'zscore': 2}.get(scoring, 1)
+        scores = DataSize(expr_size.n_cells, max(ref_size.n_cells, 1)).dense_nbytes(itemsize=4)
+        return ResourceEstimate(threads=1, memory=copies * expr_size.nbytes + 2 * scores)
+
+    def annotate(self, expr_data: AnnData, ref_data: MarkerSet, scoring: str = 'mean', layer: Optional[str] = None,
+                 **_: Any) -> pd.DataFrame:
+        """Scores every cell for every cell type.
+
+        Arguments:
+            expr_data (AnnData): experimental data being analyzed, log-normalized by the pipeline (see
+                `self.expr_representation`) unless `layer` is set
+            ref_data (MarkerSet): marker genes of the cell types
+            scoring (str): scoring method <mean/zscore/rank>. `'mean'` is the weighted mean expression of the markers,
+                `'zscore'` the same mean after standardizing each cell over all of its genes, and `'rank'` the mean
+                normalized rank of the markers among the genes of each cell
+            layer (str): layer of `expr_data` to use instead of `X`
+
+        Returns:
+            cells x cell types `DataFrame` of scores
+        """
+
+        if scoring not in SCORINGS:
+            raise ValueError(f'{scoring} is an invalid option for `scoring`, expected one of {SCORINGS}')
+
+        matrix = expr_data.X if layer is None else expr_data.layers[layer]
+        weights = ref_data.align(expr_data.var)
+
+        if scoring == 'rank':
+            # Copied, as the shared representations are read-only
+            matrix = sparse.csr_matrix(matrix, dtype=np.float32, copy=True)
+            matrix.eliminate_zeros()
+            matrix = _row_ranks(matrix)
+
+        # Missing cell types have NaN weights, which would spread to every score through the product
+        missing = np.isnan(weights).any(axis=0)
+        scores = np.asarray(matrix @ np.nan_to_num(weights), dtype=np.float32)
+
+        if scoring == 'zscore':
+            n_genes = matrix.shape[1]
+            means = np.asarray(matrix.sum(axis=1), dtype=np.float64).ravel() / n_genes
+            squares = matrix.multiply(matrix) if sparse.issparse(matrix) else np.square(matrix)
+            variances = np.asarray(squares.sum(axis=1), dtype=np.float64).ravel() / n_genes - means ** 2
+            stds = np.sqrt(np.maximum(variances, 0))
+            stds[stds == 0] = 1
+            scores = ((scores - means[:, None]) / stds[:, None]).astype(np.float32)
+
+        scores[:, missing] = np.nan
+        return pd.DataFrame(scores, index=expr_data.obs_names, columns=ref_data.cell_types)
+
+    def convert(self, results: pd.DataFrame, convert_to: str, **_: Any) -> Union[pd.DataFrame, pd.Series]:
+        """Converts marker scores to standardized format.
+
+        Arguments:
+            results (pd.DataFrame): cells x cell types scores
+            convert_to (str): format to which `results` will be converted
+
+        Returns:
+            `pandas` object containing data in the `convert_to` format; labels are the best scoring cell types, NaN
+            for cells without any score
+        """
+
+        if convert_to == 'labels':
+            scores = results.to_numpy()
+            unscored = np.isnan(scores).all(axis=1)
+            labels = pd.Series(results.columns[np.nan_to_num(scores, nan=-np.inf).argmax(axis=1)],
+                               index=results.index, dtype=object)
+            return labels.where(~unscored)
+
+        if convert_to == 'scores':
+            return results
+
+        raise ValueError(f'{convert_to} is an invalid option for `convert_to`')
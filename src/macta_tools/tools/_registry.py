@@ -0,0 +1,234 @@
+"""Lazy registry of the annotation tools, which only imports a tool's backend when its interface is first used.
+
+Besides the tools of this package, the registry discovers third-party tools from the `macta_tools.tools` entry point
+group. An entry point should refer to a `ToolSpec` defined in a lightweight module of the plugin, e.g.
+
+    [project.entry-points."macta_tools.tools"]
+    my_tool = "my_package.macta_plugin:SPEC"
+
+where `SPEC = ToolSpec('my_tool', 'my_package.interface:MyInterface', requires=(...), annot_types=('marker',))`, so
+that the tool can be listed and selected by its capabilities without importing its backend. An entry point may also
+refer to a `CTAToolInterface` subclass directly, at the cost of importing it during discovery.
+"""
+
+import dataclasses
+import importlib
+import logging
+import sys
+import warnings
+from contextlib import suppress
+from dataclasses import dataclass
+from importlib.util import find_spec
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple, Type
+
+from macta_tools.tools._cta_tool_interface import CTAToolInterface
+
+ENTRY_POINT_GROUP = 'macta_tools.tools'
+
+
+@dataclass(frozen=True)
+class ToolSpec:
+    """Describes where an annotation tool is implemented and what it can do, without importing it.
+
+    Attributes:
+        name (str): name of the tool, as used by `annotate` and `--tools`
+        target (str): `'module:ClassName'` of the `CTAToolInterface` subclass of the tool
+        requires (Tuple[str, ...]): top-level packages the tool needs, checked with `importlib.util.find_spec`
+        annot_types (Tuple[str, ...]): annotation types the tool performs <marker/ref>, `None` if undeclared
+        result_types (Tuple[str, ...]): result types the tool outputs <labels/scores>, `None` if undeclared
+        supports_chunks (bool): whether the tool can annotate the expression data in chunks of cells
+    """
+
+    name: str
+    target: str
+    requires: Tuple[str, ...] = ()
+    annot_types: Optional[Tuple[str, ...]] = None
+    result_types: Optional[Tuple[str, ...]] = None
+    supports_chunks: bool = False
+
+    def is_installed(self) -> bool:
+        """Checks that every required package can be found, without importing any of them."""
+
+        try:
+            return all(find_spec(package) is not None for package in self.requires)
+        except (ImportError, ValueError):
+            return False
+
+    def supports(self, annot_type: Optional[str] = None, result_type: Optional[str] = None,
+                 chunks: bool = False) -> bool:
+        """Checks the declared capabilities of the tool; undeclared capabilities are assumed to be supported.
+
+        Arguments:
+            annot_type (str): annotation type to perform, not checked if `None`
+            result_type (str): result type to output, not checked if `None`
+            chunks (bool): if `True`, the tool must support annotating in chunks
+
+        Returns:
+            `False` if the tool declares that it does not support one of the arguments, otherwise `True`
+        """
+
+        return (annot_type is None or self.annot_types is None or annot_type in self.annot_types) and \
+            (result_type is None or self.result_types is None or result_type in self.result_types) and \
+            (not chunks or self.supports_chunks)
+
+    def load(self) -> Type[CTAToolInterface]:
+        """Imports the module of the tool and returns its interface class."""
+
+        module_name, _, class_name = self.target.partition(':')
+
+        with warnings.catch_warnings():
+            # TODO delete this when possible
+            if not sys.warnoptions:
+                with suppress(ImportError):
+                    from numba.core.errors import NumbaDeprecationWarning
+                    warnings.simplefilter('ignore', NumbaDeprecationWarning)
+
+            module = importlib.import_module(module_name)
+
+        interface_class: Type[CTAToolInterface] = getattr(module, class_name)
+        return interface_class
+
+
+def _entry_points(group: str) -> List[Any]:
+    """Entry points of `group` of every installed distribution."""
+
+    from importlib import metadata
+
+    # `EntryPoints.select` is new in Python 3.10, before which `entry_points` returns a dict of group -> entry points
+    entry_points: Any = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=group))
+    return list(entry_points.get(group, []))
+
+
+def discover_plugins(group: str = ENTRY_POINT_GROUP) -> List[ToolSpec]:
+    """Reads the `ToolSpec` of every tool registered under the entry point `group`.
+
+    Arguments:
+        group (str): entry point group in which the tools are registered
+
+    Returns:
+        specs of the plugins, named after their entry points; entry points that cannot be loaded are logged and skipped
+    """
+
+    specs = []
+
+    for entry_point in _entry_points(group):
+        try:
+            target = entry_point.load()
+        except Exception as e:
+            logging.error(f'{entry_point.name}: could not load the plugin {entry_point.value} ({e}). '
+                          'Skipping this tool.')
+            continue
+
+        if isinstance(target, ToolSpec):
+            specs.append(dataclasses.replace(target, name=entry_point.name))
+
+        elif isinstance(target, type) and issubclass(target, CTAToolInterface):
+            specs.append(ToolSpec(entry_point.name, f'{target.__module__}:{target.__qualname__}',
+                                  supports_chunks=target._supports_chunks))
+
+        else:
+            logging.error(f'{entry_point.name}: plugin {entry_point.value} is neither a `ToolSpec` nor a '
+                          '`CTAToolInterface` subclass. Skipping this tool.')
+
+    return specs
+
+
+class ToolRegistry(Mapping[str, CTAToolInterface]):
+    """Read-only mapping of tool name -> `CTAToolInterface`, for every tool whose required packages are installed.
+
+    Listing the tools (iterating, `len`, `in`) only looks up the required packages; the backend of a tool is imported
+    and its interface instantiated the first time it is retrieved, and then reused. Plugins of the entry point `group`
+    are discovered on first use; they cannot replace a tool of `specs` with the same name.
+    """
+
+    def __init__(self, specs: Iterable[ToolSpec], group: Optional[str] = None):
+        """Creates a registry of `specs`, extended with the plugins of the entry point `group` if set."""
+        self._builtin_specs = list(specs)
+        self._group = group
+        self._discovered: Optional[Dict[str, ToolSpec]] = None
+        self._interfaces: Dict[str, CTAToolInterface] = {}
+        self._installed: Dict[str, bool] = {}
+
+    @property
+    def _specs(self) -> Dict[str, ToolSpec]:
+        if self._discovered is None:
+            discovered = {spec.name: spec for spec in self._builtin_specs}
+            for spec in discover_plugins(self._group) if self._group is not None else []:
+                if spec.name in discovered:
+                    logging.warning(f'{spec.name}: a tool with this name is already registered. Ignoring the plugin '
+                                    f'{spec.target}.')
+                    continue
+                discovered[spec.name] = spec
+            self._discovered = discovered
+        return self._discovered
+
+    @property
+    def specs(self) -> Dict[str, ToolSpec]:
+        """Specs of every known tool, installed or not."""
+        return dict(self._specs)
+
+    def find(self, annot_type: Optional[str] = None, result_type: Optional[str] = None,
+             chunks: bool = False) -> List[str]:
+        """Lists the installed tools whose declared capabilities match, without importing any of them.
+
+        Arguments:
+            annot_type (str): annotation type to perform, not checked if `None`
+            result_type (str): result type to output, not checked if `None`
+            chunks (bool): if `True`, only lists tools that support annotating in chunks
+
+        Returns:
+            names of the matching tools
+        """
+        return [name for name in self if self._specs[name].supports(annot_type, result_type, chunks)]
+
+    def _is_installed(self, name: str) -> bool:
+        if name not in self._installed:
+            self._installed[name] = self._specs[name].is_installed()
+        return self._installed[name]
+
+    def __getitem__(self, name: str) -> CTAToolInterface:
+        if name in self._interfaces:
+            return self._interfaces[name]
+
+        if name not in self:
+            raise KeyError(name)
+
+        try:
+            interface = self._specs[name].load()()
+        except ImportError:
+            # The packages are installed, but broken; the tool is skipped from now on
+            self._installed[name] = False
+            raise
+
+        self._interfaces[name] = interface
+        return interface
+
+    def __contains__(self, name: object) -> bool:
+        return isinstance(name, str) and name in self._specs and self._is_installed(name)
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name in self._specs if self._is_installed(name))
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def loaded(self) -> Dict[str, CTAToolInterface]:
+        """Interfaces that have been imported so far."""
+        return dict(self._interfaces)
+
+    def load_all(self) -> Dict[str, CTAToolInterface]:
+        """Imports every installed tool, logging and skipping those whose import fails.
+
+        Returns:
+            dict of tool name -> interface, for every tool that could be imported
+        """
+
+        interfaces = {}
+        for name in list(self):
+            try:
+                interfaces[name] = self[name]
+            except ImportError as e:
+                logging.error(f'{name}: could not import the tool ({e}). Skipping this tool.')
+        return interfaces
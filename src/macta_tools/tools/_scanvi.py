@@ -1,13 +1,19 @@
 import logging
-from typing import Any, Union
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Union
 
 import numpy as np
 import pandas as pd
 from scanpy import AnnData
 
 from macta_tools.tools._cta_tool_interface import CTAToolInterface
+from macta_tools.tools._training import TrainingProfile, resolve_profile, train
 from macta_tools.utils.contexts import suppress_logging
+from macta_tools.utils.fingerprint import fingerprint
+from macta_tools.utils.representations import Representation
 from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+from macta_tools.utils.resources import DataSize, ResourceEstimate
+from macta_tools.utils.validation import check_counts, check_gene_overlap, check_obs_columns
 
 # Suppress the output that comes with importing scArches
 with suppress_logging():
@@ -16,6 +22,14 @@ with suppress_logging():
     from scarches import SCANVI, SCVI  # type: ignore
 
 
+# Label of the cells whose cell type is unknown
+_UNLABELED_CATEGORY = 'Unknown'
+
+# Threads of training when the training profile does not set them, and memory of `torch` and the models themselves
+_DEFAULT_THREADS = 4
+_TORCH_MEMORY = 1024 ** 3
+
+
 class ScanviInterface(CTAToolInterface):
     """Interface for running ScanVI analysis."""
 
@@ -25,12 +39,67 @@ class ScanviInterface(CTAToolInterface):
 
     _required_kwargs = ['batch_col', 'cell_type_col']
 
-    def annotate(self, expr_data: AnnData, ref_data: SCANVI, **kwargs: Any) -> SCANVI:
+    # Trained reference models are cached, and annotating trains a model on the query, which is worth checkpointing
+    _caches_ref = True
+    _checkpoints_state = True
+
+    # Architecture of the reference `SCVI` model
+    _scvi_kwargs: Dict[str, Any] = dict(
+        n_layers=2,
+        encode_covariates=True,
+        deeply_inject_covariates=False,
+        use_layer_norm='both',
+        use_batch_norm='none',
+    )
+
+    def expr_representation(self, ref_data: SCANVI, ref_type: str = 'counts', **_: Any) -> Representation:
+        """The query is mapped onto the reference model from its raw counts, in the `ref_type` layer, with its genes
+        aligned to the genes of the reference."""
+        return Representation('counts', counts_layer=ref_type, genes=tuple(ref_data.adata.var_names))
+
+    def ref_representation(self, ref_type: str = 'counts', **_: Any) -> Representation:
+        """The reference model is trained on raw counts, in the `ref_type` layer."""
+        return Representation('counts', counts_layer=ref_type)
+
+    def validate(self, expr_data: Optional[AnnData], ref_data: AnnData, ref_type: str = 'counts', **kwargs: Any
+                 ) -> List[str]:
+        """Checks the obs columns and raw counts that training needs, and that `expr_data` shares genes with
+        `ref_data`, so that problems are not found after the reference model trained."""
+
+        problems = super().validate(expr_data, ref_data, **kwargs)
+        columns = [kwargs.get('cell_type_col'), kwargs.get('batch_col')]
+        problems += check_obs_columns(ref_data, columns, 'ref_data')
+        problems += check_counts(ref_data, ref_type, 'ref_data')
+
+        try:
+            resolve_profile(kwargs.get('training_profile'))
+        except (TypeError, ValueError) as e:
+            problems.append(f'invalid `training_profile`: {e}')
+
+        if expr_data is not None:
+            problems += check_counts(expr_data, ref_type, 'expr_data')
+            if isinstance(ref_data, AnnData):
+                problems += check_gene_overlap(expr_data.var, ref_data.var_names)
+        return problems
+
+    def estimate_resources(self, expr_size: DataSize, ref_size: DataSize,
+                           training_profile: Union[str, TrainingProfile, Dict[str, Any], None] = None, **_: Any
+                           ) -> ResourceEstimate:
+        """Training runs on the `n_threads` of the training profile, or `_DEFAULT_THREADS`, in minibatches, so memory
+        is dominated by `torch` and the copies of the counts that the models register."""
+
+        n_threads = resolve_profile(training_profile).n_threads or _DEFAULT_THREADS
+        return ResourceEstimate(threads=n_threads, memory=_TORCH_MEMORY + 3 * (expr_size.nbytes + ref_size.nbytes))
+
+    def annotate(self, expr_data: AnnData, ref_data: SCANVI,
+                 training_profile: Union[str, TrainingProfile, Dict[str, Any], None] = None, **_: Any) -> SCANVI:
         """Runs annotation using `SCANVI`.
 
         Arguments:
             expr_data (AnnData): experimental data to analyse
-            ref_data (Path): path to marker list to use
+            ref_data (SCANVI): the trained reference model, as returned by `self.preprocess_ref`
+            training_profile (str/TrainingProfile/dict): budget of mapping the query onto the reference, see
+                `resolve_profile`
 
         Returns:
             The `SCANVI` model with all of the cell type predictions
@@ -41,11 +110,7 @@ class ScanviInterface(CTAToolInterface):
         model._unlabeled_indices = np.arange(expr_data.n_obs)
         model._labeled_indices = []
 
-        model.train(
-            max_epochs=100,
-            plan_kwargs=kwargs,
-            check_val_every_n_epoch=10,
-        )
+        train(model, 'query', resolve_profile(training_profile), 'ScanVI')
 
         return model
 
@@ -60,16 +125,19 @@ class ScanviInterface(CTAToolInterface):
             `pandas` object containing the results of the analysis in the specified format
         """
 
+        cells = results.adata.obs_names
         if convert_to == 'labels':
-            return pd.Series(results.predict())
+            return pd.Series(results.predict(), index=cells)
 
         if convert_to == 'scores':
-            results.predict(soft=False)
+            # Probabilities of every cell type; unlabelled cells are not a cell type
+            scores = pd.DataFrame(results.predict(soft=True))
+            return scores.drop(columns=[_UNLABELED_CATEGORY], errors='ignore').set_axis(cells, axis=0)
 
         raise ValueError(f'{convert_to} is an invalid option for `convert_to`')
 
     def preprocess_ref(self, ref_data: AnnData, cell_type_col: str = '', batch_col: str = '', ref_type: str = 'counts',
-                       **_: Any) -> SCANVI:
+                       training_profile: Union[str, TrainingProfile, Dict[str, Any], None] = None, **_: Any) -> SCANVI:
         """Preprocesses the reference data into a `SCANVI` model.
 
         Arguments:
@@ -77,33 +145,68 @@ class ScanviInterface(CTAToolInterface):
             cell_type_col (str): the name of the observation column in `ref_data` containing the cell types
             batch_col (str): the name of the observation column in `ref_data` containing the batch IDs
             ref_type (str): the type of the reference
+            training_profile (str/TrainingProfile/dict): budgets of training the `SCVI` and `SCANVI` models, see
+                `resolve_profile`
 
         Returns:
             A trained `SCANVI` model that can be used to predict cell types
         """
 
-        SCVI.setup_anndata(ref_data, layer=ref_type, batch_key='batch')
-        vae = SCVI(
-            ref_data,
-            n_layers=2,
-            encode_covariates=True,
-            deeply_inject_covariates=False,
-            use_layer_norm='both',
-            use_batch_norm='none',
-        )
+        SCVI.setup_anndata(ref_data, layer=ref_type, batch_key=batch_col)
+        vae = SCVI(ref_data, **self._scvi_kwargs)
 
-        vae.train()
+        profile = resolve_profile(training_profile)
+        train(vae, 'scvi', profile, 'ScanVI')
 
-        scanvae = SCANVI.from_scvi_model(vae, unlabeled_category='Unknown')
+        scanvae = SCANVI.from_scvi_model(vae, unlabeled_category=_UNLABELED_CATEGORY, labels_key=cell_type_col)
 
-        scanvae.train(max_epochs=20)
+        train(scanvae, 'scanvi', profile, 'ScanVI')
 
         reference_latent = AnnData(scanvae.get_latent_representation())
-        reference_latent['scanvi_cell_type'] = ref_data.obs[cell_type_col].tolist()
-        reference_latent['scanvi_batch'] = ref_data.obs[batch_col].tolist()
+        reference_latent.obs['scanvi_cell_type'] = ref_data.obs[cell_type_col].tolist()
+        reference_latent.obs['scanvi_batch'] = ref_data.obs[batch_col].tolist()
 
-        reference_latent['scanvi_predictions'] = scanvae.predict()
-        accuracy = np.mean(reference_latent.obs.scanvi_predictions == reference_latent.obs.cell_type)
+        reference_latent.obs['scanvi_predictions'] = scanvae.predict()
+        accuracy = np.mean(reference_latent.obs.scanvi_predictions == reference_latent.obs.scanvi_cell_type)
         logging.info(f'ScanVI: {accuracy = :.4%}')
 
         return scanvae
+
+    def ref_cache_parts(self, ref_data: AnnData, cell_type_col: str = '', batch_col: str = '',
+                        ref_type: str = 'counts',
+                        training_profile: Union[str, TrainingProfile, Dict[str, Any], None] = None,
+                        **_: Any) -> Optional[Dict[str, Any]]:
+        """Describes a trained `SCANVI` reference model for the model cache.
+
+        Arguments:
+            ref_data (AnnData): the reference data to process
+            cell_type_col (str): the name of the observation column in `ref_data` containing the cell types
+            batch_col (str): the name of the observation column in `ref_data` containing the batch IDs
+            ref_type (str): the type of the reference
+            training_profile (str/TrainingProfile/dict): budgets of training the reference model
+
+        Returns:
+            dict describing the trained model
+        """
+
+        obs_columns = [column for column in (cell_type_col, batch_col) if column]
+        return {
+            'ref': fingerprint(ref_data, layer=ref_type, obs_columns=obs_columns),
+            'cell_type_col': cell_type_col,
+            'batch_col': batch_col,
+            'ref_type': ref_type,
+            'scvi_kwargs': self._scvi_kwargs,
+            'training': resolve_profile(training_profile).describe(),
+        }
+
+    def save_ref(self, model: SCANVI, path: Path) -> None:
+        model.save(str(path), overwrite=True)
+
+    def load_ref(self, path: Path, ref_data: AnnData, **_: Any) -> SCANVI:
+        return SCANVI.load(str(path), adata=ref_data)
+
+    def save_state(self, state: SCANVI, path: Path) -> None:
+        state.save(str(path), overwrite=True)
+
+    def load_state(self, path: Path, expr_data: AnnData, ref_data: SCANVI, **_: Any) -> SCANVI:
+        return SCANVI.load(str(path), adata=expr_data)
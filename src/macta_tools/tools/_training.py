@@ -0,0 +1,208 @@
+"""Training budgets of the models that tools train (epochs, batch size, early stopping, threads), as speed/accuracy
+profiles.
+
+Nothing here imports the training backends: `torch` is only imported when a thread count is set, so profiles can be
+resolved and validated without the tool being installed.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field, fields, replace
+from typing import Any, Dict, Iterator, Mapping, Optional, Union
+
+from macta_tools.utils.profiling import stage
+
+TRAINING_PHASES = ('scvi', 'scanvi', 'query')
+
+# Metric monitored for early stopping, the evidence lower bound on the validation cells
+EARLY_STOPPING_MONITOR = 'elbo_validation'
+
+
+@dataclass(frozen=True)
+class PhaseBudget:
+    """Training budget of one phase.
+
+    Attributes:
+        max_epochs (int): maximum number of epochs
+        batch_size (int): number of cells per mini-batch
+        early_stopping (bool): whether training stops once the validation ELBO stops improving
+        early_stopping_patience (int): number of validation checks without improvement before training stops
+        check_val_every_n_epoch (int): number of epochs between validation checks
+        train_size (float): fraction of the cells trained on, the others are used for validation
+        plan_kwargs (Mapping[str, Any]): key word arguments of the training plan, e.g. `{'weight_decay': 0.0}`
+    """
+
+    max_epochs: int = 400
+    batch_size: int = 128
+    early_stopping: bool = True
+    early_stopping_patience: int = 10
+    check_val_every_n_epoch: int = 1
+    train_size: float = 0.9
+    plan_kwargs: Mapping[str, Any] = field(default_factory=dict)
+
+    def __post_init__(self) -> None:
+        if self.max_epochs < 1 or self.batch_size < 1 or self.check_val_every_n_epoch < 1:
+            raise ValueError('`max_epochs`, `batch_size` and `check_val_every_n_epoch` must be positive')
+        if not 0 < self.train_size <= 1:
+            raise ValueError(f'`train_size` must be in (0, 1], got {self.train_size}')
+        if self.early_stopping and self.train_size == 1:
+            raise ValueError('early stopping needs validation cells, so `train_size` must be below 1')
+
+
+@dataclass(frozen=True)
+class TrainingProfile:
+    """Training budgets of every phase, and the resources training uses.
+
+    Attributes:
+        scvi (PhaseBudget): budget of the unsupervised reference model (`SCVI`)
+        scanvi (PhaseBudget): budget of the semi-supervised reference model (`SCANVI`), fine-tuned from `scvi`
+        query (PhaseBudget): budget of mapping the query onto the reference model
+        num_workers (int): number of dataloader worker processes, batches are loaded in the training process if 0
+        n_threads (int): number of threads of `torch` while training, unchanged if `None`
+    """
+
+    scvi: PhaseBudget = PhaseBudget()
+    scanvi: PhaseBudget = PhaseBudget(max_epochs=20, early_stopping_patience=5)
+    query: PhaseBudget = PhaseBudget(max_epochs=100, plan_kwargs={'weight_decay': 0.0})
+    num_workers: int = 0
+    n_threads: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if self.num_workers < 0:
+            raise ValueError(f'`num_workers` must not be negative, got {self.num_workers}')
+        if self.n_threads is not None and self.n_threads < 1:
+            raise ValueError(f'`n_threads` must be positive, got {self.n_threads}')
+
+    def budget(self, phase: str) -> PhaseBudget:
+        """Returns the budget of `phase`, one of `TRAINING_PHASES`."""
+
+        if phase not in TRAINING_PHASES:
+            raise ValueError(f'{phase} is an invalid training phase, expected one of {TRAINING_PHASES}')
+        budget: PhaseBudget = getattr(self, phase)
+        return budget
+
+    def train_kwargs(self, phase: str) -> Dict[str, Any]:
+        """Key word arguments of `train` of a `scvi-tools` model for `phase`."""
+
+        budget = self.budget(phase)
+        kwargs: Dict[str, Any] = dict(
+            max_epochs=budget.max_epochs,
+            batch_size=budget.batch_size,
+            train_size=budget.train_size,
+            early_stopping=budget.early_stopping,
+            check_val_every_n_epoch=budget.check_val_every_n_epoch,
+            plan_kwargs=dict(budget.plan_kwargs),
+        )
+        if budget.early_stopping:
+            kwargs.update(early_stopping_monitor=EARLY_STOPPING_MONITOR,
+                          early_stopping_patience=budget.early_stopping_patience)
+        if self.num_workers:
+            kwargs['datasplitter_kwargs'] = {'num_workers': self.num_workers}
+        return kwargs
+
+    def describe(self) -> Dict[str, Any]:
+        """Describes what determines the trained models, for the model cache; the resources are left out."""
+        return {phase: asdict(self.budget(phase)) for phase in TRAINING_PHASES}
+
+
+TRAINING_PROFILES: Dict[str, TrainingProfile] = {
+    'fast': TrainingProfile(
+        scvi=PhaseBudget(max_epochs=50, batch_size=512, early_stopping_patience=5),
+        scanvi=PhaseBudget(max_epochs=10, batch_size=512, early_stopping_patience=3),
+        query=PhaseBudget(max_epochs=50, batch_size=512, early_stopping_patience=5, plan_kwargs={'weight_decay': 0.0}),
+    ),
+    'balanced': TrainingProfile(
+        scvi=PhaseBudget(max_epochs=200, batch_size=256),
+        scanvi=PhaseBudget(max_epochs=20, batch_size=256, early_stopping_patience=5),
+        query=PhaseBudget(max_epochs=100, batch_size=256, plan_kwargs={'weight_decay': 0.0}),
+    ),
+    'accurate': TrainingProfile(
+        scvi=PhaseBudget(max_epochs=400, batch_size=128, early_stopping_patience=25),
+        scanvi=PhaseBudget(max_epochs=50, batch_size=128, early_stopping_patience=10),
+        query=PhaseBudget(max_epochs=200, batch_size=128, early_stopping_patience=20,
+                          plan_kwargs={'weight_decay': 0.0}),
+    ),
+}
+
+DEFAULT_PROFILE = 'balanced'
+
+
+def resolve_profile(profile: Union[str, TrainingProfile, Mapping[str, Any], None] = None) -> TrainingProfile:
+    """Resolves a training profile.
+
+    Arguments:
+        profile (str/TrainingProfile/Mapping): name of one of `TRAINING_PROFILES`, an explicit profile, or a mapping
+            overriding a named profile, e.g. `{'base': 'fast', 'scvi': {'max_epochs': 30}, 'n_threads': 4}`, where
+            `base` defaults to `DEFAULT_PROFILE`. `DEFAULT_PROFILE` if `None`
+
+    Returns:
+        the resolved `TrainingProfile`
+    """
+
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if isinstance(profile, TrainingProfile):
+        return profile
+    if isinstance(profile, str):
+        if profile not in TRAINING_PROFILES:
+            raise ValueError(f'{profile} is an invalid training profile, expected one of {tuple(TRAINING_PROFILES)}')
+        return TRAINING_PROFILES[profile]
+    if not isinstance(profile, Mapping):
+        raise TypeError(f'a training profile must be a name, a `TrainingProfile` or a mapping, got {type(profile)}')
+
+    overrides = dict(profile)
+    base = resolve_profile(overrides.pop('base', DEFAULT_PROFILE))
+    unknown = set(overrides) - {profile_field.name for profile_field in fields(TrainingProfile)}
+    if unknown:
+        raise ValueError(f'unknown training profile options: {sorted(unknown)}')
+
+    for phase in TRAINING_PHASES:
+        if isinstance(overrides.get(phase), Mapping):
+            budget_fields = {budget_field.name for budget_field in fields(PhaseBudget)}
+            unknown = set(overrides[phase]) - budget_fields
+            if unknown:
+                raise ValueError(f'unknown options of training phase {phase}: {sorted(unknown)}')
+            overrides[phase] = replace(base.budget(phase), **overrides[phase])
+    return replace(base, **overrides)
+
+
+@contextmanager
+def torch_threads(n_threads: Optional[int]) -> Iterator[None]:
+    """Sets the number of threads of `torch` in the enclosed code, if `n_threads` is set, and restores it after."""
+
+    if n_threads is None:
+        yield
+        return
+
+    import torch
+
+    previous = torch.get_num_threads()
+    torch.set_num_threads(n_threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def train(model: Any, phase: str, profile: TrainingProfile, tool: str) -> float:
+    """Trains `model` within the budget of `phase`, measured as stage `train_<phase>` of the current tool.
+
+    Arguments:
+        model (Any): `scvi-tools` model to train
+        phase (str): training phase, one of `TRAINING_PHASES`
+        profile (TrainingProfile): budgets and resources of the training
+        tool (str): name of the tool, for the log
+
+    Returns:
+        wall time of the training in seconds
+    """
+
+    kwargs = profile.train_kwargs(phase)
+    with stage(f'train_{phase}'), torch_threads(profile.n_threads):
+        start = time.perf_counter()
+        model.train(**kwargs)
+        seconds = time.perf_counter() - start
+
+    logging.info(f'{tool}: trained the {phase} phase for at most {kwargs["max_epochs"]} epochs in {seconds:.1f} s')
+    return seconds
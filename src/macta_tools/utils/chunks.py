@@ -0,0 +1,73 @@
+"""Helpers to process `AnnData` objects, possibly backed on disk, a chunk of cells at a time, and to load them (or
+only some of their matrices) into memory."""
+
+from typing import Any, Iterator
+
+from anndata import AnnData
+
+# `anndata.abc` is new in anndata 0.11, which needs Python 3.10
+try:
+    from anndata.abc import CSCDataset, CSRDataset
+except ImportError:
+    from anndata.experimental import CSCDataset, CSRDataset  # type: ignore
+
+# Matrices that are read from disk when they are sliced: backed sparse datasets, and h5py/zarr arrays
+_ON_DISK = (CSRDataset, CSCDataset)
+
+
+def iter_chunks(data: AnnData, chunk_size: int) -> Iterator[AnnData]:
+    """Iterates over consecutive chunks of cells of `data`, loading only one chunk into memory at a time.
+
+    Arguments:
+        data (AnnData): the data to split, which may be backed on disk
+        chunk_size (int): maximum number of cells in each chunk
+
+    Returns:
+        iterator of in-memory `AnnData` objects holding `chunk_size` cells each (except possibly the last)
+    """
+
+    if chunk_size < 1:
+        raise ValueError(f'{chunk_size} is an invalid `chunk_size`, it must be positive')
+
+    for start in range(0, data.n_obs, chunk_size):
+        chunk = data[start:start + chunk_size]
+        yield chunk.to_memory() if data.isbacked else chunk.copy()
+
+
+def is_on_disk(matrix: Any) -> bool:
+    """Whether `matrix` is read from disk when it is accessed (a backed sparse dataset, or an h5py/zarr array)."""
+    return isinstance(matrix, _ON_DISK) or type(matrix).__module__.split('.')[0] in ('h5py', 'zarr')
+
+
+def materialize(matrix: Any) -> Any:
+    """Loads `matrix` into memory if it is on disk (see `is_on_disk`), otherwise returns it unchanged."""
+
+    if isinstance(matrix, _ON_DISK):
+        return matrix.to_memory()
+    if is_on_disk(matrix):
+        return matrix[()]
+    return matrix
+
+
+def _matrices(data: AnnData) -> Iterator[Any]:
+    yield data.X
+    for mapping in (data.layers, data.obsm, data.varm, data.obsp, data.varp):
+        yield from mapping.values()
+    if data.raw is not None:
+        yield data.raw.X
+
+
+def is_lazy(data: Any) -> bool:
+    """Whether `data` is an `AnnData` that is backed, or holds matrices on disk (see `macta_tools.read_input`)."""
+    return isinstance(data, AnnData) and (data.isbacked or any(is_on_disk(matrix) for matrix in _matrices(data)))
+
+
+def to_memory(data: Any) -> Any:
+    """Loads all of `data` into memory if it is lazy (see `is_lazy`), otherwise returns it unchanged.
+
+    Memory-mapped arrays are kept as they are, their pages are read as they are accessed.
+    """
+
+    if is_lazy(data):
+        return data.to_memory()
+    return data
@@ -0,0 +1,163 @@
+"""Alignment of the genes of a query to the features of a reference or model, computed once per pair of gene lists.
+
+A `GeneAlignment` maps every feature of a reference to the position of its gene in the query. Genes are matched on
+`var_names`, or on an identifier column of `var` (e.g. `gene_ids` holding Ensembl IDs next to symbols in `var_names`)
+when it shares more genes with the reference, so Ensembl IDs and gene symbols can be matched to each other as long as
+the query holds both. Ensembl version suffixes (`ENSG00000141510.16`) are ignored, and duplicated genes are matched on
+their first occurrence.
+
+Alignments are cached on the gene lists they were computed from, so repeated queries with the same genes against the
+same reference reuse them.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Sequence, Tuple, Union
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from scipy import sparse
+
+# Columns of `var` that may hold other identifiers of the genes than `var_names`, e.g. Ensembl IDs or symbols
+GENE_ID_COLUMNS = ('gene_ids', 'gene_id', 'ensembl_id', 'gene_symbols', 'gene_symbol', 'feature_name', 'symbol')
+
+_ENSEMBL_VERSION = r'^(ENS[A-Z]*[GT]\d+)\.\d+$'
+
+# Number of alignments kept by the cache, least recently used ones are evicted beyond it
+_CACHE_SIZE = 64
+_ALIGNMENTS: 'OrderedDict[bytes, GeneAlignment]' = OrderedDict()
+_ALIGNMENTS_LOCK = threading.Lock()
+
+
+@dataclass(frozen=True)
+class GeneAlignment:
+    """Maps the features of a reference to the genes of a query.
+
+    Attributes:
+        features (Tuple[str, ...]): features of the reference, in the order of the aligned matrix; only the ones found
+            in the query if the alignment was computed with `fill_missing=False`
+        positions (np.ndarray): position in the query of the gene of every feature, -1 for the missing ones
+        n_features (int): number of features of the reference
+        key (str): what the genes were matched on, `'var_names'` or a column of `var`
+        n_duplicates (int): number of query genes that repeat an earlier gene, which are not used
+    """
+
+    features: Tuple[str, ...]
+    positions: npt.NDArray[np.intp]
+    n_features: int
+    key: str = 'var_names'
+    n_duplicates: int = 0
+
+    @property
+    def n_shared(self) -> int:
+        """Number of features of the reference found in the query."""
+        return int((self.positions >= 0).sum())
+
+    @property
+    def overlap(self) -> float:
+        """Fraction of the features of the reference found in the query."""
+        return self.n_shared / self.n_features if self.n_features else 0.0
+
+    def is_identity(self, n_genes: int) -> bool:
+        """Whether the aligned matrix of a query of `n_genes` genes is the query matrix itself."""
+        return len(self.positions) == n_genes and bool((self.positions == np.arange(n_genes)).all())
+
+    def reindex(self, matrix: Any) -> sparse.csr_matrix:
+        """Reorders the columns of the query `matrix` to `self.features`, with zero columns for missing features.
+
+        The columns are gathered with a single sparse product with a selection matrix, so the result stays sparse and
+        `matrix` is read once.
+        """
+
+        found = np.flatnonzero(self.positions >= 0)
+        selection = sparse.csr_matrix((np.ones(len(found), dtype=np.float32), (self.positions[found], found)),
+                                      shape=(matrix.shape[1], len(self.positions)))
+
+        aligned = sparse.csr_matrix(sparse.csr_matrix(matrix) @ selection)
+        aligned.sort_indices()
+        return aligned.astype(matrix.dtype, copy=False)
+
+    def describe(self) -> str:
+        """Describes the overlap, for the logs."""
+        duplicates = f', ignoring {self.n_duplicates} duplicated genes' if self.n_duplicates else ''
+        return f'{self.n_shared} of {self.n_features} reference genes ({self.overlap:.0%}) matched on {self.key}' \
+               f'{duplicates}'
+
+
+def _normalize(genes: Any) -> pd.Index:
+    """Gene identifiers as strings, without the version suffixes of Ensembl IDs."""
+    return pd.Index(pd.Series(np.asarray(genes), dtype=str).str.replace(_ENSEMBL_VERSION, r'\1', regex=True))
+
+
+def _candidates(var: Union[pd.DataFrame, pd.Index]) -> Tuple[Tuple[str, pd.Index], ...]:
+    """Identifiers of the genes of the query that may match the reference: `var_names` and `GENE_ID_COLUMNS`."""
+
+    if isinstance(var, pd.Index):
+        return (('var_names', var),)
+    columns = [column for column in GENE_ID_COLUMNS if column in var.columns]
+    return (('var_names', var.index), *((column, pd.Index(var[column])) for column in columns))
+
+
+def _cache_key(candidates: Tuple[Tuple[str, pd.Index], ...], features: Sequence[str], fill_missing: bool) -> bytes:
+    digest = hashlib.blake2b(digest_size=32)
+    for name, genes in (*candidates, ('features', features)):
+        digest.update(f'{name}:{len(genes)}:{fill_missing}\0'.encode())
+        digest.update('\0'.join(map(str, genes)).encode())
+    return digest.digest()
+
+
+def _align(candidates: Tuple[Tuple[str, pd.Index], ...], features: Sequence[str], fill_missing: bool
+           ) -> GeneAlignment:
+    normalized = _normalize(features)
+
+    best = None
+    for key, genes in candidates:
+        genes = _normalize(genes)
+        first = ~genes.duplicated()
+        indexer = genes[first].get_indexer(normalized)
+        positions = np.where(indexer >= 0, np.flatnonzero(first)[np.maximum(indexer, 0)], -1)
+        # Ties go to `var_names`, which comes first
+        if best is None or (positions >= 0).sum() > (best[1] >= 0).sum():
+            best = (key, positions, int((~first).sum()))
+
+    assert best is not None
+    key, positions, n_duplicates = best
+    kept = tuple(str(feature) for feature, position in zip(features, positions) if fill_missing or position >= 0)
+    return GeneAlignment(kept, positions if fill_missing else positions[positions >= 0], len(features), key,
+                         n_duplicates)
+
+
+def gene_alignment(var: Union[pd.DataFrame, pd.Index], features: Sequence[str], fill_missing: bool = True
+                   ) -> GeneAlignment:
+    """Aligns the genes of a query to `features`, reusing the alignment if these gene lists were already aligned.
+
+    Arguments:
+        var (DataFrame/Index): `var` of the query, whose index and `GENE_ID_COLUMNS` are matched, or its `var_names`
+        features (Sequence[str]): features of the reference or model, in the order of the aligned matrix
+        fill_missing (bool): if `True`, features missing from the query are kept (as zero columns once reindexed);
+            otherwise only the features found in the query are kept, in the order of `features`
+
+    Returns:
+        the `GeneAlignment`, matched on whichever of `var_names` and the identifier columns shares the most genes
+    """
+
+    candidates = _candidates(var)
+    key = _cache_key(candidates, features, fill_missing)
+
+    with _ALIGNMENTS_LOCK:
+        if key in _ALIGNMENTS:
+            _ALIGNMENTS.move_to_end(key)
+            return _ALIGNMENTS[key]
+
+    alignment = _align(candidates, features, fill_missing)
+    logging.debug(f'Aligned genes: {alignment.describe()}')
+
+    with _ALIGNMENTS_LOCK:
+        _ALIGNMENTS[key] = alignment
+        while len(_ALIGNMENTS) > _CACHE_SIZE:
+            _ALIGNMENTS.popitem(last=False)
+    return alignment
@@ -0,0 +1,81 @@
+"""Isolated copies of `AnnData` objects that share their matrices, so that every tool can modify its inputs freely.
+
+Tools modify the `AnnData` objects they are given (e.g. `SCVI.setup_anndata` registers fields in `obs` and `uns`,
+`celltypist` stores its neighbourhood graph), which makes the results of a tool depend on the tools run before it.
+`isolate` gives each tool its own annotations while sharing the (large) matrices of the original object read-only:
+in-place writes into a shared matrix raise instead of leaking into other tools, and functions that replace a matrix
+(e.g. `scanpy.pp.normalize_total`, which allocates a new one when `X` is read-only) only do so in the isolated copy.
+"""
+
+from typing import Any, Mapping, MutableMapping
+
+import numpy as np
+from anndata import AnnData
+from scipy import sparse
+
+
+def read_only(matrix: Any) -> Any:
+    """Returns a read-only view of a dense or compressed sparse matrix, sharing its buffers.
+
+    Arguments:
+        matrix (Any): `numpy` array or `scipy.sparse` CSR/CSC matrix; other objects are returned unchanged
+
+    Returns:
+        matrix of the same type, whose buffers cannot be written into
+    """
+
+    if isinstance(matrix, np.ndarray):
+        view = matrix.view()
+        view.flags.writeable = False
+        return view
+
+    if isinstance(matrix, (sparse.csr_matrix, sparse.csc_matrix)):
+        buffers = tuple(read_only(buffer) for buffer in (matrix.data, matrix.indices, matrix.indptr))
+        return type(matrix)(buffers, shape=matrix.shape, copy=False)
+
+    return matrix
+
+
+def _copy_nested(mapping: Mapping[str, Any]) -> MutableMapping[str, Any]:
+    """Copies the nested dicts of `mapping` (e.g. `uns`), sharing their other values."""
+    return {key: _copy_nested(value) if isinstance(value, Mapping) else value for key, value in mapping.items()}
+
+
+def _read_only_mapping(mapping: Mapping[str, Any]) -> MutableMapping[str, Any]:
+    return {key: read_only(value) for key, value in mapping.items()}
+
+
+def isolate(data: Any) -> Any:
+    """Returns a copy of `data` that shares its matrices read-only and owns its annotations.
+
+    `X`, `layers`, `obsm`, `varm`, `obsp`, `varp` and `raw.X` are shared as read-only views. `obs`, `var` and `raw.var`
+    are copied (their indexes, which are immutable, are shared), as are the nested dicts of `uns`. Matrices on disk,
+    e.g. `X` of a backed `AnnData`, are shared as they are and stay on disk.
+
+    Arguments:
+        data (Any): data to isolate; types other than `AnnData` are returned unchanged
+
+    Returns:
+        isolated `AnnData`, which takes about as much memory as the annotations of `data`
+    """
+
+    if not isinstance(data, AnnData):
+        return data
+
+    isolated = AnnData(
+        read_only(data.X),
+        obs=data.obs.copy(),
+        var=data.var.copy(),
+        uns=_copy_nested(data.uns),
+        obsm=_read_only_mapping(data.obsm),
+        varm=_read_only_mapping(data.varm),
+        obsp=_read_only_mapping(data.obsp),
+        varp=_read_only_mapping(data.varp),
+        layers=_read_only_mapping(data.layers),
+    )
+
+    if data.raw is not None:
+        isolated.raw = AnnData(read_only(data.raw.X), var=data.raw.var.copy(),
+                               varm=_read_only_mapping(data.raw.varm))
+
+    return isolated
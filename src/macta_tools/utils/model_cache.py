@@ -0,0 +1,180 @@
+"""Persistent, content-addressed on-disk cache for trained reference models."""
+
+import hashlib
+import json
+import logging
+import shutil
+import tempfile
+import time
+from contextlib import suppress
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+_ENTRY_FILE = 'entry.json'
+_MODEL_DIR = 'model'
+
+
+def _directory_size(path: Path) -> int:
+    return sum(file.stat().st_size for file in path.rglob('*') if file.is_file())
+
+
+class ModelCache:
+    """Directory of trained models keyed on a hash of everything that determines the model.
+
+    Every entry is stored in `<directory>/<key>/`, where `model/` holds whatever the tool saved and `entry.json` holds
+    the entry's size and last access time. When the cache grows beyond `max_bytes` or `max_entries`, the least recently
+    used entries are evicted.
+    """
+
+    def __init__(self, directory: Union[str, Path], max_bytes: Optional[int] = None,
+                 max_entries: Optional[int] = None):
+        """Creates a cache in `directory`, which is created if it does not exist.
+
+        Arguments:
+            directory (str/Path): directory in which the models are stored
+            max_bytes (int): maximum total size of all stored models, unlimited if `None`
+            max_entries (int): maximum number of stored models, unlimited if `None`
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self) -> str:
+        return f'{type(self).__name__}({str(self.directory)!r}, max_bytes={self.max_bytes}, ' \
+            f'max_entries={self.max_entries})'
+
+    @staticmethod
+    def key(**parts: Any) -> str:
+        """Builds a cache key from JSON-serializable `parts` (fingerprints, column names, hyperparameters...)."""
+        encoded = json.dumps(parts, sort_keys=True, default=str).encode()
+        return hashlib.blake2b(encoded, digest_size=20).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.directory / key
+
+    def __contains__(self, key: str) -> bool:
+        return (self._entry(key) / _ENTRY_FILE).is_file()
+
+    def _touch(self, key: str) -> None:
+        entry_file = self._entry(key) / _ENTRY_FILE
+        # The entry may have been evicted by another process in the meantime
+        with suppress(OSError, ValueError):
+            entry = json.loads(entry_file.read_text())
+            entry['last_used'] = time.time()
+            entry_file.write_text(json.dumps(entry))
+
+    def load(self, key: str, loader: Callable[[Path], Any]) -> Optional[Any]:
+        """Loads the model stored under `key`.
+
+        Arguments:
+            key (str): key of the model, as returned by `ModelCache.key`
+            loader (Callable): function that loads the model from the directory it was saved in
+
+        Returns:
+            the loaded model, or `None` if there is no model stored under `key` or it could not be loaded
+        """
+
+        if key not in self:
+            return None
+
+        try:
+            model = loader(self._entry(key) / _MODEL_DIR)
+        except Exception as e:
+            logging.warning(f'Model cache: could not load entry {key} ({e}). Discarding it.')
+            self.remove(key)
+            return None
+
+        self._touch(key)
+        return model
+
+    def store(self, key: str, model: Any, saver: Callable[[Any, Path], None]) -> None:
+        """Stores `model` under `key`, then evicts old entries if the cache is over its limits.
+
+        Arguments:
+            key (str): key of the model, as returned by `ModelCache.key`
+            model (Any): the model to store
+            saver (Callable): function that saves `model` into an existing, empty directory
+        """
+
+        # Save into a temporary directory first, so that concurrent readers never see a partially written entry
+        staging = Path(tempfile.mkdtemp(prefix=f'.{key}-', dir=self.directory))
+        try:
+            (staging / _MODEL_DIR).mkdir()
+            saver(model, staging / _MODEL_DIR)
+            now = time.time()
+            entry = {'size': _directory_size(staging / _MODEL_DIR), 'created': now, 'last_used': now}
+            (staging / _ENTRY_FILE).write_text(json.dumps(entry))
+
+            self.remove(key)
+            staging.rename(self._entry(key))
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def remove(self, key: str) -> None:
+        """Removes the entry stored under `key`, if any."""
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+
+    def entries(self) -> List[Tuple[str, Dict[str, Any]]]:
+        """Lists all the `(key, entry)` pairs in the cache, from the least to the most recently used."""
+
+        entries = []
+        for entry_file in self.directory.glob(f'*/{_ENTRY_FILE}'):
+            # Hidden directories are entries that are still being stored
+            if entry_file.parent.name.startswith('.'):
+                continue
+
+            try:
+                entries.append((entry_file.parent.name, json.loads(entry_file.read_text())))
+            except (OSError, ValueError):
+                continue
+
+        return sorted(entries, key=lambda item: item[1]['last_used'])
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes least recently used entries until the cache is within `max_bytes` and `max_entries`.
+
+        Arguments:
+            keep (str): key of an entry that is never evicted, e.g. the one that was just stored
+        """
+
+        entries = self.entries()
+        total_bytes = sum(entry['size'] for _, entry in entries)
+        n_entries = len(entries)
+
+        for key, entry in entries:
+            over_bytes = self.max_bytes is not None and total_bytes > self.max_bytes
+            over_entries = self.max_entries is not None and n_entries > self.max_entries
+            if not (over_bytes or over_entries):
+                break
+
+            if key == keep:
+                continue
+
+            self.remove(key)
+            total_bytes -= entry['size']
+            n_entries -= 1
+
+
+@dataclass
+class CacheEntry:
+    """One entry of a `ModelCache`, for code that loads or stores a single model without knowing how it is keyed.
+
+    Attributes:
+        cache (ModelCache): the cache holding the entry
+        key (str): key of the entry, as returned by `ModelCache.key`
+    """
+
+    cache: ModelCache
+    key: str
+
+    def load(self, loader: Callable[[Path], Any]) -> Optional[Any]:
+        """Loads the model of this entry, see `ModelCache.load`."""
+        return self.cache.load(self.key, loader)
+
+    def store(self, model: Any, saver: Callable[[Any, Path], None]) -> None:
+        """Stores `model` into this entry, see `ModelCache.store`."""
+        self.cache.store(self.key, model, saver)
@@ -0,0 +1,210 @@
+"""Per-tool, per-stage instrumentation of annotation runs (wall time, CPU time and peak resident memory).
+
+Instrumented code marks its stages with the module-level `stage` context manager. It only measures anything while a
+`Profiler` is active for the current tool (see `Profiler.tool`), so instrumentation costs a single context variable
+lookup when profiling is disabled.
+"""
+
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Callable, ContextManager, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pandas as pd
+
+_ACTIVE: ContextVar[Optional[Tuple['Profiler', str]]] = ContextVar('macta_tools_profiler', default=None)
+
+
+def current_rss() -> Optional[int]:
+    """Current resident memory of this process in bytes, or `None` where `/proc` is not available."""
+
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+@dataclass
+class StageRecord:
+    """Measurements of one run of one stage of one tool.
+
+    Attributes:
+        tool (str): name of the tool
+        stage (str): name of the stage, e.g. `'annotate'`
+        wall_seconds (float): elapsed wall time
+        cpu_seconds (float): CPU time of the whole process (all threads) during the stage
+        start_rss_bytes (int): resident memory when the stage started, `None` if unavailable
+        peak_rss_bytes (int): highest resident memory sampled during the stage, `None` if unavailable
+    """
+
+    tool: str
+    stage: str
+    wall_seconds: float
+    cpu_seconds: float
+    start_rss_bytes: Optional[int] = None
+    peak_rss_bytes: Optional[int] = None
+
+
+class _MemorySampler:
+    """Background thread that keeps track of the peak resident memory of every running stage."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.peaks: Dict[int, int] = {}
+        self._users = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        rss = current_rss()
+        if rss is None:
+            return
+        for key, peak in list(self.peaks.items()):
+            if rss > peak:
+                self.peaks[key] = rss
+
+    def start(self) -> None:
+        with self._lock:
+            self._users += 1
+            if self._thread is None:
+                self._stop.clear()
+                self._thread = threading.Thread(target=self._run, name='macta-tools-memory', daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._lock:
+            self._users -= 1
+            if self._users == 0 and self._thread is not None:
+                self._stop.set()
+                self._thread.join()
+                self._thread = None
+
+
+class Profiler:
+    """Collects a `StageRecord` for every instrumented stage run while it is active.
+
+    Pass a `Profiler` to `annotate` (or `run_tool`) and read its `records`, `report()`, or export them with
+    `to_json`/`to_csv` afterwards. CPU time and resident memory are process-wide, so when tools run concurrently on
+    threads their measurements overlap.
+    """
+
+    def __init__(self, track_memory: bool = True, memory_interval: float = 0.005,
+                 callback: Optional[Callable[[StageRecord], None]] = None):
+        """Creates an empty profiler.
+
+        Arguments:
+            track_memory (bool): if `True`, samples resident memory on a background thread during stages
+            memory_interval (float): seconds between two memory samples
+            callback (Callable): function called with every new `StageRecord`, e.g. to feed a metrics system
+        """
+        self.track_memory = track_memory
+        self.memory_interval = memory_interval
+        self.callback = callback
+        self.records: List[StageRecord] = []
+        self._sampler = _MemorySampler(memory_interval)
+        self._keys = itertools.count()
+
+    def __reduce__(self) -> Tuple[type, Tuple[bool, float]]:
+        # Copies sent to worker processes start empty, without callback; their records are merged back with `add`
+        return type(self), (self.track_memory, self.memory_interval)
+
+    def add(self, records: Iterable[StageRecord]) -> None:
+        """Adds records (e.g. measured in another process) to this profiler."""
+        for record in records:
+            self.records.append(record)
+            if self.callback is not None:
+                self.callback(record)
+
+    @contextmanager
+    def measure(self, tool: str, stage: str) -> Iterator[None]:
+        """Measures the enclosed code as `stage` of `tool`."""
+
+        key = next(self._keys)
+        start_rss = current_rss() if self.track_memory else None
+        if start_rss is not None:
+            self._sampler.peaks[key] = start_rss
+            self._sampler.start()
+
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - start_wall, time.process_time() - start_cpu
+            peak = None
+            if start_rss is not None:
+                self._sampler.sample()
+                self._sampler.stop()
+                peak = self._sampler.peaks.pop(key)
+            self.add([StageRecord(tool, stage, wall, cpu, start_rss, peak)])
+
+    @contextmanager
+    def tool(self, tool_name: str) -> Iterator[None]:
+        """Activates this profiler for `tool_name` in the current context, measuring the enclosed code as `'total'`."""
+
+        token = _ACTIVE.set((self, tool_name))
+        try:
+            with self.measure(tool_name, 'total'):
+                yield
+        finally:
+            _ACTIVE.reset(token)
+
+    def report(self) -> pd.DataFrame:
+        """Summarizes the records per tool and stage.
+
+        Returns:
+            `DataFrame` indexed by (tool, stage) with the number of runs, the total wall and CPU times, and the
+            highest peak resident memory of each stage
+        """
+
+        columns = ['tool', 'stage', 'wall_seconds', 'cpu_seconds', 'start_rss_bytes', 'peak_rss_bytes']
+        frame = pd.DataFrame([asdict(record) for record in self.records], columns=columns)
+        return frame.groupby(['tool', 'stage'], sort=False).agg(
+            runs=('wall_seconds', 'size'),
+            wall_seconds=('wall_seconds', 'sum'),
+            cpu_seconds=('cpu_seconds', 'sum'),
+            peak_rss_bytes=('peak_rss_bytes', 'max'),
+        )
+
+    def to_json(self, path: Union[str, Path]) -> None:
+        """Writes every record to `path` as a JSON list."""
+        with open(path, 'w') as file:
+            json.dump([asdict(record) for record in self.records], file, indent=2)
+
+    def to_csv(self, path: Union[str, Path]) -> None:
+        """Writes every record to `path` as a CSV table."""
+        pd.DataFrame([asdict(record) for record in self.records]).to_csv(path, index=False)
+
+
+def stage(name: str) -> ContextManager[None]:
+    """Measures the enclosed code as stage `name` of the current tool, if a `Profiler` is active.
+
+    Arguments:
+        name (str): name of the stage
+
+    Returns:
+        context manager that measures the stage, or does nothing if no profiler is active
+    """
+
+    active = _ACTIVE.get()
+    if active is None:
+        return nullcontext()
+
+    profiler, tool_name = active
+    return profiler.measure(tool_name, name)
+
+
+def tool_context(profiler: Optional[Profiler], tool_name: str) -> ContextManager[None]:
+    """Returns `profiler.tool(tool_name)`, or a context manager doing nothing if `profiler` is `None`."""
+    return nullcontext() if profiler is None else profiler.tool(tool_name)
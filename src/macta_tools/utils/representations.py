@@ -0,0 +1,218 @@
+"""Representations of an `AnnData` (raw counts, log-normalized data, genes aligned to a reference) that tools declare
+they need, computed once per data set and shared by every tool that needs them.
+
+Representations are computed in sparse form from `layers`, `raw` or `X` (whichever holds the expected values) and
+memoized by `RepresentationCache`, which hands every tool an isolated copy sharing the cached matrix read-only.
+"""
+
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools.utils.chunks import is_on_disk, materialize, to_memory
+from macta_tools.utils.genes import gene_alignment
+from macta_tools.utils.isolation import isolate
+
+REPRESENTATION_KINDS = ('counts', 'lognorm')
+
+# Counts per cell that log-normalized data is scaled to before `log1p`
+TARGET_SUM = 1e4
+
+# Number of cells checked to detect whether a matrix holds counts or log-normalized data
+_N_CHECKED_CELLS = 100
+
+
+@dataclass(frozen=True)
+class Representation:
+    """Representation of the expression data that a tool expects.
+
+    Attributes:
+        kind (str): values of the matrix <counts/lognorm>. Log-normalized data is `log1p` of the counts scaled to
+            `TARGET_SUM` counts per cell
+        counts_layer (str): layer holding the raw counts, if any; the counts are also stored in this layer of the
+            representation, for tools that read them from there
+        genes (Tuple[str, ...]): if set, the genes are reordered to these, with zeros for the genes missing from the
+            data
+    """
+
+    kind: str = 'lognorm'
+    counts_layer: Optional[str] = 'counts'
+    genes: Optional[Tuple[str, ...]] = None
+
+    def __post_init__(self) -> None:
+        if self.kind not in REPRESENTATION_KINDS:
+            raise ValueError(f'{self.kind} is an invalid representation, expected one of {REPRESENTATION_KINDS}')
+
+    def aligned_to(self, genes: Optional[Sequence[str]]) -> 'Representation':
+        """Returns this representation with its genes aligned to `genes`."""
+        return Representation(self.kind, self.counts_layer, None if genes is None else tuple(genes))
+
+
+def _first_rows(matrix: Any) -> npt.NDArray[Any]:
+    rows = matrix[:_N_CHECKED_CELLS]
+    return rows.toarray() if sparse.issparse(rows) else np.asarray(rows)
+
+
+def is_counts(matrix: Any) -> bool:
+    """Whether the first cells of `matrix` hold non-negative integers."""
+    rows = _first_rows(matrix)
+    return bool((rows >= 0).all() and (rows == np.round(rows)).all())
+
+
+def is_lognorm(matrix: Any) -> bool:
+    """Whether the first cells of `matrix` hold `log1p` of counts scaled to `TARGET_SUM` per cell."""
+    rows = _first_rows(matrix)
+    return bool((rows >= 0).all() and np.allclose(np.expm1(rows).sum(axis=1), TARGET_SUM, rtol=1e-3))
+
+
+def find_counts(data: AnnData, counts_layer: Optional[str] = 'counts') -> Any:
+    """Returns the raw counts of `data`, from `layers[counts_layer]`, `X` or `raw.X`, in that order.
+
+    Arguments:
+        data (AnnData): data whose counts to find
+        counts_layer (str): layer that holds the counts, if any
+
+    Returns:
+        matrix of raw counts
+    """
+
+    if counts_layer is not None and counts_layer in data.layers:
+        return data.layers[counts_layer]
+
+    if data.X is not None and is_counts(data.X):
+        return data.X
+
+    if data.raw is not None and data.raw.n_vars == data.n_vars and is_counts(data.raw.X):
+        return data.raw.X
+
+    raise ValueError(f'no raw counts found in `layers[{counts_layer!r}]`, `X` or `raw.X`')
+
+
+def log_normalize(counts: Any) -> sparse.csr_matrix:
+    """Scales every cell of `counts` to `TARGET_SUM` counts and applies `log1p`, keeping the matrix sparse."""
+
+    counts = sparse.csr_matrix(counts)
+    totals = np.asarray(counts.sum(axis=1), dtype=np.float64).ravel()
+    scale = np.divide(TARGET_SUM, totals, out=np.zeros_like(totals), where=totals > 0)
+
+    lognorm = sparse.csr_matrix((counts.data.astype(np.float32), counts.indices, counts.indptr), shape=counts.shape)
+    lognorm.data *= np.repeat(scale, np.diff(counts.indptr)).astype(np.float32)
+    np.log1p(lognorm.data, out=lognorm.data)
+    return lognorm
+
+
+def align_genes(matrix: Any, var: Any, genes: Sequence[str]) -> sparse.csr_matrix:
+    """Reorders the columns of `matrix` (genes `var`, a `var` DataFrame or `var_names`) to `genes`, with zero columns
+    for missing genes, see `macta_tools.utils.genes.gene_alignment`."""
+    return gene_alignment(var, genes).reindex(matrix)
+
+
+class RepresentationCache:
+    """Computes the representations of one data set on demand, memoizing them for the whole run.
+
+    Safe to share between threads; every representation is computed once.
+
+    Attributes:
+        data (AnnData): data set whose representations are computed; backed data is loaded on first use, and of
+            data whose matrices are on disk (see `macta_tools.read_input`), only the matrices that are used
+    """
+
+    def __init__(self, data: Any):
+        self.data = data
+        self._cache: Dict[Representation, AnnData] = {}
+        self._loaded: Dict[int, Tuple[Any, Any]] = {}
+        self._lock = threading.RLock()
+
+    def get(self, representation: Optional[Representation]) -> Any:
+        """Returns an isolated copy of `representation` of the data, computing it if it is not cached yet.
+
+        Arguments:
+            representation (Representation): representation to return; the data is returned as is if `None`, or
+                if it is not an `AnnData`
+
+        Returns:
+            `AnnData` holding the representation in `X`, whose matrices are shared read-only with the cache
+        """
+
+        if representation is None or not isinstance(self.data, AnnData):
+            with self._lock:
+                # Tools that take the data as it is may read any of its matrices
+                self.data = to_memory(self.data)
+            return isolate(self.data)
+
+        with self._lock:
+            if representation not in self._cache:
+                self._cache[representation] = self._compute(representation)
+            return isolate(self._cache[representation])
+
+    def _compute(self, representation: Representation) -> AnnData:
+        if representation.genes is not None:
+            unaligned = self.get(representation.aligned_to(None))
+            alignment = gene_alignment(unaligned.var, representation.genes)
+            logging.info(f'Aligned genes to the reference: {alignment.describe()}')
+            var = pd.DataFrame(index=pd.Index(representation.genes, name=unaligned.var_names.name))
+            matrix = alignment.reindex(unaligned.X)
+            return self._make(matrix, unaligned, var, representation)
+
+        data = self.data
+        if data.isbacked:
+            # Loaded only once, as both representations can derive from the same matrices
+            self.data = data = to_memory(data)
+
+        # Only the matrix that the representation derives from is loaded, if it is on disk
+        if representation.kind == 'counts':
+            matrix = self._load(find_counts(data, representation.counts_layer))
+        elif data.X is not None and is_lognorm(data.X):
+            matrix = self._load(data.X)
+        else:
+            try:
+                matrix = log_normalize(self._load(find_counts(data, representation.counts_layer)))
+            except ValueError:
+                logging.warning('`X` is not log1p-normalized to 10000 counts per cell and holds no raw counts. '
+                                'Using `X` as it is.')
+                matrix = self._load(data.X)
+
+        return self._make(matrix, data, data.var, representation)
+
+    def _load(self, matrix: Any) -> Any:
+        """Loads `matrix` into memory if it is on disk, once for all the representations that derive from it."""
+
+        if not is_on_disk(matrix):
+            return matrix
+        if id(matrix) not in self._loaded:
+            # The matrix is kept alongside its copy, so that its id is not reused
+            self._loaded[id(matrix)] = (matrix, materialize(matrix))
+        return self._loaded[id(matrix)][1]
+
+    @staticmethod
+    def _make(matrix: Any, cells: AnnData, var: pd.DataFrame, representation: Representation) -> AnnData:
+        """Builds a representation, which keeps the per-cell annotations of `cells` (e.g. a precomputed neighbourhood
+        graph in `obsp`), as only the genes differ."""
+
+        layers = {representation.counts_layer: matrix} \
+            if representation.kind == 'counts' and representation.counts_layer is not None else None
+        return AnnData(matrix, obs=cells.obs, var=var, layers=layers,
+                       obsm={key: materialize(value) for key, value in cells.obsm.items()},
+                       obsp={key: materialize(value) for key, value in cells.obsp.items()})
+
+
+def represent(data: Any, representation: Optional[Representation], cache: Optional[RepresentationCache] = None
+              ) -> Any:
+    """Returns `representation` of `data`, from `cache` if it is set (in which case it must be a cache of `data`).
+
+    `data` is returned as it is (loaded into memory if it is lazy, see `utils.chunks.is_lazy`) if `representation` is
+    `None`.
+    """
+
+    if representation is None:
+        return to_memory(data)
+    if cache is None:
+        cache = RepresentationCache(data)
+    return cache.get(representation)
@@ -1,7 +1,9 @@
 from macta_tools.utils.requirements._contains_requirement import ContainsRequirement
+from macta_tools.utils.requirements._dispatch_table import DispatchTable
 from macta_tools.utils.requirements._equality_requirement import EqualityRequirement
 from macta_tools.utils.requirements._is_instance_requirement import IsInstanceRequirement
 from macta_tools.utils.requirements._requirement import Requirement
 from macta_tools.utils.requirements._requirement_list import RequirementList
 
-__all__ = ['Requirement', 'ContainsRequirement', 'IsInstanceRequirement', 'EqualityRequirement', 'RequirementList']
+__all__ = ['Requirement', 'ContainsRequirement', 'IsInstanceRequirement', 'EqualityRequirement', 'RequirementList',
+           'DispatchTable']
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Hashable, List, Mapping, Tuple, Type
+
+from macta_tools.utils.requirements._requirement import Requirement
+from macta_tools.utils.requirements._requirement_list import RequirementList
+
+# Number of combinations of values whose compatible tools are kept, least recently used ones are evicted beyond it
+_CACHE_SIZE = 1024
+
+# Dispatch key of a value that was not given
+_MISSING = object()
+
+
+class DispatchTable:
+    """Requirements of several tools compiled into a lookup of the tools that accept a set of values.
+
+    Values are reduced to the `Requirement.dispatch_key` of every class of requirement on their name (e.g. the type of
+    `ref_data` for an `IsInstanceRequirement`, the value of `annot_type` for an `EqualityRequirement`), and the tools
+    compatible with a combination of keys are computed once. Selecting tools for e.g. the same `annot_type`,
+    `result_type` and kinds of inputs is then a single dictionary lookup, however many tools are registered. Values
+    without a requirement in any tool are ignored.
+
+    The requirements are read when the table is built, so it must be rebuilt if they change.
+
+    Arguments:
+        requirements (Mapping[str, RequirementList]): dict of tool name -> requirements of the tool
+    """
+
+    def __init__(self, requirements: Mapping[str, RequirementList]):
+        self._requirements = dict(requirements)
+
+        # One dispatch key per requirement name and class of requirement, shared by all tools
+        dispatchers: Dict[Tuple[str, Type[Requirement]], Requirement] = {}
+        for requirement_list in self._requirements.values():
+            for name, requirement in requirement_list.requirements.items():
+                dispatchers.setdefault((name, type(requirement)), requirement)
+        self._dispatchers: List[Tuple[str, Requirement]] = [(name, requirement)
+                                                            for (name, _), requirement in dispatchers.items()]
+
+        self._matches: 'OrderedDict[Tuple[Hashable, ...], FrozenSet[str]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def tools(self) -> List[str]:
+        """Names of the tools of the table."""
+        return list(self._requirements)
+
+    def key(self, **values: Any) -> Tuple[Hashable, ...]:
+        """Dispatch keys of `values`, which determine the tools that accept them."""
+        return tuple(requirement.dispatch_key(values[name]) if name in values else _MISSING
+                     for name, requirement in self._dispatchers)
+
+    def match(self, **values: Any) -> FrozenSet[str]:
+        """Names of the tools whose requirements accept `values`, see `RequirementList.check`."""
+
+        key = self.key(**values)
+        try:
+            hash(key)
+            with self._lock:
+                self._matches.move_to_end(key)
+                return self._matches[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable keys cannot be cached
+            return self._match(values)
+
+        matches = self._match(values)
+        with self._lock:
+            self._matches[key] = matches
+            while len(self._matches) > _CACHE_SIZE:
+                self._matches.popitem(last=False)
+        return matches
+
+    def _match(self, values: Mapping[str, Any]) -> FrozenSet[str]:
+        return frozenset(tool_name for tool_name, requirement_list in self._requirements.items()
+                         if requirement_list.check(**values))
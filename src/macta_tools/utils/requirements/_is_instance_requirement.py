@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Hashable, cast
 
 from pydantic import field_validator
 
@@ -21,3 +21,7 @@ class IsInstanceRequirement(Requirement):
 
     def _checker(self, other_value: Any) -> bool:
         return isinstance(other_value, self.value)
+
+    def dispatch_key(self, checked: Any) -> Hashable:
+        """Instances of the same type are all accepted or all rejected."""
+        return cast(Hashable, type(checked))
@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Any, Sequence, Union
+from typing import Any, Hashable, Sequence, Union, cast
 
 
 @dataclass(frozen=True)
@@ -18,6 +18,19 @@ class Requirement(ABC):
             True if this requirement is upheld, False otherwise
         """
 
+    def dispatch_key(self, checked: Any) -> Hashable:
+        """Key of a value that determines whether it upholds this requirement, under which the outcome of checking it
+        is memoized (see `RequirementList.check`). Keys may only depend on the class of the requirement, not on
+        `self.value`, so that requirements of the same class share them.
+
+        Arguments:
+            checked (Any): the value that is checked against this requirement
+
+        Returns:
+            the value itself by default; unhashable keys are checked every time
+        """
+        return cast(Hashable, checked)
+
     def check(self, *args: Union[Sequence[Any], Any]) -> bool:
         """Checks if values uphold this requirement
 
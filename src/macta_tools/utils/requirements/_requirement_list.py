@@ -1,16 +1,22 @@
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Hashable, Optional, Tuple
 
 import pydantic
-from pydantic import field_validator
+from pydantic import PrivateAttr, field_validator
 
 from macta_tools.utils.requirements._is_instance_requirement import IsInstanceRequirement
 from macta_tools.utils.requirements._requirement import Requirement
 
+# Number of memoized outcomes of a `RequirementList`, beyond which they are forgotten
+_MAX_OUTCOMES = 4096
+
 
 # TODO: make this inherit from `dict` and use its methods to store data
 class RequirementList(pydantic.BaseModel):
     requirements: Dict[str, Requirement]
 
+    # Outcome of checking every (requirement name, dispatch key) seen so far
+    _outcomes: Dict[Tuple[str, Hashable], bool] = PrivateAttr(default_factory=dict)
+
     def __init__(self, requirements: Optional[Dict[str, Requirement]] = None, **kwargs: Any):
         if not requirements:
             requirements = {}
@@ -30,6 +36,10 @@ class RequirementList(pydantic.BaseModel):
     def check(self, **kwargs: Any) -> bool:
         """Check if a set of other values is compatible with this `RequirementList`
 
+        Values without a requirement are ignored, so any key word arguments can be passed. The outcome of every
+        requirement is memoized on the `Requirement.dispatch_key` of the value (e.g. its type for an
+        `IsInstanceRequirement`), so repeated checks are dictionary lookups.
+
         Arguments:
             **kwargs: values to be tested against requirements
 
@@ -37,4 +47,21 @@ class RequirementList(pydantic.BaseModel):
             `True` if all of the `other_values` are compatible with this `RequirementList`'s requirements
         """
 
-        return all(self.requirements[k].check(v) for k, v in kwargs.items())
+        requirements = self.requirements
+        return all(self._check_one(name, requirements[name], value) for name, value in kwargs.items()
+                   if name in requirements)
+
+    def _check_one(self, name: str, requirement: Requirement, value: Any) -> bool:
+        key = (name, requirement.dispatch_key(value))
+        try:
+            return self._outcomes[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable keys cannot be memoized
+            return requirement.check(value)
+
+        if len(self._outcomes) >= _MAX_OUTCOMES:
+            self._outcomes.clear()
+        outcome = self._outcomes[key] = requirement.check(value)
+        return outcome
@@ -0,0 +1,145 @@
+"""CPU threads and memory of tool runs: the size of their inputs, the estimates that tools declare from it (see
+`CTAToolInterface.estimate_resources`), the capacity of the node, and limits on the threads of native libraries.
+
+Estimates are deliberately rough upper bounds of the peak of a run, from which the scheduler (see `ResourceScheduler`)
+decides which runs fit on the node together.
+"""
+
+import os
+import sys
+from dataclasses import dataclass
+from typing import Any, Optional, Tuple
+
+# Bytes per stored value of a sparse matrix: a float64 and an int32 column index, which covers most copies tools make
+BYTES_PER_VALUE = 12
+
+# Fraction of the memory available when scheduling starts that runs may use, leaving room for estimation errors
+MEMORY_FRACTION = 0.8
+
+# Environment variables that set the number of threads of native libraries loaded after they are set
+THREAD_VARIABLES = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                    'NUMEXPR_NUM_THREADS', 'NUMBA_NUM_THREADS')
+
+
+@dataclass(frozen=True)
+class DataSize:
+    """Size of a data set, as known without loading its matrices.
+
+    Attributes:
+        n_cells (int): number of cells (rows)
+        n_genes (int): number of genes (columns)
+        n_values (int): number of values stored by the matrix, i.e. its non-zeros if it is sparse
+    """
+
+    n_cells: int = 0
+    n_genes: int = 0
+    n_values: int = 0
+
+    @classmethod
+    def of(cls, data: Any) -> 'DataSize':
+        """Size of `X` of an `AnnData` (in memory, backed or opened by `read_input`), or of a table; other inputs
+        (e.g. the names of models) have size 0."""
+
+        shape = getattr(data, 'shape', None)
+        if shape is None or len(shape) != 2:
+            return cls()
+
+        matrix = getattr(data, 'X', data)
+        if hasattr(matrix, 'nnz'):
+            n_values = int(matrix.nnz)
+        elif hasattr(matrix, 'group'):
+            # Sparse datasets on disk, whose non-zeros are the length of their `data` array
+            n_values = int(matrix.group['data'].shape[0])
+        else:
+            n_values = int(shape[0]) * int(shape[1])
+        return cls(int(shape[0]), int(shape[1]), n_values)
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes of one in-memory sparse copy of the matrix."""
+        return self.n_values * BYTES_PER_VALUE + self.n_cells * 8
+
+    def dense_nbytes(self, n_genes: Optional[int] = None, itemsize: int = 8) -> int:
+        """Bytes of a dense copy of the matrix, restricted to `n_genes` genes if set."""
+        return self.n_cells * min(self.n_genes, self.n_genes if n_genes is None else n_genes) * itemsize
+
+
+@dataclass(frozen=True)
+class ResourceEstimate:
+    """Resources a tool run needs at its peak.
+
+    Attributes:
+        threads (int): number of CPU threads the run keeps busy, to which its native libraries are limited
+        memory (int): peak memory of the run in bytes, besides the memory of the interpreter and imported modules
+    """
+
+    threads: int = 1
+    memory: int = 0
+
+    def __post_init__(self) -> None:
+        if self.threads < 1:
+            raise ValueError(f'`threads` must be positive, got {self.threads}')
+        if self.memory < 0:
+            raise ValueError(f'`memory` must not be negative, got {self.memory}')
+
+
+def available_threads() -> int:
+    """Number of CPU cores this process may run on."""
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def available_memory() -> Optional[int]:
+    """Memory available to new processes in bytes, without swapping, or `None` if it cannot be determined."""
+
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def node_capacity(max_threads: Optional[int] = None, max_memory: Optional[int] = None) -> Tuple[int, Optional[int]]:
+    """Threads and memory that tool runs may use together, `MEMORY_FRACTION` of the available memory by default.
+
+    Returns:
+        `max_threads` or the number of usable cores, and `max_memory` or the default budget in bytes (`None` if the
+        available memory cannot be determined, in which case memory is not limited)
+    """
+
+    if max_threads is None:
+        max_threads = available_threads()
+    if max_memory is None:
+        available = available_memory()
+        max_memory = None if available is None else int(available * MEMORY_FRACTION)
+    return max_threads, max_memory
+
+
+def limit_threads(n_threads: int) -> None:
+    """Limits the native libraries of this process (OpenMP, BLAS, torch, numba) to `n_threads` threads.
+
+    Libraries already loaded are limited at once, and the ones loaded later read the limit from the environment, so
+    this is meant for worker processes that run a single task.
+    """
+
+    for variable in THREAD_VARIABLES:
+        os.environ[variable] = str(n_threads)
+
+    from threadpoolctl import threadpool_limits
+
+    threadpool_limits(n_threads)
+
+    if 'torch' in sys.modules:
+        sys.modules['torch'].set_num_threads(n_threads)
+    if 'numba' in sys.modules:
+        numba = sys.modules['numba']
+        numba.set_num_threads(min(n_threads, numba.config.NUMBA_NUM_THREADS))
@@ -0,0 +1,71 @@
+"""Standard format of the scores that tools output: a cells x cell types `DataFrame` of a configurable float dtype
+(float32 by default), which can keep only the `top_k` best scores of every cell.
+
+Top-k scores are stored as sparse columns whose other entries are `NaN`, i.e. not reported, which is how the results
+files and the consensus already treat missing scores. They take `n_cells * top_k * (itemsize + 4)` bytes per tool,
+whatever the number of cell types.
+"""
+
+from typing import Any, List, Optional
+
+import numpy as np
+import pandas as pd
+
+SCORE_DTYPES = ('float16', 'float32', 'float64')
+
+# Number of cells whose best scores `format_scores` selects at a time
+_BLOCK_SIZE = 2 ** 16
+
+
+def check_score_format(score_dtype: Any = 'float32', score_top_k: Any = None) -> List[str]:
+    """Checks the options of `format_scores`, returning the problems found."""
+
+    problems = []
+    if score_dtype not in SCORE_DTYPES:
+        problems.append(f'{score_dtype} is an invalid `score_dtype`, expected one of {SCORE_DTYPES}')
+    if score_top_k is not None and (not isinstance(score_top_k, int) or score_top_k < 1):
+        problems.append(f'`score_top_k` must be a positive integer, got {score_top_k!r}')
+    return problems
+
+
+def format_scores(scores: pd.DataFrame, dtype: str = 'float32', top_k: Optional[int] = None) -> pd.DataFrame:
+    """Casts scores to `dtype`, keeping only the `top_k` best scores of every cell if it is set.
+
+    Arguments:
+        scores (DataFrame): cells x cell types scores
+        dtype (str): float dtype of the scores, one of `SCORE_DTYPES`
+        top_k (int): number of scores kept per cell, as sparse columns filled with `NaN`; all are kept if `None`
+
+    Returns:
+        `DataFrame` with the same index and columns as `scores`
+    """
+
+    problems = check_score_format(dtype, top_k)
+    if problems:
+        raise ValueError('; '.join(problems))
+
+    if top_k is None or top_k >= scores.shape[1]:
+        return scores.astype(dtype, copy=False)
+
+    # The best scores are selected a block of cells at a time, so that no dense copy of all the scores is made
+    rows, positions, values = [], [], []
+    for start in range(0, len(scores), _BLOCK_SIZE):
+        block = scores.iloc[start:start + _BLOCK_SIZE].to_numpy(dtype=dtype)
+        best = np.argpartition(np.nan_to_num(-block, nan=np.inf), top_k - 1, axis=1)[:, :top_k]
+        rows.append(np.repeat(np.arange(start, start + len(block)), top_k))
+        positions.append(best.ravel())
+        values.append(np.take_along_axis(block, best, axis=1).ravel())
+
+    rows_array, positions_array, values_array = (np.concatenate(parts) for parts in (rows, positions, values))
+    order = np.argsort(positions_array, kind='stable')
+    bounds = np.searchsorted(positions_array[order], np.arange(scores.shape[1] + 1))
+
+    # Every sparse column is built from one dense column at a time
+    sparse_dtype = pd.SparseDtype(dtype, np.nan)
+    columns = {}
+    for position in range(scores.shape[1]):
+        kept = order[bounds[position]:bounds[position + 1]]
+        column = np.full(len(scores), np.nan, dtype=dtype)
+        column[rows_array[kept]] = values_array[kept]
+        columns[position] = pd.arrays.SparseArray(column, dtype=sparse_dtype)
+    return pd.DataFrame(columns, index=scores.index).set_axis(scores.columns, axis=1)
@@ -0,0 +1,58 @@
+"""Checks of the inputs of the tools that are cheap enough to run on every tool before any of them starts.
+
+Every check returns a list of problems (empty if there are none), described in messages that name the offending input,
+so that all problems of all tools can be reported at once.
+"""
+
+from typing import Any, Collection, List, Optional, Sequence, Union
+
+import pandas as pd
+from anndata import AnnData
+
+from macta_tools.utils.genes import gene_alignment
+from macta_tools.utils.representations import find_counts
+
+# Fraction of the genes of a reference that must be measured in the query
+MIN_GENE_OVERLAP = 0.1
+
+
+def check_kwargs(kwargs: Collection[str], required: Collection[str]) -> List[str]:
+    """Checks that every key word argument in `required` is in `kwargs`."""
+    return [f'missing required key word argument `{kwarg}`' for kwarg in required if kwarg not in kwargs]
+
+
+def check_obs_columns(data: Any, columns: Sequence[Optional[str]], name: str) -> List[str]:
+    """Checks that `data` is an `AnnData` whose `obs` holds every column in `columns` (`None`s are skipped)."""
+
+    if not isinstance(data, AnnData):
+        return [f'`{name}` must be an AnnData, not a {type(data).__name__}']
+    return [f'`{name}` has no obs column {column!r}' for column in columns
+            if column is not None and column not in data.obs.columns]
+
+
+def check_counts(data: Any, layer: Optional[str], name: str) -> List[str]:
+    """Checks that raw integer counts of `data` can be found in `layers[layer]`, `X` or `raw.X`."""
+
+    if not isinstance(data, AnnData):
+        return []
+
+    try:
+        find_counts(data, layer)
+    except ValueError as e:
+        return [f'`{name}` holds no raw counts: {e}']
+    return []
+
+
+def check_gene_overlap(expr_var: Union[pd.DataFrame, pd.Index], ref_genes: Sequence[str],
+                       min_overlap: float = MIN_GENE_OVERLAP, what: str = 'reference genes') -> List[str]:
+    """Checks that at least a `min_overlap` fraction (and at least one) of `ref_genes` is in the genes of `expr_data`,
+    given its `var` (or `var_names`), matched as by `gene_alignment`."""
+
+    if len(ref_genes) == 0:
+        return [f'no {what}']
+
+    alignment = gene_alignment(expr_var, ref_genes)
+    if alignment.n_shared == 0 or alignment.overlap < min_overlap:
+        return [f'only {alignment.n_shared} of {len(ref_genes)} {what} are in `expr_data` (expected at least '
+                f'{min_overlap:.0%}); check that both use the same gene identifiers']
+    return []
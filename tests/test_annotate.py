@@ -0,0 +1,205 @@
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import annotate, annotate_many, prepare
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+
+class CountingInterface(CTAToolInterface):
+    """Labels every cell with the total counts of the reference, so that results depend on both inputs."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+
+    def annotate(self, expr_data: AnnData, ref_data: AnnData, **_: Any) -> pd.Series:
+        return pd.Series(np.asarray(expr_data.X).sum(axis=1) + ref_data.X.sum(), index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+class FailingInterface(CountingInterface):
+    """Interface whose annotation always fails."""
+
+    def annotate(self, expr_data: AnnData, ref_data: AnnData, **_: Any) -> pd.Series:
+        raise RuntimeError('annotation failed')
+
+
+class ChunkedInterface(CountingInterface):
+    """Interface that supports chunks and records the size of every `expr_data` it annotates."""
+
+    _supports_chunks = True
+
+    def __init__(self) -> None:
+        self.sizes: List[int] = []
+
+    def annotate(self, expr_data: AnnData, ref_data: AnnData, **kwargs: Any) -> pd.Series:
+        self.sizes.append(expr_data.n_obs)
+        return super().annotate(expr_data, ref_data, **kwargs)
+
+
+class PreparingInterface(CountingInterface):
+    """Interface that counts how many times it prepared a reference."""
+
+    def __init__(self) -> None:
+        self.n_prepared = 0
+
+    def preprocess_ref(self, ref_data: AnnData, **_: Any) -> AnnData:
+        self.n_prepared += 1
+        return ref_data
+
+
+class MutatingInterface(CountingInterface):
+    """Interface that modifies its inputs in place, like tools that register fields or normalize the data."""
+
+    def preprocess_ref(self, ref_data: AnnData, **_: Any) -> AnnData:
+        ref_data.obs['registered'] = True
+        return ref_data
+
+    def preprocess_expr(self, expr_data: AnnData, **_: Any) -> AnnData:
+        expr_data.uns['normalized'] = True
+        expr_data.X = expr_data.X * 2
+        return expr_data
+
+
+@pytest.fixture
+def data() -> AnnData:
+    return AnnData(np.arange(12, dtype=np.float32).reshape(4, 3))
+
+
+class TestAnnotateExecutors:
+    """Tests that running tools on worker pools gives the same results as running them serially."""
+
+    tool_interfaces: Dict[str, CTAToolInterface] = {
+        'counting': CountingInterface(),
+        'failing': FailingInterface(),
+        'other': CountingInterface(),
+    }
+
+    @pytest.mark.parametrize('executor', ['process', 'thread', 'scheduled'])
+    def test_executor_matches_serial(self, data: AnnData, executor: str) -> None:
+        serial = annotate(data, data, 'ref', tool_interfaces=self.tool_interfaces)
+        parallel = annotate(data, data, 'ref', tool_interfaces=self.tool_interfaces, executor=executor,
+                            max_workers=2)
+
+        assert list(parallel) == list(serial) == ['counting', 'other']
+        for tool_name, result in serial.items():
+            pd.testing.assert_series_equal(parallel[tool_name], result)
+
+    def test_process_paths_not_rewritten(self, data: AnnData, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+                                         ) -> None:
+        """Tests that worker processes open inputs given as files again instead of having them written."""
+
+        data.write_h5ad(tmp_path / 'data.h5ad')
+        serial = annotate(data, data, 'ref', tool_interfaces=self.tool_interfaces)
+
+        def fail(*_: Any, **__: Any) -> None:
+            raise AssertionError('an input file was written again')
+
+        monkeypatch.setattr(AnnData, 'write_h5ad', fail)
+        parallel = annotate(tmp_path / 'data.h5ad', tmp_path / 'data.h5ad', 'ref', tool_interfaces=self.tool_interfaces,
+                            executor='process', max_workers=2)
+
+        assert list(parallel) == list(serial)
+        for tool_name, result in serial.items():
+            pd.testing.assert_series_equal(parallel[tool_name], result)
+
+    def test_annot_tools_selection(self, data: AnnData) -> None:
+        results = annotate(data, data, 'ref', annot_tools=['other'], tool_interfaces=self.tool_interfaces,
+                           executor='thread')
+        assert list(results) == ['other']
+
+    def test_invalid_executor(self, data: AnnData) -> None:
+        with pytest.raises(ValueError):
+            annotate(data, data, 'ref', tool_interfaces=self.tool_interfaces, executor='cluster')
+
+
+class TestAnnotateIsolation:
+    """Tests that tools cannot affect each other's inputs nor the caller's data."""
+
+    def test_tools_isolated(self, data: AnnData) -> None:
+        original = data.copy()
+        tool_interfaces = {'mutating': MutatingInterface(), 'counting': CountingInterface()}
+        results = annotate(data, data, 'ref', tool_interfaces=tool_interfaces)
+
+        expected = annotate(original, original, 'ref', tool_interfaces={'counting': CountingInterface()})
+        pd.testing.assert_series_equal(results['counting'], expected['counting'])
+        np.testing.assert_array_equal(data.X, original.X)
+        assert 'registered' not in data.obs and 'normalized' not in data.uns
+
+    def test_in_place_writes_fail(self, data: AnnData) -> None:
+        class WritingInterface(CountingInterface):
+            def preprocess_expr(self, expr_data: AnnData, **_: Any) -> AnnData:
+                expr_data.X *= 2
+                return expr_data
+
+        assert annotate(data, data, 'ref', tool_interfaces={'writing': WritingInterface()}) == {}
+        np.testing.assert_array_equal(data.X, np.arange(12, dtype=np.float32).reshape(4, 3))
+
+
+class TestAnnotateChunks:
+    """Tests annotating `expr_data` a chunk of cells at a time."""
+
+    @pytest.fixture
+    def expr_data(self) -> AnnData:
+        return AnnData(np.arange(30, dtype=np.float32).reshape(10, 3))
+
+    def test_chunks_match_full(self, expr_data: AnnData, data: AnnData) -> None:
+        interface = ChunkedInterface()
+        full = annotate(expr_data, data, 'ref', tool_interfaces={'chunked': interface})
+        chunked = annotate(expr_data, data, 'ref', tool_interfaces={'chunked': interface}, chunk_size=4)
+
+        pd.testing.assert_series_equal(chunked['chunked'], full['chunked'])
+        assert interface.sizes == [10, 4, 4, 2]
+
+    def test_backed_path(self, expr_data: AnnData, data: AnnData, tmp_path: Path) -> None:
+        expr_data.write_h5ad(tmp_path / 'expr.h5ad')
+        interface = ChunkedInterface()
+        tool_interfaces: Dict[str, CTAToolInterface] = {'chunked': interface, 'counting': CountingInterface()}
+
+        full = annotate(expr_data, data, 'ref', tool_interfaces=tool_interfaces)
+        chunked = annotate(tmp_path / 'expr.h5ad', data, 'ref', tool_interfaces=tool_interfaces, chunk_size=3)
+
+        assert list(chunked) == ['chunked', 'counting']
+        for tool_name, result in full.items():
+            pd.testing.assert_series_equal(chunked[tool_name], result)
+        assert interface.sizes == [10, 3, 3, 3, 1]
+
+
+class TestPrepareAnnotateMany:
+    """Tests preparing references once and annotating several query data sets against them."""
+
+    def test_reference_prepared_once(self, data: AnnData) -> None:
+        interface = PreparingInterface()
+        tool_interfaces: Dict[str, CTAToolInterface] = {'preparing': interface, 'failing': FailingInterface()}
+        queries = [data, data[:2].copy(), data[1:].copy()]
+
+        prepared = prepare(data, 'ref', tool_interfaces=tool_interfaces)
+        all_results = annotate_many(prepared, queries)
+
+        assert interface.n_prepared == 1
+        assert len(all_results) == len(queries)
+        for query, results in zip(queries, all_results):
+            assert list(results) == ['preparing']
+            pd.testing.assert_series_equal(results['preparing'],
+                                           annotate(query, data, 'ref', tool_interfaces=tool_interfaces)['preparing'])
+
+    def test_incompatible_tools_not_prepared(self, data: AnnData) -> None:
+        prepared = prepare(data, 'marker', tool_interfaces={'preparing': PreparingInterface()})
+        assert prepared == {}
+
+    def test_paths_and_chunks(self, data: AnnData, tmp_path: Path) -> None:
+        data.write_h5ad(tmp_path / 'query.h5ad')
+        interface = ChunkedInterface()
+
+        prepared = prepare(data, 'ref', tool_interfaces={'chunked': interface})
+        [results] = annotate_many(prepared, [tmp_path / 'query.h5ad'], chunk_size=3)
+
+        expected = annotate(data, data, 'ref', tool_interfaces={'chunked': ChunkedInterface()})
+        pd.testing.assert_series_equal(results['chunked'], expected['chunked'])
+        assert interface.sizes == [3, 1]
@@ -0,0 +1,132 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+import numpy.typing as npt
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import RunDirectory, annotate, prepare
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+
+class Preempted(BaseException):
+    """Stands for the run being killed, which the tools cannot catch."""
+
+
+class TrainingInterface(CTAToolInterface):
+    """Interface that trains a reference and a query model, counting how many times it ran every stage."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+    _caches_ref = True
+    _checkpoints_state = True
+
+    def __init__(self, fail_convert: bool = False) -> None:
+        self.calls: Dict[str, int] = {'preprocess_ref': 0, 'annotate': 0, 'convert': 0}
+        self.fail_convert = fail_convert
+
+    def preprocess_ref(self, ref_data: AnnData, **_: Any) -> float:
+        self.calls['preprocess_ref'] += 1
+        return float(ref_data.X.sum())
+
+    def ref_cache_parts(self, ref_data: AnnData, **_: Any) -> Optional[Dict[str, Any]]:
+        return {'total': float(ref_data.X.sum())}
+
+    def save_ref(self, model: float, path: Path) -> None:
+        (path / 'model.json').write_text(json.dumps(model))
+
+    def load_ref(self, path: Path, ref_data: Any, **_: Any) -> float:
+        return float(json.loads((path / 'model.json').read_text()))
+
+    def annotate(self, expr_data: AnnData, ref_data: float, **_: Any) -> npt.NDArray[np.float64]:
+        self.calls['annotate'] += 1
+        totals: npt.NDArray[np.float64] = np.asarray(expr_data.X).sum(axis=1) + ref_data
+        return totals
+
+    def save_state(self, state: npt.NDArray[np.float64], path: Path) -> None:
+        np.save(path / 'state.npy', state)
+
+    def load_state(self, path: Path, expr_data: Any, ref_data: Any, **_: Any) -> npt.NDArray[np.float64]:
+        state: npt.NDArray[np.float64] = np.load(path / 'state.npy')
+        return state
+
+    def convert(self, results: npt.NDArray[np.float64], convert_to: str, **_: Any) -> pd.DataFrame:
+        self.calls['convert'] += 1
+        if self.fail_convert:
+            raise Preempted()
+        return pd.DataFrame({'score': results}, index=[f'cell_{i}' for i in range(len(results))])
+
+
+@pytest.fixture
+def data() -> AnnData:
+    return AnnData(np.arange(12, dtype=np.float32).reshape(4, 3))
+
+
+class TestRunDirectory:
+    """Tests that runs resume from the last stage every tool completed."""
+
+    def test_resume_completed_tools(self, data: AnnData, tmp_path: Path) -> None:
+        first, second = TrainingInterface(), TrainingInterface(fail_convert=True)
+        with pytest.raises(Preempted):
+            annotate(data, data, 'ref', tool_interfaces={'first': first, 'second': second}, run_dir=tmp_path)
+
+        # The first tool completed, while the second one had trained its reference and query models
+        resumed_first, resumed_second = TrainingInterface(), TrainingInterface()
+        results = annotate(data, data, 'ref', tool_interfaces={'first': resumed_first, 'second': resumed_second},
+                           run_dir=tmp_path)
+
+        assert list(results) == ['first', 'second']
+        assert resumed_first.calls == {'preprocess_ref': 0, 'annotate': 0, 'convert': 0}
+        assert resumed_second.calls == {'preprocess_ref': 0, 'annotate': 0, 'convert': 1}
+        np.testing.assert_allclose(results['first']['score'], np.asarray(data.X).sum(axis=1) + data.X.sum())
+        pd.testing.assert_frame_equal(results['first'], results['second'])
+
+    def test_changed_inputs_not_resumed(self, data: AnnData, tmp_path: Path) -> None:
+        annotate(data, data, 'ref', tool_interfaces={'tool': TrainingInterface()}, run_dir=tmp_path)
+
+        changed = data.copy()
+        changed.X[0, 0] = 100
+        interface = TrainingInterface()
+        annotate(changed, data, 'ref', tool_interfaces={'tool': interface}, run_dir=tmp_path)
+
+        # The reference did not change, so its model is reused, but the query is annotated again
+        assert interface.calls == {'preprocess_ref': 0, 'annotate': 1, 'convert': 1}
+
+    def test_unused_columns_ignored(self, data: AnnData, tmp_path: Path) -> None:
+        """Tests that only the `obs` columns named by the key word arguments key the run."""
+
+        data.obs['cell_type'] = ['a', 'b', 'a', 'b']
+        annotate(data, data, 'ref', tool_interfaces={'tool': TrainingInterface()}, run_dir=tmp_path,
+                 labels='cell_type')
+
+        data.obs['unused'] = 1
+        interface = TrainingInterface()
+        annotate(data, data, 'ref', tool_interfaces={'tool': interface}, run_dir=tmp_path, labels='cell_type')
+        assert interface.calls == {'preprocess_ref': 0, 'annotate': 0, 'convert': 0}
+
+        data.obs['cell_type'] = ['b', 'a', 'b', 'a']
+        annotate(data, data, 'ref', tool_interfaces={'tool': interface}, run_dir=tmp_path, labels='cell_type')
+        assert interface.calls == {'preprocess_ref': 0, 'annotate': 1, 'convert': 1}
+
+    def test_prepare(self, data: AnnData, tmp_path: Path) -> None:
+        prepare(data, 'ref', tool_interfaces={'tool': TrainingInterface()}, run_dir=tmp_path)
+        assert len(RunDirectory(tmp_path).models.entries()) == 1
+
+        interface = TrainingInterface()
+        prepared = prepare(data, 'ref', tool_interfaces={'tool': interface}, run_dir=tmp_path)
+        assert interface.calls['preprocess_ref'] == 0
+        assert prepared['tool'].model == data.X.sum()
+
+    def test_state_checkpoints_undeclared(self, data: AnnData, tmp_path: Path) -> None:
+        """Tests that states of interfaces which do not declare `_checkpoints_state` are never checkpointed."""
+
+        class UncheckpointedInterface(TrainingInterface):
+            _checkpoints_state = False
+
+        annotate(data, data, 'ref', tool_interfaces={'tool': UncheckpointedInterface()}, run_dir=tmp_path)
+        assert not RunDirectory(tmp_path).states.entries()
+        with pytest.raises(TypeError):
+            CTAToolInterface.save_state(UncheckpointedInterface(), np.zeros(1), tmp_path)
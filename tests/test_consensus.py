@@ -0,0 +1,102 @@
+from typing import Dict
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from macta_tools import _consensus, consensus, label_matrix
+
+CELLS = ['c0', 'c1', 'c2', 'c3']
+
+
+@pytest.fixture
+def results() -> Dict[str, pd.Series]:
+    return {
+        'first': pd.Series(['a', 'a', 'b', 'c'], index=CELLS),
+        'second': pd.Series(pd.Categorical(['a', 'b', 'b', None], categories=['b', 'a']), index=CELLS),
+        'third': pd.Series(['b', 'b', 'b', 'd'], index=CELLS),
+    }
+
+
+class TestLabelMatrix:
+    """Tests that the labels of every tool are encoded with one vocabulary."""
+
+    def test_codes(self, results: Dict[str, pd.Series]) -> None:
+        matrix = label_matrix(results)
+
+        assert matrix.tools == ['first', 'second', 'third']
+        assert list(matrix.cells) == CELLS
+        frame = matrix.to_frame()
+        for tool, labels in results.items():
+            assert list(frame[tool].astype(object).where(frame[tool].notna(), None)) == \
+                list(labels.astype(object).where(labels.notna(), None))
+        assert matrix.codes[3, 1] == -1
+
+    def test_cells_aligned(self, results: Dict[str, pd.Series]) -> None:
+        results['third'] = pd.Series(['b', 'e'], index=['c1', 'c4'])
+        matrix = label_matrix(results)
+
+        assert list(matrix.cells) == CELLS + ['c4']
+        assert list(matrix.codes[:, 2] >= 0) == [False, True, False, False, True]
+        assert list(matrix.codes[4, :2]) == [-1, -1]
+
+    def test_scores_as_labels(self) -> None:
+        scores = pd.DataFrame({'a': [0.9, 0.2, np.nan], 'b': [0.1, 0.8, np.nan]}, index=['c0', 'c1', 'c2'])
+        labels = label_matrix({'tool': scores}).to_frame()['tool']
+        assert list(labels[:2]) == ['a', 'b'] and pd.isna(labels['c2'])
+
+
+class TestConsensus:
+    """Tests the consensus methods."""
+
+    def test_majority(self, results: Dict[str, pd.Series]) -> None:
+        combined = consensus(results)
+
+        assert list(combined['label']) == ['a', 'b', 'b', 'c']
+        np.testing.assert_allclose(combined['confidence'], [2 / 3, 2 / 3, 1, 1 / 2])
+
+    def test_weighted(self, results: Dict[str, pd.Series]) -> None:
+        combined = consensus(results, 'weighted', weights={'first': 1, 'second': 1, 'third': 3})
+
+        assert list(combined['label']) == ['b', 'b', 'b', 'd']
+        np.testing.assert_allclose(combined['confidence'], [3 / 5, 4 / 5, 1, 3 / 4])
+
+    def test_min_confidence(self, results: Dict[str, pd.Series]) -> None:
+        combined = consensus(results, min_confidence=0.6)
+        assert list(combined['label'].isna()) == [False, False, False, True]
+
+    def test_scores(self) -> None:
+        results = {
+            'first': pd.DataFrame({'a': [0.6, 0.1], 'b': [0.4, 0.9]}, index=['c0', 'c1']),
+            'second': pd.DataFrame({'b': [0.7, 0.5], 'c': [0.3, 0.5]}, index=['c0', 'c1']),
+            'third': pd.Series(['a', 'c'], index=['c0', 'c1']),
+        }
+        combined = consensus(results, 'scores')
+
+        # Cell types missing from the scores of a tool are left out of their average, unlike unpicked labels
+        assert list(combined['label']) == ['a', 'c']
+        np.testing.assert_allclose(combined['confidence'], [(0.6 + 1) / 2, (0.5 + 1) / 2], rtol=1e-6)
+
+    def test_scores_in_blocks(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        """Tests that accumulating the scores a few cells at a time matches all cells at once."""
+
+        rng = np.random.default_rng(0)
+        cells = [f'c{i}' for i in range(10)]
+        results = {
+            'first': pd.DataFrame(rng.random((10, 3)), index=cells, columns=['a', 'b', 'c']),
+            'second': pd.DataFrame(rng.random((6, 2)), index=cells[4:], columns=['c', 'd']),
+            'third': pd.Series(['a', None, 'd'] * 3 + ['b'], index=cells[::-1]),
+        }
+        results['first'].iloc[3] = np.nan
+
+        expected = consensus(results, 'scores')
+        monkeypatch.setattr(_consensus, '_BLOCK_SIZE', 3)
+        pd.testing.assert_frame_equal(consensus(results, 'scores'), expected)
+
+    def test_invalid_arguments(self, results: Dict[str, pd.Series]) -> None:
+        with pytest.raises(ValueError):
+            consensus(results, 'unknown')
+        with pytest.raises(ValueError):
+            consensus(results, 'weighted')
+        with pytest.raises(ValueError):
+            consensus({})
@@ -0,0 +1,176 @@
+from pathlib import Path
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+import pytest
+import scanpy as sc
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools import annotate, read_input
+from macta_tools._inputs import input_format, open_ref
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils import chunks, representations
+from macta_tools.utils.chunks import is_lazy, is_on_disk, to_memory
+from macta_tools.utils.representations import Representation, RepresentationCache
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+
+class LognormInterface(CTAToolInterface):
+    """Interface that expects log-normalized data and labels every cell with its total."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+
+    def expr_representation(self, ref_data: Any, **_: Any) -> Representation:
+        return Representation('lognorm')
+
+    def annotate(self, expr_data: AnnData, ref_data: Any, **_: Any) -> pd.Series:
+        return pd.Series(np.asarray(expr_data.X.sum(axis=1)).ravel(), index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+@pytest.fixture
+def data() -> AnnData:
+    counts = sparse.random(40, 12, density=0.5, format='csr', dtype=np.float32, random_state=0)
+    counts.data = np.ceil(counts.data * 10)
+
+    data = AnnData(counts.copy(), obs=pd.DataFrame({'batch': ['a', 'b'] * 20}, index=[f'c{i}' for i in range(40)]))
+    data.var_names = [f'g{i}' for i in range(data.n_vars)]
+    data.layers['counts'] = counts
+    sc.pp.normalize_total(data, target_sum=1e4)
+    sc.pp.log1p(data)
+    data.obsm['X_pca'] = np.arange(80, dtype=np.float64).reshape(40, 2)
+    return data
+
+
+@pytest.fixture
+def h5ad_file(data: AnnData, tmp_path: Path) -> Path:
+    data.write_h5ad(tmp_path / 'data.h5ad')
+    return tmp_path / 'data.h5ad'
+
+
+class TestReadInput:
+    """Tests opening each input format."""
+
+    def test_h5ad_matrices_stay_on_disk(self, data: AnnData, h5ad_file: Path) -> None:
+        opened = read_input(h5ad_file)
+
+        assert isinstance(opened, AnnData) and is_lazy(opened) and not opened.isbacked
+        assert is_on_disk(opened.X) and is_on_disk(opened.layers['counts'])
+        pd.testing.assert_frame_equal(opened.obs, data.obs)
+
+        # Contiguous arrays are mapped read-only rather than read
+        assert isinstance(opened.obsm['X_pca'], np.ndarray) and not opened.obsm['X_pca'].flags.writeable
+        assert not opened.obsm['X_pca'].flags.owndata
+        np.testing.assert_array_equal(opened.obsm['X_pca'], data.obsm['X_pca'])
+
+        loaded = to_memory(opened)
+        assert not is_lazy(loaded)
+        assert (loaded.layers['counts'] != data.layers['counts']).nnz == 0
+
+    def test_dense_h5ad_is_memory_mapped(self, data: AnnData, tmp_path: Path) -> None:
+        AnnData(data.X.toarray()).write_h5ad(tmp_path / 'dense.h5ad')
+        opened = read_input(tmp_path / 'dense.h5ad')
+
+        assert isinstance(opened, AnnData) and isinstance(opened.X, np.ndarray)
+        assert not opened.X.flags.writeable and not opened.X.flags.owndata
+        np.testing.assert_array_equal(opened.X, data.X.toarray())
+
+    def test_zarr(self, data: AnnData, tmp_path: Path) -> None:
+        data.write_zarr(tmp_path / 'data.zarr')
+        opened = read_input(tmp_path / 'data.zarr')
+
+        assert isinstance(opened, AnnData) and is_on_disk(opened.X)
+        assert (to_memory(opened).X != data.X).nnz == 0
+
+    def test_loom(self, data: AnnData, tmp_path: Path) -> None:
+        pytest.importorskip('loompy')
+        data.write_loom(tmp_path / 'data.loom')
+        opened = read_input(tmp_path / 'data.loom')
+
+        assert isinstance(opened, AnnData) and opened.shape == data.shape
+
+    @pytest.mark.parametrize('name, separator', [('markers.csv', ','), ('markers.tsv', '\t'),
+                                                 ('markers.txt', ';'), ('markers.tsv.gz', '\t')])
+    def test_tables(self, name: str, separator: str, tmp_path: Path) -> None:
+        markers = pd.DataFrame({'cell_type': ['T', 'B'], 'gene': ['CD3E', 'CD19']})
+        markers.to_csv(tmp_path / name, sep=separator, index=False)
+
+        pd.testing.assert_frame_equal(read_input(tmp_path / name), markers)
+
+    def test_models_and_names(self, tmp_path: Path) -> None:
+        model = tmp_path / 'model.pkl'
+        model.write_bytes(b'')
+
+        assert read_input(model) == str(model.resolve())
+        assert open_ref(model) == str(model.resolve())
+        # Models that are not files are names, which the tools resolve
+        assert open_ref('Immune_All_Low.pkl') == 'Immune_All_Low.pkl'
+
+    def test_invalid_inputs(self, tmp_path: Path) -> None:
+        with pytest.raises(FileNotFoundError):
+            open_ref(tmp_path / 'missing.h5ad')
+        with pytest.raises(ValueError):
+            input_format(tmp_path / 'data.rds')
+
+        (tmp_path / 'markers.csv').write_text('cell_type,gene\nT,CD3E\n')
+        with pytest.raises(ValueError):
+            annotate(tmp_path / 'markers.csv', pd.DataFrame(), 'marker')
+
+
+class TestMaterialization:
+    """Tests that only the matrices that tools use are loaded."""
+
+    @pytest.fixture
+    def loaded(self, monkeypatch: pytest.MonkeyPatch) -> List[Any]:
+        loaded: List[Any] = []
+
+        def recording_materialize(matrix: Any) -> Any:
+            if is_on_disk(matrix):
+                loaded.append(matrix)
+            return materialize(matrix)
+
+        materialize = chunks.materialize
+        monkeypatch.setattr(representations, 'materialize', recording_materialize)
+        return loaded
+
+    def test_representation_loads_one_matrix(self, data: AnnData, h5ad_file: Path, loaded: List[Any]) -> None:
+        opened = read_input(h5ad_file)
+        assert isinstance(opened, AnnData)
+        cache = RepresentationCache(opened)
+
+        lognorm = cache.get(Representation('lognorm'))
+        assert loaded == [opened.X]
+        np.testing.assert_allclose(lognorm.X.toarray(), data.X.toarray())
+
+        counts = cache.get(Representation('counts'))
+        assert loaded == [opened.X, opened.layers['counts']]
+        assert (counts.X != data.layers['counts']).nnz == 0
+
+        # Loaded once, whatever the number of representations that derive from it
+        cache.get(Representation('counts', genes=('g1', 'g0')))
+        assert len(loaded) == 2
+
+    def test_annotate_path(self, data: AnnData, h5ad_file: Path, loaded: List[Any]) -> None:
+        tool_interfaces = {'first': LognormInterface(), 'second': LognormInterface()}
+
+        from_path = annotate(h5ad_file, data, 'ref', tool_interfaces=tool_interfaces)
+        in_memory = annotate(data, data, 'ref', tool_interfaces=tool_interfaces)
+
+        assert len(loaded) == 1
+        for tool_name, result in in_memory.items():
+            pd.testing.assert_series_equal(from_path[tool_name], result)
+
+    def test_annotate_paths_in_chunks(self, data: AnnData, h5ad_file: Path, tmp_path: Path) -> None:
+        class ChunkedInterface(LognormInterface):
+            _supports_chunks = True
+
+        tool_interfaces = {'chunked': ChunkedInterface()}
+        data.write_zarr(tmp_path / 'ref.zarr')
+
+        chunked = annotate(h5ad_file, tmp_path / 'ref.zarr', 'ref', tool_interfaces=tool_interfaces, chunk_size=7)
+        full = annotate(data, data, 'ref', tool_interfaces=tool_interfaces)
+        pd.testing.assert_series_equal(chunked['chunked'], full['chunked'], rtol=1e-5)
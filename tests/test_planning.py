@@ -0,0 +1,109 @@
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import PlanningError, annotate, plan, prepare
+from macta_tools.tools import CTAToolInterface, MarkerInterface
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+from macta_tools.utils.validation import check_counts, check_gene_overlap, check_obs_columns
+
+
+class TrainingInterface(CTAToolInterface):
+    """Interface that needs a label column of the reference, and records every reference it prepared."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+    _required_kwargs = ['label_col']
+
+    def __init__(self) -> None:
+        self.prepared: List[AnnData] = []
+
+    def validate(self, expr_data: Any, ref_data: AnnData, **kwargs: Any) -> List[str]:
+        problems = super().validate(expr_data, ref_data, **kwargs)
+        return problems + check_obs_columns(ref_data, [kwargs.get('label_col')], 'ref_data')
+
+    def preprocess_ref(self, ref_data: AnnData, **_: Any) -> AnnData:
+        self.prepared.append(ref_data)
+        return ref_data
+
+    def annotate(self, expr_data: AnnData, ref_data: AnnData, label_col: str = '', **_: Any) -> pd.Series:
+        return pd.Series(ref_data.obs[label_col].iloc[0], index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+class OtherTrainingInterface(TrainingInterface):
+    _required_kwargs = ['label_col', 'batch_col']
+
+
+@pytest.fixture
+def data() -> AnnData:
+    data = AnnData(np.arange(12, dtype=np.float32).reshape(4, 3))
+    data.obs['cell_type'] = ['a', 'b', 'a', 'b']
+    return data
+
+
+class TestPlan:
+    """Tests that the inputs of every tool are validated before any tool runs."""
+
+    def test_all_problems_reported(self, data: AnnData) -> None:
+        tool_interfaces = {'training': TrainingInterface(), 'other': OtherTrainingInterface()}
+
+        with pytest.raises(PlanningError) as error:
+            annotate(data, data, 'ref', tool_interfaces=tool_interfaces, label_col='unknown')
+
+        assert error.value.problems == {
+            'training': ["`ref_data` has no obs column 'unknown'"],
+            'other': ['missing required key word argument `batch_col`', "`ref_data` has no obs column 'unknown'"],
+        }
+        assert all(not interface.prepared for interface in tool_interfaces.values())
+
+    def test_skip_invalid(self, data: AnnData) -> None:
+        tool_interfaces = {'training': TrainingInterface(), 'other': OtherTrainingInterface()}
+        results = annotate(data, data, 'ref', tool_interfaces=tool_interfaces, label_col='cell_type',
+                           on_invalid='skip')
+
+        assert list(results) == ['training']
+        assert not tool_interfaces['other'].prepared
+
+    def test_incompatible_tools_skipped(self, data: AnnData) -> None:
+        execution_plan = plan({'training': TrainingInterface(), 'marker': MarkerInterface()}, data, data, 'ref',
+                              'labels', label_col='cell_type')
+
+        assert list(execution_plan.tools) == ['training']
+        assert list(execution_plan.skipped) == ['marker']
+        assert execution_plan.problems == {}
+
+    def test_prepare_validates_reference(self, data: AnnData) -> None:
+        interface = TrainingInterface()
+        with pytest.raises(PlanningError):
+            prepare(data, 'ref', tool_interfaces={'training': interface})
+        assert not interface.prepared
+
+    def test_invalid_option(self, data: AnnData) -> None:
+        with pytest.raises(ValueError):
+            plan({}, data, data, 'ref', 'labels', on_invalid='ignore')
+
+
+class TestValidation:
+    """Tests the checks that interfaces validate their inputs with."""
+
+    def test_marker_validation(self, data: AnnData) -> None:
+        markers = pd.DataFrame({'cell_type': ['a'], 'gene': ['unknown']})
+        problems = MarkerInterface().validate(data, markers, scoring='unknown')
+
+        assert len(problems) == 2
+        assert 'scoring' in problems[0] and 'marker genes' in problems[1]
+
+    def test_checks(self, data: AnnData) -> None:
+        assert check_obs_columns(pd.DataFrame(), ['a'], 'ref') == ['`ref` must be an AnnData, not a DataFrame']
+        assert check_counts(data, 'counts', 'ref_data') == []
+
+        lognorm = AnnData(np.log1p(data.X + 0.5))
+        assert len(check_counts(lognorm, 'counts', 'ref_data')) == 1
+
+        assert check_gene_overlap(pd.Index(['g0', 'g1']), pd.Index(['g1', 'g2'])) == []
+        assert len(check_gene_overlap(pd.Index(['g0']), pd.Index([f'g{i}' for i in range(1, 20)]))) == 1
@@ -0,0 +1,137 @@
+from pathlib import Path
+from typing import Any, Dict
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools import ResultsReader, ResultsWriter, annotate, read_results, write_results
+from macta_tools.tools import CTAToolInterface, MarkerInterface
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+CELLS = pd.Index([f'cell_{i}' for i in range(5)])
+
+
+class FirstGeneInterface(CTAToolInterface):
+    """Interface that does not support chunks, labelling cells by whether they express their first gene."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('marker'))
+
+    def annotate(self, expr_data: AnnData, ref_data: Any, **_: Any) -> pd.Series:
+        return pd.Series(np.where(np.asarray(expr_data.X[:, 0].todense()).ravel() > 0, 'on', 'off'),
+                         index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+class VotingInterface(FirstGeneInterface):
+    """Interface whose default labels every cell with the majority label of all cells, which chunks must disable."""
+
+    _supports_chunks = True
+    _chunk_kwargs = {'majority_voting': False}
+
+    def annotate(self, expr_data: AnnData, ref_data: Any, majority_voting: bool = True, **kwargs: Any) -> pd.Series:
+        labels = super().annotate(expr_data, ref_data, **kwargs)
+        return pd.Series(labels.mode()[0], index=labels.index) if majority_voting else labels
+
+
+@pytest.fixture
+def results() -> Dict[str, Any]:
+    return {
+        'labels': pd.Series(['a', 'b', None, 'a', 'c'], index=CELLS),
+        'categorical': pd.Series(pd.Categorical(['x', 'y', 'x', None, 'x'], categories=['y', 'x']), index=CELLS),
+        'scores': pd.DataFrame({'a': np.arange(5, dtype=np.float32), 'b': np.ones(5, dtype=np.float32)},
+                               index=CELLS),
+    }
+
+
+class TestResultsFile:
+    """Tests writing results files and reading them back, in full or in parts."""
+
+    def test_round_trip(self, results: Dict[str, Any], tmp_path: Path) -> None:
+        write_results(tmp_path / 'results.h5', results, metadata={'scores': {'version': 1}})
+        reader = read_results(tmp_path / 'results.h5')
+
+        assert list(reader) == sorted(results)
+        pd.testing.assert_index_equal(reader.cells, CELLS)
+        assert list(reader['labels'].astype(object).where(reader['labels'].notna(), None)) == \
+            ['a', 'b', None, 'a', 'c']
+        assert list(reader['categorical'].cat.categories) == ['y', 'x']
+        assert reader['categorical'].isna().tolist() == [False, False, False, True, False]
+        pd.testing.assert_frame_equal(reader['scores'], results['scores'])
+        assert reader.tool_metadata('scores') == {'version': 1, 'kind': 'scores', 'complete': True}
+
+    def test_partial_reads(self, results: Dict[str, Any], tmp_path: Path) -> None:
+        write_results(tmp_path / 'results.h5', results)
+        reader = ResultsReader(tmp_path / 'results.h5')
+
+        pd.testing.assert_frame_equal(reader.read('scores', 1, 3, columns=['b', 'a']),
+                                      results['scores'].iloc[1:3][['b', 'a']])
+        assert list(reader.read('labels', start=3)) == ['a', 'c']
+        with pytest.raises(KeyError):
+            reader.read('scores', columns=['unknown'])
+
+    def test_streaming(self, tmp_path: Path) -> None:
+        with ResultsWriter(tmp_path / 'results.h5', CELLS, chunk_rows=2) as writer:
+            writer.append('labels', pd.Series(['a', 'b'], index=CELLS[:2]), {'chunked': True})
+            writer.append('labels', pd.Series(['c', 'a', 'b'], index=CELLS[2:]))
+            writer.append('partial', pd.Series(['a'], index=CELLS[:1]))
+
+            with pytest.raises(ValueError):
+                writer.append('labels', pd.Series(['a'], index=['unknown']))
+
+        reader = ResultsReader(tmp_path / 'results.h5')
+        assert list(reader['labels']) == ['a', 'b', 'c', 'a', 'b']
+        assert reader.tool_metadata('labels')['complete'] and reader.tool_metadata('labels')['chunked']
+        assert not reader.tool_metadata('partial')['complete']
+
+    def test_add_tools(self, results: Dict[str, Any], tmp_path: Path) -> None:
+        write_results(tmp_path / 'results.h5', {'labels': results['labels']})
+        with ResultsWriter(tmp_path / 'results.h5', mode='a') as writer:
+            writer.append('scores', results['scores'])
+            with pytest.raises(ValueError):
+                writer.append('labels', results['labels'])
+
+        assert list(read_results(tmp_path / 'results.h5')) == ['labels', 'scores']
+
+
+class TestAnnotateOutput:
+    """Tests that `annotate` writes the same results into a results file as it returns in memory."""
+
+    @pytest.fixture
+    def expr_data(self) -> AnnData:
+        rng = np.random.default_rng(0)
+        data = AnnData(sparse.csr_matrix(rng.poisson(1.0, (50, 4)).astype(np.float32)))
+        data.var_names = ['g0', 'g1', 'g2', 'g3']
+        data.obs_names = [f'cell_{i}' for i in range(data.n_obs)]
+        return data
+
+    @pytest.mark.parametrize('chunk_size', [None, 7])
+    def test_output(self, expr_data: AnnData, tmp_path: Path, chunk_size: Any) -> None:
+        markers = pd.DataFrame({'cell_type': ['a', 'b'], 'gene': ['g0', 'g1']})
+        tool_interfaces = {'marker': MarkerInterface(), 'first_gene': FirstGeneInterface()}
+
+        in_memory = annotate(expr_data, markers, 'marker', 'scores', tool_interfaces=tool_interfaces)
+        written = annotate(expr_data, markers, 'marker', 'scores', tool_interfaces=tool_interfaces,
+                           chunk_size=chunk_size, output=tmp_path / 'results.h5')
+
+        assert isinstance(written, ResultsReader)
+        assert sorted(written) == sorted(in_memory)
+        pd.testing.assert_frame_equal(written['marker'], in_memory['marker'], check_column_type=False)
+        assert list(written['first_gene']) == list(in_memory['first_gene'])
+        assert written.tool_metadata('marker')['chunked'] == (chunk_size is not None)
+
+    def test_streamed_chunk_kwargs(self, expr_data: AnnData, tmp_path: Path) -> None:
+        """Tests that streamed chunks disable the same options as chunks annotated in memory."""
+
+        markers = pd.DataFrame({'cell_type': ['a', 'b'], 'gene': ['g0', 'g1']})
+        tool_interfaces = {'voting': VotingInterface()}
+        in_memory = annotate(expr_data, markers, 'marker', tool_interfaces=tool_interfaces, chunk_size=7)
+        written = annotate(expr_data, markers, 'marker', tool_interfaces=tool_interfaces, chunk_size=7,
+                           output=tmp_path / 'results.h5')
+
+        assert list(written['voting']) == list(in_memory['voting'])
+        assert in_memory['voting'].nunique() == 2
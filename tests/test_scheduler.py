@@ -0,0 +1,172 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Hashable, List, Tuple
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import annotate, annotate_batch
+from macta_tools._scheduler import ResourceScheduler, Task
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+from macta_tools.utils.resources import DataSize, ResourceEstimate
+
+
+def timed(duration: float) -> Tuple[float, float, str]:
+    """Sleeps for `duration` seconds, returning when it started and ended, and the thread limit of its process."""
+
+    start = time.time()
+    time.sleep(duration)
+    return start, time.time(), os.environ['OMP_NUM_THREADS']
+
+
+def failing() -> None:
+    raise RuntimeError('task failed')
+
+
+def max_overlap(intervals: List[Tuple[float, float]]) -> int:
+    """Largest number of `intervals` that overlap at once."""
+
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def task(key: Hashable, threads: int = 1, memory: int = 0, duration: float = 0.5, **kwargs: Any) -> Task:
+    return Task(key, timed, (duration,), ResourceEstimate(threads, memory), **kwargs)
+
+
+class TestResourceScheduler:
+    """Tests placing tasks within a budget of threads and memory."""
+
+    def test_threads(self) -> None:
+        scheduler = ResourceScheduler(max_threads=2, max_memory=None, process_memory=0)
+        futures = scheduler.run([task('a', threads=2), task('b'), task('c'), task('d', threads=4)])
+
+        results = {key: future.result() for key, future in futures.items()}
+        assert list(results) == ['a', 'b', 'c', 'd']
+        # Every task's libraries are limited to its threads, at most the budget
+        assert [thread_limit for *_, thread_limit in results.values()] == ['2', '1', '1', '2']
+        assert max_overlap([(start, end) for start, end, _ in results.values()]) <= 2
+        assert scheduler.peak_threads == 2
+
+    def test_memory(self) -> None:
+        scheduler = ResourceScheduler(max_threads=4, max_memory=100, process_memory=10)
+        futures = scheduler.run([task('a', memory=50), task('b', memory=50), task('c', memory=30)])
+
+        intervals = {key: future.result()[:2] for key, future in futures.items()}
+        # `c` fills the room next to `a`, and `b` waits for them
+        assert max_overlap(list(intervals.values())) == 2
+        assert intervals['b'][0] >= min(intervals['a'][1], intervals['c'][1])
+        assert scheduler.peak_memory == 100
+
+    def test_oversized_runs_alone(self, caplog: pytest.LogCaptureFixture) -> None:
+        scheduler = ResourceScheduler(max_threads=4, max_memory=100, process_memory=0)
+        with caplog.at_level(logging.WARNING):
+            futures = scheduler.run([task('small', memory=10), task('large', memory=200)])
+
+        small, large = futures['small'].result(), futures['large'].result()
+        assert large[0] >= small[1]
+        assert 'large' in caplog.text
+
+    def test_dependencies_and_failures(self) -> None:
+        scheduler = ResourceScheduler(max_threads=4, max_memory=None)
+        futures = scheduler.run([Task('failing', failing, (), ResourceEstimate()),
+                                 task('after', after='failing', duration=0)])
+
+        with pytest.raises(RuntimeError):
+            futures['failing'].result()
+        assert futures['after'].result()
+
+    def test_invalid_tasks(self) -> None:
+        scheduler = ResourceScheduler(max_threads=1, max_memory=None)
+        with pytest.raises(ValueError):
+            scheduler.run([task('a'), task('a')])
+        with pytest.raises(ValueError):
+            scheduler.run([task('a', after='missing')])
+        with pytest.raises(ValueError):
+            scheduler.run([task('a', after='b'), task('b', after='a')])
+        with pytest.raises(ValueError):
+            ResourceScheduler(max_threads=0)
+
+
+class CachingInterface(CTAToolInterface):
+    """Labels every cell with its total counts plus those of the reference, logging every preparation to `log`."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+    _caches_ref = True
+
+    def preprocess_ref(self, ref_data: AnnData, log: str = '', **_: Any) -> float:
+        with open(log, 'a') as file:
+            file.write('prepared\n')
+        return float(ref_data.X.sum())
+
+    def annotate(self, expr_data: AnnData, ref_data: float, **_: Any) -> pd.Series:
+        return pd.Series(np.asarray(expr_data.X).sum(axis=1) + ref_data, index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+    def estimate_resources(self, expr_size: DataSize, ref_size: DataSize, **_: Any) -> ResourceEstimate:
+        return ResourceEstimate(threads=1, memory=expr_size.n_values)
+
+    def ref_cache_parts(self, ref_data: AnnData, **_: Any) -> Dict[str, Any]:
+        return {'total': float(ref_data.X.sum())}
+
+    def save_ref(self, model: float, path: Path) -> None:
+        (path / 'total').write_text(str(model))
+
+    def load_ref(self, path: Path, ref_data: AnnData, **_: Any) -> float:
+        return float((path / 'total').read_text())
+
+
+class FailingInterface(CachingInterface):
+    """Interface whose annotation always fails."""
+
+    def annotate(self, expr_data: AnnData, ref_data: float, **_: Any) -> pd.Series:
+        raise RuntimeError('annotation failed')
+
+
+@pytest.fixture
+def data() -> AnnData:
+    return AnnData(np.arange(12, dtype=np.float32).reshape(4, 3))
+
+
+class TestAnnotateBatch:
+    """Tests annotating several queries with every tool on a `ResourceScheduler`."""
+
+    def test_matches_serial(self, data: AnnData, tmp_path: Path) -> None:
+        data.write_h5ad(tmp_path / 'query.h5ad')
+        queries: List[Any] = [data, tmp_path / 'query.h5ad', data[1:].copy()]
+        tool_interfaces: Dict[str, CTAToolInterface] = {'caching': CachingInterface(), 'other': CachingInterface()}
+        log = tmp_path / 'preparations.log'
+
+        all_results = annotate_batch(queries, data, 'ref', tool_interfaces=tool_interfaces, max_threads=2,
+                                     log=str(log))
+
+        assert len(all_results) == len(queries)
+        for query, results in zip(queries, all_results):
+            expected = annotate(query, data, 'ref', tool_interfaces=tool_interfaces, log=str(log))
+            assert list(results) == ['caching', 'other']
+            for tool_name, result in expected.items():
+                pd.testing.assert_series_equal(results[tool_name], result)
+
+    def test_reference_prepared_once(self, data: AnnData, tmp_path: Path) -> None:
+        log = tmp_path / 'preparations.log'
+        annotate_batch([data] * 3, data, 'ref', tool_interfaces={'caching': CachingInterface()}, max_threads=3,
+                       log=str(log))
+
+        assert log.read_text().count('prepared') == 1
+
+    def test_failures_are_isolated(self, data: AnnData, tmp_path: Path) -> None:
+        tool_interfaces: Dict[str, CTAToolInterface] = {'failing': FailingInterface(), 'caching': CachingInterface()}
+        all_results = annotate_batch([data], data, 'ref', tool_interfaces=tool_interfaces,
+                                     log=str(tmp_path / 'preparations.log'))
+        assert [list(results) for results in all_results] == [['caching']]
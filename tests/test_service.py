@@ -0,0 +1,223 @@
+import http.client
+import json
+import socket
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools import AnnotationService, annotate, make_server, read_results
+from macta_tools._service import results_to_json
+from macta_tools.tools import MarkerInterface
+
+
+@pytest.fixture
+def markers() -> pd.DataFrame:
+    return pd.DataFrame({'cell_type': ['a', 'a', 'b', 'b'], 'gene': ['g0', 'g1', 'g2', 'g3']})
+
+
+@pytest.fixture
+def expr_data() -> AnnData:
+    """Cells 0-2 express the markers of `a`, cells 3-5 those of `b`."""
+
+    rng = np.random.default_rng(0)
+    matrix = rng.poisson(0.5, (6, 6)).astype(np.float32)
+    matrix[:3, :2] += 5
+    matrix[3:, 2:4] += 5
+    data = AnnData(sparse.csr_matrix(np.log1p(matrix)))
+    data.obs_names = [f'cell_{i}' for i in range(data.n_obs)]
+    data.var_names = [f'g{i}' for i in range(data.n_vars)]
+    return data
+
+
+@pytest.fixture
+def expr_file(expr_data: AnnData, tmp_path: Path) -> Path:
+    expr_data.write_h5ad(tmp_path / 'query.h5ad')
+    return tmp_path / 'query.h5ad'
+
+
+@pytest.fixture
+def service(markers: pd.DataFrame) -> Iterator[AnnotationService]:
+    with AnnotationService.from_reference(markers, 'marker', tool_interfaces={'marker': MarkerInterface()}) as service:
+        yield service
+
+
+class UnixConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket."""
+
+    def __init__(self, path: str):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self) -> None:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(connection: http.client.HTTPConnection, method: str, url: str, body: Optional[bytes] = None,
+            content_type: str = 'application/json') -> Tuple[int, Dict[str, Any]]:
+    connection.request(method, url, body, headers={'Content-Type': content_type})
+    response = connection.getresponse()
+    return response.status, json.loads(response.read())
+
+
+@contextmanager
+def serve(service: AnnotationService, socket_path: Optional[Path] = None,
+          **options: Any) -> Iterator[http.client.HTTPConnection]:
+    """Serves `service` on a thread (over a Unix socket if `socket_path` is set), yielding a connection to it."""
+
+    server: Any = make_server(service, port=0, socket_path=socket_path, **options)
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+
+    connection = UnixConnection(str(socket_path)) if socket_path is not None else \
+        http.client.HTTPConnection(*server.server_address)
+    yield connection
+
+    connection.close()
+    server.shutdown()
+    server.server_close()
+    assert socket_path is None or not socket_path.exists()
+
+
+class TestAnnotationService:
+    """Tests annotating queries against references kept in memory."""
+
+    def test_matches_annotate(self, service: AnnotationService, markers: pd.DataFrame, expr_file: Path) -> None:
+        expected = annotate(expr_file, markers, 'marker', 'scores', tool_interfaces={'marker': MarkerInterface()})
+
+        results = service.annotate(expr_file, 'scores')
+        pd.testing.assert_frame_equal(results['marker'], expected['marker'])
+        assert list(service.annotate(expr_file)['marker']) == ['a'] * 3 + ['b'] * 3
+
+    def test_batches(self, service: AnnotationService, expr_data: AnnData) -> None:
+        calls = []
+        annotate_prepared = service.prepared['marker'].annotate
+
+        def recording_annotate(*args: Any, **kwargs: Any) -> Any:
+            calls.append(threading.current_thread().name)
+            return annotate_prepared(*args, **kwargs)
+
+        service.prepared['marker'].annotate = recording_annotate  # type: ignore[method-assign]
+
+        # Queued while the worker is busy, so that they are annotated in one batch
+        blocker = threading.Event()
+        service.submit(expr_data).add_done_callback(lambda _: blocker.wait())
+        futures = [service.submit(expr_data) for _ in range(4)]
+        blocker.set()
+
+        assert all(list(future.result()['marker']) == ['a'] * 3 + ['b'] * 3 for future in futures)
+        service.close()
+        assert service.n_completed == 5 and service.n_batches <= 2
+        assert set(calls) == {'macta-annotation-service'}
+
+    def test_failures_are_isolated(self, service: AnnotationService, expr_data: AnnData, tmp_path: Path) -> None:
+        blocker = threading.Event()
+        service.submit(expr_data).add_done_callback(lambda _: blocker.wait())
+        missing, valid = service.submit(tmp_path / 'missing.h5ad'), service.submit(expr_data)
+        blocker.set()
+
+        with pytest.raises(FileNotFoundError):
+            missing.result()
+        assert len(valid.result()['marker']) == expr_data.n_obs
+
+    def test_run_on_calling_thread(self, markers: pd.DataFrame, expr_data: AnnData) -> None:
+        service = AnnotationService.from_reference(markers, 'marker', tool_interfaces={'marker': MarkerInterface()})
+        with pytest.raises(RuntimeError):
+            service.annotate(expr_data)
+
+        future = service.submit(expr_data)
+        future.add_done_callback(lambda _: threading.Thread(target=service.close).start())
+        service.run()
+
+        assert list(future.result()['marker']) == ['a'] * 3 + ['b'] * 3
+
+    def test_invalid_options(self, service: AnnotationService, expr_data: AnnData) -> None:
+        with pytest.raises(ValueError):
+            service.submit(expr_data, 'probabilities')
+        with pytest.raises(ValueError):
+            AnnotationService({})
+
+
+class TestServer:
+    """Tests the HTTP endpoints, over TCP and Unix sockets."""
+
+    @pytest.fixture(params=['tcp', 'unix'])
+    def connection(self, request: pytest.FixtureRequest, service: AnnotationService,
+                   tmp_path: Path) -> Iterator[http.client.HTTPConnection]:
+        socket_path = tmp_path / 'macta.sock' if request.param == 'unix' else None
+        (tmp_path / 'results').mkdir()
+        with serve(service, socket_path, data_dir=tmp_path, output_dir=tmp_path / 'results') as connection:
+            yield connection
+
+    def test_health(self, connection: http.client.HTTPConnection) -> None:
+        status, body = request(connection, 'GET', '/health')
+        assert status == 200 and body['status'] == 'ok' and body['tools'] == ['marker']
+
+    def test_annotate_path(self, connection: http.client.HTTPConnection, expr_file: Path) -> None:
+        status, body = request(connection, 'POST', '/annotate', json.dumps({'expr': str(expr_file)}).encode())
+
+        assert status == 200
+        assert body['results']['marker']['index'] == [f'cell_{i}' for i in range(6)]
+        assert body['results']['marker']['data'] == ['a'] * 3 + ['b'] * 3
+
+    def test_upload(self, connection: http.client.HTTPConnection, expr_file: Path) -> None:
+        status, body = request(connection, 'POST', '/annotate?result_type=scores', expr_file.read_bytes(),
+                               'application/x-hdf5')
+
+        assert status == 200
+        assert body['results']['marker']['columns'] == ['a', 'b']
+        assert np.array(body['results']['marker']['data']).shape == (6, 2)
+
+    def test_output(self, connection: http.client.HTTPConnection, expr_file: Path, tmp_path: Path) -> None:
+        options = {'expr': expr_file.name, 'output': 'results.h5'}
+        status, body = request(connection, 'POST', '/annotate', json.dumps(options).encode())
+
+        assert status == 200 and body['tools'] == ['marker']
+        assert list(read_results(tmp_path / 'results' / 'results.h5')['marker']) == ['a'] * 3 + ['b'] * 3
+
+    @pytest.mark.parametrize('body', [b'{}', b'not json', b'{"expr": "missing.h5ad"}',
+                                      b'{"expr": "query.h5ad", "result_type": "probabilities"}',
+                                      b'{"expr": "query.h5ad", "unknown": 1}',
+                                      b'{"expr": "query.h5ad", "chunk_size": "many"}',
+                                      b'{"expr": "query.h5ad", "chunk_size": 0}',
+                                      b'{"expr": "../query.h5ad"}', b'{"expr": "/etc/hosts"}',
+                                      b'{"expr": "query.h5ad", "output": "../results.h5"}'])
+    def test_bad_requests(self, connection: http.client.HTTPConnection, body: bytes) -> None:
+        status, reply = request(connection, 'POST', '/annotate', body)
+        assert status == 400 and reply['error']
+
+        # The connection and the service are still usable
+        assert request(connection, 'GET', '/health')[0] == 200
+
+    def test_bad_content_length(self, connection: http.client.HTTPConnection) -> None:
+        connection.putrequest('POST', '/annotate')
+        connection.putheader('Content-Type', 'application/json')
+        connection.putheader('Content-Length', 'many')
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 400 and json.loads(response.read())['error']
+
+    def test_paths_refused_without_directories(self, service: AnnotationService, expr_file: Path) -> None:
+        with serve(service) as connection:
+            for options in ({'expr': str(expr_file)}, {'expr': expr_file.name, 'output': 'results.h5'}):
+                assert request(connection, 'POST', '/annotate', json.dumps(options).encode())[0] == 400
+            assert request(connection, 'POST', '/annotate', expr_file.read_bytes(), 'application/x-hdf5')[0] == 200
+
+    def test_unknown_endpoint(self, connection: http.client.HTTPConnection) -> None:
+        assert request(connection, 'GET', '/models')[0] == 404
+
+
+def test_results_to_json(expr_data: AnnData) -> None:
+    labels = pd.Series(['a', None], index=['c0', 'c1'], dtype='category')
+    scores = pd.DataFrame({'a': [0.5, np.nan]}, index=['c0', 'c1'], dtype=np.float32)
+
+    parsed = json.loads(results_to_json({'labels': labels, 'scores': scores}))
+    assert parsed['labels']['data'] == ['a', None]
+    assert parsed['scores'] == {'columns': ['a'], 'index': ['c0', 'c1'], 'data': [[0.5], [None]]}
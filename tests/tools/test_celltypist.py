@@ -1,8 +1,17 @@
+from typing import Any
+
+import numpy as np
+import pandas as pd
 import pytest
+from anndata import AnnData
+from scipy import sparse
 
 # Skip this file if this module cannot be used with the current MACTA installation
 try:
-    from macta_tools.tools import CelltypistInterface
+    from celltypist.classifier import Classifier
+
+    from macta_tools.tools import CelltypistInterface, _celltypist_interface
+    from macta_tools.utils.resources import DataSize
 except ImportError:
     pytest.skip(allow_module_level=True, reason='Celltypist-compatible extra not installed.')
 
@@ -15,3 +24,134 @@ class TestCelltypistRqlist():
         interface = CelltypistInterface()
         assert interface.check_requirements(annot_type='ref')
         assert not interface.check_requirements(annot_type='marker')
+
+
+def test_estimate_resources() -> None:
+    interface = CelltypistInterface()
+    expr_size, ref_size = DataSize(100_000, 20_000, 10 ** 8), DataSize(10_000, 20_000, 10 ** 7)
+
+    full = interface.estimate_resources(expr_size, ref_size, majority_voting=False)
+    chunked = interface.estimate_resources(expr_size, ref_size, majority_voting=False, prediction_chunk_size=1000,
+                                           n_jobs=4)
+    assert full.threads == 1 and chunked.threads == 4
+    assert chunked.memory < full.memory
+
+    # Named models are not trained, so only the query counts
+    named = interface.estimate_resources(expr_size, DataSize(), prediction_chunk_size=1000)
+    assert named.memory < interface.estimate_resources(expr_size, ref_size, prediction_chunk_size=1000).memory
+
+
+class TestCelltypistChunks:
+    """Tests that annotating in chunks gives the same per-cell predictions as annotating all cells at once."""
+
+    @pytest.fixture
+    def ref_data(self) -> AnnData:
+        rng = np.random.default_rng(0)
+        data = AnnData(np.log1p(rng.poisson(1.0, (100, 20)).astype(np.float32)))
+        data.var_names = [f'gene_{i}' for i in range(data.n_vars)]
+        data.obs['cell_type'] = rng.choice(['a', 'b'], data.n_obs)
+        return data
+
+    def test_chunked_labels(self, ref_data: AnnData) -> None:
+        interface = CelltypistInterface()
+        model = interface.prepare_ref(ref_data, labels='cell_type')
+
+        full = interface.run_prepared(ref_data, model, 'labels', majority_voting=False)
+        chunked = interface.run_chunked(ref_data, ref_data, 'labels', chunk_size=30, labels='cell_type')
+
+        pd.testing.assert_series_equal(chunked, full)
+
+    def test_validate(self, ref_data: AnnData) -> None:
+        interface = CelltypistInterface()
+
+        assert interface.validate(ref_data, ref_data, labels='cell_type') == []
+        assert interface.validate(ref_data, 'Immune_All_Low.pkl') == []
+        assert len(interface.validate(ref_data, ref_data)) == 1
+        assert len(interface.validate(ref_data, ref_data, labels='unknown')) == 1
+
+
+class TestCelltypistScaling:
+    """Tests predicting in chunks, and reusing the over-clustering or neighbourhood graph of the query."""
+
+    @pytest.fixture
+    def data(self) -> AnnData:
+        rng = np.random.default_rng(0)
+        cell_types = rng.choice(3, 300)
+        rates = np.full((3, 60), 0.5)
+        for cell_type in range(3):
+            rates[cell_type, cell_type * 20:(cell_type + 1) * 20] = 5
+
+        counts = rng.poisson(rates[cell_types]).astype(np.float32)
+        data = AnnData(np.log1p(counts / counts.sum(axis=1, keepdims=True) * 1e4))
+        data.var_names = [f'gene_{i}' for i in range(data.n_vars)]
+        data.obs['cell_type'] = np.array(['a', 'b', 'c'])[cell_types]
+        return data
+
+    @pytest.fixture
+    def no_graph_construction(self, monkeypatch: pytest.MonkeyPatch) -> None:
+        def fail(*_: Any, **__: Any) -> None:
+            raise AssertionError('the neighbourhood graph was constructed')
+
+        monkeypatch.setattr(Classifier, '_construct_neighbor_graph', fail)
+        monkeypatch.setattr(_celltypist_interface, '_approximate_graph', fail)
+
+    @pytest.mark.parametrize('convert_to', ['labels', 'scores'])
+    def test_chunked_predictions(self, data: AnnData, convert_to: str) -> None:
+        interface = CelltypistInterface()
+        model = interface.prepare_ref(data, labels='cell_type')
+
+        full = interface.run_prepared(data, model, convert_to, majority_voting=False)
+        chunked = interface.run_prepared(data, model, convert_to, majority_voting=False, prediction_chunk_size=70,
+                                         n_jobs=2)
+
+        if convert_to == 'labels':
+            pd.testing.assert_series_equal(chunked, full)
+        else:
+            pd.testing.assert_frame_equal(chunked, full)
+
+    @pytest.mark.usefixtures('no_graph_construction')
+    def test_reuses_over_clustering(self, data: AnnData) -> None:
+        interface = CelltypistInterface()
+        model = interface.prepare_ref(data, labels='cell_type')
+
+        data.obs['clusters'] = np.where(np.arange(data.n_obs) < 150, 'first', 'second')
+        labels = interface.run_prepared(data, model, 'labels', over_clustering='clusters')
+
+        assert labels.groupby(data.obs['clusters'].to_numpy()).nunique().tolist() == [1, 1]
+
+    @pytest.mark.usefixtures('no_graph_construction')
+    def test_reuses_neighbors_graph(self, data: AnnData) -> None:
+        interface = CelltypistInterface()
+        model = interface.prepare_ref(data, labels='cell_type')
+
+        # Cells are only connected to cells of the same type
+        same_type = data.obs['cell_type'].to_numpy()[:, None] == data.obs['cell_type'].to_numpy()[None, :]
+        data.obsp['connectivities'] = sparse.csr_matrix(same_type.astype(np.float32))
+        labels = interface.run_prepared(data, model, 'labels')
+
+        assert (labels == data.obs['cell_type']).all()
+
+    def test_validate_neighbors(self, data: AnnData) -> None:
+        interface = CelltypistInterface()
+
+        assert interface.validate(data, data, labels='cell_type', neighbors='approximate') == []
+        assert len(interface.validate(data, data, labels='cell_type', neighbors='exact')) == 1
+
+    def test_aligns_genes_to_model(self, data: AnnData) -> None:
+        interface = CelltypistInterface()
+        model = interface.prepare_ref(data, labels='cell_type')
+        expected = interface.run_prepared(data, model, 'scores', majority_voting=False)
+
+        # Ensembl IDs in `var_names` with the symbols of the model in a column, genes shuffled and some missing
+        order = np.random.default_rng(1).permutation(data.n_vars)[:50]
+        query = data[:, order].copy()
+        query.var['gene_symbols'] = query.var_names
+        query.var_names = [f'ENSG{i:011d}' for i in range(query.n_vars)]
+
+        scores = interface.run_prepared(query, model, 'scores', majority_voting=False, prediction_chunk_size=70)
+        assert scores.shape == expected.shape
+        assert (scores.idxmax(axis=1) == expected.idxmax(axis=1)).mean() > 0.9
+
+        query.var = query.var.drop(columns='gene_symbols')
+        with pytest.raises(ValueError, match='no genes'):
+            interface.run_prepared(query, model, 'labels', majority_voting=False)
@@ -0,0 +1,115 @@
+import json
+from pathlib import Path
+
+import numpy as np
+import pytest
+from anndata import AnnData
+
+from macta_tools.tools import CelltypistModelStore
+from macta_tools.tools._celltypist_models import MANIFEST_FILE
+
+# Skip this file if this module cannot be used with the current MACTA installation
+try:
+    import celltypist
+
+    from macta_tools.tools import CelltypistInterface
+except ImportError:
+    pytest.skip(allow_module_level=True, reason='Celltypist-compatible extra not installed.')
+
+
+@pytest.fixture(scope='module')
+def model_file(tmp_path_factory: pytest.TempPathFactory) -> Path:
+    """A model trained on random data, written where the collection is "hosted"."""
+
+    rng = np.random.default_rng(0)
+    data = AnnData(np.log1p(rng.poisson(1.0, (100, 20)).astype(np.float32)))
+    data.var_names = [f'gene_{i}' for i in range(data.n_vars)]
+    data.obs['cell_type'] = rng.choice(['a', 'b'], data.n_obs)
+
+    path = tmp_path_factory.mktemp('remote') / 'Tiny_Model.pkl'
+    celltypist.train(data, labels='cell_type', check_expression=False).write(str(path))
+    return path
+
+
+@pytest.fixture
+def index_url(model_file: Path, tmp_path: Path) -> str:
+    index = {'models': [{'filename': 'Tiny_Model.pkl', 'url': model_file.as_uri(), 'version': 'v1'}]}
+    index_file = tmp_path / 'remote_index.json'
+    index_file.write_text(json.dumps(index))
+    return index_file.as_uri()
+
+
+class TestCelltypistModelStore:
+
+    def test_downloads_single_model(self, tmp_path: Path, index_url: str) -> None:
+        store = CelltypistModelStore(tmp_path / 'store', index_url=index_url)
+
+        model = store.load('Tiny_Model')
+        assert set(model.cell_types) == {'a', 'b'}
+
+        entry = store.manifest()['Tiny_Model.pkl']
+        assert entry['version'] == 'v1' and len(entry['sha256']) == 64
+        assert store.verify('Tiny_Model.pkl')
+
+    def test_offline_with_preseeded_models(self, tmp_path: Path, model_file: Path) -> None:
+        directory = tmp_path / 'store'
+        directory.mkdir()
+        (directory / model_file.name).write_bytes(model_file.read_bytes())
+        store = CelltypistModelStore(directory, offline=True, index_url='http://unreachable.invalid/models.json')
+
+        assert set(store.load('Tiny_Model.pkl').cell_types) == {'a', 'b'}
+        assert store.manifest()['Tiny_Model.pkl']['version'] is None
+
+        with pytest.raises(FileNotFoundError):
+            store.load('Missing_Model.pkl')
+
+    def test_corrupt_model(self, tmp_path: Path, index_url: str) -> None:
+        store = CelltypistModelStore(tmp_path / 'store', index_url=index_url)
+        path = store.fetch('Tiny_Model')
+        path.write_bytes(path.read_bytes()[:100])
+        assert not store.verify('Tiny_Model')
+
+        with pytest.raises(FileNotFoundError):
+            CelltypistModelStore(store.directory, offline=True).fetch('Tiny_Model')
+
+        # Online, the corrupt model is downloaded again
+        assert store.fetch('Tiny_Model') == path and store.verify('Tiny_Model')
+
+    def test_loaded_once_per_process(self, tmp_path: Path, index_url: str, monkeypatch: pytest.MonkeyPatch) -> None:
+        store = CelltypistModelStore(tmp_path / 'store', index_url=index_url)
+        first = store.load('Tiny_Model')
+
+        def fail(*_: object, **__: object) -> None:
+            raise AssertionError('the model was loaded again')
+
+        monkeypatch.setattr(celltypist.models.Model, 'load', fail)
+        second = CelltypistModelStore(store.directory, offline=True).load('Tiny_Model')
+
+        # Copies, so that predicting with one does not modify the other
+        assert second is not first and second.classifier is not first.classifier
+        assert second.classifier.coef_ is first.classifier.coef_
+
+    def test_load_from_path(self, tmp_path: Path, model_file: Path) -> None:
+        store = CelltypistModelStore(tmp_path / 'store', offline=True)
+        assert set(store.load(str(model_file)).cell_types) == {'a', 'b'}
+        assert not (tmp_path / 'store' / MANIFEST_FILE).exists()
+
+        with pytest.raises(FileNotFoundError):
+            store.load(tmp_path / 'missing.pkl')
+
+
+class TestCelltypistInterfaceModels:
+
+    def test_prepare_named_model(self, tmp_path: Path, index_url: str) -> None:
+        interface = CelltypistInterface()
+        store = CelltypistModelStore(tmp_path / 'store', index_url=index_url)
+
+        model = interface.prepare_ref('Tiny_Model.pkl', model_store=store)
+        assert set(model.cell_types) == {'a', 'b'}
+
+    def test_validate_offline(self, tmp_path: Path, model_file: Path) -> None:
+        interface = CelltypistInterface()
+
+        assert interface.validate(None, 'Tiny_Model.pkl', model_store=tmp_path, offline=True) != []
+        assert interface.validate(None, str(model_file), offline=True) == []
+        assert interface.validate(None, str(tmp_path / 'missing.pkl')) != []
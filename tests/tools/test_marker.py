@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy import sparse
+from scipy.stats import rankdata
+
+from macta_tools import annotate
+from macta_tools.tools import MarkerInterface
+from macta_tools.tools._marker_interface import MarkerSet, _row_ranks
+from macta_tools.utils.representations import log_normalize
+from macta_tools.utils.resources import DataSize
+
+
+@pytest.fixture
+def markers() -> pd.DataFrame:
+    return pd.DataFrame({'cell_type': ['a', 'a', 'b', 'b', 'c'], 'gene': ['g0', 'g1', 'g2', 'g3', 'g_absent']})
+
+
+@pytest.fixture
+def expr_data() -> AnnData:
+    """Cells 0-2 express the markers of `a`, cells 3-5 those of `b`."""
+
+    rng = np.random.default_rng(0)
+    matrix = rng.poisson(0.5, (6, 6)).astype(np.float32)
+    matrix[:3, :2] += 5
+    matrix[3:, 2:4] += 5
+    data = AnnData(sparse.csr_matrix(np.log1p(matrix)))
+    data.var_names = [f'g{i}' for i in range(data.n_vars)]
+    return data
+
+
+class TestMarkerSet:
+    """Tests the parsing of long and wide marker tables."""
+
+    def test_long_and_wide(self, markers: pd.DataFrame) -> None:
+        long = MarkerSet.from_frame(markers)
+        wide = MarkerSet.from_frame(pd.DataFrame({'a': ['g0', 'g1'], 'b': ['g2', 'g3'], 'c': ['g_absent', None]}))
+
+        assert list(long.cell_types) == list(wide.cell_types) == ['a', 'b', 'c']
+        assert list(long.genes) == list(wide.genes)
+        np.testing.assert_array_equal(long.weights, wide.weights)
+
+    def test_align(self, markers: pd.DataFrame) -> None:
+        weights = MarkerSet.from_frame(markers).align(pd.Index(['g1', 'g0', 'g2', 'other']))
+
+        np.testing.assert_allclose(weights[:, :2], np.array([[0.5, 0], [0.5, 0], [0, 1], [0, 0]]))
+        assert np.isnan(weights[:, 2]).all()
+
+    def test_align_gene_symbols_column(self, markers: pd.DataFrame) -> None:
+        var = pd.DataFrame({'gene_symbols': ['g1', 'g0', 'g2', 'other']}, index=[f'ENSG{i:011d}' for i in range(4)])
+
+        np.testing.assert_array_equal(MarkerSet.from_frame(markers).align(var),
+                                      MarkerSet.from_frame(markers).align(pd.Index(var['gene_symbols'])))
+
+
+class TestMarkerInterface:
+    """Tests the scoring methods and the conversion of their results."""
+
+    @pytest.mark.parametrize('scoring', ['mean', 'zscore', 'rank'])
+    def test_labels(self, markers: pd.DataFrame, expr_data: AnnData, scoring: str) -> None:
+        interface = MarkerInterface()
+        scores = interface.run_full(expr_data, markers, 'scores', scoring=scoring)
+        labels = interface.run_full(expr_data, markers, 'labels', scoring=scoring)
+
+        assert list(scores.columns) == ['a', 'b', 'c']
+        assert scores['c'].isna().all()
+        assert list(labels) == ['a'] * 3 + ['b'] * 3
+
+    def test_unscored_cells_unlabelled(self) -> None:
+        scores = pd.DataFrame({'a': [1.0, np.nan], 'b': [2.0, np.nan]}, index=['cell_0', 'cell_1'])
+        labels = MarkerInterface().convert(scores, 'labels')
+
+        assert labels['cell_0'] == 'b'
+        assert pd.isna(labels['cell_1'])
+
+    def test_counts_log_normalized(self, markers: pd.DataFrame) -> None:
+        """Tests that raw counts are scored as log-normalized data, and layers as they are."""
+
+        counts = AnnData(sparse.csr_matrix(np.arange(1, 37, dtype=np.float32).reshape(6, 6)))
+        counts.var_names = [f'g{i}' for i in range(counts.n_vars)]
+        counts.layers['raw'] = counts.X.copy()
+        lognorm = AnnData(log_normalize(counts.X), var=counts.var)
+
+        expected = MarkerInterface().run_full(lognorm, markers, 'scores')
+        pd.testing.assert_frame_equal(MarkerInterface().run_full(counts, markers, 'scores'), expected)
+        pd.testing.assert_frame_equal(MarkerInterface().run_full(counts, markers, 'scores', layer='raw'),
+                                      MarkerInterface().annotate(counts, MarkerSet.from_frame(markers), layer='raw'))
+
+    def test_dense_matches_sparse(self, markers: pd.DataFrame, expr_data: AnnData) -> None:
+        interface = MarkerInterface()
+        dense = AnnData(expr_data.X.toarray(), var=expr_data.var)
+
+        for scoring in ['mean', 'zscore', 'rank']:
+            pd.testing.assert_frame_equal(interface.run_full(dense, markers, 'scores', scoring=scoring),
+                                          interface.run_full(expr_data, markers, 'scores', scoring=scoring))
+
+    def test_chunks_match_full(self, markers: pd.DataFrame, expr_data: AnnData) -> None:
+        interface = MarkerInterface()
+        full = interface.run_full(expr_data, markers, 'scores', scoring='zscore')
+        chunked = interface.run_chunked(expr_data, markers, 'scores', chunk_size=4, scoring='zscore')
+        pd.testing.assert_frame_equal(chunked, full)
+
+    def test_invalid_scoring(self, markers: pd.DataFrame, expr_data: AnnData) -> None:
+        with pytest.raises(ValueError):
+            MarkerInterface().run_full(expr_data, markers, 'scores', scoring='unknown')
+
+    def test_row_ranks(self) -> None:
+        matrix = sparse.random(10, 30, density=0.4, format='csr', random_state=0)
+        matrix.data = np.round(matrix.data * 4) + 1
+        dense = matrix.toarray()
+
+        expected = np.apply_along_axis(rankdata, 1, dense) / dense.shape[1]
+        np.testing.assert_allclose(_row_ranks(matrix).toarray()[dense > 0], expected[dense > 0], rtol=1e-6)
+
+    def test_estimate_resources(self, markers: pd.DataFrame, expr_data: AnnData) -> None:
+        expr_size, ref_size = DataSize.of(expr_data), DataSize.of(markers)
+        estimates = {scoring: MarkerInterface().estimate_resources(expr_size, ref_size, scoring=scoring)
+                     for scoring in ('mean', 'zscore', 'rank')}
+
+        assert all(estimate.threads == 1 for estimate in estimates.values())
+        assert 0 < estimates['mean'].memory < estimates['zscore'].memory < estimates['rank'].memory
+
+    def test_annotate_marker_mode(self, markers: pd.DataFrame, expr_data: AnnData) -> None:
+        results = annotate(expr_data, markers, 'marker', annot_tools=['marker'])
+        assert list(results['marker']) == ['a'] * 3 + ['b'] * 3
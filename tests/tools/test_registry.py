@@ -0,0 +1,115 @@
+import subprocess
+import sys
+from importlib.metadata import EntryPoint
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import annotate
+from macta_tools.tools import CTAToolInterface, ToolRegistry, ToolSpec, _registry
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+
+class EmptyInterface(CTAToolInterface):
+    """Interface that labels every cell with an empty string."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+
+    def annotate(self, expr_data: AnnData, ref_data: AnnData, **_: Any) -> pd.Series:
+        return pd.Series('', index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+PLUGIN_SPEC = ToolSpec('spec_name', f'{__name__}:EmptyInterface', annot_types=('marker',), result_types=('labels',))
+NOT_A_TOOL = object()
+
+
+@pytest.fixture
+def registry() -> ToolRegistry:
+    return ToolRegistry([
+        ToolSpec('empty', f'{__name__}:EmptyInterface', requires=('numpy',)),
+        ToolSpec('missing', f'{__name__}:EmptyInterface', requires=('numpy', 'not_an_installed_package')),
+        ToolSpec('broken', 'not_an_installed_package.module:Interface'),
+    ])
+
+
+class TestToolRegistry:
+    """Tests that the registry lists installed tools without importing them, and imports them once when used."""
+
+    def test_installed_tools(self, registry: ToolRegistry) -> None:
+        assert list(registry) == ['empty', 'broken']
+        assert len(registry) == 2
+        assert 'empty' in registry and 'missing' not in registry
+        assert set(registry.specs) == {'empty', 'missing', 'broken'}
+
+        with pytest.raises(KeyError):
+            registry['missing']
+
+    def test_interfaces_loaded_once(self, registry: ToolRegistry) -> None:
+        assert registry.loaded() == {}
+
+        interface = registry['empty']
+        assert isinstance(interface, EmptyInterface)
+        assert registry['empty'] is interface
+        assert registry.loaded() == {'empty': interface}
+
+    def test_broken_tool_skipped(self, registry: ToolRegistry) -> None:
+        with pytest.raises(ImportError):
+            registry['broken']
+        assert 'broken' not in registry
+
+    def test_annotate_selects_lazily(self, registry: ToolRegistry) -> None:
+        data = AnnData(np.ones((3, 2), dtype=np.float32))
+        assert list(annotate(data, data, 'ref', annot_tools=['empty'], tool_interfaces=registry)) == ['empty']
+        assert list(registry.loaded()) == ['empty']
+
+        assert list(annotate(data, data, 'ref', tool_interfaces=registry)) == ['empty']
+
+    def test_import_does_not_load_backends(self) -> None:
+        code = ('import sys, macta_tools; '
+                'print(*[name for name in ("celltypist", "scarches", "scanpy", "torch") if name in sys.modules])')
+        output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+        assert output.strip() == ''
+
+
+class TestPlugins:
+    """Tests the discovery of third-party tools from entry points."""
+
+    @pytest.fixture
+    def plugins(self, monkeypatch: pytest.MonkeyPatch) -> ToolRegistry:
+        entry_points = [
+            EntryPoint('marker_plugin', f'{__name__}:PLUGIN_SPEC', 'test_group'),
+            EntryPoint('class_plugin', f'{__name__}:EmptyInterface', 'test_group'),
+            EntryPoint('empty', f'{__name__}:PLUGIN_SPEC', 'test_group'),
+            EntryPoint('unloadable', 'not_an_installed_package:SPEC', 'test_group'),
+            EntryPoint('invalid', f'{__name__}:NOT_A_TOOL', 'test_group'),
+        ]
+
+        def fake_entry_points(group: str) -> List[EntryPoint]:
+            return [entry_point for entry_point in entry_points if entry_point.group == group]
+
+        monkeypatch.setattr(_registry, '_entry_points', fake_entry_points)
+        return ToolRegistry([ToolSpec('empty', f'{__name__}:EmptyInterface', annot_types=('ref',))], group='test_group')
+
+    def test_discovery(self, plugins: ToolRegistry) -> None:
+        assert list(plugins) == ['empty', 'marker_plugin', 'class_plugin']
+        assert plugins.specs['marker_plugin'] == ToolSpec('marker_plugin', PLUGIN_SPEC.target, annot_types=('marker',),
+                                                          result_types=('labels',))
+        assert plugins.specs['empty'].annot_types == ('ref',)
+        assert isinstance(plugins['class_plugin'], EmptyInterface)
+
+    def test_find_by_capabilities(self, plugins: ToolRegistry) -> None:
+        assert plugins.find(annot_type='ref') == ['empty', 'class_plugin']
+        assert plugins.find(annot_type='marker', result_type='labels') == ['marker_plugin', 'class_plugin']
+        assert plugins.find(result_type='scores') == ['empty', 'class_plugin']
+        assert plugins.find(chunks=True) == []
+
+    def test_annotate_skips_incapable_tools(self, plugins: ToolRegistry) -> None:
+        data = AnnData(np.ones((3, 2), dtype=np.float32))
+        assert list(annotate(data, data, 'ref', tool_interfaces=plugins)) == ['empty', 'class_plugin']
+        assert 'marker_plugin' not in plugins.loaded()
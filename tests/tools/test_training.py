@@ -0,0 +1,123 @@
+import sys
+from types import ModuleType
+from typing import Any, Dict, List
+
+import pytest
+
+from macta_tools.tools import TRAINING_PROFILES, PhaseBudget, TrainingProfile, resolve_profile
+from macta_tools.tools._training import EARLY_STOPPING_MONITOR, TRAINING_PHASES, train
+from macta_tools.utils.profiling import Profiler
+
+
+class RecordingModel:
+    """Stands in for a `scvi-tools` model, recording the arguments of `train`."""
+
+    def __init__(self) -> None:
+        self.calls: List[Dict[str, Any]] = []
+
+    def train(self, **kwargs: Any) -> None:
+        self.calls.append(kwargs)
+
+
+@pytest.fixture
+def fake_torch(monkeypatch: pytest.MonkeyPatch) -> ModuleType:
+    torch = ModuleType('torch')
+    torch.threads = 4  # type: ignore[attr-defined]
+    torch.get_num_threads = lambda: torch.threads  # type: ignore[attr-defined]
+    torch.set_num_threads = lambda n: setattr(torch, 'threads', n)  # type: ignore[attr-defined]
+    monkeypatch.setitem(sys.modules, 'torch', torch)
+    return torch
+
+
+class TestResolveProfile:
+
+    def test_named_profiles_trade_speed_for_accuracy(self) -> None:
+        fast, balanced, accurate = (resolve_profile(name) for name in ('fast', 'balanced', 'accurate'))
+        for phase in TRAINING_PHASES:
+            epochs = [profile.budget(phase).max_epochs for profile in (fast, balanced, accurate)]
+            assert epochs == sorted(epochs) and epochs[0] < epochs[2]
+
+        assert resolve_profile() is resolve_profile(None) is TRAINING_PROFILES['balanced']
+
+    def test_explicit_profile(self) -> None:
+        profile = TrainingProfile(query=PhaseBudget(max_epochs=5, early_stopping=False), n_threads=2)
+        assert resolve_profile(profile) is profile
+
+    def test_overrides(self) -> None:
+        profile = resolve_profile({'base': 'fast', 'scvi': {'max_epochs': 30}, 'num_workers': 2})
+
+        fast = TRAINING_PROFILES['fast']
+        assert profile.scvi.max_epochs == 30 and profile.scvi.batch_size == fast.scvi.batch_size
+        assert profile.scanvi == fast.scanvi and profile.query == fast.query
+        assert profile.num_workers == 2 and profile.n_threads is None
+
+    @pytest.mark.parametrize('profile', [
+        'fastest',
+        {'epochs': 10},
+        {'query': {'epochs': 10}},
+        {'query': {'max_epochs': 0}},
+        {'scvi': {'train_size': 1.0}},
+        {'n_threads': 0},
+    ])
+    def test_invalid_profiles(self, profile: Any) -> None:
+        with pytest.raises(ValueError):
+            resolve_profile(profile)
+
+    def test_invalid_type(self) -> None:
+        with pytest.raises(TypeError):
+            resolve_profile(10)  # type: ignore[arg-type]
+
+    def test_description_ignores_resources(self) -> None:
+        threaded = resolve_profile({'n_threads': 8, 'num_workers': 4})
+        assert threaded.describe() == resolve_profile().describe()
+        assert resolve_profile('fast').describe() != resolve_profile().describe()
+
+
+class TestTrain:
+
+    def test_train_kwargs(self) -> None:
+        profile = resolve_profile({'scvi': {'max_epochs': 7, 'batch_size': 64}, 'num_workers': 3})
+        model = RecordingModel()
+        train(model, 'scvi', profile, 'test')
+
+        assert model.calls == [dict(
+            max_epochs=7,
+            batch_size=64,
+            train_size=0.9,
+            early_stopping=True,
+            check_val_every_n_epoch=1,
+            plan_kwargs={},
+            early_stopping_monitor=EARLY_STOPPING_MONITOR,
+            early_stopping_patience=profile.scvi.early_stopping_patience,
+            datasplitter_kwargs={'num_workers': 3},
+        )]
+
+    def test_without_early_stopping(self) -> None:
+        kwargs = resolve_profile({'query': {'early_stopping': False}}).train_kwargs('query')
+        assert 'early_stopping_monitor' not in kwargs and 'datasplitter_kwargs' not in kwargs
+        assert kwargs['plan_kwargs'] == {'weight_decay': 0.0}
+
+    def test_phases_are_profiled(self) -> None:
+        profiler = Profiler(track_memory=False)
+        with profiler.tool('scanvi'):
+            for phase in TRAINING_PHASES:
+                assert train(RecordingModel(), phase, resolve_profile('fast'), 'test') >= 0
+
+        stages = [record.stage for record in profiler.records]
+        assert stages == ['train_scvi', 'train_scanvi', 'train_query', 'total']
+
+    def test_torch_threads(self, fake_torch: ModuleType) -> None:
+        class ThreadsModel(RecordingModel):
+            def train(self, **kwargs: Any) -> None:
+                super().train(threads=fake_torch.threads, **kwargs)  # type: ignore[attr-defined]
+
+        model = ThreadsModel()
+        train(model, 'scanvi', resolve_profile({'n_threads': 2}), 'test')
+        train(model, 'scanvi', resolve_profile(), 'test')
+
+        assert [call['threads'] for call in model.calls] == [2, 4]
+        assert fake_torch.threads == 4  # type: ignore[attr-defined]
+
+    def test_invalid_phase(self) -> None:
+        with pytest.raises(ValueError):
+            train(RecordingModel(), 'pretrain', resolve_profile(), 'test')
@@ -0,0 +1,43 @@
+from typing import Any, Dict, Set
+
+import pytest
+
+from macta_tools.utils.requirements import (ContainsRequirement, DispatchTable, EqualityRequirement,
+                                            IsInstanceRequirement, RequirementList)
+
+
+@pytest.fixture
+def table() -> DispatchTable:
+    return DispatchTable({
+        'ref_tool': RequirementList(annot_type=EqualityRequirement('ref')),
+        'marker_tool': RequirementList(annot_type=EqualityRequirement('marker'), ref_data=IsInstanceRequirement(dict)),
+        'labels_tool': RequirementList(result_type=ContainsRequirement(('labels',))),
+    })
+
+
+@pytest.mark.parametrize('values, expected', [
+    ({'annot_type': 'ref', 'result_type': 'labels'}, {'ref_tool', 'labels_tool'}),
+    ({'annot_type': 'marker', 'result_type': 'scores', 'ref_data': {}}, {'marker_tool'}),
+    ({'annot_type': 'marker', 'result_type': 'labels', 'ref_data': []}, {'labels_tool'}),
+    ({'annot_type': 'marker', 'batch_col': 'batch'}, {'marker_tool', 'labels_tool'}),
+])
+def test_match(table: DispatchTable, values: Dict[str, Any], expected: Set[str]) -> None:
+    assert table.match(**values) == expected
+    # The second lookup hits the cache
+    assert table.match(**values) == expected
+
+
+def test_match_cached_by_kind(table: DispatchTable) -> None:
+    """Tests that values of the same kind share a single entry."""
+
+    table.match(annot_type='marker', ref_data={'a': 0})
+    table.match(annot_type='marker', ref_data={'b': 1}, unrelated=[0])
+    assert len(table._matches) == 1
+
+
+def test_match_unhashable() -> None:
+    table = DispatchTable({'tool': RequirementList(genes=EqualityRequirement(['a', 'b']))})
+
+    assert table.match(genes=['a', 'b']) == {'tool'}
+    assert table.match(genes=['a']) == set()
+    assert not table._matches
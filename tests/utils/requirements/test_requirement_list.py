@@ -1,4 +1,4 @@
-from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+from macta_tools.utils.requirements import EqualityRequirement, IsInstanceRequirement, RequirementList
 
 
 def test_basic_rqlist() -> None:
@@ -12,3 +12,28 @@ def test_basic_rqlist() -> None:
     assert not rqlist.check(annot_type='ref')
     assert rqlist.check(**{'annot_type': 'marker'})
     assert not rqlist.check(**{'annot_type': 'ref'})
+
+
+def test_rqlist_ignores_unrelated_kwargs() -> None:
+    """Tests that values without a requirement do not affect the check"""
+
+    rqlist = RequirementList(annot_type=EqualityRequirement('marker'))
+
+    assert rqlist.check(annot_type='marker', labels='cell_type')
+    assert not rqlist.check(annot_type='ref', labels='cell_type')
+    assert rqlist.check(labels='cell_type')
+
+
+def test_rqlist_memoizes_by_dispatch_key() -> None:
+    """Tests that `IsInstanceRequirement`s are memoized on the type of the value, and unhashable values still work"""
+
+    rqlist = RequirementList(ref_data=IsInstanceRequirement(list), annot_type=EqualityRequirement('marker'))
+
+    assert rqlist.check(ref_data=[0], annot_type='marker')
+    assert rqlist.check(ref_data=[1, 2], annot_type='marker')
+    assert not rqlist.check(ref_data=(0,), annot_type='marker')
+    assert set(rqlist._outcomes) == {('ref_data', list), ('ref_data', tuple), ('annot_type', 'marker')}
+
+    unhashable = RequirementList(value=EqualityRequirement([0]))
+    assert unhashable.check(value=[0])
+    assert not unhashable.check(value=[1])
@@ -0,0 +1,82 @@
+from pathlib import Path
+
+import anndata
+import numpy as np
+import pytest
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools.utils.fingerprint import fingerprint
+
+
+@pytest.fixture
+def data() -> AnnData:
+    rng = np.random.default_rng(0)
+    data = AnnData(sparse.random(200, 50, density=0.1, format='csr', dtype=np.float32, random_state=rng))
+    data.layers['counts'] = data.X.copy()
+    data.obs['cell_type'] = rng.choice(['a', 'b'], data.n_obs)
+    return data
+
+
+# Small chunks so that the tests go through multi-chunk and sampled code paths
+CHUNK_BYTES = 256
+
+
+class TestFingerprint:
+    """Tests that fingerprints are deterministic and change with the fingerprinted contents."""
+
+    def test_deterministic(self, data: AnnData) -> None:
+        assert fingerprint(data) == fingerprint(data.copy())
+        assert fingerprint(data, n_threads=1, chunk_bytes=CHUNK_BYTES) == \
+            fingerprint(data, n_threads=4, chunk_bytes=CHUNK_BYTES)
+
+    def test_matrix_changes(self, data: AnnData) -> None:
+        original = fingerprint(data)
+        data.X.data[-1] += 1
+        assert fingerprint(data) != original
+
+    def test_format_changes(self, data: AnnData) -> None:
+        dense = data.copy()
+        dense.X = data.X.toarray()
+        csc = data.copy()
+        csc.X = data.X.tocsc()
+        assert len({fingerprint(data), fingerprint(dense), fingerprint(csc)}) == 3
+
+    def test_layer(self, data: AnnData) -> None:
+        original = fingerprint(data, layer='counts')
+        data.X.data[:] = 0
+        assert fingerprint(data, layer='counts') == original
+        data.layers['counts'].data[0] += 1
+        assert fingerprint(data, layer='counts') != original
+
+    def test_names_and_columns(self, data: AnnData) -> None:
+        original = fingerprint(data, obs_columns=['cell_type'])
+        assert fingerprint(data) != original
+
+        data.obs['cell_type'] = data.obs['cell_type'].iloc[::-1].to_numpy()
+        assert fingerprint(data, obs_columns=['cell_type']) != original
+
+        renamed = data.copy()
+        renamed.var_names = [f'other_{i}' for i in range(data.n_vars)]
+        assert fingerprint(data) != fingerprint(renamed)
+
+    def test_non_str_columns(self, data: AnnData) -> None:
+        data.obs[0] = data.obs['cell_type'].to_numpy()
+        assert fingerprint(data, obs_columns=[0]) != fingerprint(data)
+
+    def test_sampled(self, data: AnnData) -> None:
+        sampled = fingerprint(data, sample_bytes=1024, chunk_bytes=CHUNK_BYTES)
+        assert sampled == fingerprint(data.copy(), sample_bytes=1024, chunk_bytes=CHUNK_BYTES)
+        assert sampled != fingerprint(data, chunk_bytes=CHUNK_BYTES)
+
+    @pytest.mark.parametrize('sample_bytes', [None, 1024])
+    @pytest.mark.parametrize('to_dense', [False, True], ids=['sparse', 'dense'])
+    def test_backed_matches_in_memory(self, data: AnnData, tmp_path: Path, sample_bytes: int, to_dense: bool
+                                      ) -> None:
+        if to_dense:
+            data.X = data.X.toarray()
+        data.write_h5ad(tmp_path / 'data.h5ad')
+        backed = anndata.read_h5ad(tmp_path / 'data.h5ad', backed='r')
+
+        assert fingerprint(backed, sample_bytes=sample_bytes, chunk_bytes=CHUNK_BYTES) == \
+            fingerprint(data, sample_bytes=sample_bytes, chunk_bytes=CHUNK_BYTES)
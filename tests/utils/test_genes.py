@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools.utils.genes import gene_alignment
+from macta_tools.utils.representations import Representation, RepresentationCache
+from macta_tools.utils.validation import check_gene_overlap
+
+
+@pytest.fixture
+def var() -> pd.DataFrame:
+    """Genes with symbols in `var_names` and versioned Ensembl IDs in `gene_ids`."""
+    return pd.DataFrame({'gene_ids': [f'ENSG0000000000{i}.{i + 1}' for i in range(5)]},
+                        index=[f'GENE{i}' for i in range(5)])
+
+
+class TestGeneAlignment:
+    """Tests matching the genes of a query to the features of a reference."""
+
+    def test_var_names(self, var: pd.DataFrame) -> None:
+        alignment = gene_alignment(var, ['GENE3', 'MISSING', 'GENE0'])
+
+        assert alignment.key == 'var_names'
+        np.testing.assert_array_equal(alignment.positions, [3, -1, 0])
+        assert alignment.n_shared == 2 and alignment.overlap == pytest.approx(2 / 3)
+
+    def test_ensembl_ids(self, var: pd.DataFrame) -> None:
+        # Versions are ignored on both sides
+        alignment = gene_alignment(var, ['ENSG00000000004', 'ENSG00000000001.9'])
+
+        assert alignment.key == 'gene_ids'
+        np.testing.assert_array_equal(alignment.positions, [4, 1])
+        assert alignment.features == ('ENSG00000000004', 'ENSG00000000001.9')
+
+    def test_duplicates(self) -> None:
+        alignment = gene_alignment(pd.Index(['a', 'b', 'a', 'c']), ['c', 'a'])
+
+        np.testing.assert_array_equal(alignment.positions, [3, 0])
+        assert alignment.n_duplicates == 1
+
+    def test_drop_missing(self, var: pd.DataFrame) -> None:
+        alignment = gene_alignment(var, ['GENE3', 'MISSING', 'GENE0'], fill_missing=False)
+
+        assert alignment.features == ('GENE3', 'GENE0')
+        np.testing.assert_array_equal(alignment.positions, [3, 0])
+        assert alignment.n_features == 3 and alignment.n_shared == 2
+
+    def test_cached(self, var: pd.DataFrame) -> None:
+        features = ['GENE1', 'GENE2']
+
+        assert gene_alignment(var, features) is gene_alignment(var.copy(), list(features))
+        assert gene_alignment(var, features) is not gene_alignment(var, features, fill_missing=False)
+        assert gene_alignment(var, features) is not gene_alignment(var.index, features)
+
+    def test_reindex(self, var: pd.DataFrame) -> None:
+        matrix = sparse.csr_matrix(np.arange(10, dtype=np.float32).reshape(2, 5))
+        alignment = gene_alignment(var, ['ENSG00000000004', 'MISSING', 'ENSG00000000000'])
+
+        reindexed = alignment.reindex(matrix)
+        assert reindexed.dtype == np.float32
+        np.testing.assert_array_equal(reindexed.toarray(), [[4, 0, 0], [9, 0, 5]])
+        assert gene_alignment(var, list(var.index)).is_identity(len(var))
+
+
+class TestSharedAlignment:
+    """Tests the tools' uses of the alignment."""
+
+    def test_representation(self, var: pd.DataFrame) -> None:
+        data = AnnData(sparse.csr_matrix(np.arange(10, dtype=np.float32).reshape(2, 5)), var=var)
+        genes = ('ENSG00000000002', 'ENSG00000000000')
+
+        represented = RepresentationCache(data).get(Representation('counts', genes=genes))
+        assert tuple(represented.var_names) == genes
+        np.testing.assert_array_equal(represented.X.toarray(), [[2, 0], [7, 5]])
+
+    def test_check_gene_overlap(self, var: pd.DataFrame) -> None:
+        assert check_gene_overlap(var, pd.Index(['ENSG00000000002.1', 'ENSG00000000003'])) == []
+        assert len(check_gene_overlap(var.index, pd.Index(['ENSG00000000002.1', 'ENSG00000000003']))) == 1
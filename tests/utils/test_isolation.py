@@ -0,0 +1,80 @@
+from pathlib import Path
+
+import anndata
+import numpy as np
+import pandas as pd
+import pytest
+import scanpy as sc
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools.utils.isolation import isolate, read_only
+
+
+@pytest.fixture
+def data() -> AnnData:
+    matrix = sparse.random(20, 10, density=0.3, format='csr', dtype=np.float32, random_state=0)
+    data = AnnData(matrix, obs=pd.DataFrame({'batch': ['a', 'b'] * 10}, index=[f'cell_{i}' for i in range(20)]))
+    data.layers['counts'] = matrix.toarray()
+    data.obsm['X_pca'] = np.ones((20, 2))
+    data.uns['log1p'] = {'base': None}
+    data.raw = data.copy()
+    return data
+
+
+class TestIsolate:
+    """Tests that isolated copies share the matrices of the data but not its annotations."""
+
+    def test_shares_matrices(self, data: AnnData) -> None:
+        isolated = isolate(data)
+
+        assert np.shares_memory(isolated.X.data, data.X.data)
+        assert np.shares_memory(isolated.layers['counts'], data.layers['counts'])
+        assert np.shares_memory(isolated.obsm['X_pca'], data.obsm['X_pca'])
+        assert np.shares_memory(isolated.raw.X.data, data.raw.X.data)
+
+    def test_matrices_read_only(self, data: AnnData) -> None:
+        isolated = isolate(data)
+
+        with pytest.raises(ValueError):
+            isolated.X.data *= 2
+        with pytest.raises(ValueError):
+            isolated.layers['counts'][0, 0] = 1
+        assert data.X.data.flags.writeable
+
+    def test_annotations_copied(self, data: AnnData) -> None:
+        isolated = isolate(data)
+        isolated.obs['registered'] = 1
+        isolated.obs.loc['cell_0', 'batch'] = 'c'
+        isolated.uns['log1p']['base'] = 2
+        isolated.uns['neighbors'] = {}
+        isolated.obsm['X_umap'] = np.zeros((20, 2))
+
+        assert list(data.obs.columns) == ['batch']
+        assert data.obs.loc['cell_0', 'batch'] == 'a'
+        assert data.uns['log1p'] == {'base': None} and 'neighbors' not in data.uns
+        assert 'X_umap' not in data.obsm
+
+    def test_replaced_matrix(self, data: AnnData) -> None:
+        original = data.X.copy()
+        isolated = isolate(data)
+        sc.pp.normalize_total(isolated)
+
+        assert not np.shares_memory(isolated.X.data, data.X.data)
+        assert (data.X != original).nnz == 0
+
+    def test_backed(self, data: AnnData, tmp_path: Path) -> None:
+        data.write_h5ad(tmp_path / 'data.h5ad')
+        backed = anndata.read_h5ad(tmp_path / 'data.h5ad', backed='r')
+        isolated = isolate(backed)
+        isolated.obs['registered'] = 1
+        isolated.uns['neighbors'] = {}
+
+        assert isolated is not backed
+        assert list(backed.obs.columns) == ['batch'] and 'neighbors' not in backed.uns
+        assert (isolated.X[:] != data.X).nnz == 0
+
+    def test_other_types(self) -> None:
+        frame = pd.DataFrame({'a': [1]})
+        assert isolate(frame) is frame
+        assert read_only(frame) is frame
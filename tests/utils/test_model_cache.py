@@ -0,0 +1,147 @@
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.fingerprint import fingerprint
+from macta_tools.utils.model_cache import ModelCache
+
+
+def save_pickle(model: Any, path: Path) -> None:
+    with (path / 'model.pkl').open('wb') as file:
+        pickle.dump(model, file)
+
+
+def load_pickle(path: Path) -> Any:
+    with (path / 'model.pkl').open('rb') as file:
+        return pickle.load(file)
+
+
+class TrainingInterface(CTAToolInterface):
+    """Interface whose "training" sums the reference, counting how many times it was trained."""
+
+    _caches_ref = True
+
+    def __init__(self) -> None:
+        self.n_trained = 0
+
+    def annotate(self, expr_data: AnnData, ref_data: float, **_: Any) -> pd.Series:
+        return pd.Series(ref_data, index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+    def preprocess_ref(self, ref_data: AnnData, **_: Any) -> float:
+        self.n_trained += 1
+        return float(ref_data.X.sum())
+
+    def ref_cache_parts(self, ref_data: AnnData, labels: str = '', **_: Any) -> Optional[Dict[str, Any]]:
+        return {'ref': fingerprint(ref_data, obs_columns=[labels]), 'labels': labels}
+
+    def save_ref(self, model: float, path: Path) -> None:
+        save_pickle(model, path)
+
+    def load_ref(self, path: Path, ref_data: AnnData, **_: Any) -> float:
+        return load_pickle(path)  # type: ignore[no-any-return]
+
+
+@pytest.fixture
+def ref_data() -> AnnData:
+    data = AnnData(np.arange(12, dtype=np.float32).reshape(4, 3))
+    data.obs['cell_type'] = ['a', 'b', 'a', 'b']
+    return data
+
+
+class TestModelCache:
+    """Tests storing, loading and evicting entries of a `ModelCache`."""
+
+    def test_store_and_load(self, tmp_path: Path) -> None:
+        cache = ModelCache(tmp_path)
+        key = cache.key(tool='tool', ref='abc')
+
+        assert cache.load(key, load_pickle) is None
+        cache.store(key, {'weights': [1, 2, 3]}, save_pickle)
+        assert key in cache
+        assert cache.load(key, load_pickle) == {'weights': [1, 2, 3]}
+        assert ModelCache(tmp_path).load(key, load_pickle) == {'weights': [1, 2, 3]}
+
+    def test_key_depends_on_parts(self) -> None:
+        assert ModelCache.key(a=1, b='x') == ModelCache.key(b='x', a=1)
+        assert ModelCache.key(a=1, b='x') != ModelCache.key(a=2, b='x')
+
+    def test_lru_eviction(self, tmp_path: Path) -> None:
+        cache = ModelCache(tmp_path, max_entries=2)
+
+        for name in 'abc':
+            cache.store(name, name, save_pickle)
+            if name == 'b':
+                cache.load('a', load_pickle)
+
+        assert [key for key, _ in cache.entries()] == ['a', 'c']
+
+    def test_size_eviction(self, tmp_path: Path) -> None:
+        cache = ModelCache(tmp_path, max_bytes=10_000)
+
+        cache.store('small', 0, save_pickle)
+        cache.store('large', np.zeros(2_000), save_pickle)
+
+        assert 'small' not in cache
+        assert 'large' in cache
+
+    def test_broken_entry_is_discarded(self, tmp_path: Path) -> None:
+        cache = ModelCache(tmp_path)
+        cache.store('key', 0, save_pickle)
+        (tmp_path / 'key' / 'model' / 'model.pkl').write_bytes(b'not a pickle')
+
+        assert cache.load('key', load_pickle) is None
+        assert 'key' not in cache
+
+
+class TestPrepareRef:
+    """Tests that `CTAToolInterface.prepare_ref` only trains a reference once per cache key."""
+
+    def test_cache_hit_skips_training(self, ref_data: AnnData, tmp_path: Path) -> None:
+        interface = TrainingInterface()
+
+        first = interface.prepare_ref(ref_data, model_cache=tmp_path, labels='cell_type')
+        second = interface.prepare_ref(ref_data, model_cache=tmp_path, labels='cell_type')
+
+        assert first == second == 66.0
+        assert interface.n_trained == 1
+
+    def test_changed_labels_retrain(self, ref_data: AnnData, tmp_path: Path) -> None:
+        interface = TrainingInterface()
+
+        interface.prepare_ref(ref_data, model_cache=tmp_path, labels='cell_type')
+        ref_data.obs['cell_type'] = ['a', 'a', 'a', 'b']
+        interface.prepare_ref(ref_data, model_cache=tmp_path, labels='cell_type')
+
+        assert interface.n_trained == 2
+
+    def test_no_cache(self, ref_data: AnnData) -> None:
+        interface = TrainingInterface()
+
+        interface.prepare_ref(ref_data, labels='cell_type')
+        interface.prepare_ref(ref_data, labels='cell_type')
+
+        assert interface.n_trained == 2
+
+    def test_caching_undeclared(self, ref_data: AnnData, tmp_path: Path) -> None:
+        """Tests that interfaces which do not declare `_caches_ref` never touch the cache."""
+
+        class UncachedInterface(TrainingInterface):
+            _caches_ref = False
+
+        interface = UncachedInterface()
+        interface.prepare_ref(ref_data, model_cache=tmp_path, labels='cell_type')
+        interface.prepare_ref(ref_data, model_cache=tmp_path, labels='cell_type')
+
+        assert interface.n_trained == 2
+        assert not any(tmp_path.iterdir())
+        with pytest.raises(TypeError):
+            CTAToolInterface.save_ref(interface, 66.0, tmp_path)
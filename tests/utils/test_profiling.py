@@ -0,0 +1,92 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import annotate, annotate_many, prepare
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.profiling import Profiler, StageRecord, stage
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+STAGES = ['prepare_ref', 'preprocess_expr', 'annotate', 'convert', 'total']
+
+
+class SummingInterface(CTAToolInterface):
+    """Labels every cell with its total counts."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+
+    def annotate(self, expr_data: AnnData, ref_data: AnnData, **_: Any) -> pd.Series:
+        return pd.Series(np.asarray(expr_data.X).sum(axis=1), index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+@pytest.fixture
+def data() -> AnnData:
+    return AnnData(np.arange(12, dtype=np.float32).reshape(4, 3))
+
+
+def stages_of(profiler: Profiler, tool: str) -> List[str]:
+    return [record.stage for record in profiler.records if record.tool == tool]
+
+
+class TestProfiler:
+    tool_interfaces: Dict[str, CTAToolInterface] = {'first': SummingInterface(), 'second': SummingInterface()}
+
+    def test_stages_recorded_per_tool(self, data: AnnData) -> None:
+        profiler = Profiler()
+        annotate(data, data, 'ref', tool_interfaces=self.tool_interfaces, profiler=profiler)
+
+        for tool in self.tool_interfaces:
+            assert sorted(stages_of(profiler, tool)) == sorted(STAGES)
+
+        for record in profiler.records:
+            assert record.wall_seconds >= 0 and record.cpu_seconds >= 0
+            if record.start_rss_bytes is not None:
+                assert record.peak_rss_bytes is not None and record.peak_rss_bytes >= record.start_rss_bytes
+
+        report = profiler.report()
+        assert set(report.index) == {(tool, name) for tool in self.tool_interfaces for name in STAGES}
+        assert (report['runs'] == 1).all()
+
+    def test_records_merged_from_worker_processes(self, data: AnnData) -> None:
+        profiler = Profiler()
+        annotate(data, data, 'ref', tool_interfaces=self.tool_interfaces, executor='process', profiler=profiler)
+
+        for tool in self.tool_interfaces:
+            assert sorted(stages_of(profiler, tool)) == sorted(STAGES)
+
+    def test_prepared_references(self, data: AnnData) -> None:
+        profiler = Profiler()
+        prepared = prepare(data, 'ref', tool_interfaces={'first': SummingInterface()}, profiler=profiler)
+        annotate_many(prepared, [data, data], profiler=profiler)
+
+        report = profiler.report()
+        assert report.loc[('first', 'prepare_ref'), 'runs'] == 1
+        assert report.loc[('first', 'annotate'), 'runs'] == 2
+        assert report.loc[('first', 'total'), 'runs'] == 3
+
+    def test_callback_and_exports(self, data: AnnData, tmp_path: Path) -> None:
+        received: List[StageRecord] = []
+        profiler = Profiler(track_memory=False, callback=received.append)
+        annotate(data, data, 'ref', tool_interfaces={'first': SummingInterface()}, profiler=profiler)
+
+        assert received == profiler.records
+        assert all(record.peak_rss_bytes is None for record in received)
+
+        profiler.to_json(tmp_path / 'profile.json')
+        profiler.to_csv(tmp_path / 'profile.csv')
+        assert len(json.loads((tmp_path / 'profile.json').read_text())) == len(STAGES)
+        assert list(pd.read_csv(tmp_path / 'profile.csv')['stage']) == [record.stage for record in received]
+
+    def test_stage_without_profiler(self) -> None:
+        profiler = Profiler()
+        with stage('annotate'):
+            pass
+        assert profiler.records == []
@@ -0,0 +1,108 @@
+from typing import Any, List
+
+import numpy as np
+import pandas as pd
+import pytest
+import scanpy as sc
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools import annotate
+from macta_tools.tools import CTAToolInterface
+from macta_tools.utils.representations import Representation, RepresentationCache, align_genes, find_counts
+from macta_tools.utils.requirements import EqualityRequirement, RequirementList
+
+
+class LognormInterface(CTAToolInterface):
+    """Interface that expects log-normalized data and keeps the matrices it was given."""
+
+    _requirements = RequirementList(annot_type=EqualityRequirement('ref'))
+
+    def __init__(self) -> None:
+        self.matrices: List[Any] = []
+
+    def expr_representation(self, ref_data: Any, **_: Any) -> Representation:
+        return Representation('lognorm')
+
+    def annotate(self, expr_data: AnnData, ref_data: Any, **_: Any) -> pd.Series:
+        self.matrices.append(expr_data.X)
+        return pd.Series(np.asarray(expr_data.X.sum(axis=1)).ravel(), index=expr_data.obs_names)
+
+    def convert(self, results: pd.Series, convert_to: str, **_: Any) -> pd.Series:
+        return results
+
+
+@pytest.fixture
+def counts() -> AnnData:
+    matrix = sparse.random(30, 8, density=0.5, format='csr', dtype=np.float32, random_state=0)
+    matrix.data = np.ceil(matrix.data * 10)
+    data = AnnData(matrix)
+    data.var_names = [f'g{i}' for i in range(data.n_vars)]
+    return data
+
+
+class TestRepresentations:
+    """Tests finding the counts of data sets and computing their representations."""
+
+    def test_find_counts(self, counts: AnnData) -> None:
+        lognorm = counts.copy()
+        sc.pp.normalize_total(lognorm, target_sum=1e4)
+        sc.pp.log1p(lognorm)
+
+        assert find_counts(counts) is counts.X
+        lognorm.raw = counts
+        assert (find_counts(lognorm) != counts.X).nnz == 0
+        lognorm.layers['counts'] = counts.X
+        assert find_counts(lognorm) is lognorm.layers['counts']
+
+        with pytest.raises(ValueError):
+            find_counts(AnnData(lognorm.X))
+
+    def test_lognorm(self, counts: AnnData) -> None:
+        expected = counts.copy()
+        sc.pp.normalize_total(expected, target_sum=1e4)
+        sc.pp.log1p(expected)
+
+        lognorm = RepresentationCache(counts).get(Representation('lognorm'))
+        np.testing.assert_allclose(lognorm.X.toarray(), expected.X.toarray(), rtol=1e-5)
+
+        # Data that is already log-normalized is shared rather than recomputed
+        again = RepresentationCache(lognorm).get(Representation('lognorm'))
+        assert np.shares_memory(again.X.data, lognorm.X.data)
+
+    def test_counts_layer(self, counts: AnnData) -> None:
+        represented = RepresentationCache(counts).get(Representation('counts', counts_layer='raw_counts'))
+        assert np.shares_memory(represented.layers['raw_counts'].data, represented.X.data)
+        assert np.shares_memory(represented.X.data, counts.X.data)
+
+    def test_align_genes(self, counts: AnnData) -> None:
+        genes = ['g3', 'missing', 'g0']
+        aligned = align_genes(counts.X, counts.var_names, genes)
+
+        np.testing.assert_array_equal(aligned.toarray(), np.column_stack([
+            counts.X[:, 3].toarray().ravel(), np.zeros(counts.n_obs), counts.X[:, 0].toarray().ravel()]))
+
+        represented = RepresentationCache(counts).get(Representation('counts', genes=tuple(genes)))
+        assert list(represented.var_names) == genes
+
+    def test_cached(self, counts: AnnData) -> None:
+        cache = RepresentationCache(counts)
+        first, second = cache.get(Representation('lognorm')), cache.get(Representation('lognorm'))
+
+        assert first is not second
+        assert np.shares_memory(first.X.data, second.X.data)
+        assert not first.X.data.flags.writeable
+
+    def test_invalid_kind(self) -> None:
+        with pytest.raises(ValueError):
+            Representation('scaled')
+
+
+def test_shared_between_tools(counts: AnnData) -> None:
+    tool_interfaces = {'first': LognormInterface(), 'second': LognormInterface()}
+    results = annotate(counts, counts, 'ref', tool_interfaces=tool_interfaces)
+
+    pd.testing.assert_series_equal(results['first'], results['second'])
+    first, second = (interface.matrices[0] for interface in tool_interfaces.values())
+    assert np.shares_memory(first.data, second.data)
+    assert not np.shares_memory(first.data, counts.X.data)
@@ -0,0 +1,59 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+from scipy import sparse
+
+from macta_tools import read_input
+from macta_tools.tools import CTAToolInterface, MarkerInterface
+from macta_tools.utils.resources import DataSize, ResourceEstimate, node_capacity
+
+
+@pytest.fixture
+def data() -> AnnData:
+    return AnnData(sparse.random(20, 10, density=0.3, format='csr', dtype=np.float32, random_state=0))
+
+
+class TestDataSize:
+    """Tests measuring inputs without loading their matrices."""
+
+    def test_sparse_and_dense(self, data: AnnData) -> None:
+        assert DataSize.of(data) == DataSize(20, 10, data.X.nnz)
+        assert DataSize.of(AnnData(data.X.toarray())) == DataSize(20, 10, 200)
+
+    def test_lazy(self, data: AnnData, tmp_path: Path) -> None:
+        data.write_h5ad(tmp_path / 'data.h5ad')
+        assert DataSize.of(read_input(tmp_path / 'data.h5ad')) == DataSize(20, 10, data.X.nnz)
+
+    def test_other_inputs(self) -> None:
+        assert DataSize.of(pd.DataFrame({'cell_type': ['a', 'b'], 'gene': ['g0', 'g1']})) == DataSize(2, 2, 4)
+        assert DataSize.of('Immune_All_Low.pkl') == DataSize()
+
+    def test_bytes(self) -> None:
+        size = DataSize(100, 50, 1000)
+        assert size.nbytes > 1000
+        assert size.dense_nbytes() == 100 * 50 * 8 and size.dense_nbytes(10, itemsize=4) == 100 * 10 * 4
+
+
+class TestResourceEstimate:
+    """Tests the estimates of the tools and the capacity of the node."""
+
+    def test_default_estimate(self, data: AnnData) -> None:
+        class Interface(MarkerInterface):
+            estimate_resources = CTAToolInterface.estimate_resources
+
+        size = DataSize.of(data)
+        assert Interface().estimate_resources(size, size) == ResourceEstimate(1, 4 * size.nbytes)
+
+    def test_invalid(self) -> None:
+        with pytest.raises(ValueError):
+            ResourceEstimate(threads=0)
+        with pytest.raises(ValueError):
+            ResourceEstimate(memory=-1)
+
+    def test_node_capacity(self) -> None:
+        threads, memory = node_capacity()
+        assert threads >= 1 and (memory is None or memory > 0)
+        assert node_capacity(2, 1024) == (2, 1024)
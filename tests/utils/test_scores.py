@@ -0,0 +1,102 @@
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+from anndata import AnnData
+
+from macta_tools import annotate, consensus, read_results
+from macta_tools.tools import MarkerInterface
+from macta_tools.utils import scores as scores_module
+from macta_tools.utils.scores import check_score_format, format_scores
+
+
+@pytest.fixture
+def scores() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(rng.normal(size=(50, 6)), index=[f'cell_{i}' for i in range(50)],
+                        columns=[f'type_{i}' for i in range(6)])
+
+
+class TestFormatScores:
+
+    @pytest.mark.parametrize('dtype', ['float16', 'float32', 'float64'])
+    def test_dtype(self, scores: pd.DataFrame, dtype: str) -> None:
+        formatted = format_scores(scores, dtype)
+
+        assert (formatted.dtypes == dtype).all()
+        pd.testing.assert_index_equal(formatted.index, scores.index)
+        pd.testing.assert_index_equal(formatted.columns, scores.columns)
+
+    def test_float32_halves_memory(self, scores: pd.DataFrame) -> None:
+        formatted = format_scores(scores)
+        assert formatted.memory_usage(index=False).sum() * 2 == scores.memory_usage(index=False).sum()
+
+    def test_top_k(self, scores: pd.DataFrame) -> None:
+        scores.iloc[0, :4] = np.nan
+        top = format_scores(scores, top_k=2)
+
+        assert all(isinstance(dtype, pd.SparseDtype) for dtype in top.dtypes)
+        dense = top.sparse.to_dense()
+        assert (dense.notna().sum(axis=1) == 2).all()
+        # Missing scores are never among the best
+        assert dense.iloc[0].dropna().index.tolist() == ['type_4', 'type_5']
+
+        best = scores.iloc[1:].to_numpy(dtype=np.float32)
+        kept = dense.iloc[1:].to_numpy()
+        np.testing.assert_array_equal(np.nanmax(kept, axis=1), best.max(axis=1))
+        np.testing.assert_array_equal(np.nanmin(kept, axis=1), np.sort(best, axis=1)[:, -2])
+
+    def test_top_k_bounds_memory(self, scores: pd.DataFrame) -> None:
+        top = format_scores(scores, top_k=1)
+        assert top.memory_usage(index=False).sum() == len(scores) * (4 + 4)
+
+        pd.testing.assert_frame_equal(format_scores(scores, top_k=10), format_scores(scores))
+
+    def test_top_k_in_blocks(self, scores: pd.DataFrame, monkeypatch: pytest.MonkeyPatch) -> None:
+        expected = format_scores(scores, top_k=2)
+        monkeypatch.setattr(scores_module, '_BLOCK_SIZE', 7)
+        pd.testing.assert_frame_equal(format_scores(scores, top_k=2), expected)
+
+    def test_invalid_options(self, scores: pd.DataFrame) -> None:
+        assert check_score_format() == []
+        assert len(check_score_format('int8', 0)) == 2
+        with pytest.raises(ValueError):
+            format_scores(scores, top_k=0)
+
+
+class TestScoreOutput:
+    """Tests that formatted scores flow through the tools, results files and consensus."""
+
+    @pytest.fixture
+    def expr_data(self) -> AnnData:
+        rng = np.random.default_rng(0)
+        matrix = rng.poisson(0.5, (30, 6)).astype(np.float32)
+        for cell_type in range(3):
+            matrix[cell_type * 10:(cell_type + 1) * 10, cell_type * 2:(cell_type + 1) * 2] += 5
+        data = AnnData(np.log1p(matrix))
+        data.var_names = [f'g{i}' for i in range(data.n_vars)]
+        return data
+
+    @pytest.fixture
+    def markers(self) -> pd.DataFrame:
+        return pd.DataFrame({'cell_type': ['a', 'a', 'b', 'b', 'c', 'c'], 'gene': [f'g{i}' for i in range(6)]})
+
+    def test_top_k_scores(self, expr_data: AnnData, markers: pd.DataFrame, tmp_path: Path) -> None:
+        tool_interfaces = {'marker': MarkerInterface()}
+        full = annotate(expr_data, markers, 'marker', 'scores', tool_interfaces=tool_interfaces)['marker']
+        top = annotate(expr_data, markers, 'marker', 'scores', tool_interfaces=tool_interfaces,
+                       score_top_k=1)['marker']
+        annotate(expr_data, markers, 'marker', 'scores', tool_interfaces=tool_interfaces, score_top_k=1,
+                 output=tmp_path / 'results.h5')
+
+        assert (full.dtypes == np.float32).all()
+        assert top.notna().sum(axis=1).eq(1).all()
+        pd.testing.assert_series_equal(consensus({'marker': top})['label'], consensus({'marker': full})['label'])
+        pd.testing.assert_frame_equal(read_results(tmp_path / 'results.h5')['marker'], top.sparse.to_dense(),
+                                      check_column_type=False)
+
+    def test_invalid_options_are_planned(self, expr_data: AnnData, markers: pd.DataFrame) -> None:
+        with pytest.raises(ValueError):
+            annotate(expr_data, markers, 'marker', 'scores', tool_interfaces={'marker': MarkerInterface()},
+                     score_dtype='int8')